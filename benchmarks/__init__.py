@@ -0,0 +1,8 @@
+"""
+Offline benchmarks for retrogallery.
+
+Recorded or generated gallery pages and image payloads (benchmarks.fixtures)
+are replayed through a local HTTP stand-in (benchmarks.server), so runs need
+no network access and are comparable over time. Results are saved as JSON;
+see benchmarks.__main__ for usage.
+"""
@@ -0,0 +1,126 @@
+"""
+Runs the offline benchmark suite and compares results.
+
+    python -m benchmarks.fixtures generate
+    python -m benchmarks run --output benchmarks/results/baseline.json
+    python -m benchmarks run --suite micro --engines parsel lxml
+    python -m benchmarks run --suite crawl -s RETROGALLERYLOCALPIPELINE_STREAMING=False
+    python -m benchmarks compare benchmarks/results/baseline.json benchmarks/results/<run>.json
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+from benchmarks import suite
+from benchmarks.fixtures import DEFAULT_FIXTURES_DIR
+
+
+DEFAULT_RESULTS_DIR = Path(__file__).parent / 'results'
+
+SUITES = ('micro', 'crawl')
+
+
+def _setting(value):
+    key, sep, value = value.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got {key!r}")
+    return key, value
+
+
+def _format(value):
+    if value is None:
+        return '-'
+    return f"{value:,.3f}" if isinstance(value, float) else f"{value:,}"
+
+
+def run(args):
+    fixtures = Path(args.fixtures)
+    if not any(fixtures.glob('*/**/*.html')):
+        print(f"No fixtures in {fixtures}; run python -m benchmarks.fixtures generate first", file=sys.stderr)
+        return 1
+    engines = suite.available_engines(args.engines)
+    overrides = dict(args.set or [])
+    output = {'environment': suite.environment(fixtures), 'settings': overrides, 'results': {}}
+    results = output['results']
+
+    if 'micro' in args.suite:
+        for name, result in suite.run_micro(fixtures, engines, args.min_time).items():
+            results[name] = result
+            if 'bytes_per_item' in result:
+                sizes = result['bytes_per_item']
+                print(f"{name:50} {_format(sizes['scrapy_item']):>14} -> {_format(sizes['compact'])} "
+                      f"bytes/item  ({_format(result['reduction'] * 100)}% less)")
+                continue
+            rate = result.get('pages_per_sec') or result.get('calls_per_sec')
+            print(f"{name:50} {_format(rate):>14}/s  p50 {_format(result['latency']['p50_ms'])} ms  "
+                  f"p99 {_format(result['latency']['p99_ms'])} ms")
+    if 'crawl' in args.suite:
+        for spider_name in suite.SPIDERS:
+            result = suite.run_crawl(fixtures, spider_name, engines[0], overrides)
+            results[f'crawl/{spider_name}'] = result
+            print(f"crawl/{spider_name:44} {_format(result['items_per_sec']):>14} items/s  "
+                  f"{_format(result['bytes_per_sec'] / 1e6 if result['bytes_per_sec'] else None)} MB/s  "
+                  f"peak RSS {_format(result['peak_rss_mb'])} MiB")
+
+    path = Path(args.output or DEFAULT_RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(output, indent=2))
+    print(f"Results written to {path}")
+    return 0
+
+
+def compare(args):
+    baseline = json.loads(Path(args.baseline).read_text())
+    current = json.loads(Path(args.current).read_text())
+    for name, before, after, change in suite.compare(baseline, current):
+        if args.filter and args.filter not in name:
+            continue
+        change = f"{change:+.1%}" if change is not None else '-'
+        print(f"{name:70} {_format(before):>16} {_format(after):>16} {change:>9}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Run the retrogallery offline benchmarks.'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('run', help='run the benchmarks and save the results as JSON')
+    command.add_argument('--fixtures', default=str(DEFAULT_FIXTURES_DIR), help='fixture directory (default: %(default)s)')
+    command.add_argument('--output', help=f'results file (default: {DEFAULT_RESULTS_DIR}/<timestamp>.json)')
+    command.add_argument('--suite', nargs='+', choices=SUITES, default=list(SUITES))
+    command.add_argument('--engines', nargs='+', help='extraction engines (default: all installed); crawls use the first')
+    command.add_argument('--min-time', type=float, default=1.0, help='seconds per micro benchmark (default: %(default)s)')
+    command.add_argument('-s', '--set', type=_setting, action='append', metavar='KEY=VALUE',
+                         help='override a Scrapy setting for the crawls')
+
+    command = commands.add_parser('compare', help='compare two results files')
+    command.add_argument('baseline')
+    command.add_argument('current')
+    command.add_argument('--filter', help='only show measurements whose name contains this')
+
+    # Runs a single crawl; used by run to isolate each crawl in its own process
+    command = commands.add_parser('crawl')
+    command.add_argument('spider', choices=sorted(suite.SPIDERS))
+    command.add_argument('--origin', required=True)
+    command.add_argument('--store', required=True)
+    command.add_argument('--engine', default='parsel')
+    command.add_argument('--result-file', required=True)
+    command.add_argument('-s', '--set', type=_setting, action='append', metavar='KEY=VALUE')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        return run(args)
+    if args.command == 'compare':
+        return compare(args)
+    suite.crawl(args.spider, args.origin, args.store, args.engine, args.result_file, dict(args.set or []))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,326 @@
+"""
+Gallery fixtures for the benchmarks.
+
+A fixture directory holds HTML pages and image payloads keyed by URL:
+
+    <fixtures>/<host>/<path>            e.g. oldcrap.org/wp-content/uploads/2017/12/a.jpeg
+    <fixtures>/<host>/<path>/index.html for URLs ending in a slash or
+                                        without a file extension
+
+Query strings are ignored and Jetpack's Photon CDN (i0.wp.com/<host>/<path>)
+is unwrapped, so Photon URLs are served from the origin's fixtures. WordPress
+REST API routes are stored as a JSON list of the whole collection:
+
+    <fixtures>/<host>/wp-json/<route>.json  e.g. oldcrap.org/wp-json/wp/v2/media.json
+
+which benchmarks.server filters and pages like WordPress does.
+
+Fixtures can be generated (deterministic sites shaped like oldcrap.org and
+nostalgianerd.com, with JPEG payloads rendered by Pillow) or recorded from
+the real sites:
+
+    python -m benchmarks.fixtures generate --galleries 20 --images 12
+    python -m benchmarks.fixtures record https://oldcrap.org https://oldcrap.org/2017/12/06/robotron-kc85-3/
+"""
+
+import argparse
+import html
+import json
+import random
+import re
+import sys
+import urllib.request
+from io import BytesIO
+from pathlib import Path
+from urllib.parse import urlparse
+
+
+DEFAULT_FIXTURES_DIR = Path(__file__).parent / 'fixtures'
+
+OLDCRAP = 'https://oldcrap.org'
+NOSTALGIANERD = 'https://www.nostalgianerd.com'
+
+USER_AGENT = "retrogallery (+https://github.com/cloudartisan/retrogallery)"
+
+_PHOTON_HOST = re.compile(r'^i[0-3]\.wp\.com$')
+
+# The category of NostalgiaNerdGallerySpider's galleries, by REST API ID
+GALLERY_CATEGORY = {'id': 7, 'slug': 'gallery', 'name': 'Gallery'}
+
+
+def fixture_path(root, url):
+    """
+    Returns the path of the fixture for url under root.
+    """
+    parsed = urlparse(url)
+    host, path = parsed.netloc.lower(), parsed.path or '/'
+    if _PHOTON_HOST.match(host):
+        host, _, path = path.lstrip('/').partition('/')
+        path = '/' + path
+    if is_rest_route(path):
+        path = path.rstrip('/') + '.json'
+    elif '.' not in path.rsplit('/', 1)[-1]:
+        path = path.rstrip('/') + '/index.html'
+    return Path(root) / host / path.lstrip('/')
+
+
+def is_rest_route(path):
+    """
+    Returns True for the path of a WordPress REST API route.
+    """
+    return path.startswith('/wp-json/')
+
+
+def _write(root, url, data):
+    path = fixture_path(root, url)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data if isinstance(data, bytes) else data.encode('utf8'))
+    return path
+
+
+def _jpeg(rng, size, quality=85):
+    """
+    Renders a JPEG of the given size from seeded noise, so payloads are
+    distinct and compress like photographs rather than flat colour.
+    """
+    from PIL import Image
+
+    width, height = size
+    tile = (max(width // 8, 1), max(height // 8, 1))
+    noise = Image.frombytes('RGB', tile, rng.randbytes(tile[0] * tile[1] * 3))
+    buf = BytesIO()
+    noise.resize(size, Image.Resampling.BILINEAR).save(buf, 'JPEG', quality=quality)
+    return buf.getvalue()
+
+
+def _oldcrap_gallery(title, images):
+    """
+    A gallery page with h1/h2/h3 sections of Jetpack carousels, as in the
+    OldCrapGallerySpider.parse_gallery docstring.
+    """
+    parts = [f'<html><head><title>{html.escape(title)}</title></head><body>',
+             f'<h1 class="entry-title">{html.escape(title)}</h1>',
+             '<div class="entry-content">']
+    for i, (orig, width, height) in enumerate(images):
+        if i % 6 == 0:
+            parts.append(f'<h1>Part {i // 6 + 1}</h1>')
+        if i % 3 == 0:
+            parts.append(f'<h2>Section {i // 3 + 1}</h2>')
+        if i % 3 != 2:
+            parts.append(f'<h3>Detail {i + 1}</h3>')
+        photon = f'https://i0.wp.com/{orig[len("https://"):]}'
+        resized = photon.replace('.jpeg', '-1024x768.jpeg')
+        srcset = ','.join(f'{resized}?strip=info&#038;w={w}&#038;ssl=1 {w}w' for w in (600, 900, 1200))
+        img = (
+            f'data-orig-file="{photon}?fit={width}%2C{height}&amp;ssl=1" data-orig-size="{width},{height}" '
+            f'data-image-title="fullsizeoutput_{i:x}" src="{resized}?ssl=1" alt=""'
+        )
+        parts.append(
+            '<div class="wp-block-jetpack-slideshow" data-carousel-extra=\'{"blog_id":1}\'>'
+            f'<figure class="tiled-gallery__item"><img {img} data-lazy-srcset="{srcset}" '
+            'srcset="data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7" '
+            f'class=" jetpack-lazy-image"><noscript><img data-lazy-fallback="1" {img} srcset="{srcset}" /></noscript>'
+            '</figure></div>'
+        )
+    parts.append('</div></body></html>')
+    return '\n'.join(parts)
+
+
+def _nostalgianerd_gallery(title, images):
+    """
+    A gallery page of linked images, as in the
+    NostalgiaNerdGallerySpider.parse_gallery docstring.
+    """
+    parts = ['<html><body><div class="entry-content">']
+    for i, (orig, width, height) in enumerate(images):
+        base = orig[:-len('.jpg')]
+        srcset = ', '.join([f'{orig} {width}w'] + [f'{base}-{w}x{w * 3 // 4}.jpg {w}w' for w in (300, 768, 600)])
+        alt = html.escape(title) if i % 4 else f'DSC_{1000 + i}'
+        parts.append(
+            f'<p><a href="{orig}"><img class="alignnone size-full wp-image-{1000 + i}" src="{orig}" alt="{alt}" '
+            f'width="{width}" height="{height}" srcset="{srcset}" sizes="(max-width: {width}px) 100vw, {width}px" /></a></p>'
+        )
+    parts.append('</div></body></html>')
+    return '\n'.join(parts)
+
+
+def _rest_post(post_id, title, link, categories=()):
+    """
+    A post as listed by /wp-json/wp/v2/posts.
+    """
+    return {
+        'id': post_id,
+        'link': link,
+        'slug': link.rstrip('/').rsplit('/', 1)[-1],
+        'title': {'rendered': html.escape(title)},
+        'categories': list(categories),
+    }
+
+
+def _rest_media(media_id, post_id, orig, width, height, alt=''):
+    """
+    An image attached to a post, as listed by /wp-json/wp/v2/media, with the
+    resized copies WordPress generates.
+    """
+    base, ext = orig.rsplit('.', 1)
+    sizes = {
+        name: {
+            'width': w,
+            'height': w * height // width,
+            'source_url': f'{base}-{w}x{w * height // width}.{ext}',
+        }
+        for name, w in (('medium', 300), ('large', 1024)) if w < width
+    }
+    sizes['full'] = {'width': width, 'height': height, 'source_url': orig}
+    return {
+        'id': media_id,
+        'post': post_id,
+        'mime_type': 'image/jpeg',
+        'source_url': orig,
+        'alt_text': alt,
+        'title': {'rendered': orig.rsplit('/', 1)[-1].rsplit('.', 1)[0]},
+        'media_details': {'width': width, 'height': height, 'sizes': sizes},
+    }
+
+
+def _sitemaps(write, site, links):
+    """
+    Writes a WordPress core sitemap (wp-sitemap.xml) listing the posts.
+    """
+    index = f'{site}/wp-sitemap.xml'
+    posts = f'{site}/wp-sitemap-posts-post-1.xml'
+    write(index, (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+        f'<sitemap><loc>{posts}</loc></sitemap>'
+        f'<sitemap><loc>{site}/wp-sitemap-taxonomies-category-1.xml</loc></sitemap>'
+        '</sitemapindex>'
+    ))
+    write(posts, (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+        + ''.join(f'<url><loc>{html.escape(link)}</loc></url>' for link in links)
+        + '</urlset>'
+    ))
+
+
+def generate(root=DEFAULT_FIXTURES_DIR, galleries=20, images=12, image_size=(1600, 1200), seed=0):
+    """
+    Generates a fixture site for both spiders under root, with the REST API
+    routes and sitemaps of each WordPress site.
+
+    Parameters:
+        root (str): The fixture directory.
+        galleries (int): The number of galleries per site.
+        images (int): The number of images per gallery.
+        image_size (tuple[int, int]): The size of the original images.
+        seed (int): The random seed, so runs are comparable.
+
+    Returns:
+        summary (dict): The number of pages and images, and their total
+        size in bytes.
+    """
+    rng = random.Random(seed)
+    summary = {'pages': 0, 'images': 0, 'bytes': 0}
+
+    def write(url, data):
+        path = _write(root, url, data)
+        kind = 'pages' if path.suffix in ('.html', '.json', '.xml') else 'images'
+        summary[kind] += 1
+        summary['bytes'] += path.stat().st_size
+
+    # oldcrap.org: a menu of galleries on the home page
+    menu, posts, media = [], [], []
+    for g in range(galleries):
+        title = f'Retro Computer {g + 1}'
+        gallery_url = f'{OLDCRAP}/2018/02/{g % 28 + 1:02d}/retro-computer-{g + 1}/'
+        menu.append(
+            f'<div class="iksm-term iksm-term--child iksm-term--is-post" data-id="post-{g}">'
+            f'<div class="iksm-term__inner"><a class="iksm-term__link" href=\'{gallery_url}\'>'
+            f'<span class="iksm-term__text">{title}</span></a></div></div>'
+        )
+        posts.append(_rest_post(100 + g, title, gallery_url))
+        gallery_images = []
+        for i in range(images):
+            orig = f'{OLDCRAP}/wp-content/uploads/2018/02/computer{g}_{i}.jpeg'
+            write(orig, _jpeg(rng, image_size))
+            gallery_images.append((orig, *image_size))
+            media.append(_rest_media(10000 + g * images + i, 100 + g, orig, *image_size))
+        write(gallery_url, _oldcrap_gallery(title, gallery_images))
+    write(f'{OLDCRAP}/', '<html><body>' + '\n'.join(menu) + '</body></html>')
+    write(f'{OLDCRAP}/wp-json/wp/v2/posts', json.dumps(posts))
+    write(f'{OLDCRAP}/wp-json/wp/v2/media', json.dumps(media))
+    _sitemaps(write, OLDCRAP, [post['link'] for post in posts])
+
+    # nostalgianerd.com: preview titles on the gallery category page
+    previews, posts, media = [], [], []
+    for g in range(galleries):
+        title = f'Micro {g + 1}'
+        gallery_url = f'{NOSTALGIANERD}/micro-{g + 1}/'
+        previews.append(f'<h3 class="preview-title"><a href="{gallery_url}" title="{title}">{title}</a></h3>')
+        posts.append(_rest_post(200 + g, title, gallery_url, categories=[GALLERY_CATEGORY['id']]))
+        gallery_images = []
+        for i in range(images):
+            orig = f'{NOSTALGIANERD}/wp-content/uploads/2019/11/micro{g}_{i}.jpg'
+            write(orig, _jpeg(rng, image_size))
+            gallery_images.append((orig, *image_size))
+            alt = title if i % 4 else f'DSC_{1000 + i}'
+            media.append(_rest_media(20000 + g * images + i, 200 + g, orig, *image_size, alt=alt))
+        write(gallery_url, _nostalgianerd_gallery(title, gallery_images))
+    write(f'{NOSTALGIANERD}/category/gallery/', '<html><body>' + '\n'.join(previews) + '</body></html>')
+    write(f'{NOSTALGIANERD}/wp-json/wp/v2/categories', json.dumps([GALLERY_CATEGORY]))
+    write(f'{NOSTALGIANERD}/wp-json/wp/v2/posts', json.dumps(posts))
+    write(f'{NOSTALGIANERD}/wp-json/wp/v2/media', json.dumps(media))
+    _sitemaps(write, NOSTALGIANERD, [post['link'] for post in posts])
+    return summary
+
+
+def record(root, urls):
+    """
+    Fetches urls from the live sites and stores them as fixtures.
+    """
+    for url in urls:
+        request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+        with urllib.request.urlopen(request) as response:
+            path = _write(root, url, response.read())
+        print(f"{url} -> {path}")
+
+
+def pages(root, host):
+    """
+    Yields (url, body) for every HTML fixture of host.
+    """
+    base = Path(root) / host
+    for path in sorted(base.rglob('*.html')):
+        relative = path.relative_to(base).as_posix()
+        if relative.endswith('index.html'):
+            relative = relative[:-len('index.html')]
+        yield f'https://{host}/{relative}', path.read_bytes()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.fixtures',
+        description='Generate or record gallery fixtures for the benchmarks.'
+    )
+    parser.add_argument('--fixtures', default=str(DEFAULT_FIXTURES_DIR), help='fixture directory (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('generate', help='generate deterministic fixture sites')
+    command.add_argument('--galleries', type=int, default=20)
+    command.add_argument('--images', type=int, default=12)
+    command.add_argument('--image-size', type=int, nargs=2, default=(1600, 1200), metavar=('WIDTH', 'HEIGHT'))
+    command.add_argument('--seed', type=int, default=0)
+    commands.add_parser('record', help='record pages or images from the live sites').add_argument('urls', nargs='+')
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        summary = generate(args.fixtures, args.galleries, args.images, tuple(args.image_size), args.seed)
+        print(f"Generated {summary['pages']} pages and {summary['images']} images "
+              f"({summary['bytes'] / 1e6:.1f} MB) in {args.fixtures}")
+    elif args.command == 'record':
+        record(args.fixtures, args.urls)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
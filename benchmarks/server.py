@@ -0,0 +1,200 @@
+"""
+A local HTTP stand-in for the gallery sites.
+
+FixtureServer serves a fixture directory over HTTP on 127.0.0.1, with
+requests for /<host>/<path> answered from the fixture of
+https://<host>/<path> (see benchmarks.fixtures). It counts the requests and
+bytes it serves, which is how the benchmarks measure bytes/sec even when the
+crawler streams bodies straight to disk. WordPress REST API routes are
+answered from their collection fixtures, filtered and paged as WordPress
+does (see rest_page()), and other files honour single-range Range headers.
+
+ReplayDownloadHandler points a crawl at the stand-in without changing the
+spiders: every http(s) request is rewritten to the stand-in, downloaded
+through the project's usual download handler, and the response is handed
+back under the original URL.
+"""
+
+import json
+import math
+import mimetypes
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from scrapy.exceptions import NotConfigured
+
+from benchmarks.fixtures import fixture_path, is_rest_route
+from retrogallery.streaming import StreamingHTTPDownloadHandler
+
+
+# The REST API query parameters that filter a collection, and the field of
+# each entry they match; WordPress calls the post of a media item its parent
+REST_FILTERS = {'parent': 'post', 'categories': 'categories', 'slug': 'slug', 'include': 'id'}
+REST_MAX_PER_PAGE = 100
+
+
+def _matches(value, wanted):
+    values = value if isinstance(value, list) else [value]
+    return any(str(v) in wanted for v in values)
+
+
+def rest_page(entries, params):
+    """
+    Filters and pages a REST API collection as WordPress does.
+
+    Parameters:
+        entries (list[dict]): The whole collection.
+        params (dict): The parsed query string.
+
+    Returns:
+        (status, entries, headers) (tuple[int, list, dict]): The entries of
+        the requested page, with the X-WP-Total and X-WP-TotalPages headers,
+        or a 400 and an error for a bad page.
+    """
+    for param, field in REST_FILTERS.items():
+        if param in params:
+            wanted = {value for values in params[param] for value in values.split(',')}
+            entries = [entry for entry in entries if _matches(entry.get(field), wanted)]
+    try:
+        page = int(params.get('page', ['1'])[0])
+        per_page = int(params.get('per_page', ['10'])[0])
+    except ValueError:
+        return 400, {'code': 'rest_invalid_param'}, {}
+    if not 1 <= per_page <= REST_MAX_PER_PAGE:
+        return 400, {'code': 'rest_invalid_param'}, {}
+    total_pages = math.ceil(len(entries) / per_page)
+    if page < 1 or (page > total_pages and entries):
+        return 400, {'code': 'rest_post_invalid_page_number'}, {}
+    headers = {'X-WP-Total': str(len(entries)), 'X-WP-TotalPages': str(total_pages)}
+    return 200, entries[(page - 1) * per_page:page * per_page], headers
+
+
+def byte_range(header, size):
+    """
+    Returns the (first, last) byte positions asked for by a single-range
+    Range header, or None if it asks for anything else.
+    """
+    match = re.match(r'^bytes=(\d+)-(\d*)$', (header or '').strip())
+    if match is None:
+        return None
+    first = int(match.group(1))
+    last = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if first > last:
+        return None
+    return first, last
+
+
+class _FixtureRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        host, _, path = urlparse(self.path).path.lstrip('/').partition('/')
+        query = urlparse(self.path).query
+        url = f"https://{host}/{path}" + (f"?{query}" if query else '')
+        try:
+            body = fixture_path(self.server.root, url).read_bytes()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            self.send_error(404)
+            return
+        status, headers = 200, {}
+        if is_rest_route(f"/{path}"):
+            status, entries, headers = rest_page(json.loads(body), parse_qs(query))
+            body = json.dumps(entries).encode()
+            content_type = 'application/json; charset=UTF-8'
+        else:
+            content_type = mimetypes.guess_type(url.split('?')[0])[0] or 'text/html; charset=utf-8'
+            # Range requests, as used to probe images
+            requested = byte_range(self.headers.get('Range'), len(body))
+            if requested is not None:
+                first, last = requested
+                status, headers = 206, {'Content-Range': f"bytes {first}-{last}/{len(body)}"}
+                body = body[first:last + 1]
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(len(body))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(ThreadingHTTPServer):
+    """
+    Serves a fixture directory on a background thread.
+
+    Parameters:
+        root (str): The fixture directory.
+        port (int): The port to listen on, 0 for any free port.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, root, port=0):
+        super().__init__(('127.0.0.1', port), _FixtureRequestHandler)
+        self.root = root
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def origin(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, size):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += size
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = self.bytes_sent = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='FixtureServer', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def replay_url(origin, url):
+    """
+    Returns the stand-in URL for url, e.g.
+    https://oldcrap.org/a/?b=1 -> http://127.0.0.1:8000/oldcrap.org/a/?b=1
+    """
+    parsed = urlparse(url)
+    replayed = f"{origin}/{parsed.netloc}{parsed.path or '/'}"
+    return f"{replayed}?{parsed.query}" if parsed.query else replayed
+
+
+class ReplayDownloadHandler(StreamingHTTPDownloadHandler):
+    """
+    Downloads every request from the stand-in at
+    RETROGALLERY_BENCHMARK_ORIGIN instead of the real site.
+    """
+
+    def __init__(self, settings, crawler=None):
+        self.origin = settings.get('RETROGALLERY_BENCHMARK_ORIGIN')
+        if not self.origin:
+            raise NotConfigured("RETROGALLERY_BENCHMARK_ORIGIN is not set")
+        super().__init__(settings, crawler)
+
+    def download_request(self, request, spider):
+        replayed = request.replace(url=replay_url(self.origin, request.url))
+
+        def _restore(response):
+            # Meta set while downloading (e.g. the streamed file) belongs to
+            # the original request
+            request.meta.update(replayed.meta)
+            return response.replace(url=request.url)
+
+        return super().download_request(replayed, spider).addCallback(_restore)
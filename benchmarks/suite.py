@@ -0,0 +1,547 @@
+"""
+The benchmarks.
+
+Micro benchmarks call the hot functions directly on fixture pages, with no
+network or reactor:
+
+    parse_gallery/<spider>/<engine>   pages/sec, items/sec, bytes/sec of HTML
+    extract_image_title               calls/sec
+    classify_titles                   batches/sec, alt texts/sec
+    construct_title_from_url          calls/sec
+    file_path                         calls/sec (RetroGalleryLocalPipeline)
+    item_memory                       bytes per in-flight item, as
+                                      scrapy.Items and as compact items
+
+Crawl benchmarks run each spider end to end, images included, against a
+FixtureServer stand-in, in a fresh process and image store per crawl so
+that peak memory and the image store are not shared between runs:
+
+    crawl/<spider>                    pages/sec, items/sec, bytes/sec, peak RSS
+
+Every benchmark but item_memory reports latency percentiles (per call, or
+per spider callback for crawls) and peak memory (tracemalloc peak for micro
+benchmarks, peak RSS for crawls).
+"""
+
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from itertools import cycle
+from pathlib import Path
+
+import scrapy
+from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse, Request
+from scrapy.pipelines.media import MediaPipeline
+from scrapy.settings import Settings
+from itemadapter import ItemAdapter
+
+from benchmarks.fixtures import pages
+from benchmarks.server import FixtureServer
+from retrogallery import extract, streaming, titles, utils
+from retrogallery.items import IMAGE_META_KEY
+from retrogallery.spiders.NostalgiaNerdGallerySpider import NostalgiaNerdGallerySpider
+from retrogallery.spiders.OldCrapGallerySpider import OldCrapGallerySpider
+
+
+SPIDERS = {
+    OldCrapGallerySpider.name: ('oldcrap.org', OldCrapGallerySpider),
+    NostalgiaNerdGallerySpider.name: ('www.nostalgianerd.com', NostalgiaNerdGallerySpider),
+}
+
+
+def percentile(ordered, q):
+    """
+    Returns the q-th percentile (0-100) of an ordered list, interpolating
+    between the closest ranks.
+    """
+    if not ordered:
+        return None
+    rank = (len(ordered) - 1) * q / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def summarise(samples):
+    """
+    Summarises latency samples (in seconds) in milliseconds.
+    """
+    ordered = sorted(samples)
+    total = sum(ordered)
+    return {
+        'count': len(ordered),
+        'mean_ms': total / len(ordered) * 1e3 if ordered else None,
+        'p50_ms': _ms(percentile(ordered, 50)),
+        'p90_ms': _ms(percentile(ordered, 90)),
+        'p99_ms': _ms(percentile(ordered, 99)),
+        'max_ms': _ms(ordered[-1] if ordered else None),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1e3
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process in MiB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KiB elsewhere
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def time_calls(func, inputs, min_time=1.0):
+    """
+    Calls func on each of inputs, cycling through them until at least
+    min_time seconds have passed.
+
+    Returns:
+        samples (list[float]): The duration of each call in seconds.
+    """
+    samples = []
+    elapsed = 0.0
+    for n, args in enumerate(cycle(inputs)):
+        if elapsed >= min_time and n >= len(inputs):
+            break
+        start = time.perf_counter()
+        func(args)
+        duration = time.perf_counter() - start
+        samples.append(duration)
+        elapsed += duration
+    return samples
+
+
+def peak_memory_mb(func, inputs):
+    """
+    Returns the peak Python heap use, in MiB, of one pass of func over
+    inputs.
+    """
+    tracemalloc.start()
+    try:
+        for args in inputs:
+            func(args)
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+
+def _rate(count, samples):
+    total = sum(samples)
+    return count / total if total else None
+
+
+def _benchmark(func, inputs, min_time):
+    samples = time_calls(func, inputs, min_time)
+    return {
+        'calls': len(samples),
+        'calls_per_sec': _rate(len(samples), samples),
+        'latency': summarise(samples),
+        'peak_memory_mb': peak_memory_mb(func, inputs),
+    }
+
+
+def _spider(cls, settings=None):
+    spider = cls()
+    spider.settings = Settings(settings or {})
+    return spider
+
+
+def gallery_pages(fixtures, spider_name):
+    """
+    Returns [(url, body)] for the gallery pages of a spider's fixtures,
+    leaving out its start pages.
+    """
+    host, cls = SPIDERS[spider_name]
+    start_urls = {url.rstrip('/') for url in cls.start_urls}
+    return [(url, body) for url, body in pages(fixtures, host) if url.rstrip('/') not in start_urls]
+
+
+def _gallery_response(url, body):
+    request = Request(url, meta={'gallery_title': 'Gallery', 'gallery_url': url})
+    return HtmlResponse(url, body=body, encoding='utf-8', request=request)
+
+
+def bench_parse_gallery(fixtures, spider_name, engine, min_time=1.0):
+    """
+    Benchmarks parse_gallery() of a spider on its fixture gallery pages.
+    A fresh response is built for every call, so parsing is included.
+    """
+    cls = SPIDERS[spider_name][1]
+    spider = _spider(cls, {'RETROGALLERY_EXTRACTION_ENGINE': engine})
+    inputs = gallery_pages(fixtures, spider_name)
+    if not inputs:
+        raise ValueError(f"No gallery fixtures for {spider_name} in {fixtures}")
+    items = {}
+
+    def parse(page):
+        items[page[0]] = len(list(spider.parse_gallery(_gallery_response(*page))))
+
+    result = _benchmark(parse, inputs, min_time)
+    pages_per_sec = result.pop('calls_per_sec')
+    items_per_page = sum(items.values()) / len(items)
+    bytes_per_page = sum(len(body) for _, body in inputs) / len(inputs)
+    result.update({
+        'pages': result.pop('calls'),
+        'pages_per_sec': pages_per_sec,
+        'items_per_sec': pages_per_sec * items_per_page,
+        'bytes_per_sec': pages_per_sec * bytes_per_page,
+    })
+    return result
+
+
+def _fixture_items(fixtures):
+    items = []
+    for spider_name, (host, cls) in SPIDERS.items():
+        spider = _spider(cls)
+        for page in gallery_pages(fixtures, spider_name):
+            items.extend((spider, item) for item in spider.parse_gallery(_gallery_response(*page)))
+    return items
+
+
+def bench_functions(fixtures, min_time=1.0):
+    """
+    Benchmarks the title and path helpers on the images in the fixtures.
+    """
+    from retrogallery.pipelines import RetroGalleryLocalPipeline
+
+    results = {}
+    imgs = []
+    for spider_name in SPIDERS:
+        for url, body in gallery_pages(fixtures, spider_name):
+            selector = scrapy.Selector(text=body.decode('utf-8'))
+            imgs.extend(selector.css('noscript img, div.entry-content p a img'))
+    results['extract_image_title'] = _benchmark(
+        lambda img: utils.extract_image_title(img, default='Gallery'), imgs, min_time
+    )
+
+    # The batched title classifier, on the fixture alt texts plus some
+    # camera file names, in one batch per call
+    classifier = titles.get_classifier()
+    batch = [img.attrib.get('alt') for img in imgs] + ['DSC_1234', 'IMG_0001', 'P1010001', 'fullsizeoutput_134e']
+    result = _benchmark(lambda alts: classifier.titles(alts, default='Gallery'), [batch], min_time)
+    result['alts_per_sec'] = result['calls_per_sec'] * len(batch)
+    results['classify_titles'] = result
+
+    items = _fixture_items(fixtures)
+    urls = [url for _, item in items for url in item['image_urls']]
+    results['construct_title_from_url'] = _benchmark(utils.construct_title_from_url, urls, min_time)
+
+    with tempfile.TemporaryDirectory() as store:
+        pipeline = RetroGalleryLocalPipeline(store, settings=Settings({
+            'RETROGALLERYLOCALPIPELINE_IMAGES_STORE': store,
+            'RETROGALLERYLOCALPIPELINE_BLOB_STORE': False,
+        }))
+        spiderinfo = {}
+        requests = []
+        for spider, item in items:
+            info = spiderinfo.setdefault(spider.name, MediaPipeline.SpiderInfo(spider))
+            for i, url in enumerate(item['image_urls']):
+                requests.append((info, Request(url, meta={IMAGE_META_KEY: i}), item))
+
+        def file_path(args):
+            pipeline.spiderinfo, request, item = args
+            return pipeline.file_path(request, item=item)
+
+        results['file_path'] = _benchmark(file_path, requests, min_time)
+    return results
+
+
+class ScrapyImageItem(scrapy.Item):
+    """
+    ImageItem as it was before items became slotted dataclasses, for
+    bench_item_memory().
+    """
+    spider = scrapy.Field()
+    gallery_title = scrapy.Field()
+    gallery_url = scrapy.Field()
+    image_title = scrapy.Field()
+    image_urls = scrapy.Field()
+    image_sizes = scrapy.Field()
+    images = scrapy.Field()
+
+
+def _own_copy(value):
+    # A string object of its own, as parsing made one before strings were
+    # interned
+    return (value + ' ')[:-1] if isinstance(value, str) else value
+
+
+def _scrapy_item_media(items, spider_name, pipeline):
+    """
+    Returns [(item, requests)] for the ImageItems of a gallery page as they
+    were before: each a scrapy.Item with strings of its own, except for the
+    gallery title and URL of the page, and with the titles and dimensions
+    of its images copied into the meta of every request.
+    """
+    page = {}
+    media = []
+    for image in items:
+        fields = {key: _own_copy(value) for key, value in ItemAdapter(image).items() if value is not None}
+        for key in ('gallery_title', 'gallery_url'):
+            fields[key] = page.setdefault(key, fields[key])
+        if image['image_title'] == image['gallery_title']:
+            fields['image_title'] = fields['gallery_title']
+        item = ScrapyImageItem(fields, spider=spider_name)
+        requests = []
+        image_sizes = item.get('image_sizes') or []
+        for i, url in enumerate(item['image_urls']):
+            request = Request(url)
+            request.meta['gallery_title'] = item['gallery_title']
+            request.meta['image_title'] = item['image_title']
+            if i < len(image_sizes) and image_sizes[i]:
+                request.meta['image_size'] = tuple(image_sizes[i])
+            if pipeline.streaming:
+                request.meta[streaming.STREAM_META_KEY] = True
+                request.headers['Accept-Encoding'] = 'identity'
+            requests.append(request)
+        media.append((item, requests))
+    return media
+
+
+def _compact_item_media(items, spider_name, pipeline):
+    media = []
+    for item in items:
+        item['spider'] = spider_name
+        media.append((item, pipeline.get_media_requests(item, None)))
+    return media
+
+
+def in_flight_bytes(build, inputs):
+    """
+    Returns the Python heap, in bytes, held by what build() returns for
+    every input, once the rest of what it allocated has been freed.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        retained = [build(args) for args in inputs]
+        gc.collect()
+        return retained, tracemalloc.get_traced_memory()[0] - baseline
+    finally:
+        tracemalloc.stop()
+
+
+def bench_item_memory(fixtures, repeat=10):
+    """
+    Measures the memory held per in-flight image item, with the requests of
+    its images: the items of every fixture gallery page, parsed repeat
+    times, as the scrapy.Items of before and as the current compact items.
+    """
+    from retrogallery.pipelines import RetroGalleryLocalPipeline
+
+    pages = []
+    for spider_name, (host, cls) in SPIDERS.items():
+        spider = _spider(cls)
+        pages.extend((spider, page) for page in gallery_pages(fixtures, spider_name))
+    with tempfile.TemporaryDirectory() as store:
+        pipeline = RetroGalleryLocalPipeline(store, settings=Settings({
+            'RETROGALLERYLOCALPIPELINE_IMAGES_STORE': store,
+            'RETROGALLERYLOCALPIPELINE_BLOB_STORE': False,
+            'RETROGALLERYLOCALPIPELINE_STREAMING': True,
+        }))
+        result = {'bytes_per_item': {}}
+        for name, media in (('scrapy_item', _scrapy_item_media), ('compact', _compact_item_media)):
+            def build(args):
+                spider, page = args
+                return media(list(spider.parse_gallery(_gallery_response(*page))), spider.name, pipeline)
+
+            # A first pass, so that caches filled once are not counted
+            for args in pages:
+                build(args)
+            retained, held = in_flight_bytes(build, pages * repeat)
+            items = sum(len(page) for page in retained)
+            result['items'] = items
+            result['images'] = sum(len(requests) for page in retained for _, requests in page)
+            result['bytes_per_item'][name] = held / items if items else None
+            del retained
+    before, after = result['bytes_per_item']['scrapy_item'], result['bytes_per_item']['compact']
+    result['reduction'] = 1 - after / before if before else None
+    return result
+
+
+def available_engines(engines=None):
+    """
+    Returns the extraction engines that can run here, out of engines (all
+    by default).
+    """
+    available = []
+    for name in engines or extract.ENGINES:
+        try:
+            extract.get_engine(name)
+        except NotConfigured:
+            continue
+        available.append(name)
+    return available
+
+
+def run_micro(fixtures, engines, min_time=1.0):
+    results = {}
+    for spider_name in SPIDERS:
+        for engine in engines:
+            results[f'parse_gallery/{spider_name}/{engine}'] = bench_parse_gallery(
+                fixtures, spider_name, engine, min_time
+            )
+    results.update(bench_functions(fixtures, min_time))
+    results['item_memory'] = bench_item_memory(fixtures)
+    return results
+
+
+def run_crawl(fixtures, spider_name, engine, overrides=None):
+    """
+    Crawls a spider against a FixtureServer in a separate process.
+    """
+    server = FixtureServer(fixtures).start()
+    try:
+        with tempfile.TemporaryDirectory() as store:
+            result_file = os.path.join(store, 'result.json')
+            command = [
+                sys.executable, '-m', 'benchmarks', 'crawl', spider_name,
+                '--origin', server.origin,
+                '--store', os.path.join(store, 'images'),
+                '--engine', engine,
+                '--result-file', result_file,
+            ]
+            for key, value in (overrides or {}).items():
+                command += ['-s', f'{key}={value}']
+            subprocess.run(command, check=True)
+            result = json.loads(Path(result_file).read_text())
+    finally:
+        server.stop()
+    result['bytes'] = server.bytes_sent
+    result['requests'] = server.requests
+    result['bytes_per_sec'] = server.bytes_sent / result['elapsed_s'] if result['elapsed_s'] else None
+    return result
+
+
+def crawl(spider_name, origin, store, engine, result_file, overrides=None):
+    """
+    Runs one crawl in this process and writes its measurements to
+    result_file as JSON. See run_crawl().
+    """
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    os.environ.setdefault('SCRAPY_SETTINGS_MODULE', 'retrogallery.settings')
+    settings = get_project_settings()
+    settings.setdict({
+        'DOWNLOAD_HANDLERS': {
+            'http': 'benchmarks.server.ReplayDownloadHandler',
+            'https': 'benchmarks.server.ReplayDownloadHandler',
+        },
+        'RETROGALLERY_BENCHMARK_ORIGIN': origin,
+        'RETROGALLERY_EXTRACTION_ENGINE': engine,
+        'RETROGALLERY_INCREMENTAL': False,
+        'RETROGALLERY_STATE_DB': os.path.join(store, 'state.sqlite3'),
+        'RETROGALLERYLOCALPIPELINE_IMAGES_STORE': store,
+        'ITEM_PIPELINES': {'retrogallery.pipelines.RetroGalleryLocalPipeline': 100},
+        'AUTOTHROTTLE_ENABLED': False,
+        'HTTPCACHE_ENABLED': False,
+        'ROBOTSTXT_OBEY': False,
+        'TELNETCONSOLE_ENABLED': False,
+        'LOG_LEVEL': 'WARNING',
+    }, priority='cmdline')
+    settings.setdict(overrides or {}, priority='cmdline')
+
+    latencies = {}
+
+    class TimedSpider(SPIDERS[spider_name][1]):
+        def _timed(self, callback, response):
+            start = time.perf_counter()
+            results = list(callback(response))
+            latencies.setdefault(callback.__name__, []).append(time.perf_counter() - start)
+            return results
+
+        def parse(self, response):
+            return self._timed(super().parse, response)
+
+        def parse_gallery(self, response):
+            return self._timed(super().parse_gallery, response)
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(TimedSpider)
+    process.crawl(crawler)
+    process.start()
+
+    stats = crawler.stats.get_stats()
+    elapsed = stats.get('elapsed_time_seconds') or 0
+    pages = sum(len(samples) for samples in latencies.values())
+    items = stats.get('item_scraped_count', 0)
+    result = {
+        'spider': spider_name,
+        'engine': engine,
+        'elapsed_s': elapsed,
+        'pages': pages,
+        'items': items,
+        'images': stats.get('file_status_count/downloaded', 0),
+        'pages_per_sec': pages / elapsed if elapsed else None,
+        'items_per_sec': items / elapsed if elapsed else None,
+        'callback_latency': {name: summarise(samples) for name, samples in latencies.items()},
+        'peak_rss_mb': peak_rss_mb(),
+        'finish_reason': stats.get('finish_reason'),
+    }
+    Path(result_file).write_text(json.dumps(result))
+
+
+def environment(fixtures):
+    """
+    Describes the machine, code and fixtures a run was made with.
+    """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, cwd=Path(__file__).parent
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    files = [path for path in Path(fixtures).rglob('*') if path.is_file()]
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'scrapy': scrapy.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'fixtures': {
+            'path': str(fixtures),
+            'pages': sum(1 for path in files if path.suffix == '.html'),
+            'images': sum(1 for path in files if path.suffix != '.html'),
+            'bytes': sum(path.stat().st_size for path in files),
+        },
+    }
+
+
+def flatten(results, prefix=''):
+    """
+    Flattens nested results into {'a/b/c': number}.
+    """
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}/"))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(baseline, current):
+    """
+    Returns [(name, baseline, current, change)] for every measurement in
+    both runs, where change is the relative difference.
+    """
+    base, new = flatten(baseline.get('results', {})), flatten(current.get('results', {}))
+    rows = []
+    for name in sorted(base.keys() & new.keys()):
+        change = (new[name] - base[name]) / base[name] if base[name] else None
+        rows.append((name, base[name], new[name], change))
+    return rows
@@ -0,0 +1,474 @@
+"""
+Content-addressed blob storage for downloaded images.
+
+Image bytes are hashed once and stored exactly once under
+{basedir}/blobs/{digest[:2]}/{digest[2:4]}/{digest}{ext}. The gallery layout
+used by RetroGalleryLocalPipeline ({spider}/{gallery_title}/{image_title}/...)
+is then materialised as cheap hard links or symlinks to the blobs, or not at
+all when the index is used as a manifest.
+
+A small SQLite index records which blob every stored path and every
+downloaded URL refers to, so the same photo reached through different URLs
+(CDN variants, ?ssl=1 vs. bare, and so on) is written to disk once and
+re-crawls can skip any URL whose blob is already present.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from contextlib import suppress
+from pathlib import Path
+
+from scrapy.pipelines.files import FSFilesStore
+
+from retrogallery.resources import is_shared, shared
+
+
+logger = logging.getLogger(__name__)
+
+
+LINK_MODES = ('hardlink', 'symlink', 'manifest')
+
+
+class BlobIndex:
+    """
+    SQLite index mapping stored paths and URLs to blobs.
+
+    Tables:
+        blobs: one row per unique blob (digest, extension, size, md5).
+        entries: one row per stored path, with the blob it refers to and,
+        when known, the URL, spider, gallery title and image title it was
+        stored for.
+        downloads: one row per downloaded URL, normalised (see
+        retrogallery.urls), with the blob it was last downloaded as and
+        when. Linking a path to the blob of a URL does not count as a
+        download, so the download time is what IMAGES_EXPIRES is measured
+        against.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS blobs (
+            digest TEXT PRIMARY KEY,
+            ext TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            md5 TEXT NOT NULL,
+            created REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS entries (
+            path TEXT PRIMARY KEY,
+            digest TEXT NOT NULL REFERENCES blobs(digest),
+            url TEXT,
+            spider TEXT,
+            gallery_title TEXT,
+            image_title TEXT,
+            updated REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS downloads (
+            url TEXT PRIMARY KEY,
+            digest TEXT NOT NULL REFERENCES blobs(digest),
+            fetched REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_url ON entries(url);
+        CREATE INDEX IF NOT EXISTS entries_digest ON entries(digest);
+        CREATE INDEX IF NOT EXISTS entries_gallery ON entries(spider, gallery_title);
+        CREATE INDEX IF NOT EXISTS blobs_size ON blobs(size);
+    """
+
+    # Commit after this many writes; the index is also committed on close.
+    COMMIT_EVERY = 100
+
+    def __init__(self, path, commit_every=None):
+        self.path = str(path)
+        self.commit_every = commit_every or self.COMMIT_EVERY
+        # Wait for other processes sharing the index (see
+        # retrogallery.distributed) rather than failing
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.executescript(self.SCHEMA)
+        self._pending_writes = 0
+
+    def _write(self, sql, params):
+        self.conn.execute(sql, params)
+        self._pending_writes += 1
+        if self._pending_writes >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._pending_writes = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def get_blob(self, digest):
+        """
+        Returns the (digest, ext, size, md5) row for a blob, or None if the
+        blob is not indexed.
+        """
+        return self.conn.execute(
+            "SELECT digest, ext, size, md5 FROM blobs WHERE digest = ?",
+            (digest,)
+        ).fetchone()
+
+    def add_blob(self, digest, ext, size, md5):
+        self._write(
+            "INSERT OR IGNORE INTO blobs (digest, ext, size, md5, created) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (digest, ext, size, md5, time.time())
+        )
+
+    def blobs_of_size(self, size):
+        """
+        Returns the (digest, ext) rows of the blobs of size bytes.
+        """
+        return self.conn.execute(
+            "SELECT digest, ext FROM blobs WHERE size = ?",
+            (size,)
+        ).fetchall()
+
+    def blob_for_path(self, path):
+        """
+        Returns the (digest, ext, size, md5) row for the blob stored at path,
+        or None if nothing is stored at path.
+        """
+        return self.conn.execute(
+            "SELECT b.digest, b.ext, b.size, b.md5 FROM entries e "
+            "JOIN blobs b ON b.digest = e.digest WHERE e.path = ?",
+            (path,)
+        ).fetchone()
+
+    def blob_for_url(self, url):
+        """
+        Returns the (digest, ext, size, md5, fetched) row for the blob last
+        downloaded from url, fetched being the time of the download, or None
+        if the URL has not been downloaded.
+        """
+        return self.conn.execute(
+            "SELECT b.digest, b.ext, b.size, b.md5, d.fetched FROM downloads d "
+            "JOIN blobs b ON b.digest = d.digest WHERE d.url = ?",
+            (url,)
+        ).fetchone()
+
+    def record_download(self, url, path):
+        """
+        Records that url was just downloaded as the blob stored at path.
+        """
+        self._write(
+            "INSERT INTO downloads (url, digest, fetched) "
+            "SELECT ?, digest, ? FROM entries WHERE path = ? "
+            "ON CONFLICT(url) DO UPDATE SET digest = excluded.digest, "
+            "fetched = excluded.fetched",
+            (url, time.time(), path)
+        )
+
+    def set_entry(self, path, digest):
+        """
+        Points path at digest, keeping any URL/title metadata already
+        recorded for path.
+        """
+        self._write(
+            "INSERT INTO entries (path, digest, updated) VALUES (?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET digest = excluded.digest, "
+            "updated = excluded.updated",
+            (path, digest, time.time())
+        )
+
+    def describe_entry(self, path, url=None, spider=None, gallery_title=None, image_title=None):
+        """
+        Records the URL and titles that a stored path was downloaded for.
+        """
+        self._write(
+            "UPDATE entries SET url = ?, spider = ?, gallery_title = ?, "
+            "image_title = ?, updated = ? WHERE path = ?",
+            (url, spider, gallery_title, image_title, time.time(), path)
+        )
+
+    def remove_blob_if_unused(self, digest):
+        """
+        Forgets a blob that no entry refers to.
+
+        Returns:
+            row (tuple): The (digest, ext, size, md5) row of the removed
+            blob, or None if the blob is still in use or not indexed.
+        """
+        row = self.get_blob(digest)
+        if row is None or self.conn.execute(
+            "SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)
+        ).fetchone():
+            return None
+        self._write("DELETE FROM blobs WHERE digest = ?", (digest,))
+        return row
+
+    def manifest(self, spider, gallery_title):
+        """
+        Returns the (path, digest, url, image_title) entries stored for a
+        gallery, ordered by path.
+        """
+        return self.conn.execute(
+            "SELECT path, digest, url, image_title FROM entries "
+            "WHERE spider = ? AND gallery_title = ? ORDER BY path",
+            (spider, gallery_title)
+        ).fetchall()
+
+
+class BlobStore:
+    """
+    Stores blobs by content digest and links logical paths to them.
+
+    Parameters:
+        basedir (str): The root of the image store.
+        link_mode (str): How logical paths refer to blobs. One of:
+            hardlink - a hard link (falls back to symlink across devices)
+            symlink - a relative symlink
+            manifest - no file at all; the index is the only record
+        commit_every (int): Commit the index after this many writes
+        (default BlobIndex.COMMIT_EVERY); 1 when several processes share
+        the store.
+    """
+
+    BLOBS_DIR = 'blobs'
+    INDEX_NAME = 'index.sqlite3'
+
+    def __init__(self, basedir, link_mode='hardlink', commit_every=None):
+        if link_mode not in LINK_MODES:
+            raise ValueError(f"Unknown blob link mode {link_mode!r}, expected one of {LINK_MODES}")
+        self.basedir = Path(basedir)
+        self.link_mode = link_mode
+        self.blobs_dir = self.basedir / self.BLOBS_DIR
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+        self.index = BlobIndex(self.blobs_dir / self.INDEX_NAME, commit_every=commit_every)
+
+    @staticmethod
+    def digest(data):
+        # deepcode ignore InsecureHash: <not used in a security context>
+        return hashlib.sha1(data).hexdigest()
+
+    def blob_path(self, digest, ext=''):
+        return self.blobs_dir / digest[:2] / digest[2:4] / f"{digest}{ext}"
+
+    def has_blob(self, digest):
+        row = self.index.get_blob(digest)
+        return row is not None and self.blob_path(digest, row[1]).exists()
+
+    def put(self, data, ext=''):
+        """
+        Stores data as a blob unless an identical blob already exists.
+
+        Returns:
+            (digest, created) (tuple[str, bool]): The blob digest and whether
+            new bytes were written.
+        """
+        digest = self.digest(data)
+        if self.has_blob(digest):
+            return digest, False
+        blob_path = self.blob_path(digest, ext)
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary name and rename so a crash never leaves a
+        # truncated blob under its final digest.
+        tmp_path = blob_path.with_name(f".{blob_path.name}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, blob_path)
+        # deepcode ignore InsecureHash: <not used in a security context>
+        self.index.add_blob(digest, ext, len(data), hashlib.md5(data).hexdigest())
+        return digest, True
+
+    def put_file(self, src, digest, size, md5, ext=''):
+        """
+        Moves the file at src into the store as a blob whose digest was
+        computed while the file was written. src is removed if an identical
+        blob already exists.
+
+        Returns:
+            created (bool): Whether the file became a new blob.
+        """
+        if self.has_blob(digest):
+            os.unlink(src)
+            return False
+        blob_path = self.blob_path(digest, ext)
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(src, blob_path)
+        self.index.add_blob(digest, ext, size, md5)
+        return True
+
+    def find_prefix(self, size, prefix):
+        """
+        Returns the digest of a stored blob of size bytes that starts with
+        the bytes prefix, or None if there is none (see retrogallery.probe).
+        """
+        for digest, ext in self.index.blobs_of_size(size):
+            try:
+                with open(self.blob_path(digest, ext), 'rb') as f:
+                    if f.read(len(prefix)) == prefix:
+                        return digest
+            except FileNotFoundError:
+                continue
+        return None
+
+    def link(self, digest, path):
+        """
+        Makes the logical path (relative to basedir) refer to the blob.
+        """
+        self.index.set_entry(path, digest)
+        if self.link_mode == 'manifest':
+            return
+        row = self.index.get_blob(digest)
+        target = self.target_path(path)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        self.link_file(self.blob_path(digest, row[1]), target)
+
+    def target_path(self, path):
+        return self.basedir.joinpath(*path.split('/'))
+
+    def link_file(self, blob_path, target):
+        """
+        Links the file at target, whose directory exists, to a blob file.
+        """
+        if target.is_symlink() or target.exists():
+            if target.exists() and os.path.samefile(target, blob_path):
+                return
+            target.unlink()
+        if self.link_mode == 'hardlink':
+            try:
+                os.link(blob_path, target)
+                return
+            except OSError as e:
+                logger.debug("Hard link %s -> %s failed (%s), using a symlink", target, blob_path, e)
+        os.symlink(os.path.relpath(blob_path, target.parent), target)
+
+    def remove_unused(self, digest):
+        """
+        Deletes a blob that no stored path refers to any more, e.g. after
+        its paths were relinked to a near-duplicate (see retrogallery.phash).
+
+        Returns:
+            removed (bool): Whether the blob was deleted.
+        """
+        row = self.index.remove_blob_if_unused(digest)
+        if row is None:
+            return False
+        with suppress(FileNotFoundError):
+            self.blob_path(digest, row[1]).unlink()
+        return True
+
+    def resolve(self, path):
+        """
+        Returns the (blob path, md5) of the blob stored at the logical path,
+        or None if nothing is stored there.
+        """
+        row = self.index.blob_for_path(path)
+        if row is None:
+            return None
+        blob_path = self.blob_path(row[0], row[1])
+        return (blob_path, row[3]) if blob_path.exists() else None
+
+    def close(self):
+        self.index.close()
+
+
+def _stat_blob(blob_path, checksum):
+    try:
+        return {"last_modified": blob_path.stat().st_mtime, "checksum": checksum}
+    except FileNotFoundError:
+        return {}
+
+
+class BlobFilesStore(FSFilesStore):
+    """
+    A drop-in replacement for Scrapy's FSFilesStore that writes through a
+    BlobStore, so identical bytes stored under different paths share one
+    blob on disk.
+    """
+
+    def __init__(self, basedir, link_mode='hardlink', commit_every=None, writer=None):
+        super().__init__(basedir)
+        # The jobs of a crawl service share one index (see
+        # retrogallery.service)
+        self.blobs = shared(
+            ('blobs', str(self.basedir), link_mode),
+            lambda: BlobStore(self.basedir, link_mode=link_mode, commit_every=commit_every)
+        )
+        # With a writer (see retrogallery.fswriter), blob files and links
+        # are written in its threads and the index is updated once they are
+        # in place; persist_file(), persist_stream() and stat_file() then
+        # return Deferreds
+        self.writer = writer
+
+    def persist_file(self, path, buf, info, meta=None, headers=None):
+        data = buf.getvalue()
+        ext = os.path.splitext(path)[1]
+        if self.writer is not None:
+            digest = self.blobs.digest(data)
+            if self.blobs.has_blob(digest):
+                logger.debug("Blob %s already stored, linking %s", digest, path)
+                return self._link(digest, path)
+            # deepcode ignore InsecureHash: <not used in a security context>
+            md5 = hashlib.md5(data).hexdigest()
+            dfd = self.writer.write(self.blobs.blob_path(digest, ext), data)
+            dfd.addCallback(lambda _: self.blobs.index.add_blob(digest, ext, len(data), md5))
+            return dfd.addCallback(lambda _: self._link(digest, path))
+        digest, created = self.blobs.put(data, ext)
+        if not created:
+            logger.debug("Blob %s already stored, linking %s", digest, path)
+        self.blobs.link(digest, path)
+
+    def persist_stream(self, path, streamed, info):
+        """
+        Stores a response body that was streamed to a spool file (see
+        retrogallery.streaming) without reading it back into memory.
+        """
+        ext = os.path.splitext(path)[1]
+        if self.writer is not None:
+            if self.blobs.has_blob(streamed.sha1):
+                dfd = self.writer.call(streamed.path, os.unlink, streamed.path)
+            else:
+                dfd = self.writer.move(streamed.path, self.blobs.blob_path(streamed.sha1, ext))
+                dfd.addCallback(
+                    lambda _: self.blobs.index.add_blob(streamed.sha1, ext, streamed.size, streamed.md5)
+                )
+            return dfd.addCallback(lambda _: self._link(streamed.sha1, path))
+        self.blobs.put_file(streamed.path, streamed.sha1, streamed.size, streamed.md5, ext)
+        self.blobs.link(streamed.sha1, path)
+
+    def link(self, digest, path):
+        """
+        Makes path refer to a stored blob, e.g. one already downloaded from
+        the same URL. With a writer, the link is made in its threads and a
+        Deferred is returned that fires once it is in place.
+        """
+        if self.writer is not None:
+            return self._link(digest, path)
+        self.blobs.link(digest, path)
+        return None
+
+    def _link(self, digest, path):
+        self.blobs.index.set_entry(path, digest)
+        if self.blobs.link_mode == 'manifest':
+            return None
+        blob_path = self.blobs.blob_path(digest, self.blobs.index.get_blob(digest)[1])
+        target = self.blobs.target_path(path)
+
+        def _link_file():
+            self.writer.makedirs(target.parent)
+            self.blobs.link_file(blob_path, target)
+
+        return self.writer.call(target, _link_file)
+
+    def stat_file(self, path, info):
+        if self.writer is not None:
+            row = self.blobs.index.blob_for_path(path)
+            if row is None:
+                return {}
+            blob_path = self.blobs.blob_path(row[0], row[1])
+            return self.writer.call(blob_path, _stat_blob, blob_path, row[3])
+        resolved = self.blobs.resolve(path)
+        if resolved is None:
+            return {}
+        return _stat_blob(*resolved)
+
+    def close(self):
+        if is_shared(self.blobs):
+            self.blobs.index.commit()
+        else:
+            self.blobs.close()
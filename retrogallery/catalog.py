@@ -0,0 +1,288 @@
+"""
+A columnar catalog of the scraped images, for querying crawls without
+rescanning JSON feeds.
+
+RetroGalleryCatalogPipeline writes one row per stored image (see SCHEMA):
+the item's spider, gallery and image titles, and from the image's download
+result its URL, path, checksum, fetch status and near-duplicate, plus its
+dimensions and size in bytes, read from the stored file. Rows are buffered
+and written in a worker thread as a Parquet row group every
+RETROGALLERYCATALOGPIPELINE_BATCH_SIZE rows, to one file per spider and
+crawl:
+
+    RETROGALLERYCATALOGPIPELINE_DIR/<spider>-<UTC start time>.parquet
+
+A file is written under a hidden name and renamed once the crawl closes
+it, so a crawl that dies leaves nothing that looks like a catalog file. The
+catalog directory can be queried from the command line; only the columns
+a query needs are read:
+
+    python -m retrogallery.catalog summary
+    python -m retrogallery.catalog galleries --spider OldCrapGallerySpider --limit 20
+    python -m retrogallery.catalog gallery "Apple ///"
+    python -m retrogallery.catalog files
+
+or opened directly, e.g. with pyarrow.dataset.dataset(directory) or
+pandas.read_parquet(directory). Requires pyarrow.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from itemadapter import ItemAdapter
+from scrapy.exceptions import NotConfigured
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CATALOG_DIR = '/tmp/retrogallery/catalog'
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_COMPRESSION = 'zstd'
+
+COLUMNS = (
+    ('spider', 'string'),
+    ('gallery_title', 'string'),
+    ('gallery_url', 'string'),
+    ('image_title', 'string'),
+    ('url', 'string'),
+    ('path', 'string'),
+    ('checksum', 'string'),
+    ('status', 'string'),
+    ('width', 'int32'),
+    ('height', 'int32'),
+    ('size', 'int64'),
+    ('duplicate_of', 'string'),
+    ('scraped_at', 'timestamp'),
+)
+
+
+def require_pyarrow():
+    if pa is None:
+        raise NotConfigured("The image catalog requires pyarrow")
+
+
+def schema():
+    require_pyarrow()
+    types = {
+        'string': pa.string(),
+        'int32': pa.int32(),
+        'int64': pa.int64(),
+        'timestamp': pa.timestamp('s', tz='UTC'),
+    }
+    return pa.schema([(name, types[kind]) for name, kind in COLUMNS])
+
+
+def catalog_path(directory, spider_name, started=None):
+    started = datetime.fromtimestamp(started or time.time(), timezone.utc)
+    return Path(directory) / f"{spider_name}-{started:%Y%m%dT%H%M%S}.parquet"
+
+
+def rows(item, spider_name, scraped_at=None):
+    """
+    Returns the catalog rows of an item (an ImageItem or a GalleryItem), one
+    per image in its download results (IMAGES_RESULT_FIELD). Dimensions and sizes are filled in when
+    the rows are written.
+    """
+    adapter = ItemAdapter(item)
+    scraped_at = datetime.fromtimestamp(scraped_at or time.time(), timezone.utc)
+    common = {
+        'spider': adapter.get('spider') or spider_name,
+        'gallery_title': adapter.get('gallery_title'),
+        'gallery_url': adapter.get('gallery_url'),
+        'image_title': adapter.get('image_title'),
+        'scraped_at': scraped_at,
+    }
+    return [
+        dict(
+            common,
+            # The images of a GalleryItem carry their own titles
+            image_title=result.get('image_title') or common['image_title'],
+            url=result.get('url'),
+            path=result.get('path'),
+            checksum=result.get('checksum'),
+            status=result.get('status'),
+            duplicate_of=result.get('duplicate_of'),
+        )
+        for result in adapter.get('images') or []
+    ]
+
+
+def probe(path):
+    """
+    Returns the (width, height, size) of a stored image, reading only its
+    header; any that cannot be determined are None.
+    """
+    from PIL import Image
+
+    try:
+        size = os.stat(path).st_size
+    except OSError:
+        return None, None, None
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+    except Exception:
+        width = height = None
+    return width, height, size
+
+
+class CatalogWriter:
+    """
+    Writes catalog rows to a Parquet file, one row group per batch.
+
+    Parameters:
+        path (str): The catalog file. It is written as a hidden file beside
+        it and renamed on close().
+        compression (str): The Parquet compression codec.
+    """
+
+    def __init__(self, path, compression=DEFAULT_COMPRESSION):
+        require_pyarrow()
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(f".{self.path.name}.partial")
+        self.compression = compression
+        self.schema = schema()
+        self.writer = None
+        self.rows = 0
+
+    def write(self, rows, local_paths=None):
+        """
+        Writes a batch of rows as a row group, filling in the dimensions
+        and size of each row from its stored file in local_paths (None where
+        there is no local file). Blocking: call it from a worker thread.
+        """
+        if not rows:
+            return
+        for row, local_path in zip(rows, local_paths or ()):
+            if local_path is not None:
+                row['width'], row['height'], row['size'] = probe(local_path)
+        if self.writer is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.writer = pq.ParquetWriter(self.tmp_path, self.schema, compression=self.compression)
+        self.writer.write_table(pa.Table.from_pylist(rows, schema=self.schema), row_group_size=len(rows))
+        self.rows += len(rows)
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.writer = None
+        os.replace(self.tmp_path, self.path)
+        logger.info(f"Wrote {self.rows} images to the catalog {self.path}")
+
+
+def dataset(directory):
+    require_pyarrow()
+    return ds.dataset(directory, format='parquet', schema=schema())
+
+
+def summary(directory):
+    """
+    Returns, per spider, the number of galleries, images and bytes.
+    """
+    table = dataset(directory).to_table(columns=['spider', 'gallery_url', 'path', 'size'])
+    return table.group_by('spider').aggregate([
+        ('gallery_url', 'count_distinct'),
+        ('path', 'count'),
+        ('size', 'sum'),
+    ]).sort_by('spider').to_pylist()
+
+
+def galleries(directory, spider=None, limit=None):
+    """
+    Returns the galleries with the most bytes of images, with their image
+    counts.
+    """
+    filter = pc.field('spider') == spider if spider else None
+    table = dataset(directory).to_table(columns=['spider', 'gallery_title', 'path', 'size'], filter=filter)
+    table = table.group_by(['spider', 'gallery_title']).aggregate([
+        ('path', 'count'),
+        ('size', 'sum'),
+    ]).sort_by([('size_sum', 'descending')])
+    return table.slice(0, limit).to_pylist() if limit else table.to_pylist()
+
+
+def gallery_images(directory, gallery):
+    """
+    Returns the images of the galleries titled gallery or at URL gallery.
+    """
+    filter = (pc.field('gallery_title') == gallery) | (pc.field('gallery_url') == gallery)
+    return dataset(directory).to_table(filter=filter).sort_by('path').to_pylist()
+
+
+def _format_size(size):
+    if size is None:
+        return '-'
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024
+    return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+
+
+def main(argv=None):
+    from scrapy.utils.project import get_project_settings
+
+    settings = get_project_settings()
+    parser = argparse.ArgumentParser(
+        prog='python -m retrogallery.catalog',
+        description='Query the retrogallery image catalog.'
+    )
+    parser.add_argument('--dir', default=settings.get('RETROGALLERYCATALOGPIPELINE_DIR', DEFAULT_CATALOG_DIR),
+                        help='catalog directory (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('summary', help='count galleries, images and bytes per spider')
+    command = commands.add_parser('galleries', help='list galleries, most bytes first')
+    command.add_argument('--spider')
+    command.add_argument('--limit', type=int, default=50)
+    commands.add_parser('gallery', help='list the images of a gallery, by title or URL').add_argument('gallery')
+    commands.add_parser('files', help='list the catalog files with their row groups and rows')
+    args = parser.parse_args(argv)
+
+    try:
+        require_pyarrow()
+    except NotConfigured as e:
+        print(e, file=sys.stderr)
+        return 1
+    if not os.path.isdir(args.dir):
+        print(f"No catalog at {args.dir}", file=sys.stderr)
+        return 1
+
+    if args.command == 'summary':
+        for row in summary(args.dir):
+            print(f"{row['spider']}: {row['gallery_url_count_distinct']} galleries, "
+                  f"{row['path_count']} images, {_format_size(row['size_sum'])}")
+    elif args.command == 'galleries':
+        for row in galleries(args.dir, args.spider, args.limit):
+            print(f"{_format_size(row['size_sum']):>8}  {row['path_count']:>5}  {row['spider']}  {row['gallery_title']}")
+    elif args.command == 'gallery':
+        images = gallery_images(args.dir, args.gallery)
+        if not images:
+            print(f"No images for {args.gallery}", file=sys.stderr)
+            return 1
+        for row in images:
+            dimensions = f"{row['width']}x{row['height']}" if row['width'] else '-'
+            print(f"{row['status']:10}  {dimensions:>11}  {_format_size(row['size']):>8}  {row['path']}")
+    elif args.command == 'files':
+        for fragment in dataset(args.dir).get_fragments():
+            metadata = fragment.metadata
+            print(f"{fragment.path}: {metadata.num_row_groups} row groups, {metadata.num_rows} rows")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
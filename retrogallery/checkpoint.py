@@ -0,0 +1,557 @@
+"""
+Crash-safe checkpoints of in-flight crawls, and resuming them.
+
+While a spider runs with RETROGALLERY_CHECKPOINT_ENABLED (as the crawl
+command below does), CheckpointMiddleware appends to a compact, append-only
+journal (RETROGALLERY_CHECKPOINT_DIR/<spider>.journal):
+
+    request   a gallery page was scheduled (its fingerprint and the pickled
+              request)
+    done      a page was parsed and every item it yielded has left the item
+              pipelines (or it was dropped by the dupefilter)
+    item      an item completed every pipeline
+    media     an image is about to be written to the local image store
+    stored    that image was written
+
+Every record is written to the operating system as it happens, so a killed
+process (an OOM, a deploy restart) loses nothing; the journal is fsynced every
+RETROGALLERY_CHECKPOINT_INTERVAL seconds, so a machine crash loses at most
+that much. Records are framed with their length and a CRC32, and a torn
+record at the end of the journal is ignored. Whenever the journal grows to
+several times the size of what it describes, it is compacted: rewritten as
+a snapshot of the pending pages, completed pages and items and unfinished
+images.
+
+Resuming replays the journal. Half-written images (journaled but never
+stored) and the temporary files of their atomic writes are removed from the
+image store, as are the spider's streaming spool files; the scheduled pages
+that were never completed replace the start requests, completed pages seed
+the dupefilter and items that already completed are not scraped again:
+
+    python -m retrogallery.checkpoint crawl OldCrapGallerySpider --resume
+    python -m retrogallery.checkpoint status OldCrapGallerySpider
+    python -m retrogallery.checkpoint clean OldCrapGallerySpider
+
+(or scrapy crawl OldCrapGallerySpider -s RETROGALLERY_CHECKPOINT_ENABLED=1
+-s RETROGALLERY_CHECKPOINT_RESUME=1).
+A crawl started without --resume starts a new journal, and the journal of a
+crawl that finished is removed. Pages whose download
+failed (rather than their parsing) are never marked done, so they are
+retried by a resumed crawl. An item counts as completed once it has left
+the item pipelines, so items a killed crawl had not yet flushed to a feed
+export (-o) are not exported again. Checkpoints are disabled in distributed
+mode, where the shared frontier already outlives the workers.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import pickle
+import struct
+import sys
+import zlib
+from pathlib import Path
+
+from itemadapter import ItemAdapter, is_item
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.request import request_from_dict
+
+from retrogallery import distributed, streaming
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CHECKPOINT_DIR = '/tmp/retrogallery/checkpoints'
+DEFAULT_INTERVAL = 10
+
+# Journal record kinds
+REQUEST, DONE, ITEM, MEDIA, STORED = range(1, 6)
+
+# kind, payload length, payload CRC32
+HEADER = struct.Struct('>BII')
+FINGERPRINT_SIZE = 20
+
+# Compact the journal when it is this many times the size of a snapshot of
+# its state (and at least COMPACT_MIN_SIZE bytes)
+COMPACT_RATIO = 4
+COMPACT_MIN_SIZE = 1024 * 1024
+
+# Set on the requests the checkpoint has journaled, and carried over to the
+# requests that replace them (e.g. redirects)
+FINGERPRINT_META_KEY = '_retrogallery_checkpoint_fp'
+
+
+def journal_path(settings, spider_name):
+    directory = settings.get('RETROGALLERY_CHECKPOINT_DIR') or DEFAULT_CHECKPOINT_DIR
+    return Path(directory) / f"{spider_name}.journal"
+
+
+def item_id(item, spider_name):
+    """
+    Returns a stable 20 byte ID for an image item: the same gallery, image
+    title and image URLs always give the same ID.
+    """
+    adapter = ItemAdapter(item)
+    key = [
+        spider_name,
+        adapter.get('gallery_url'),
+        adapter.get('image_title'),
+        sorted(adapter.get('image_urls') or []),
+    ]
+    # deepcode ignore InsecureHash: <not used in a security context>
+    return hashlib.sha1(json.dumps(key).encode()).digest()
+
+
+def read_journal(path):
+    """
+    Yields the (kind, payload) records of a journal, stopping at the first
+    torn or corrupt record.
+    """
+    with open(path, 'rb') as f:
+        offset = 0
+        while True:
+            header = f.read(HEADER.size)
+            if not header:
+                return
+            if len(header) == HEADER.size:
+                kind, length, crc = HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) == length and zlib.crc32(payload) == crc:
+                    yield kind, payload
+                    offset += HEADER.size + length
+                    continue
+            logger.warning(f"Ignoring a torn record at offset {offset} of {path}")
+            return
+
+
+def _record(kind, payload):
+    return HEADER.pack(kind, len(payload), zlib.crc32(payload)) + payload
+
+
+class CheckpointState:
+    """
+    The state described by a journal: the pages scheduled but not done, the
+    pages done, the items completed and the images being written.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.done = set()
+        self.items = set()
+        self.media = set()
+
+    @classmethod
+    def load(cls, path):
+        state = cls()
+        if Path(path).exists():
+            for kind, payload in read_journal(path):
+                state.apply(kind, payload)
+        return state
+
+    def apply(self, kind, payload):
+        if kind == REQUEST:
+            fp = payload[:FINGERPRINT_SIZE]
+            self.pending[fp] = payload[FINGERPRINT_SIZE:]
+            self.done.discard(fp)
+        elif kind == DONE:
+            self.pending.pop(payload, None)
+            self.done.add(payload)
+        elif kind == ITEM:
+            self.items.add(payload)
+        elif kind == MEDIA:
+            self.media.add(payload.decode())
+        elif kind == STORED:
+            self.media.discard(payload.decode())
+
+    def records(self):
+        """
+        Yields the records of a journal snapshot of this state.
+        """
+        for fp in self.done:
+            yield _record(DONE, fp)
+        for item in self.items:
+            yield _record(ITEM, item)
+        for path in self.media:
+            yield _record(MEDIA, path.encode())
+        for fp, request in self.pending.items():
+            yield _record(REQUEST, fp + request)
+
+    def __bool__(self):
+        return bool(self.pending or self.done or self.items or self.media)
+
+
+class Checkpoint:
+    """
+    The journal of one spider's crawl, and the state it describes.
+
+    Parameters:
+        path (str): The journal. Parent directories are created if needed.
+        resume (bool): Replay the journal and carry on appending to it;
+        otherwise a new journal is started.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.resume = resume
+        if resume:
+            self.state = CheckpointState.load(self.path)
+        else:
+            if self.path.exists() and self.path.stat().st_size:
+                logger.info(f"Starting a new checkpoint journal; the previous crawl's journal {self.path} is discarded")
+            self.state = CheckpointState()
+        self.file = None
+        self.size = self.snapshot_size = 0
+        # Rewriting the journal on open also drops a torn record left at
+        # its end, which would hide everything appended after it
+        self.compact()
+
+    @classmethod
+    def from_settings(cls, settings, spider_name):
+        return cls(
+            journal_path(settings, spider_name),
+            resume=settings.getbool('RETROGALLERY_CHECKPOINT_RESUME'),
+        )
+
+    def _append(self, kind, payload):
+        record = _record(kind, payload)
+        self.file.write(record)
+        self.size += len(record)
+
+    def request_scheduled(self, fp, request):
+        """
+        Journals a scheduled page request, unless it is already pending.
+
+        Returns:
+            journaled (bool): Whether the request was journaled.
+        """
+        if fp in self.state.pending:
+            return False
+        data = pickle.dumps(request, protocol=pickle.HIGHEST_PROTOCOL)
+        self.state.apply(REQUEST, fp + data)
+        self._append(REQUEST, fp + data)
+        return True
+
+    def page_done(self, fp):
+        if fp not in self.state.pending:
+            return
+        self.state.apply(DONE, fp)
+        self._append(DONE, fp)
+
+    def item_completed(self, item):
+        self.state.items.add(item)
+        self._append(ITEM, item)
+
+    def media_started(self, path):
+        self.state.media.add(path)
+        self._append(MEDIA, path.encode())
+
+    def media_stored(self, path):
+        self.state.media.discard(path)
+        self._append(STORED, path.encode())
+
+    def pending_requests(self):
+        """
+        Yields the request dicts of the pages scheduled but not done.
+        """
+        for data in list(self.state.pending.values()):
+            yield pickle.loads(data)
+
+    def sync(self):
+        """
+        Flushes the journal to disk, compacting it first if it has grown to
+        several times the size of its state.
+        """
+        if self.size > max(COMPACT_MIN_SIZE, COMPACT_RATIO * self.snapshot_size):
+            self.compact()
+        else:
+            os.fsync(self.file.fileno())
+
+    def compact(self):
+        """
+        Atomically replaces the journal with a snapshot of its state.
+        """
+        if self.file is not None:
+            self.file.close()
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        size = 0
+        with open(tmp_path, 'wb') as f:
+            for record in self.state.records():
+                f.write(record)
+                size += len(record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.size = self.snapshot_size = size
+        # Unbuffered: every record reaches the operating system as it is
+        # appended, so it survives the process being killed
+        self.file = open(self.path, 'ab', buffering=0)
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        """
+        Closes and deletes the journal of a crawl that finished.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.path.unlink(missing_ok=True)
+
+
+def get_checkpoint(crawler):
+    """
+    Returns the Checkpoint of a crawler, creating it on first use, or None
+    if checkpoints are disabled.
+    """
+    settings = crawler.settings
+    if not settings.getbool('RETROGALLERY_CHECKPOINT_ENABLED') or distributed.is_enabled(settings):
+        return None
+    checkpoint = getattr(crawler, '_retrogallery_checkpoint', None)
+    if checkpoint is None:
+        checkpoint = crawler._retrogallery_checkpoint = Checkpoint.from_settings(settings, crawler.spidercls.name)
+    return checkpoint
+
+
+def remove_partial_files(state, spool_dir, spider_name):
+    """
+    Removes the images a crashed crawl left half written, with the temporary
+    files of their interrupted atomic writes (see retrogallery.fswriter and
+    retrogallery.phash), and the streaming spool files of the spider's
+    crawls. Nothing else in the image store is touched.
+
+    Returns:
+        removed (int): The number of files removed.
+    """
+    removed = 0
+    candidates = []
+    for path in state.media:
+        directory, name = os.path.split(path)
+        candidates.extend((path, os.path.join(directory, f".{name}.tmp"), os.path.join(directory, f".{name}.link")))
+    if spool_dir and os.path.isdir(spool_dir):
+        prefix = streaming.spool_prefix(spider_name)
+        candidates.extend(entry.path for entry in os.scandir(spool_dir) if entry.name.startswith(prefix))
+    for path in candidates:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            continue
+        logger.debug(f"Removed partial file {path}")
+        removed += 1
+    return removed
+
+
+class CheckpointMiddleware:
+    """
+    Spider middleware that journals the frontier, completed pages and items
+    of a crawl, and resumes a crawl from its journal. See the module
+    docstring.
+
+    A page is only done once its callback has finished and every item it
+    yielded has completed, failed or been dropped, so the items of a page
+    are never lost between a crash and the resumed crawl.
+    """
+
+    def __init__(self, crawler, checkpoint, interval):
+        self.crawler = crawler
+        self.checkpoint = checkpoint
+        self.interval = interval
+        self.stats = crawler.stats
+        self.fingerprinter = crawler.request_fingerprinter
+        self.task = None
+        # fingerprint -> outstanding items, for pages whose callback is
+        # running and pages whose callback finished before their items
+        self.running = {}
+        self.waiting = {}
+        # id(item) -> (page fingerprint, item ID)
+        self.items = {}
+        self._scheduled = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        checkpoint = get_checkpoint(crawler)
+        if checkpoint is None:
+            raise NotConfigured
+        s = cls(crawler, checkpoint, crawler.settings.getfloat('RETROGALLERY_CHECKPOINT_INTERVAL', DEFAULT_INTERVAL))
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.request_scheduled, signal=signals.request_scheduled)
+        crawler.signals.connect(s.request_dropped, signal=signals.request_dropped)
+        crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(s.item_finished, signal=signals.item_dropped)
+        crawler.signals.connect(s.item_finished, signal=signals.item_error)
+        return s
+
+    def fingerprint(self, request):
+        return self.fingerprinter.fingerprint(request)
+
+    def process_start_requests(self, start_requests, spider):
+        if not (self.checkpoint.resume and self.checkpoint.state):
+            yield from start_requests
+            return
+        # The journaled frontier replaces the start requests
+        for request in self.checkpoint.pending_requests():
+            self.stats.inc_value('checkpoint/pages_resumed', spider=spider)
+            yield request_from_dict(request, spider=spider)
+
+    def process_spider_output(self, response, result, spider):
+        fp = self.fingerprint(response.request)
+        self.running.setdefault(fp, 0)
+        try:
+            for i in result:
+                if is_item(i):
+                    item = item_id(i, spider.name)
+                    if item in self.checkpoint.state.items:
+                        self.stats.inc_value('checkpoint/items_skipped', spider=spider)
+                        continue
+                    self.items[id(i)] = (fp, item)
+                    self.running[fp] += 1
+                yield i
+        finally:
+            self._callback_finished(fp)
+
+    def process_spider_exception(self, response, exception, spider):
+        # Requests rejected before their callback ran (e.g. HTTP errors)
+        self._callback_finished(self.fingerprint(response.request))
+        return None
+
+    def _callback_finished(self, fp):
+        if fp in self.waiting:
+            return
+        outstanding = self.running.pop(fp, 0)
+        if outstanding:
+            self.waiting[fp] = outstanding
+        else:
+            self.checkpoint.page_done(fp)
+
+    def _item_finished(self, fp):
+        if fp in self.running:
+            self.running[fp] -= 1
+        elif fp in self.waiting:
+            self.waiting[fp] -= 1
+            if not self.waiting[fp]:
+                del self.waiting[fp]
+                self.checkpoint.page_done(fp)
+
+    def request_scheduled(self, request, spider):
+        fp = self.fingerprint(request)
+        previous = request.meta.get(FINGERPRINT_META_KEY)
+        if previous == fp:
+            # A retry of a journaled request
+            self._scheduled = None
+            return
+        request.meta[FINGERPRINT_META_KEY] = fp
+        journaled = self.checkpoint.request_scheduled(fp, request.to_dict(spider=spider))
+        self._scheduled = request if journaled else None
+        # A redirect replaces the request it was made from
+        if previous is not None and 'redirect_urls' in request.meta:
+            self.checkpoint.page_done(previous)
+
+    def request_dropped(self, request, spider):
+        # request_dropped is sent straight after request_scheduled; only a
+        # request journaled by that call is marked done, not an identical
+        # request that is still pending
+        if request is self._scheduled:
+            self.checkpoint.page_done(self.fingerprint(request))
+        self._scheduled = None
+
+    def item_scraped(self, item, response, spider):
+        entry = self.items.pop(id(item), None)
+        if entry is not None:
+            fp, item_id = entry
+            self.checkpoint.item_completed(item_id)
+            self._item_finished(fp)
+
+    def item_finished(self, item, response, spider):
+        entry = self.items.pop(id(item), None)
+        if entry is not None:
+            self._item_finished(entry[0])
+
+    def spider_opened(self, spider):
+        from twisted.internet import task
+
+        state = self.checkpoint.state
+        if self.checkpoint.resume:
+            settings = self.crawler.settings
+            removed = remove_partial_files(state, streaming.default_spool_dir(settings), spider.name)
+            state.media.clear()
+            self.checkpoint.compact()
+            self.stats.set_value('checkpoint/partial_files_removed', removed, spider=spider)
+            # Pages parsed before the crash are not fetched again
+            dupefilter = self.crawler.engine.slot.scheduler.df
+            if hasattr(dupefilter, 'fingerprints'):
+                dupefilter.fingerprints.update(fp.hex() for fp in state.done)
+            logger.info(
+                f"Resuming {spider.name} from {self.checkpoint.path}: {len(state.pending)} pages pending, "
+                f"{len(state.done)} pages and {len(state.items)} items done, {removed} partial files removed"
+            )
+        self.task = task.LoopingCall(self.checkpoint.sync)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        if reason == 'finished':
+            # Nothing is left to resume
+            self.checkpoint.remove()
+        else:
+            self.checkpoint.close()
+
+
+def main(argv=None):
+    from scrapy.utils.project import get_project_settings
+
+    settings = get_project_settings()
+    parser = argparse.ArgumentParser(
+        prog='python -m retrogallery.checkpoint',
+        description='Resume, inspect and clean up after checkpointed retrogallery crawls.'
+    )
+    parser.add_argument('--dir', default=settings.get('RETROGALLERY_CHECKPOINT_DIR', DEFAULT_CHECKPOINT_DIR),
+                        help='checkpoint directory (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('crawl', help='crawl the given spiders, checkpointing as they go')
+    command.add_argument('spiders', nargs='+')
+    command.add_argument('--resume', action='store_true', help='resume each spider from its journal')
+    commands.add_parser('status', help='summarise the journal of a spider').add_argument('spider')
+    commands.add_parser('clean', help='remove the partial files a crashed crawl left behind').add_argument('spider')
+    args = parser.parse_args(argv)
+    settings.set('RETROGALLERY_CHECKPOINT_DIR', args.dir, priority='cmdline')
+
+    if args.command == 'crawl':
+        from scrapy.crawler import CrawlerProcess
+
+        settings.set('RETROGALLERY_CHECKPOINT_ENABLED', True, priority='cmdline')
+        settings.set('RETROGALLERY_CHECKPOINT_RESUME', args.resume, priority='cmdline')
+        process = CrawlerProcess(settings)
+        for spider in args.spiders:
+            process.crawl(spider)
+        process.start()
+        return 0
+
+    path = journal_path(settings, args.spider)
+    if not path.exists():
+        print(f"No checkpoint journal at {path}", file=sys.stderr)
+        return 1
+    state = CheckpointState.load(path)
+    if args.command == 'status':
+        print(f"journal: {path} ({path.stat().st_size} bytes)")
+        print(f"pages pending: {len(state.pending)}")
+        print(f"pages done: {len(state.done)}")
+        print(f"items done: {len(state.items)}")
+        print(f"images unfinished: {len(state.media)}")
+    elif args.command == 'clean':
+        removed = remove_partial_files(state, streaming.default_spool_dir(settings), args.spider)
+        print(f"Removed {removed} partial files")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
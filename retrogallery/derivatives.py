@@ -0,0 +1,237 @@
+"""
+Renders image derivatives (thumbnails and resized copies) in a pool of
+worker processes.
+
+ImagesPipeline decodes, resizes and re-encodes every image with Pillow on
+the reactor thread, which stalls every other download and parse while it
+runs. DerivativePool ships that work to a bounded ProcessPoolExecutor and
+returns a Deferred that fires on the reactor thread when the job is done.
+At most max_pending jobs are handed to the pool at once; further jobs wait
+on a DeferredSemaphore, and because the pipeline does not complete an item
+until its derivatives are rendered, a full pool slows the crawl down rather
+than queueing unbounded work.
+
+Derivatives are configured as a dict of name -> spec:
+
+    RETROGALLERYLOCALPIPELINE_DERIVATIVES = {
+        "small": {"size": (320, 320), "format": "WEBP", "quality": 80},
+        "medium": {"size": (1024, 1024), "format": "JPEG", "quality": 85},
+    }
+
+AVIF output requires the pillow-avif-plugin package.
+"""
+
+import logging
+import multiprocessing
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import suppress
+from io import BytesIO
+
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
+
+
+logger = logging.getLogger(__name__)
+
+
+DerivativeSpec = namedtuple('DerivativeSpec', ['name', 'size', 'format', 'quality'])
+DerivativeSpec.__doc__ = """
+A derivative to render from each downloaded image.
+
+    name (str): The derivative name, used in its path.
+    size (tuple[int, int]): The bounding box; aspect ratio is preserved.
+    format (str): The Pillow output format, e.g. JPEG, WEBP, AVIF.
+    quality (int): The encoder quality, or None for the encoder default.
+"""
+
+EXTENSIONS = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'WEBP': '.webp',
+    'AVIF': '.avif',
+    'GIF': '.gif',
+}
+
+CONTENT_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    'AVIF': 'image/avif',
+    'GIF': 'image/gif',
+}
+
+# Formats that cannot store an alpha channel
+_OPAQUE_FORMATS = ('JPEG',)
+
+
+def _register_plugins():
+    from PIL import Image
+
+    # AVIF support is provided by an optional Pillow plugin
+    with suppress(ImportError):
+        import pillow_avif  # noqa: F401
+    Image.init()
+
+
+def parse_specs(derivatives, thumbs=None):
+    """
+    Builds derivative specs from the RETROGALLERYLOCALPIPELINE_DERIVATIVES
+    setting and, optionally, the stock IMAGES_THUMBS setting (rendered as
+    JPEG, as ImagesPipeline does).
+
+    Parameters:
+        derivatives (dict): name -> {"size": (w, h), "format": str,
+        "quality": int}.
+        thumbs (dict): thumb_id -> (w, h).
+
+    Returns:
+        specs (list[DerivativeSpec]): The specs, thumbs first. Specs in a
+        format the installed Pillow cannot write are skipped with a warning.
+    """
+    from PIL import Image
+
+    _register_plugins()
+    specs = [
+        DerivativeSpec(thumb_id, tuple(size), 'JPEG', None)
+        for thumb_id, size in (thumbs or {}).items()
+    ]
+    for name, options in (derivatives or {}).items():
+        image_format = options.get('format', 'JPEG').upper()
+        if image_format not in Image.SAVE:
+            logger.warning(f"Skipping derivative {name}: Pillow cannot write {image_format}")
+            continue
+        specs.append(DerivativeSpec(
+            name,
+            tuple(options['size']),
+            image_format,
+            options.get('quality'),
+        ))
+    return specs
+
+
+def render(source, specs, min_width=0, min_height=0):
+    """
+    Decodes an image once and renders every derivative from it. Runs in a
+    worker process.
+
+    Parameters:
+        source (str or bytes): The path of the image file, or its bytes.
+        specs (list[DerivativeSpec]): The derivatives to render.
+        min_width (int): Reject images narrower than this.
+        min_height (int): Reject images shorter than this.
+
+    Returns:
+        ((width, height), outputs): The original dimensions and a list of
+        (name, data, (width, height)) tuples, one per spec.
+    """
+    from PIL import Image
+
+    _register_plugins()
+    image = Image.open(source if isinstance(source, str) else BytesIO(source))
+    width, height = image.size
+    if width < min_width or height < min_height:
+        raise ValueError(f"Image too small ({width}x{height} < {min_width}x{min_height})")
+    if not specs:
+        return (width, height), []
+    # Let the JPEG decoder downscale by a power of two while decoding when
+    # the largest derivative is much smaller than the original
+    image.draft('RGB', (max(s.size[0] for s in specs), max(s.size[1] for s in specs)))
+    image.load()
+
+    outputs = []
+    for spec in specs:
+        derivative = image.copy()
+        derivative.thumbnail(spec.size, Image.Resampling.LANCZOS)
+        if spec.format in _OPAQUE_FORMATS and derivative.mode != 'RGB':
+            # Flatten any transparency onto white, as ImagesPipeline does
+            derivative = derivative.convert('RGBA')
+            background = Image.new('RGBA', derivative.size, (255, 255, 255))
+            background.paste(derivative, derivative)
+            derivative = background.convert('RGB')
+        elif derivative.mode not in ('RGB', 'RGBA'):
+            derivative = derivative.convert('RGBA')
+        buf = BytesIO()
+        options = {'quality': spec.quality} if spec.quality else {}
+        derivative.save(buf, spec.format, **options)
+        outputs.append((spec.name, buf.getvalue(), derivative.size))
+    return (width, height), outputs
+
+
+class DerivativePool:
+    """
+    A bounded pool of worker processes rendering derivatives.
+
+    Parameters:
+        max_workers (int): The number of worker processes, None for the
+        number of CPUs, or 0 to render inline on the calling thread.
+        max_pending (int): The number of jobs handed to the pool at once.
+    """
+
+    def __init__(self, max_workers=None, max_pending=32):
+        self.max_workers = os.cpu_count() if max_workers is None else max_workers
+        self._semaphore = defer.DeferredSemaphore(max_pending)
+        self._executor = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        workers = settings.get('RETROGALLERY_DERIVATIVES_WORKERS')
+        return cls(
+            max_workers=None if workers is None else int(workers),
+            max_pending=settings.getint('RETROGALLERY_DERIVATIVES_MAX_PENDING', 32),
+        )
+
+    @property
+    def pending(self):
+        """
+        The number of jobs waiting for a free slot in the pool.
+        """
+        return len(self._semaphore.waiting)
+
+    def submit(self, source, specs, min_width=0, min_height=0):
+        """
+        Queues a render() job.
+
+        Returns:
+            Deferred: Fires with the render() result on the reactor thread.
+        """
+        return self._semaphore.run(self._submit, source, specs, min_width, min_height)
+
+    def _submit(self, *args):
+        if not self.max_workers:
+            return defer.maybeDeferred(render, *args)
+        if self._executor is None:
+            # Forking a process with a running reactor is unsafe, so workers
+            # are started fresh
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        from twisted.internet import reactor
+
+        dfd = defer.Deferred()
+        future = self._executor.submit(render, *args)
+
+        def _fire(future):
+            exception = future.exception()
+            if exception is not None:
+                dfd.errback(Failure(exception))
+            else:
+                dfd.callback(future.result())
+
+        future.add_done_callback(lambda f: reactor.callFromThread(_fire, f))
+        return dfd
+
+    def close(self):
+        """
+        Shuts the worker processes down, waiting for them to exit in a
+        thread so the reactor is not blocked meanwhile.
+
+        Returns:
+            Deferred: Fires once the workers have exited.
+        """
+        executor, self._executor = self._executor, None
+        if executor is None:
+            return defer.succeed(None)
+        return threads.deferToThread(executor.shutdown, wait=True, cancel_futures=True)
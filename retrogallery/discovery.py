@@ -0,0 +1,377 @@
+"""
+Finds galleries and their images through WordPress's own indexes rather
+than by scraping menus and category pages.
+
+Both sites are WordPress. OldCrapGallerySpider finds galleries in a sidebar
+menu and NostalgiaNerdGallerySpider on a category page, then fetches and
+parses every gallery page for its images. WordPressDiscoveryMixin adds two
+other ways in, chosen by RETROGALLERY_DISCOVERY:
+
+    rest     pages through /wp-json/wp/v2/posts (restricted to the spider's
+             discovery_category, if it has one), 100 posts per request, and
+             for each page of posts through /wp-json/wp/v2/media?parent=...,
+             100 images per request. Every image comes with its original
+             file URL, dimensions and resized copies, so ImageItems are
+             yielded straight from the JSON without fetching a gallery page.
+             Posts with no attached images (their images are inline, on a
+             CDN or attached to another post) are parsed from their gallery
+             pages instead.
+    sitemap  reads the posts listed in the WordPress sitemap (wp-sitemap.xml)
+             and parses each as a gallery page.
+    html     the spider's own start_urls and parse() (the default).
+
+A spider given gallery_urls (e.g. scrapy crawl OldCrapGallerySpider -a
+gallery_urls=<url>,<url>, or a job of retrogallery.service) skips discovery
+and parses just those gallery pages, for targeted re-crawls.
+
+Either index also finds galleries that the menus miss. If the REST API is
+disabled (or answers with something other than JSON), discovery falls back
+to the sitemap, and if that fails too, to the spider's HTML parsing. Spiders
+with a discovery_category skip the sitemap, which does not say which
+category a post is in.
+
+Images from the REST API are titled by their alt text or caption (see
+retrogallery.titles), and their URL is chosen from the original and its
+resized copies by RETROGALLERY_IMAGE_VARIANT_POLICY.
+
+REST discovery does not lay out the image store as HTML and sitemap
+discovery do. The media route says nothing of the headings an image sits
+under on its gallery page, so an image with neither alt text nor caption is
+titled after its gallery, where parse_gallery() would title it after its
+headings (e.g. "Part 1 Section 1 Detail 1"). And its URL is the origin's
+file (source_url), not the Photon CDN URL of the gallery markup, so its file
+name, the hash of its URL (see retrogallery.urls), differs too. Keep to one
+discovery mode per image store: a store crawled both ways holds the images
+of a gallery twice, under different paths.
+"""
+
+import html
+from urllib.parse import urlencode, urlparse
+
+import scrapy
+from scrapy.utils.sitemap import Sitemap
+from w3lib.html import remove_tags
+
+from retrogallery import titles, utils, variants
+from retrogallery.items import ImageItem
+
+
+HTML = 'html'
+SITEMAP = 'sitemap'
+REST = 'rest'
+DISCOVERY_MODES = (HTML, SITEMAP, REST)
+
+# The most entries WordPress returns per REST API request
+PER_PAGE = 100
+
+# The fields requested of each route, to keep responses small
+POST_FIELDS = 'id,link,title'
+MEDIA_FIELDS = 'id,post,mime_type,source_url,alt_text,caption,media_details'
+
+SITEMAP_INDEX = '/wp-sitemap.xml'
+# The sub-sitemaps of a sitemap index that list posts: WordPress core's
+# wp-sitemap-posts-post-N.xml, or Yoast's post-sitemap.xml
+SITEMAP_FOLLOW = ('-posts-post-', '/post-sitemap')
+
+
+def site_root(url):
+    """
+    Returns the scheme and host of url, e.g. https://www.nostalgianerd.com.
+    """
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+
+def rest_url(site, route, params):
+    """
+    Returns the URL of a WordPress REST API route, e.g.
+    rest_url('https://oldcrap.org', 'posts', {'page': 2})
+    -> https://oldcrap.org/wp-json/wp/v2/posts?page=2
+    """
+    return f"{site}/wp-json/wp/v2/{route}?{urlencode(params)}"
+
+
+def media_attributes(media):
+    """
+    Returns the img attributes (see retrogallery.variants) describing a
+    REST API media entry: its original file and size, and its resized
+    copies as a srcset.
+    """
+    details = media.get('media_details') or {}
+    attributes = {'data-orig-file': media['source_url']}
+    if details.get('width') and details.get('height'):
+        attributes['data-orig-size'] = f"{details['width']},{details['height']}"
+    srcset = [
+        f"{size['source_url']} {size['width']}w"
+        for size in (details.get('sizes') or {}).values()
+        if size.get('source_url') and size.get('width')
+    ]
+    if srcset:
+        attributes['srcset'] = ', '.join(srcset)
+    return attributes
+
+
+def media_alt(media):
+    """
+    Returns the alt text of a REST API media entry, or its caption if it
+    has none, or None.
+    """
+    caption = (media.get('caption') or {}).get('rendered') or ''
+    alt = media.get('alt_text') or html.unescape(remove_tags(caption)).strip()
+    return alt or None
+
+
+def rendered(field):
+    return html.unescape((field or {}).get('rendered') or '').strip()
+
+
+class WordPressDiscoveryMixin:
+    """
+    Spider mixin that discovers galleries through the REST API or sitemap
+    of a WordPress site (see the module docstring). The site is the scheme
+    and host of the spider's first start URL.
+
+    Spiders using it must have a parse_gallery() callback taking the
+    gallery_title and gallery_url from response.meta.
+    """
+
+    # The slug of the category whose posts are galleries; None if every
+    # post is a gallery
+    discovery_category = None
+    # Gallery pages to crawl instead of discovering galleries: a list, or a
+    # comma-separated string from scrapy crawl -a gallery_urls=...
+    gallery_urls = None
+
+    def start_requests(self):
+        if self.gallery_urls:
+            urls = self.gallery_urls.split(',') if isinstance(self.gallery_urls, str) else self.gallery_urls
+            return (self._gallery_request(url.strip()) for url in urls if url.strip())
+        mode = self.settings.get('RETROGALLERY_DISCOVERY') or HTML
+        if mode not in DISCOVERY_MODES:
+            raise ValueError(f"Unknown discovery mode {mode!r}")
+        if mode == REST:
+            # The media pages still to handle of each page of posts, and the
+            # posts they had images of (see _media_page_done())
+            self._rest_media_batches = {}
+            return self._rest_requests()
+        if mode == SITEMAP:
+            if not self.discovery_category:
+                return self._sitemap_requests()
+            self.logger.info("The sitemap does not say which category a post is in, using HTML discovery")
+        return super().start_requests()
+
+    @property
+    def discovery_site(self):
+        return site_root(self.start_urls[0])
+
+    def _rest_requests(self):
+        if self.discovery_category:
+            params = {'slug': self.discovery_category, '_fields': 'id'}
+            yield scrapy.Request(
+                rest_url(self.discovery_site, 'categories', params),
+                self.parse_rest_categories,
+                errback=self.discovery_failed,
+                meta={'discovery': REST, 'discovery_fallback': True},
+            )
+        else:
+            yield self._rest_page('posts', {'_fields': POST_FIELDS}, self.parse_rest_posts, fallback=True)
+
+    def _rest_page(self, route, params, callback, page=1, fallback=False, **meta):
+        params = dict(params, per_page=PER_PAGE, page=page)
+        return scrapy.Request(
+            rest_url(self.discovery_site, route, params),
+            callback,
+            errback=self.discovery_failed,
+            meta=dict(meta, discovery=REST, discovery_fallback=fallback, discovery_params=params),
+        )
+
+    def _next_rest_pages(self, response, route, callback, **meta):
+        """
+        Yields the requests for the remaining pages of a REST API collection
+        once its first page has been fetched.
+        """
+        params = response.meta['discovery_params']
+        if params['page'] != 1:
+            return
+        total_pages = int(response.headers.get('X-WP-TotalPages', b'1'))
+        for page in range(2, total_pages + 1):
+            yield self._rest_page(route, params, callback, page=page, **meta)
+
+    def _json(self, response):
+        """
+        Returns the decoded JSON of a REST API response, or None if it is
+        not JSON (e.g. the API is disabled and the site answers with HTML).
+        """
+        try:
+            return response.json()
+        except (AttributeError, ValueError):
+            return None
+
+    def parse_rest_categories(self, response):
+        categories = self._json(response)
+        if not categories:
+            self.logger.warning("No %s category in %s", self.discovery_category, response.url)
+            yield from self.discovery_fallback(REST)
+            return
+        params = {'categories': ','.join(str(category['id']) for category in categories), '_fields': POST_FIELDS}
+        yield self._rest_page('posts', params, self.parse_rest_posts, fallback=True)
+
+    def parse_rest_posts(self, response):
+        """
+        Parses a page of posts, each a gallery, and requests the images
+        attached to them.
+        """
+        posts = self._json(response)
+        if posts is None:
+            if response.meta.get('discovery_fallback'):
+                yield from self.discovery_fallback(REST)
+            else:
+                self.logger.error("Not a REST API response: %s", response.url)
+            return
+        yield from self._next_rest_pages(response, 'posts', self.parse_rest_posts)
+        galleries = {}
+        for post in posts:
+            link = post.get('link')
+            if not link:
+                continue
+            title = rendered(post.get('title')) or utils.construct_gallery_title_from_url(link)
+            galleries[str(post['id'])] = (title, link)
+        self.crawler.stats.inc_value('discovery/rest/galleries', len(galleries), spider=self)
+        if galleries:
+            params = {'parent': ','.join(galleries), 'orderby': 'id', 'order': 'asc', '_fields': MEDIA_FIELDS}
+            yield self._rest_page('media', params, self.parse_rest_media, discovery_galleries=galleries)
+
+    def parse_rest_media(self, response):
+        """
+        Parses a page of the images attached to a page of posts into
+        ImageItems, one per image.
+        """
+        entries = self._json(response)
+        if entries is None:
+            self.logger.error("Not a REST API response: %s", response.url)
+            yield from self._media_page_done(response.meta, ())
+            return
+        galleries = response.meta['discovery_galleries']
+        yield from self._next_rest_pages(
+            response, 'media', self.parse_rest_media, discovery_galleries=galleries
+        )
+        variant_policy = self.settings.get('RETROGALLERY_IMAGE_VARIANT_POLICY', variants.DEFAULT_POLICY)
+        classifier = titles.get_classifier(self.settings)
+        posts = set()
+        for media in entries:
+            post = str(media.get('post'))
+            gallery = galleries.get(post)
+            if gallery is None or not media.get('source_url'):
+                continue
+            if not (media.get('mime_type') or 'image/').startswith('image/'):
+                continue
+            gallery_title, gallery_url = gallery
+            image_urls, image_sizes = utils.extract_images([media_attributes(media)], policy=variant_policy)
+            self.crawler.stats.inc_value('discovery/rest/images', spider=self)
+            posts.add(post)
+            yield ImageItem(
+                gallery_title=gallery_title,
+                gallery_url=gallery_url,
+                image_title=classifier.title(media_alt(media), default=gallery_title),
+                image_urls=image_urls,
+                image_sizes=image_sizes,
+            )
+        total_pages = int(response.headers.get('X-WP-TotalPages', b'1'))
+        yield from self._media_page_done(response.meta, posts, total_pages)
+
+    def _media_page_done(self, meta, posts, total_pages=1):
+        """
+        Records the posts a page of media had images of. Once every media
+        page of a page of posts is handled, yields a gallery page request
+        for each post that had none: its images are inline in the post, on
+        a CDN or attached to another post, so only its page lists them.
+
+        Parameters:
+            meta (dict): The meta of the media page request.
+            posts (set[str]): The IDs of the posts the page had images of.
+            total_pages (int): The number of media pages, as the first page
+            says; a failed first page counts as the only one.
+        """
+        key = meta['discovery_params']['parent']
+        batch = self._rest_media_batches.setdefault(key, {'pages': max(total_pages, 1), 'posts': set()})
+        batch['posts'].update(posts)
+        batch['pages'] -= 1
+        if batch['pages'] > 0:
+            return
+        del self._rest_media_batches[key]
+        galleries = meta['discovery_galleries']
+        missing = [post for post in galleries if post not in batch['posts']]
+        if not missing:
+            return
+        self.logger.info("%d posts have no attached images, parsing their gallery pages", len(missing))
+        self.crawler.stats.inc_value('discovery/rest/html_galleries', len(missing), spider=self)
+        for post in missing:
+            yield self._gallery_request(galleries[post][1])
+
+    def _sitemap_requests(self):
+        yield scrapy.Request(
+            self.discovery_site + SITEMAP_INDEX,
+            self.parse_sitemap,
+            errback=self.discovery_failed,
+            meta={'discovery': SITEMAP, 'discovery_fallback': True},
+        )
+
+    def parse_sitemap(self, response):
+        """
+        Follows the post sitemaps of a sitemap index, and requests every post
+        of a post sitemap as a gallery page.
+        """
+        try:
+            sitemap = Sitemap(response.body)
+        except ValueError:
+            sitemap = None
+        fallback = response.meta.get('discovery_fallback')
+        if sitemap is None or sitemap.type not in ('sitemapindex', 'urlset'):
+            if fallback:
+                yield from self.discovery_fallback(SITEMAP)
+            else:
+                self.logger.error("Not a sitemap: %s", response.url)
+            return
+        locs = [entry['loc'] for entry in sitemap if entry.get('loc')]
+        if sitemap.type == 'sitemapindex':
+            locs = [loc for loc in locs if any(follow in loc for follow in SITEMAP_FOLLOW)]
+            if not locs and fallback:
+                yield from self.discovery_fallback(SITEMAP)
+            for loc in locs:
+                yield scrapy.Request(loc, self.parse_sitemap, errback=self.discovery_failed,
+                                     meta={'discovery': SITEMAP})
+            return
+        self.crawler.stats.inc_value('discovery/sitemap/galleries', len(locs), spider=self)
+        for loc in locs:
+            yield self._gallery_request(loc)
+
+    def _gallery_request(self, url):
+        return scrapy.Request(url, self.parse_gallery, meta={
+            'gallery_title': utils.construct_gallery_title_from_url(url),
+            'gallery_url': url,
+        })
+
+    def discovery_failed(self, failure):
+        """
+        Errback of the discovery requests: falls back to the next way in if
+        the first request of a mode failed.
+        """
+        request = failure.request
+        self.logger.warning("Error discovering galleries from %s: %s", request.url, failure.value)
+        if request.meta.get('discovery_fallback'):
+            yield from self.discovery_fallback(request.meta['discovery'])
+        elif 'discovery_galleries' in request.meta:
+            yield from self._media_page_done(request.meta, ())
+
+    def discovery_fallback(self, mode):
+        """
+        Yields the start requests of the discovery mode to fall back to when
+        mode fails: the sitemap after the REST API, then HTML parsing.
+        """
+        self.crawler.stats.inc_value(f'discovery/{mode}/failed', spider=self)
+        if mode == REST and not self.discovery_category:
+            self.logger.info("Falling back to sitemap discovery")
+            yield from self._sitemap_requests()
+        else:
+            self.logger.info("Falling back to HTML discovery")
+            yield from super().start_requests()
@@ -0,0 +1,633 @@
+"""
+Distributed crawls: several worker processes, on one machine or many,
+sharing one crawl.
+
+Workers share, through a pluggable backend:
+
+    the frontier      gallery pages waiting to be fetched, highest priority
+                      first (SharedPriorityQueue)
+    the dupefilter    the fingerprints of every page request ever scheduled,
+                      so no two workers fetch the same page (SharedDupeFilter)
+    the seen images   every image URL a worker has claimed, with the stored
+                      result once it is downloaded (SeenImages), so an image
+                      that appears in galleries parsed by different workers
+                      is downloaded once, like ImagesPipeline does for the
+                      galleries of a single process
+
+Every worker runs the same spiders; start requests are filtered by the
+shared dupefilter (SharedStartRequestsMiddleware), so only the first worker
+to start schedules them. A
+worker whose own queue runs dry waits for more work for as long as another
+worker is busy (DistributedWorker), so the crawl finishes when the frontier
+is empty and every worker is idle.
+
+DistributedScheduler replaces Scrapy's scheduler (the SCHEDULER setting) and
+behaves exactly like it unless RETROGALLERY_DISTRIBUTED is on. The worker
+command below sets both; to run a worker with scrapy crawl instead:
+
+    SCHEDULER = "retrogallery.distributed.DistributedScheduler"
+    RETROGALLERY_DISTRIBUTED = True
+    RETROGALLERY_DISTRIBUTED_BACKEND = "retrogallery.distributed.SQLiteBackend"
+    RETROGALLERY_DISTRIBUTED_URI = "/tmp/retrogallery/distributed.sqlite3"
+    RETROGALLERY_DISTRIBUTED_CRAWL = "retrogallery"
+
+The crawl name namespaces everything in the backend, so a finished crawl
+has to be reset (or renamed) before it can run again. SQLiteBackend is a
+stand-in for a network service such as Redis: every operation is a single
+atomic SQLite statement, so any number of processes on one machine can
+share it. Workers are started, and crawls inspected and reset, with:
+
+    python -m retrogallery.distributed worker --processes 4 OldCrapGallerySpider NostalgiaNerdGallerySpider
+    python -m retrogallery.distributed stats
+    python -m retrogallery.distributed reset
+
+JOBDIR is ignored in distributed mode; the shared frontier already outlives
+the workers.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import socket
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+from scrapy import signals
+from scrapy.core.scheduler import Scheduler
+from scrapy.dupefilters import RFPDupeFilter
+from scrapy.exceptions import DontCloseSpider, NotConfigured
+from scrapy.utils.misc import create_instance, load_object
+from scrapy.utils.request import request_from_dict
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from retrogallery import urls
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_BACKEND = 'retrogallery.distributed.SQLiteBackend'
+DEFAULT_URI = '/tmp/retrogallery/distributed.sqlite3'
+DEFAULT_CRAWL = 'retrogallery'
+
+# Seconds after its last heartbeat that a worker is presumed dead
+WORKER_TIMEOUT = 60
+HEARTBEAT_INTERVAL = 5
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def is_enabled(settings):
+    return settings.getbool('RETROGALLERY_DISTRIBUTED')
+
+
+class DistributedBackend:
+    """
+    The storage shared by the workers of a distributed crawl: named
+    priority queues of opaque byte strings, named sets (which may map their
+    keys to string values) and a registry of workers. Every method must be
+    atomic across processes.
+    """
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('RETROGALLERY_DISTRIBUTED_URI', DEFAULT_URI))
+
+    def push(self, queue, data, priority=0):
+        raise NotImplementedError
+
+    def pop(self, queue):
+        """
+        Removes and returns the highest priority, oldest entry of a queue,
+        or None if the queue is empty.
+        """
+        raise NotImplementedError
+
+    def size(self, queue):
+        raise NotImplementedError
+
+    def add(self, name, key):
+        """
+        Adds a key to a set. Returns True if it was not already there.
+        """
+        raise NotImplementedError
+
+    def get(self, name, key):
+        raise NotImplementedError
+
+    def setdefault(self, name, key, value):
+        """
+        Stores value under key unless the key is already in the set, and
+        returns the value stored.
+        """
+        raise NotImplementedError
+
+    def set(self, name, key, value):
+        raise NotImplementedError
+
+    def discard(self, name, key):
+        raise NotImplementedError
+
+    def count(self, name):
+        raise NotImplementedError
+
+    def heartbeat(self, crawl, worker, busy):
+        raise NotImplementedError
+
+    def workers(self, crawl, since):
+        """
+        Returns (worker, busy, last heartbeat) for the workers of a crawl
+        heard from since a time.
+        """
+        raise NotImplementedError
+
+    def remove_worker(self, crawl, worker):
+        raise NotImplementedError
+
+    def clear(self, crawl):
+        """
+        Forgets every queue, set and worker of a crawl.
+        """
+        raise NotImplementedError
+
+    def stats(self, crawl):
+        """
+        Returns a dict of queue and set sizes of a crawl.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend(DistributedBackend):
+    """
+    A DistributedBackend in a SQLite database, for workers on one machine.
+    Names are expected to start with "{crawl}:".
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS queue_order ON queue(name, priority DESC, id);
+        CREATE TABLE IF NOT EXISTS sets (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS workers (
+            crawl TEXT NOT NULL,
+            worker TEXT NOT NULL,
+            busy INTEGER NOT NULL,
+            seen REAL NOT NULL,
+            PRIMARY KEY (crawl, worker)
+        );
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        # Autocommit: every statement is its own transaction
+        self.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def push(self, queue, data, priority=0):
+        self.conn.execute("INSERT INTO queue (name, priority, data) VALUES (?, ?, ?)", (queue, priority, data))
+
+    def pop(self, queue):
+        # fetchall() steps the statement to completion, so the delete is
+        # committed before this returns
+        rows = self.conn.execute(
+            "DELETE FROM queue WHERE id = (SELECT id FROM queue WHERE name = ? "
+            "ORDER BY priority DESC, id LIMIT 1) RETURNING data",
+            (queue,)
+        ).fetchall()
+        return rows[0][0] if rows else None
+
+    def size(self, queue):
+        return self.conn.execute("SELECT COUNT(*) FROM queue WHERE name = ?", (queue,)).fetchone()[0]
+
+    def add(self, name, key):
+        return self.conn.execute(
+            "INSERT OR IGNORE INTO sets (name, key) VALUES (?, ?)", (name, key)
+        ).rowcount == 1
+
+    def get(self, name, key):
+        row = self.conn.execute("SELECT value FROM sets WHERE name = ? AND key = ?", (name, key)).fetchone()
+        return row[0] if row else None
+
+    def setdefault(self, name, key, value):
+        return self.conn.execute(
+            "INSERT INTO sets (name, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT(name, key) DO UPDATE SET value = value RETURNING value",
+            (name, key, value)
+        ).fetchall()[0][0]
+
+    def set(self, name, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO sets (name, key, value) VALUES (?, ?, ?)", (name, key, value))
+
+    def discard(self, name, key):
+        self.conn.execute("DELETE FROM sets WHERE name = ? AND key = ?", (name, key))
+
+    def count(self, name):
+        return self.conn.execute("SELECT COUNT(*) FROM sets WHERE name = ?", (name,)).fetchone()[0]
+
+    def heartbeat(self, crawl, worker, busy):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO workers (crawl, worker, busy, seen) VALUES (?, ?, ?, ?)",
+            (crawl, worker, int(busy), time.time())
+        )
+
+    def workers(self, crawl, since):
+        return [(worker, bool(busy), seen) for worker, busy, seen in self.conn.execute(
+            "SELECT worker, busy, seen FROM workers WHERE crawl = ? AND seen >= ? ORDER BY worker",
+            (crawl, since)
+        )]
+
+    def remove_worker(self, crawl, worker):
+        self.conn.execute("DELETE FROM workers WHERE crawl = ? AND worker = ?", (crawl, worker))
+
+    def clear(self, crawl):
+        prefix = f"{crawl}:%"
+        self.conn.execute("DELETE FROM queue WHERE name LIKE ?", (prefix,))
+        self.conn.execute("DELETE FROM sets WHERE name LIKE ?", (prefix,))
+        self.conn.execute("DELETE FROM workers WHERE crawl = ?", (crawl,))
+
+    def stats(self, crawl):
+        prefix = f"{crawl}:%"
+        stats = {}
+        for name, count in self.conn.execute(
+            "SELECT name, COUNT(*) FROM queue WHERE name LIKE ? GROUP BY name", (prefix,)
+        ):
+            stats[name] = count
+        for name, count in self.conn.execute(
+            "SELECT name, COUNT(*) FROM sets WHERE name LIKE ? GROUP BY name", (prefix,)
+        ):
+            stats[name] = count
+        return stats
+
+    def close(self):
+        self.conn.close()
+
+
+def get_backend(crawler):
+    """
+    Returns the DistributedBackend of a crawler, creating it on first use.
+    """
+    backend = getattr(crawler, '_retrogallery_backend', None)
+    if backend is None:
+        backend_cls = load_object(crawler.settings.get('RETROGALLERY_DISTRIBUTED_BACKEND', DEFAULT_BACKEND))
+        backend = crawler._retrogallery_backend = create_instance(backend_cls, crawler.settings, None)
+    return backend
+
+
+def crawl_name(settings):
+    return settings.get('RETROGALLERY_DISTRIBUTED_CRAWL', DEFAULT_CRAWL)
+
+
+class SharedPriorityQueue:
+    """
+    A SCHEDULER_PRIORITY_QUEUE keeping requests in the backend, so every
+    worker pops from the same frontier.
+    """
+
+    def __init__(self, crawler, backend, name):
+        self.crawler = crawler
+        self.backend = backend
+        self.name = name
+
+    @classmethod
+    def from_crawler(cls, crawler, downstream_queue_cls=None, key='', startprios=()):
+        return cls(crawler, get_backend(crawler), f"{crawl_name(crawler.settings)}:{crawler.spider.name}:requests")
+
+    def push(self, request):
+        data = pickle.dumps(request.to_dict(spider=self.crawler.spider), protocol=4)
+        self.backend.push(self.name, data, request.priority)
+
+    def pop(self):
+        data = self.backend.pop(self.name)
+        if data is None:
+            return None
+        return request_from_dict(pickle.loads(data), spider=self.crawler.spider)
+
+    def peek(self):
+        return None
+
+    def close(self):
+        return []
+
+    def __len__(self):
+        return self.backend.size(self.name)
+
+
+class SharedDupeFilter(RFPDupeFilter):
+    """
+    A request fingerprint dupefilter whose fingerprints live in the backend.
+    """
+
+    def __init__(self, backend, name, debug=False, *, fingerprinter=None):
+        super().__init__(None, debug, fingerprinter=fingerprinter)
+        self.backend = backend
+        self.name = name
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            get_backend(crawler),
+            f"{crawl_name(crawler.settings)}:{crawler.spider.name}:seen",
+            crawler.settings.getbool('DUPEFILTER_DEBUG'),
+            fingerprinter=crawler.request_fingerprinter,
+        )
+
+    def request_seen(self, request):
+        return not self.backend.add(self.name, self.request_fingerprint(request))
+
+
+class DistributedScheduler(Scheduler):
+    """
+    Scrapy's scheduler, with the frontier and dupefilter shared through the
+    backend when RETROGALLERY_DISTRIBUTED is on. See the module docstring.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not is_enabled(crawler.settings):
+            return super().from_crawler(crawler)
+        if crawler.settings.get('JOBDIR'):
+            logger.warning("JOBDIR is ignored in distributed mode")
+        return cls(
+            dupefilter=SharedDupeFilter.from_crawler(crawler),
+            jobdir=None,
+            logunser=crawler.settings.getbool('SCHEDULER_DEBUG'),
+            stats=crawler.stats,
+            pqclass=SharedPriorityQueue,
+            dqclass=load_object(crawler.settings['SCHEDULER_DISK_QUEUE']),
+            mqclass=load_object(crawler.settings['SCHEDULER_MEMORY_QUEUE']),
+            crawler=crawler,
+        )
+
+    def next_request(self):
+        # Leave requests in the shared frontier for other workers while
+        # this worker's download slots still have page requests waiting
+        if self.backlog():
+            return None
+        return super().next_request()
+
+    def backlog(self):
+        """
+        Returns the number of page requests waiting in this worker's
+        download slots (always 0 unless distributed mode is on).
+        """
+        if not isinstance(self.mqs, SharedPriorityQueue):
+            return 0
+        downloader = self.crawler.engine.downloader
+        # HostClassDownloader slots queue pages and images separately
+        return sum(len(getattr(slot.queue, 'pages', slot.queue)) for slot in downloader.slots.values())
+
+
+class SharedStartRequestsMiddleware:
+    """
+    A spider middleware that lets the shared dupefilter filter start
+    requests (which Scrapy marks dont_filter), so only the first worker to
+    start schedules them.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not is_enabled(crawler.settings):
+            raise NotConfigured
+        return cls()
+
+    def process_start_requests(self, start_requests, spider):
+        for request in start_requests:
+            yield request.replace(dont_filter=False) if request.dont_filter else request
+
+
+class SeenImages:
+    """
+    The image URLs claimed by the workers of a crawl, shared by every
+    spider, and the stored result of each once it is downloaded. URLs are
+    keyed by their normalised form (see retrogallery.urls), so an image
+    linked as two spellings of one URL is downloaded once.
+
+    Parameters:
+        backend (DistributedBackend): The shared backend.
+        name (str): The name of the set in the backend.
+        worker (str): The ID of this worker.
+        claim_timeout (float): Seconds after which another worker's claim
+        on an image that has not arrived is taken over.
+        poll_interval (float): Seconds between checks on an image another
+        worker is downloading.
+    """
+
+    def __init__(self, backend, name, worker, claim_timeout=300, poll_interval=1.0):
+        self.backend = backend
+        self.name = name
+        self.worker = worker
+        self.claim_timeout = claim_timeout
+        self.poll_interval = poll_interval
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """
+        Returns the shared seen image set, or None when distributed mode is
+        off.
+        """
+        settings = crawler.settings
+        if not is_enabled(settings):
+            return None
+        return cls(
+            get_backend(crawler),
+            f"{crawl_name(settings)}:images",
+            worker_id(),
+            claim_timeout=settings.getfloat('RETROGALLERY_DISTRIBUTED_CLAIM_TIMEOUT', 300),
+        )
+
+    def claim(self, url):
+        """
+        Claims an image URL for this worker.
+
+        Returns:
+            Deferred: Fires with None if this worker should download the
+            image, or with the result dict (url, path, checksum) of the
+            worker that did, waiting for it if it is still downloading.
+        """
+        dfd = defer.Deferred()
+        self._poll(urls.parse_url(url).canonical, dfd)
+        return dfd
+
+    def _poll(self, url, dfd):
+        claim = json.dumps({'worker': self.worker, 'claimed': time.time()})
+        value = json.loads(self.backend.setdefault(self.name, url, claim))
+        if 'path' in value:
+            dfd.callback(value)
+        elif value['worker'] == self.worker:
+            dfd.callback(None)
+        elif time.time() - value['claimed'] > self.claim_timeout:
+            logger.debug(f"Taking over {url} from {value['worker']}")
+            self.backend.set(self.name, url, claim)
+            dfd.callback(None)
+        else:
+            from twisted.internet import reactor
+            reactor.callLater(self.poll_interval, self._poll, url, dfd)
+
+    def done(self, result, url):
+        """
+        Records the outcome of a download this worker claimed: the result
+        dict of a stored image, or a Failure, which releases the claim so
+        another worker can try. Returns result, for use as a callback.
+        """
+        key = urls.parse_url(url).canonical
+        if isinstance(result, Failure):
+            self.backend.discard(self.name, key)
+        else:
+            self.backend.set(self.name, key, json.dumps(
+                {'url': url, 'path': result['path'], 'checksum': result['checksum']}
+            ))
+        return result
+
+
+class DistributedWorker:
+    """
+    An extension that registers the worker with the backend, keeps its
+    heartbeat, and keeps an idle spider open while the shared frontier has
+    requests or another live worker is busy (and so may add some).
+    """
+
+    def __init__(self, crawler, backend, crawl):
+        self.crawler = crawler
+        self.backend = backend
+        self.crawl = crawl
+        self.worker = worker_id()
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not is_enabled(crawler.settings):
+            raise NotConfigured
+        extension = cls(crawler, get_backend(crawler), crawl_name(crawler.settings))
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        from twisted.internet import task
+
+        logger.info(f"Worker {self.worker} joined crawl {self.crawl}")
+        self.backend.heartbeat(self.crawl, self.worker, True)
+        self.task = task.LoopingCall(self.heartbeat)
+        self.task.start(HEARTBEAT_INTERVAL, now=False)
+
+    def heartbeat(self):
+        engine = self.crawler.engine
+        busy = engine is not None and engine.slot is not None and not engine.spider_is_idle()
+        self.backend.heartbeat(self.crawl, self.worker, busy)
+
+    def spider_idle(self, spider):
+        self.backend.heartbeat(self.crawl, self.worker, False)
+        if len(self.crawler.engine.slot.scheduler):
+            raise DontCloseSpider
+        busy = [
+            worker for worker, worker_busy, _ in self.backend.workers(self.crawl, time.time() - WORKER_TIMEOUT)
+            if worker_busy and worker != self.worker
+        ]
+        if busy:
+            logger.debug(f"Waiting for {len(busy)} busy worker(s)")
+            raise DontCloseSpider
+
+    def spider_closed(self, spider, reason):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.backend.remove_worker(self.crawl, self.worker)
+        logger.info(f"Worker {self.worker} left crawl {self.crawl} ({reason})")
+
+
+def _run_worker(spiders, overrides):
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    settings = get_project_settings()
+    settings.setdict(overrides, priority='cmdline')
+    process = CrawlerProcess(settings)
+    for spider in spiders:
+        process.crawl(spider)
+    process.start()
+
+
+def _setting(value):
+    key, sep, value = value.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got {key!r}")
+    return key, value
+
+
+def main(argv=None):
+    from scrapy.utils.project import get_project_settings
+
+    settings = get_project_settings()
+    parser = argparse.ArgumentParser(
+        prog='python -m retrogallery.distributed',
+        description='Run, inspect and reset retrogallery distributed crawls.'
+    )
+    parser.add_argument('--crawl', default=crawl_name(settings), help='crawl name (default: %(default)s)')
+    parser.add_argument('--uri', default=settings.get('RETROGALLERY_DISTRIBUTED_URI', DEFAULT_URI),
+                        help='backend URI (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('worker', help='start worker processes crawling the given spiders')
+    command.add_argument('spiders', nargs='+')
+    command.add_argument('--processes', type=int, default=1, help='worker processes (default: %(default)s)')
+    command.add_argument('-s', '--set', type=_setting, action='append', metavar='KEY=VALUE',
+                         help='override a Scrapy setting in every worker')
+    commands.add_parser('stats', help='show the frontier, dupefilter and seen image sizes and the workers')
+    commands.add_parser('reset', help='forget the frontier, dupefilter, seen images and workers of a crawl')
+    args = parser.parse_args(argv)
+
+    if args.command == 'worker':
+        overrides = dict(args.set or [])
+        overrides.update({
+            'SCHEDULER': 'retrogallery.distributed.DistributedScheduler',
+            'RETROGALLERY_DISTRIBUTED': True,
+            'RETROGALLERY_DISTRIBUTED_CRAWL': args.crawl,
+            'RETROGALLERY_DISTRIBUTED_URI': args.uri,
+        })
+        context = multiprocessing.get_context('spawn')
+        workers = [context.Process(target=_run_worker, args=(args.spiders, overrides)) for _ in range(args.processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return max(worker.exitcode for worker in workers)
+
+    settings.set('RETROGALLERY_DISTRIBUTED_URI', args.uri, priority='cmdline')
+    backend = create_instance(load_object(settings.get('RETROGALLERY_DISTRIBUTED_BACKEND', DEFAULT_BACKEND)), settings, None)
+    try:
+        if args.command == 'stats':
+            for name, count in sorted(backend.stats(args.crawl).items()):
+                print(f"{name}: {count}")
+            for worker, busy, seen in backend.workers(args.crawl, 0):
+                print(f"worker {worker}: {'busy' if busy else 'idle'}, last seen {time.time() - seen:.0f}s ago")
+        elif args.command == 'reset':
+            backend.clear(args.crawl)
+            print(f"Reset crawl {args.crawl}")
+    finally:
+        backend.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+"""
+Pluggable HTML extraction engines for gallery pages.
+
+The spiders describe what to extract in terms of a small engine interface
+(select by CSS, attributes, text, children, parent), so the same extraction
+code can run on:
+
+    parsel      - Scrapy's own Selectors (the default)
+    lxml        - lxml elements and precompiled XPath expressions, without
+                  building parsel Selector wrappers for every node
+    selectolax  - the lexbor HTML5 parser, if selectolax is installed
+
+The engine is chosen with the RETROGALLERY_EXTRACTION_ENGINE setting.
+
+carousels_with_headings() rebuilds the h1/h2/h3 context of each carousel on
+an oldcrap.org gallery page in a single pass over the carousels' siblings,
+instead of running several preceding-sibling XPath searches per carousel,
+which is quadratic in the length of the page.
+"""
+
+import functools
+from collections import namedtuple
+
+from scrapy.exceptions import NotConfigured
+
+
+DEFAULT_ENGINE = 'parsel'
+
+HEADING_TAGS = ('h1', 'h2', 'h3')
+CAROUSEL_SELECTOR = 'div[data-carousel-extra]'
+CAROUSEL_ATTRIBUTE = 'data-carousel-extra'
+
+
+class ParselEngine:
+    """
+    Extraction on parsel Selectors, as returned by response.css().
+    """
+
+    name = 'parsel'
+
+    def document(self, response):
+        return response.selector
+
+    def select(self, node, css):
+        return node.css(css)
+
+    def first_text(self, node, css):
+        return node.css(f"{css}::text").get()
+
+    def attributes(self, node):
+        return node.attrib
+
+    def text(self, node):
+        return node.xpath('string()').get('')
+
+    def tag(self, node):
+        tag = node.root.tag
+        return tag if isinstance(tag, str) else None
+
+    def children(self, node):
+        return node.xpath('./*')
+
+    def parent(self, node):
+        return node.xpath('..')[0]
+
+    def key(self, node):
+        return node.root
+
+
+class LxmlEngine:
+    """
+    Extraction directly on lxml elements. CSS selectors are translated to
+    XPath and compiled once per selector.
+    """
+
+    name = 'lxml'
+
+    def __init__(self):
+        import lxml.html
+
+        self._parser = lxml.html.HTMLParser(recover=True, encoding='utf8')
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _compile(css):
+        from cssselect import HTMLTranslator
+        from lxml import etree
+
+        return etree.XPath(HTMLTranslator().css_to_xpath(css))
+
+    def document(self, response):
+        from lxml import etree
+
+        return etree.fromstring(response.text.encode('utf8'), parser=self._parser)
+
+    def select(self, node, css):
+        return self._compile(css)(node)
+
+    def first_text(self, node, css):
+        nodes = self.select(node, css)
+        return nodes[0].text if nodes else None
+
+    def attributes(self, node):
+        return node.attrib
+
+    def text(self, node):
+        return ''.join(node.itertext())
+
+    def tag(self, node):
+        return node.tag if isinstance(node.tag, str) else None
+
+    def children(self, node):
+        return [child for child in node if isinstance(child.tag, str)]
+
+    def parent(self, node):
+        return node.getparent()
+
+    def key(self, node):
+        return node
+
+
+class SelectolaxEngine:
+    """
+    Extraction with selectolax's lexbor HTML5 parser.
+    """
+
+    name = 'selectolax'
+
+    def __init__(self):
+        try:
+            from selectolax.lexbor import LexborHTMLParser
+        except ImportError:
+            raise NotConfigured("The selectolax extraction engine requires selectolax")
+        self._parser = LexborHTMLParser
+
+    def document(self, response):
+        return self._parser(response.text)
+
+    def select(self, node, css):
+        return node.css(css)
+
+    def first_text(self, node, css):
+        node = node.css_first(css)
+        return node.text(deep=False) if node is not None else None
+
+    def attributes(self, node):
+        # Attributes without a value are None in selectolax and '' in lxml
+        return {name: value or '' for name, value in node.attributes.items()}
+
+    def text(self, node):
+        return node.text(deep=True)
+
+    def tag(self, node):
+        return node.tag
+
+    def children(self, node):
+        return list(node.iter())
+
+    def parent(self, node):
+        return node.parent
+
+    def key(self, node):
+        return node.mem_id
+
+
+ENGINES = {
+    ParselEngine.name: ParselEngine,
+    LxmlEngine.name: LxmlEngine,
+    SelectolaxEngine.name: SelectolaxEngine,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_engine(name=DEFAULT_ENGINE):
+    """
+    Returns the (shared) extraction engine called name.
+    """
+    try:
+        return ENGINES[name or DEFAULT_ENGINE]()
+    except KeyError:
+        raise NotConfigured(f"Unknown extraction engine {name!r}, expected one of {sorted(ENGINES)}")
+
+
+Headings = namedtuple('Headings', ['grandparent', 'parent', 'heading'])
+Headings.__doc__ = """
+The text of the headings a carousel sits under, outermost first. Missing
+headings are empty strings.
+"""
+
+
+def _walk_headings(engine, parent):
+    """
+    Walks the children of parent once, returning {carousel key: Headings}
+    for every carousel among them.
+
+    For each carousel, the heading is the nearest preceding h1, h2 or h3.
+    If that is an h3, its parent is the nearest preceding h2 and its
+    grandparent the nearest preceding h1; if it is an h2, its parent is the
+    nearest preceding h1.
+    """
+    last_h1 = last_h2 = None
+    heading = heading_tag = None
+    headings = {}
+    for child in engine.children(parent):
+        tag = engine.tag(child)
+        if tag in HEADING_TAGS:
+            heading, heading_tag = engine.text(child).strip(), tag
+            if tag == 'h1':
+                last_h1 = heading
+            elif tag == 'h2':
+                last_h2 = heading
+        elif tag == 'div' and CAROUSEL_ATTRIBUTE in engine.attributes(child):
+            grandparent_text = parent_text = ''
+            if heading_tag == 'h3' and last_h2 is not None:
+                parent_text = last_h2
+                grandparent_text = last_h1 or ''
+            elif heading_tag == 'h2':
+                parent_text = last_h1 or ''
+            headings[engine.key(child)] = Headings(grandparent_text, parent_text, heading or '')
+    return headings
+
+
+def carousels_with_headings(engine, document):
+    """
+    Yields (carousel, Headings) for every carousel in the document, in
+    document order. The siblings of the carousels are walked once per
+    parent element, so the cost is linear in the size of the page.
+    """
+    walked = {}
+    for carousel in engine.select(document, CAROUSEL_SELECTOR):
+        parent = engine.parent(carousel)
+        parent_key = engine.key(parent)
+        if parent_key not in walked:
+            walked[parent_key] = _walk_headings(engine, parent)
+        yield carousel, walked[parent_key].get(engine.key(carousel), Headings('', '', ''))
@@ -0,0 +1,373 @@
+"""
+Writes the local image store from a pool of threads, so the reactor never
+waits on the filesystem.
+
+Scrapy's FSFilesStore writes every image with a synchronous open, write and
+close on the reactor thread, after a makedirs of its gallery/title
+directory. On network storage each of those is a round trip, and small
+files make up most of a crawl. FSWriter queues the writes instead:
+
+    - jobs run in a pool of RETROGALLERYLOCALPIPELINE_WRITER_THREADS
+      threads, up to RETROGALLERYLOCALPIPELINE_WRITER_BATCH_SIZE jobs per
+      hand-off to a thread
+    - directories known to exist are cached, so makedirs runs once per
+      directory rather than once per image
+    - a write queued for a path that already has a write waiting replaces
+      it (both Deferreds fire once the newer bytes are on disk), and jobs
+      for the same path run in order, never concurrently
+    - files are written under a hidden temporary name and renamed into
+      place; with RETROGALLERYLOCALPIPELINE_WRITER_FSYNC, each file is
+      fsynced before its rename and each directory once per batch
+    - at most RETROGALLERYLOCALPIPELINE_WRITER_MAX_PENDING_BYTES of image
+      data wait to be written; beyond that, ready() holds back new
+      downloads until the queue drains (see
+      RetroGalleryLocalPipeline.media_to_download())
+
+AsyncFSFilesStore is the FSFilesStore that writes through an FSWriter; the
+blob store (retrogallery.blobstore) uses one too when it is given a writer.
+"""
+
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from scrapy.pipelines.files import FSFilesStore
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from retrogallery import streaming
+from retrogallery.metrics import NULL_METRICS
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_THREADS = 4
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_MAX_PENDING_BYTES = 64 * 1024 * 1024
+
+
+class _Job:
+    __slots__ = ('key', 'size', 'func', 'args', 'deferreds', 'coalesce', 'durable')
+
+    def __init__(self, key, size, func, args, coalesce=False, durable=False):
+        self.key = key
+        self.size = size
+        self.func = func
+        self.args = args
+        self.deferreds = []
+        # Whether a newer write to the same path can replace this job
+        self.coalesce = coalesce
+        # Whether the job puts a file in place, so its directory is synced
+        self.durable = durable
+
+
+class FSWriter:
+    """
+    A queue of filesystem jobs run by a pool of threads.
+
+    Parameters:
+        threads (int): The number of writer threads.
+        batch_size (int): The most jobs handed to a thread at once.
+        max_pending_bytes (int): The bytes of data that may wait to be
+        written before ready() applies backpressure.
+        fsync (bool): Whether to fsync files before renaming them into place,
+        and their directories after each batch.
+    """
+
+    metrics = NULL_METRICS
+
+    def __init__(self, threads=DEFAULT_THREADS, batch_size=DEFAULT_BATCH_SIZE,
+                 max_pending_bytes=DEFAULT_MAX_PENDING_BYTES, fsync=False):
+        self.threads = max(1, threads)
+        self.batch_size = max(1, batch_size)
+        self.max_pending_bytes = max_pending_bytes
+        self.fsync = fsync
+        self.pending_bytes = 0
+        # Directories known to exist; only ever added to from the writer
+        # threads, and a stale miss just costs a redundant makedirs
+        self.directories = set()
+        self._queue = deque()
+        # The queued write of each path that a newer write can replace
+        self._coalescable = {}
+        self._running_keys = set()
+        self._running_batches = 0
+        self._waiting = deque()
+        self._flushing = []
+        self._collecting = None
+        self._executor = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            threads=settings.getint('RETROGALLERYLOCALPIPELINE_WRITER_THREADS', DEFAULT_THREADS),
+            batch_size=settings.getint('RETROGALLERYLOCALPIPELINE_WRITER_BATCH_SIZE', DEFAULT_BATCH_SIZE),
+            max_pending_bytes=settings.getint(
+                'RETROGALLERYLOCALPIPELINE_WRITER_MAX_PENDING_BYTES', DEFAULT_MAX_PENDING_BYTES
+            ),
+            fsync=settings.getbool('RETROGALLERYLOCALPIPELINE_WRITER_FSYNC'),
+        )
+
+    @property
+    def pending(self):
+        """
+        The number of jobs waiting for a writer thread.
+        """
+        return len(self._queue)
+
+    def ready(self):
+        """
+        Returns a Deferred that fires once fewer than max_pending_bytes are
+        waiting to be written.
+        """
+        if self.pending_bytes < self.max_pending_bytes:
+            return defer.succeed(None)
+        dfd = defer.Deferred()
+        self._waiting.append(dfd)
+        return dfd
+
+    def write(self, path, data):
+        """
+        Queues writing data to path, replacing any write to path that is
+        still waiting.
+
+        Returns:
+            Deferred: Fires with None once the file is in place.
+        """
+        path = str(path)
+        queued = self._coalescable.get(path)
+        if queued is not None:
+            self._account(len(data) - queued.size)
+            queued.size = len(data)
+            queued.args = (path, data)
+            return self._track(queued)
+        job = _Job(path, len(data), self._write_file, (path, data), coalesce=True, durable=True)
+        self._coalescable[path] = job
+        self._account(job.size)
+        return self._submit(job)
+
+    def move(self, src, path):
+        """
+        Queues moving the file src to path, e.g. a streaming spool file into
+        the store.
+
+        Returns:
+            Deferred: Fires with None once the file is in place.
+        """
+        return self._submit(_Job(str(path), 0, self._move_file, (str(src), str(path)), durable=True))
+
+    def call(self, path, func, *args, size=0):
+        """
+        Queues func(*args) to run in a writer thread, after any job queued
+        for path before it and never at the same time as another job for
+        path. func can create directories with makedirs(). size is the
+        bytes of data the job holds, counted against max_pending_bytes.
+
+        Returns:
+            Deferred: Fires with the result of func on the reactor thread.
+        """
+        if size:
+            self._account(size)
+        return self._submit(_Job(str(path), size, func, args))
+
+    @contextmanager
+    def collect(self):
+        """
+        Collects the Deferreds of the jobs queued inside the with block, for
+        callers whose writes go through APIs that drop them (e.g. Scrapy's
+        ImagesPipeline.image_downloaded()).
+        """
+        previous, self._collecting = self._collecting, []
+        try:
+            yield self._collecting
+        finally:
+            self._collecting = previous
+
+    def flush(self):
+        """
+        Returns a Deferred that fires once every queued job has run.
+        """
+        if not self._queue and not self._running_batches:
+            return defer.succeed(None)
+        dfd = defer.Deferred()
+        self._flushing.append(dfd)
+        return dfd
+
+    def close(self):
+        """
+        Waits for the queued jobs and shuts the writer threads down.
+
+        Returns:
+            Deferred: Fires once the writer is closed.
+        """
+        def _shutdown(_):
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+        return self.flush().addBoth(_shutdown)
+
+    def makedirs(self, directory):
+        """
+        Creates directory and its parents unless they are known to exist.
+        Called from the writer threads.
+        """
+        directory = str(directory)
+        if directory in self.directories:
+            return
+        os.makedirs(directory, exist_ok=True)
+        self.directories.add(directory)
+
+    def _account(self, size):
+        self.pending_bytes += size
+        self.metrics.set('retrogallery_writer_pending_bytes', self.pending_bytes)
+        while self._waiting and self.pending_bytes < self.max_pending_bytes:
+            self._waiting.popleft().callback(None)
+
+    def _track(self, job):
+        dfd = defer.Deferred()
+        job.deferreds.append(dfd)
+        if self._collecting is not None:
+            self._collecting.append(dfd)
+        return dfd
+
+    def _submit(self, job):
+        dfd = self._track(job)
+        self._queue.append(job)
+        self._dispatch()
+        return dfd
+
+    def _dispatch(self):
+        while self._queue and self._running_batches < self.threads:
+            batch, skipped, keys = [], deque(), set()
+            while self._queue and len(batch) < self.batch_size:
+                job = self._queue.popleft()
+                # Jobs for the same path can share a batch, which runs them
+                # in order, but not run in two batches at once
+                if job.key in self._running_keys:
+                    skipped.append(job)
+                    continue
+                if job.coalesce:
+                    del self._coalescable[job.key]
+                keys.add(job.key)
+                batch.append(job)
+            self._queue.extendleft(reversed(skipped))
+            if not batch:
+                break
+            self._running_keys.update(keys)
+            self._running_batches += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='retrogallery-writer')
+            self._executor.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch):
+        from twisted.internet import reactor
+
+        results, directories = [], set()
+        for job in batch:
+            try:
+                results.append((True, job.func(*job.args)))
+            except Exception:
+                results.append((False, Failure()))
+            else:
+                if self.fsync and job.durable:
+                    directories.add(os.path.dirname(job.key))
+        for directory in directories:
+            try:
+                fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                logger.warning(f"Error syncing {directory}: {e}")
+        reactor.callFromThread(self._batch_done, batch, results)
+
+    def _batch_done(self, batch, results):
+        self._running_batches -= 1
+        for job in batch:
+            self._running_keys.discard(job.key)
+        self._account(-sum(job.size for job in batch))
+        self._dispatch()
+        for job, (ok, result) in zip(batch, results):
+            for dfd in job.deferreds:
+                if ok:
+                    dfd.callback(result)
+                else:
+                    dfd.errback(result)
+        if not self._queue and not self._running_batches:
+            flushing, self._flushing = self._flushing, []
+            for dfd in flushing:
+                dfd.callback(None)
+
+    def _write_file(self, path, data):
+        self.makedirs(os.path.dirname(path))
+        directory, name = os.path.split(path)
+        tmp_path = os.path.join(directory, f".{name}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _move_file(self, src, path):
+        self.makedirs(os.path.dirname(path))
+        if self.fsync:
+            fd = os.open(src, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        os.replace(src, path)
+
+
+class AsyncFSFilesStore(FSFilesStore):
+    """
+    A drop-in replacement for Scrapy's FSFilesStore that writes through an
+    FSWriter. persist_file(), persist_stream() and stat_file() return
+    Deferreds; use FSWriter.collect() to wait for writes made through APIs
+    that drop them.
+    """
+
+    def __init__(self, basedir, writer):
+        super().__init__(basedir)
+        self.writer = writer
+
+    def persist_file(self, path, buf, info, meta=None, headers=None):
+        return self.writer.write(self._get_filesystem_path(path), buf.getvalue())
+
+    def persist_stream(self, path, streamed, info):
+        """
+        Moves a response body that was streamed to a spool file (see
+        retrogallery.streaming) into the store.
+        """
+        dfd = self.writer.move(streamed.path, self._get_filesystem_path(path))
+
+        def _failed(failure):
+            streaming.discard(streamed)
+            return failure
+
+        return dfd.addErrback(_failed)
+
+    def stat_file(self, path, info):
+        # Queued behind any write to the same path
+        absolute_path = self._get_filesystem_path(path)
+        return self.writer.call(absolute_path, super().stat_file, path, info)
+
+
+def wait_for(writes):
+    """
+    Returns a Deferred firing with None once every Deferred in writes has
+    fired, or with the first failure.
+    """
+    if not writes:
+        return defer.succeed(None)
+    dfd = defer.DeferredList(writes, fireOnOneErrback=True, consumeErrors=True)
+
+    def _unwrap(failure):
+        failure.trap(defer.FirstError)
+        return failure.value.subFailure
+
+    return dfd.addCallbacks(lambda _: None, _unwrap)
@@ -0,0 +1,418 @@
+"""
+A bounded on-disk HTTP cache for developing the spiders and re-running the
+pipelines without touching the network.
+
+Scrapy's FilesystemCacheStorage keeps every response forever, images
+included, with one expiry for everything. RetrogalleryCacheStorage sorts
+each request into a cache class, and each class has its own byte budget,
+TTL, eviction policy and compression:
+
+    index    the start pages and category indexes, which change whenever a
+             gallery is posted: a short TTL
+    gallery  gallery posts, which rarely change once posted: a long TTL
+    image    image downloads: no TTL and the largest budget, stored
+             uncompressed (the formats are already compressed)
+
+Gallery pages are those requested with a gallery_url in their meta (see the
+spiders' parse()), images those requested by RetroGalleryLocalPipeline
+(see retrogallery.throttle.is_image_request()), and any other request is an
+index page. Once a class holds more than its max_bytes, its expired entries
+and then its least recently (lru) or least frequently (lfu) used entries
+are evicted until it is back under EVICT_TO of its budget.
+
+    HTTPCACHE_ENABLED = True
+    HTTPCACHE_STORAGE = "retrogallery.httpcache.RetrogalleryCacheStorage"
+    RETROGALLERY_HTTPCACHE_CLASSES = {
+        "index": {"ttl": 3600, "max_bytes": 64 * 1024 * 1024},
+        "gallery": {"ttl": 30 * 24 * 3600, "max_bytes": 256 * 1024 * 1024},
+        "image": {"max_bytes": 4 * 1024 * 1024 * 1024, "eviction": "lfu", "compress": False},
+    }
+
+Entries live under HTTPCACHE_DIR/<spider>/, with a SQLite index of their
+URLs, headers, sizes and use. Image downloads that were streamed to disk
+(see retrogallery.streaming) are hard linked into the cache rather than
+read into memory, and are handed back to the pipeline as spool files.
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from pathlib import Path
+
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+
+from retrogallery import streaming
+from retrogallery.resources import is_shared, shared
+from retrogallery.throttle import is_image_request
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CACHE_CLASSES = {
+    'index': {
+        'ttl': 60 * 60,
+        'max_bytes': 64 * 1024 * 1024,
+        'eviction': 'lru',
+    },
+    'gallery': {
+        'ttl': 30 * 24 * 60 * 60,
+        'max_bytes': 256 * 1024 * 1024,
+        'eviction': 'lru',
+    },
+    'image': {
+        'ttl': 0,
+        'max_bytes': 4 * 1024 * 1024 * 1024,
+        'eviction': 'lfu',
+        'compress': False,
+    },
+}
+
+# The share of its budget a class is evicted down to, so eviction runs in
+# batches rather than on every store
+EVICT_TO = 0.9
+
+# How entries are ordered for eviction, least worth keeping first
+EVICTION_ORDER = {
+    'lru': "accessed",
+    'lfu': "hits, accessed",
+}
+
+
+class CacheClass:
+    """
+    The budget and policies of a class of cached responses.
+
+    Parameters:
+        name (str): The class name, as stored in the index and used in
+        stats.
+        ttl (int): The seconds an entry stays fresh; 0 for no expiry.
+        max_bytes (int): The most bytes the class's entries may take on
+        disk; 0 for no limit.
+        eviction (str): "lru" or "lfu".
+        compress (bool): Whether to gzip the response bodies.
+    """
+
+    def __init__(self, name, ttl=0, max_bytes=0, eviction='lru', compress=True):
+        if eviction not in EVICTION_ORDER:
+            raise ValueError(f"Unknown eviction policy for cache class {name}: {eviction!r}")
+        self.name = name
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.compress = compress
+
+    def expired(self, stored, now):
+        return bool(self.ttl) and now - stored > self.ttl
+
+
+def parse_cache_classes(cache_classes, default_ttl=0):
+    """
+    Builds CacheClass objects from the RETROGALLERY_HTTPCACHE_CLASSES
+    setting, a dict of name -> CacheClass keyword arguments merged over
+    DEFAULT_CACHE_CLASSES. Classes without a ttl expire after default_ttl
+    (HTTPCACHE_EXPIRATION_SECS).
+    """
+    classes = {}
+    for name, defaults in DEFAULT_CACHE_CLASSES.items():
+        options = dict(defaults, **(cache_classes or {}).get(name, {}))
+        if 'ttl' not in (cache_classes or {}).get(name, {}) and default_ttl:
+            options['ttl'] = default_ttl
+        classes[name] = CacheClass(name, **options)
+    return classes
+
+
+def request_class(request):
+    """
+    Returns the name of the cache class of a request.
+    """
+    if is_image_request(request):
+        return 'image'
+    if 'gallery_url' in request.meta:
+        return 'gallery'
+    return 'index'
+
+
+class CacheIndex:
+    """
+    SQLite index of the cached responses of a spider.
+
+    Tables:
+        entries: one row per cached request fingerprint, with its class,
+        response URL, status and headers, the bytes its body takes on disk,
+        whether it is compressed, the body's checksums, and when it was
+        stored and last used and how often.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            class TEXT NOT NULL,
+            url TEXT NOT NULL,
+            response_url TEXT NOT NULL,
+            status INTEGER NOT NULL,
+            headers BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            compressed INTEGER NOT NULL,
+            md5 TEXT,
+            sha1 TEXT,
+            stored REAL NOT NULL,
+            accessed REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS entries_class ON entries(class, accessed);
+    """
+
+    # Commit after this many writes; the index is also committed on close.
+    COMMIT_EVERY = 100
+
+    def __init__(self, path, commit_every=None):
+        self.path = str(path)
+        self.commit_every = commit_every or self.COMMIT_EVERY
+        # Wait for other processes sharing the cache (see
+        # retrogallery.distributed) rather than failing
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.executescript(self.SCHEMA)
+        self._pending_writes = 0
+
+    def _write(self, sql, params):
+        self.conn.execute(sql, params)
+        self._pending_writes += 1
+        if self._pending_writes >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._pending_writes = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def get(self, key):
+        """
+        Returns the (class, response_url, status, headers, size, compressed,
+        md5, sha1, stored) row of an entry, or None if it is not cached.
+        """
+        return self.conn.execute(
+            "SELECT class, response_url, status, headers, size, compressed, md5, sha1, stored "
+            "FROM entries WHERE key = ?",
+            (key,)
+        ).fetchone()
+
+    def put(self, key, cache_class, url, response_url, status, headers, size, compressed, md5, sha1):
+        now = time.time()
+        self._write(
+            "INSERT OR REPLACE INTO entries "
+            "(key, class, url, response_url, status, headers, size, compressed, md5, sha1, stored, accessed, hits) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)",
+            (key, cache_class, url, response_url, status, headers, size, int(compressed), md5, sha1, now, now)
+        )
+
+    def touch(self, key):
+        self._write("UPDATE entries SET accessed = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+
+    def delete(self, key):
+        self._write("DELETE FROM entries WHERE key = ?", (key,))
+
+    def class_bytes(self, cache_class):
+        row = self.conn.execute("SELECT SUM(size) FROM entries WHERE class = ?", (cache_class,)).fetchone()
+        return row[0] or 0
+
+    def expired(self, cache_class, before):
+        """
+        Returns the (key, size) of the entries of a class stored before a
+        time.
+        """
+        return self.conn.execute(
+            "SELECT key, size FROM entries WHERE class = ? AND stored < ?",
+            (cache_class, before)
+        ).fetchall()
+
+    def least_used(self, cache_class, eviction, limit=100):
+        """
+        Returns the (key, size) of the entries of a class that an eviction
+        policy would evict first.
+        """
+        return self.conn.execute(
+            f"SELECT key, size FROM entries WHERE class = ? ORDER BY {EVICTION_ORDER[eviction]} LIMIT ?",
+            (cache_class, limit)
+        ).fetchall()
+
+
+class RetrogalleryCacheStorage:
+    """
+    A Scrapy HTTP cache storage (HTTPCACHE_STORAGE) with a byte budget, TTL
+    and eviction policy per cache class. See the module docstring.
+    """
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.classes = parse_cache_classes(
+            settings.getdict('RETROGALLERY_HTTPCACHE_CLASSES'),
+            default_ttl=settings.getint('HTTPCACHE_EXPIRATION_SECS'),
+        )
+        self.spool_dir = streaming.default_spool_dir(settings)
+        self.index = None
+        self.stats = None
+        self._class_bytes = {}
+
+    def open_spider(self, spider):
+        self._fingerprinter = spider.crawler.request_fingerprinter
+        self.stats = spider.crawler.stats
+        self.directory = Path(self.cachedir, spider.name)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # The jobs of a crawl service share one index (see
+        # retrogallery.service)
+        self.index = shared(('httpcache', str(self.directory)), lambda: CacheIndex(self.directory / 'index.sqlite3'))
+        self._class_bytes = {name: self.index.class_bytes(name) for name in self.classes}
+        logger.debug(f"Using the retrogallery cache storage in {self.directory}", extra={'spider': spider})
+
+    def close_spider(self, spider):
+        if self.index is not None:
+            if is_shared(self.index):
+                self.index.commit()
+            else:
+                self.index.close()
+            self.index = None
+
+    def retrieve_response(self, spider, request):
+        """
+        Returns the cached response to request, or None if it is not cached
+        or has expired.
+        """
+        key = self._fingerprinter.fingerprint(request).hex()
+        row = self.index.get(key)
+        if row is None:
+            return None
+        name, url, status, raw_headers, size, compressed, md5, sha1, stored = row
+        cache_class = self.classes.get(name)
+        path = self._body_path(name, key)
+        if cache_class is None or cache_class.expired(stored, time.time()) or not path.exists():
+            self._evict(name, [(key, size)])
+            return None
+        self.index.touch(key)
+        headers = Headers(headers_raw_to_dict(raw_headers))
+        flags = []
+        if request.meta.get(streaming.STREAM_META_KEY) and not compressed:
+            # Hand the body to the pipeline as a spool file, as the streaming
+            # download handler would
+            spool_path = self._spool(path)
+            request.meta[streaming.STREAMED_FILE_META_KEY] = streaming.StreamedFile(
+                spool_path, path.stat().st_size, sha1, md5
+            )
+            body, flags = b'', [streaming.STREAMED_FLAG]
+        elif compressed:
+            body = gzip.decompress(path.read_bytes())
+        else:
+            body = path.read_bytes()
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body, flags=flags)
+
+    def store_response(self, spider, request, response):
+        """
+        Stores a response, then evicts entries of its class if the class is
+        over its budget. Errors are logged, never raised, so a full or
+        read-only cache does not fail the crawl.
+        """
+        if response.status == 304:
+            # A revalidation (see IncrementalCrawlMiddleware) has no body
+            return
+        key = self._fingerprinter.fingerprint(request).hex()
+        name = request_class(request)
+        cache_class = self.classes[name]
+        path = self._body_path(name, key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            streamed = request.meta.get(streaming.STREAMED_FILE_META_KEY)
+            if streamed is not None and streaming.STREAMED_FLAG in response.flags:
+                md5, sha1 = streamed.md5, streamed.sha1
+                compressed = False
+                self._link(streamed.path, path)
+            else:
+                # deepcode ignore InsecureHash: <not used in a security context>
+                md5, sha1 = hashlib.md5(response.body).hexdigest(), hashlib.sha1(response.body).hexdigest()
+                compressed = cache_class.compress
+                body = gzip.compress(response.body, compresslevel=6) if compressed else response.body
+                tmp_path = path.with_name(f".{path.name}.tmp")
+                tmp_path.write_bytes(body)
+                os.replace(tmp_path, path)
+            size = path.stat().st_size
+        except OSError as e:
+            logger.warning(f"Error caching {request.url}: {e}")
+            return
+        previous = self.index.get(key)
+        if previous is not None:
+            # Replaced: the previous body was overwritten unless it was in
+            # another class's directory
+            if previous[0] != name:
+                self._evict(previous[0], [(key, previous[4])])
+            else:
+                self._class_bytes[name] -= previous[4]
+        self.index.put(
+            key, name, request.url, response.url, response.status,
+            headers_dict_to_raw(response.headers), size, compressed, md5, sha1
+        )
+        self._class_bytes[name] += size
+        if cache_class.max_bytes and self._class_bytes[name] > cache_class.max_bytes:
+            self._make_room(cache_class)
+
+    def _body_path(self, name, key):
+        return self.directory / name / key[:2] / key
+
+    def _link(self, src, path):
+        # The spool file is about to be moved into the image store; a hard
+        # link keeps the bytes without copying them
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        try:
+            os.link(src, tmp_path)
+        except FileExistsError:
+            os.unlink(tmp_path)
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _spool(self, path):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        spool_path = os.path.join(self.spool_dir, f"cached-{uuid.uuid4().hex}")
+        try:
+            os.link(path, spool_path)
+        except OSError:
+            shutil.copyfile(path, spool_path)
+        return spool_path
+
+    def _make_room(self, cache_class):
+        name = cache_class.name
+        if cache_class.ttl:
+            self._evict(name, self.index.expired(name, time.time() - cache_class.ttl))
+        target = cache_class.max_bytes * EVICT_TO
+        while self._class_bytes[name] > target:
+            entries = self.index.least_used(name, cache_class.eviction)
+            if not entries:
+                break
+            for key, size in entries:
+                if self._class_bytes[name] <= target:
+                    break
+                self._evict(name, [(key, size)])
+        # Other processes may share the cache
+        self._class_bytes[name] = self.index.class_bytes(name)
+
+    def _evict(self, name, entries):
+        for key, size in entries:
+            try:
+                os.unlink(self._body_path(name, key))
+            except FileNotFoundError:
+                pass
+            self.index.delete(key)
+            self._class_bytes[name] = self._class_bytes.get(name, 0) - size
+            if self.stats is not None:
+                self.stats.inc_value(f'httpcache/evicted/{name}')
@@ -2,15 +2,94 @@
 #
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/items.html
+#
+# Items are slotted dataclasses rather than dict-backed scrapy.Items, as an
+# item lives for as long as its images are in flight: a slotted record has no
+# per-instance dict, and the strings shared by every image of a gallery are
+# interned, so the items of a gallery refer to one copy of each. ItemAdapter,
+# and so the feed exports and pipelines, handle dataclasses as they do
+# scrapy.Items; a field that was never set is None (and exported as null).
+# Items can still be used like scrapy.Items: item['gallery_title'],
+# item.get('image_title'), 'images' in item.
+
+import sys
+from dataclasses import dataclass
+
+
+# The request meta key of an image request made by RetroGalleryLocalPipeline:
+# the index, in its item's image_urls, of the image it downloads. The titles
+# of the image are read from the item, rather than copied into every request.
+IMAGE_META_KEY = 'image_index'
+
+
+class _Item:
+    """
+    The dict-style access of a scrapy.Item, for the dataclass items. A
+    field set to None is treated as unset.
+    """
+
+    __slots__ = ()
+
+    # The fields whose strings are interned
+    _interned = ()
+
+    def __post_init__(self):
+        for name in self._interned:
+            value = getattr(self, name)
+            if type(value) is str:
+                setattr(self, name, sys.intern(value))
+
+    def _check_field(self, key):
+        if key not in self.__dataclass_fields__:
+            raise KeyError(f"{self.__class__.__name__} does not support field: {key}")
+
+    def __getitem__(self, key):
+        self._check_field(key)
+        value = getattr(self, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._check_field(key)
+        if key in self._interned and type(value) is str:
+            value = sys.intern(value)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__dataclass_fields__ and getattr(self, key) is not None
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in self.__dataclass_fields__ else None
+        return default if value is None else value
+
+
+@dataclass(slots=True, eq=False)
+class ImageItem(_Item):
+    spider: str = None # the name of the spider that scraped the image
+    gallery_title: str = None
+    gallery_url: str = None
+    image_title: str = None
+    image_urls: list = None # see settings.IMAGES_URLS_FIELD
+    image_sizes: list = None # the (width, height) of each of image_urls, or None
+    images: list = None # see settings.IMAGES_RESULT_FIELD
 
+    _interned = ('spider', 'gallery_title', 'gallery_url', 'image_title')
 
-import scrapy
 
+@dataclass(slots=True, eq=False)
+class GalleryItem(_Item):
+    """
+    All the images of a gallery page in one item (see
+    retrogallery.middlewares.GalleryBatchMiddleware).
+    """
+    spider: str = None # the name of the spider that scraped the gallery
+    gallery_title: str = None
+    gallery_url: str = None
+    image_titles: list = None # the image title of each of image_urls
+    image_urls: list = None # see settings.IMAGES_URLS_FIELD
+    image_sizes: list = None # the (width, height) of each of image_urls, or None
+    images: list = None # see settings.IMAGES_RESULT_FIELD
+    manifest: str = None # the path of the gallery's manifest, if stored
 
-class ImageItem(scrapy.Item):
-    spider = scrapy.Field() # the name of the spider that scraped the image
-    gallery_title = scrapy.Field()
-    gallery_url = scrapy.Field()
-    image_title = scrapy.Field()
-    image_urls = scrapy.Field() # see settings.IMAGES_URLS_FIELD
-    images = scrapy.Field() # see settings.IMAGES_RESULT_FIELD
\ No newline at end of file
+    _interned = ('spider', 'gallery_title', 'gallery_url')
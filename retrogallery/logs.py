@@ -0,0 +1,286 @@
+"""
+Logging off the reactor thread.
+
+Scrapy installs a root handler that formats and writes every log record on
+the thread that logged it, which for a crawl is the reactor thread. At high
+item rates that shows up in profiles, all the more with colour formatting.
+QueueLogging, an extension, moves the handler behind a queue:
+
+    - the root handler is replaced by a QueueHandler, which only filters a
+      record and puts it on a queue, unformatted
+    - a QueueListener thread formats the records and writes them through
+      Scrapy's handler (stderr or LOG_FILE, at LOG_LEVEL)
+    - records are formatted as LOG_FORMAT, in colour only if the handler
+      writes to a terminal (RETROGALLERY_LOG_COLOUR = "auto"), or as one JSON
+      object per line with RETROGALLERY_LOG_JSON (see JSONFormatter)
+    - RETROGALLERY_LOG_RATE_LIMITS caps the records per second below ERROR
+      that hot loggers (and their children) may log, and how many were
+      dropped is logged once a minute (see RateLimitFilter)
+
+A record's message is merged with its arguments as it is queued, on the
+thread that logged it (as logging.handlers.QueueHandler does), so arguments
+changed afterwards are logged as they were; the rest of the formatting
+happens on the listener thread. Messages should still be logged lazily,
+with %-style arguments, so that records dropped by level or rate limit
+never build theirs. Records logged before the extension is loaded (e.g.
+Scrapy's startup banner) are written as before.
+
+The extension is process-wide: every crawler of a process (see
+retrogallery.service) logs through the same queue and thread, which is
+drained when the process exits (see QueueLogging.shutdown()).
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.log import get_scrapy_root_handler
+
+try:
+    from colorlog import ColoredFormatter
+except ImportError:
+    ColoredFormatter = None
+
+
+logger = logging.getLogger(__name__)
+
+
+# The project's LOG_FORMAT, and the same in colour
+LOG_FORMAT = '%(levelname)-5s [%(asctime)s] %(name)s %(funcName)s :%(lineno)d %(message)s'
+COLOUR_FORMAT = (
+    '%(log_color)s%(levelname)-5s%(reset)s '
+    '%(yellow)s[%(asctime)s]%(reset)s'
+    '%(white)s %(name)s %(funcName)s %(bold_purple)s:%(lineno)d%(reset)s '
+    '%(log_color)s%(message)s%(reset)s'
+)
+LOG_COLOURS = {
+    'DEBUG': 'blue',
+    'INFO': 'bold_cyan',
+    'WARNING': 'red',
+    'ERROR': 'bg_bold_red',
+    'CRITICAL': 'red,bg_white',
+}
+
+# How often RateLimitFilter logs how many records it dropped, in seconds
+REPORT_INTERVAL = 60
+
+# The attributes of every LogRecord, which JSONFormatter does not repeat as
+# extra fields
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def colour_format(fmt):
+    """
+    Returns the colour version of LOG_FORMAT fmt: COLOUR_FORMAT for the
+    project's own, otherwise fmt coloured by level.
+    """
+    if fmt == LOG_FORMAT:
+        return COLOUR_FORMAT
+    return f'%(log_color)s{fmt}%(reset)s'
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats a record as one line of JSON: its time, level, logger, message,
+    source location, spider and exception, plus any extra fields logged
+    with it, e.g. logger.info("Stored %s", path, extra={'bytes': size}).
+    """
+
+    def format(self, record):
+        document = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'function': record.funcName,
+            'line': record.lineno,
+        }
+        for key, value in vars(record).items():
+            if key in _RECORD_ATTRIBUTES or key.startswith('_'):
+                continue
+            # Scrapy logs the spider or crawler object itself
+            if key == 'spider':
+                value = getattr(value, 'name', value)
+            elif key == 'crawler':
+                key, value = 'spider', getattr(getattr(value, 'spidercls', None), 'name', value)
+            document.setdefault(key, value)
+        if record.exc_info:
+            document['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            document['exception'] = record.exc_text
+        if record.stack_info:
+            document['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(document, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drops the records below ERROR of the loggers in limits, and of their
+    children, beyond a number per second (a token bucket that holds one
+    second's worth), and periodically logs how many it dropped.
+
+    Parameters:
+        limits (dict): Records per second by logger name.
+        report_interval (float): Seconds between reports of dropped records.
+    """
+
+    def __init__(self, limits, report_interval=REPORT_INTERVAL):
+        super().__init__()
+        self.limits = {name: float(rate) for name, rate in limits.items()}
+        self.report_interval = report_interval
+        self._buckets = {}
+        self._names = {}
+        self._dropped = {}
+        self._reported = time.monotonic()
+
+    def _limited(self, name):
+        """
+        Returns the logger name in limits that name is, or is a child of,
+        or None.
+        """
+        limited = self._names.get(name, False)
+        if limited is False:
+            limited = None
+            parts = name.split('.')
+            for i in range(len(parts), 0, -1):
+                if '.'.join(parts[:i]) in self.limits:
+                    limited = '.'.join(parts[:i])
+                    break
+            self._names[name] = limited
+        return limited
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR or record.name == __name__:
+            return True
+        now = time.monotonic()
+        if self._dropped and now - self._reported >= self.report_interval:
+            self._report(now)
+        name = self._limited(record.name)
+        if name is None:
+            return True
+        rate = self.limits[name]
+        tokens, last = self._buckets.get(name, (rate, now))
+        tokens = min(rate, tokens + (now - last) * rate)
+        if tokens < 1:
+            self._buckets[name] = (tokens, now)
+            self._dropped[name] = self._dropped.get(name, 0) + 1
+            return False
+        self._buckets[name] = (tokens - 1, now)
+        return True
+
+    def _report(self, now):
+        dropped, self._dropped = self._dropped, {}
+        self._reported = now
+        for name, count in sorted(dropped.items()):
+            logger.warning("Dropped %d log records from %s (limit %g/s)", count, name, self.limits[name])
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Only the message is merged here; unlike QueueHandler, the record
+        # keeps its exception for the listener's formatter (JSONFormatter
+        # logs it as a field of its own) and is not formatted twice
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+
+class QueueLogging:
+    """
+    An extension that moves Scrapy's root log handler behind a queue and a
+    writer thread. See the module docstring.
+    """
+
+    # The process-wide queue handler and listener
+    handler = None
+    listener = None
+    _lock = threading.Lock()
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('RETROGALLERY_LOG_QUEUE'):
+            raise NotConfigured
+        extension = cls(crawler.settings)
+        extension.install()
+        return extension
+
+    def formatter(self, handler):
+        """
+        Returns the formatter for handler: JSON, colour on a terminal, or
+        plain LOG_FORMAT.
+        """
+        settings = self.settings
+        if settings.getbool('RETROGALLERY_LOG_JSON'):
+            return JSONFormatter()
+        fmt, datefmt = settings.get('LOG_FORMAT'), settings.get('LOG_DATEFORMAT')
+        colour = str(settings.get('RETROGALLERY_LOG_COLOUR', 'auto')).lower()
+        if colour == 'auto':
+            stream = getattr(handler, 'stream', None)
+            use_colour = bool(stream is not None and hasattr(stream, 'isatty') and stream.isatty())
+        else:
+            use_colour = settings.getbool('RETROGALLERY_LOG_COLOUR')
+        if use_colour and ColoredFormatter is not None:
+            return ColoredFormatter(colour_format(fmt), datefmt=datefmt, log_colors=LOG_COLOURS)
+        return logging.Formatter(fmt, datefmt=datefmt)
+
+    def install(self):
+        """
+        Replaces Scrapy's root handler with the queue handler, starting the
+        listener thread on first use.
+        """
+        target = get_scrapy_root_handler()
+        if target is None:
+            # Logging is not configured by Scrapy (e.g. a CrawlerRunner
+            # embedded in another application)
+            return
+        with self._lock:
+            root = logging.getLogger()
+            if QueueLogging.listener is None:
+                target.setFormatter(self.formatter(target))
+                records = queue.SimpleQueue()
+                handler = _QueueHandler(records)
+                handler.setLevel(target.level)
+                limits = self.settings.getdict('RETROGALLERY_LOG_RATE_LIMITS')
+                if limits:
+                    handler.addFilter(RateLimitFilter(limits))
+                listener = logging.handlers.QueueListener(records, target, respect_handler_level=True)
+                listener.start()
+                atexit.register(QueueLogging.shutdown)
+                QueueLogging.handler, QueueLogging.listener = handler, listener
+            # Every crawler reinstalls Scrapy's handler; records go through
+            # the queue (and the first crawler's handler) all the same
+            if target in root.handlers:
+                root.removeHandler(target)
+            if QueueLogging.handler not in root.handlers:
+                root.addHandler(QueueLogging.handler)
+
+    @classmethod
+    def shutdown(cls):
+        """
+        Writes the records still queued and stops the listener thread, at
+        exit. Records logged afterwards are written by Scrapy's handler on
+        the thread that logs them again.
+        """
+        with cls._lock:
+            listener, handler = cls.listener, cls.handler
+            if listener is None:
+                return
+            cls.handler = cls.listener = None
+            root = logging.getLogger()
+            root.removeHandler(handler)
+            listener.stop()
+            target = get_scrapy_root_handler()
+            if target is not None and target not in root.handlers:
+                root.addHandler(target)
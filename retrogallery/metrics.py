@@ -0,0 +1,355 @@
+"""
+Crawl metrics: where a crawl spends its time.
+
+A Metrics registry holds counters, gauges and latency histograms. It is
+shared by everything that runs in a crawl (see get_metrics()):
+
+    RetrogallerySpiderMiddleware     time in each spider callback and what
+                                     each callback returns
+    RetrogalleryDownloaderMiddleware download latency, responses and bytes
+                                     transferred per domain
+    RetroGalleryLocalPipeline        time in get_media_requests, file_path
+                                     and item_completed
+    MetricsExporter                  queue depths (scheduler, downloader,
+                                     scraper), sampled periodically
+
+MetricsExporter serves the registry in the Prometheus text format at
+http://127.0.0.1:9410/metrics (and as JSON at /stats.json), and
+periodically writes it, with the Scrapy stats, to a JSON file. Neither is
+done unless a port or a dump file is set:
+
+    RETROGALLERY_METRICS_ENABLED = True
+    RETROGALLERY_METRICS_HOST = "127.0.0.1"
+    RETROGALLERY_METRICS_PORT = 9410     # 0 (the default) disables the HTTP endpoint
+    RETROGALLERY_METRICS_DUMP = "/tmp/retrogallery/metrics.json"
+    RETROGALLERY_METRICS_INTERVAL = 30   # seconds
+
+Everything is updated on the reactor thread, so the registry takes no
+locks.
+"""
+
+import json
+import logging
+import math
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+
+logger = logging.getLogger(__name__)
+
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, math.inf)
+
+
+class Histogram:
+    """
+    Counts observations into BUCKETS, keeping their count, sum and maximum.
+    """
+
+    __slots__ = ('count', 'sum', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+
+    def quantile(self, q):
+        """
+        Estimates the q-th quantile (0-1) as the upper bound of the bucket
+        it falls in.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+        }
+
+
+def _key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _bound(bound):
+    return '+Inf' if bound == math.inf else repr(bound)
+
+
+class Metrics:
+    """
+    A registry of labelled counters, gauges and histograms.
+
+    Example:
+        metrics.inc('retrogallery_responses_total', domain='oldcrap.org', status=200)
+        with metrics.time('retrogallery_pipeline_stage_seconds', stage='file_path'):
+            ...
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def time(self, name, **labels):
+        """
+        Observes the time spent in the with block, in seconds.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render_prometheus(self):
+        """
+        Returns the registry in the Prometheus text exposition format.
+        """
+        lines = []
+        for kind, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+            for name in sorted({name for name, _ in metrics}):
+                lines.append(f'# TYPE {name} {kind}')
+                for (metric, labels), value in sorted(metrics.items()):
+                    if metric == name:
+                        lines.append(f'{name}{_labels(labels)} {value}')
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f'# TYPE {name} histogram')
+            for (metric, labels), histogram in sorted(self.histograms.items(), key=lambda i: i[0]):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.buckets):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(labels, le=_bound(bound))} {cumulative}')
+                lines.append(f'{name}_sum{_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        Returns the registry as a JSON-serialisable dict of
+        name -> [{"labels": {...}, "value": ...}].
+        """
+        snapshot = {}
+        for metrics in (self.counters, self.gauges):
+            for (name, labels), value in sorted(metrics.items()):
+                snapshot.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda i: i[0]):
+            snapshot.setdefault(name, []).append({'labels': dict(labels), 'value': histogram.to_dict()})
+        return snapshot
+
+
+class NullMetrics(Metrics):
+    """
+    A registry that records nothing, used when metrics are disabled.
+    """
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def time(self, name, **labels):
+        return nullcontext()
+
+
+NULL_METRICS = NullMetrics()
+
+
+def get_metrics(crawler):
+    """
+    Returns the Metrics registry of a crawler, creating it on first use, or
+    NULL_METRICS if RETROGALLERY_METRICS_ENABLED is off.
+    """
+    if crawler is None or not crawler.settings.getbool('RETROGALLERY_METRICS_ENABLED'):
+        return NULL_METRICS
+    metrics = getattr(crawler, '_retrogallery_metrics', None)
+    if metrics is None:
+        metrics = crawler._retrogallery_metrics = Metrics()
+    return metrics
+
+
+def _metrics_resource(metrics, stats):
+    from twisted.web.resource import Resource
+
+    class MetricsPage(Resource):
+        isLeaf = True
+
+        def __init__(self, render_body, content_type):
+            super().__init__()
+            self.render_body = render_body
+            self.content_type = content_type
+
+        def render_GET(self, request):
+            request.setHeader(b'Content-Type', self.content_type)
+            return self.render_body().encode('utf-8')
+
+    root = Resource()
+    root.putChild(b'metrics', MetricsPage(
+        metrics.render_prometheus, b'text/plain; version=0.0.4; charset=utf-8'
+    ))
+    root.putChild(b'stats.json', MetricsPage(
+        lambda: json.dumps(stats(), default=str), b'application/json'
+    ))
+    return root
+
+
+class MetricsExporter:
+    """
+    An extension that samples queue depths and exports the crawl's Metrics
+    over HTTP and as a periodic JSON dump. See the module docstring.
+    """
+
+    def __init__(self, crawler, metrics, host, port, dump_path, interval):
+        self.crawler = crawler
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.dump_path = dump_path
+        self.interval = interval
+        self.listener = None
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('RETROGALLERY_METRICS_ENABLED'):
+            raise NotConfigured
+        exporter = cls(
+            crawler,
+            get_metrics(crawler),
+            settings.get('RETROGALLERY_METRICS_HOST', '127.0.0.1'),
+            settings.getint('RETROGALLERY_METRICS_PORT', 0),
+            settings.get('RETROGALLERY_METRICS_DUMP'),
+            settings.getfloat('RETROGALLERY_METRICS_INTERVAL', 30),
+        )
+        crawler.signals.connect(exporter.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(exporter.spider_closed, signal=signals.spider_closed)
+        return exporter
+
+    def spider_opened(self, spider):
+        from twisted.internet import reactor, task
+        from twisted.internet.error import CannotListenError
+        from twisted.web.server import Site
+
+        if self.port:
+            try:
+                self.listener = reactor.listenTCP(
+                    self.port, Site(_metrics_resource(self.metrics, self.stats)), interface=self.host
+                )
+                logger.info(f"Serving metrics on http://{self.host}:{self.listener.getHost().port}/metrics")
+            except CannotListenError as e:
+                logger.warning(f"Cannot serve metrics on {self.host}:{self.port}: {e}")
+        self.task = task.LoopingCall(self.tick)
+        self.task.start(self.interval, now=True)
+
+    def spider_closed(self, spider, reason):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.tick()
+        if self.listener is not None:
+            self.listener.stopListening()
+            self.listener = None
+
+    def tick(self):
+        self.sample_queues()
+        if self.dump_path:
+            self.dump()
+
+    def sample_queues(self):
+        """
+        Records the depth of the scheduler, downloader and scraper queues.
+        """
+        engine = self.crawler.engine
+        if engine is None:
+            return
+        slot = getattr(engine, 'slot', None)
+        if slot is not None and slot.scheduler is not None:
+            self.metrics.set('retrogallery_queue_depth', len(slot.scheduler), queue='scheduler')
+        downloader = getattr(engine, 'downloader', None)
+        if downloader is not None:
+            self.metrics.set('retrogallery_queue_depth', len(downloader.active), queue='downloader_active')
+            self.metrics.set(
+                'retrogallery_queue_depth',
+                sum(len(s.queue) for s in downloader.slots.values()),
+                queue='downloader_queued'
+            )
+        scraper_slot = getattr(getattr(engine, 'scraper', None), 'slot', None)
+        if scraper_slot is not None:
+            self.metrics.set('retrogallery_queue_depth', len(scraper_slot.queue), queue='scraper_queued')
+            self.metrics.set('retrogallery_queue_depth', len(scraper_slot.active), queue='scraper_active')
+            self.metrics.set('retrogallery_queue_depth', scraper_slot.itemproc_size, queue='pipeline_items')
+
+    def stats(self):
+        return {
+            'time': time.time(),
+            'stats': self.crawler.stats.get_stats(),
+            'metrics': self.metrics.snapshot(),
+        }
+
+    def dump(self):
+        """
+        Writes stats() to the dump file, atomically.
+        """
+        path = Path(self.dump_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        tmp_path.write_text(json.dumps(self.stats(), default=str, indent=2))
+        os.replace(tmp_path, path)
@@ -3,101 +3,394 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import time
+
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Request
+from scrapy.utils.httpobj import urlparse_cached
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from retrogallery import streaming
+from retrogallery.checkpoint import FINGERPRINT_META_KEY, get_checkpoint
+from retrogallery.items import IMAGE_META_KEY, GalleryItem, ImageItem
+from retrogallery.metrics import NULL_METRICS, get_metrics
+from retrogallery.resources import is_shared, shared
+from retrogallery.state import CrawlState, DEFAULT_STATE_DB
+
+
+# The request meta key of a changed gallery page's state, recorded once its
+# items complete
+PAGE_RECORD_META_KEY = '_retrogallery_incremental_page'
+
 
 class RetrogallerySpiderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the spider middleware does not modify the
-    # passed objects.
+    """
+    Spider middleware that times spider callbacks (see retrogallery.metrics).
+
+    Callbacks are generators, so the time spent in a callback is the time
+    spent producing each of its results. Enabled closest to the spider (a
+    high SPIDER_MIDDLEWARES order), this middleware times exactly that, and
+    records retrogallery_callback_seconds, retrogallery_callback_output_total
+    and retrogallery_callback_errors_total by spider and callback.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
 
     @classmethod
     def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
+        metrics = get_metrics(crawler)
+        if metrics is NULL_METRICS:
+            raise NotConfigured
+        s = cls(metrics)
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
         return s
 
-    def process_spider_input(self, response, spider):
-        # Called for each response that goes through the spider
-        # middleware and into the spider.
+    @staticmethod
+    def _callback_name(response):
+        callback = response.request.callback if response.request is not None else None
+        return getattr(callback, '__name__', None) or 'parse'
+
+    def process_spider_output(self, response, result, spider):
+        callback = self._callback_name(response)
+        elapsed = 0.0
+        outputs = {'item': 0, 'request': 0}
+        results = iter(result)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    i = next(results)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - start
+                outputs['request' if isinstance(i, Request) else 'item'] += 1
+                yield i
+        finally:
+            self.metrics.observe('retrogallery_callback_seconds', elapsed, spider=spider.name, callback=callback)
+            for kind, count in outputs.items():
+                self.metrics.inc(
+                    'retrogallery_callback_output_total', count, spider=spider.name, callback=callback, type=kind
+                )
 
-        # Should return None or raise an exception.
+    def process_spider_exception(self, response, exception, spider):
+        self.metrics.inc(
+            'retrogallery_callback_errors_total',
+            spider=spider.name,
+            callback=self._callback_name(response),
+            exception=type(exception).__name__,
+        )
         return None
 
-    def process_spider_output(self, response, result, spider):
-        # Called with the results returned from the Spider, after
-        # it has processed the response.
+    def spider_opened(self, spider):
+        spider.logger.info("Spider opened: %s" % spider.name)
+
 
-        # Must return an iterable of Request, or item objects.
+class GalleryBatchMiddleware:
+    """
+    Spider middleware that batches the ImageItems of each gallery page into
+    a single GalleryItem, so RetroGalleryLocalPipeline processes a gallery's
+    images as one item: its downloads are fanned out together and their
+    results collected per gallery. Enabled by RETROGALLERY_GALLERY_ITEMS.
+
+    The GalleryItem of a page is yielded once the page's callback has
+    finished, after any requests it yielded.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('RETROGALLERY_GALLERY_ITEMS'):
+            raise NotConfigured
+        return cls()
+
+    def process_spider_output(self, response, result, spider):
+        galleries = {}
         for i in result:
-            yield i
+            if not isinstance(i, ImageItem):
+                yield i
+                continue
+            gallery = galleries.get(i.get('gallery_url'))
+            if gallery is None:
+                gallery = galleries[i.get('gallery_url')] = GalleryItem(
+                    gallery_title=i.get('gallery_title'),
+                    gallery_url=i.get('gallery_url'),
+                    image_titles=[],
+                    image_urls=[],
+                    image_sizes=[],
+                )
+            urls = i.get('image_urls') or []
+            gallery['image_urls'].extend(urls)
+            gallery['image_titles'].extend([i.get('image_title')] * len(urls))
+            gallery['image_sizes'].extend(i.get('image_sizes') or [None] * len(urls))
+        yield from galleries.values()
 
-    def process_spider_exception(self, response, exception, spider):
-        # Called when a spider or process_spider_input() method
-        # (from other spider middleware) raises an exception.
 
-        # Should return either None or an iterable of Request or item objects.
-        pass
+class RetrogalleryDownloaderMiddleware:
+    """
+    Downloader middleware that records, per domain, download latency
+    (retrogallery_download_latency_seconds, to the response headers, and
+    retrogallery_download_seconds, to the whole body), responses by status
+    and bytes transferred, including bodies streamed to disk. Enabled
+    closest to the downloader (a high DOWNLOADER_MIDDLEWARES order).
+    """
+
+    START_META_KEY = '_retrogallery_download_start'
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        metrics = get_metrics(crawler)
+        if metrics is NULL_METRICS:
+            raise NotConfigured
+        s = cls(metrics)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        return s
+
+    def process_request(self, request, spider):
+        request.meta[self.START_META_KEY] = time.perf_counter()
+        return None
 
-    def process_start_requests(self, start_requests, spider):
-        # Called with the start requests of the spider, and works
-        # similarly to the process_spider_output() method, except
-        # that it doesn’t have a response associated.
+    def process_response(self, request, response, spider):
+        domain = urlparse_cached(request).hostname or ''
+        start = request.meta.pop(self.START_META_KEY, None)
+        if start is not None:
+            self.metrics.observe('retrogallery_download_seconds', time.perf_counter() - start, domain=domain)
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.metrics.observe('retrogallery_download_latency_seconds', latency, domain=domain)
+        self.metrics.inc('retrogallery_responses_total', domain=domain, status=response.status)
+        streamed = request.meta.get(streaming.STREAMED_FILE_META_KEY)
+        if streamed is not None and streaming.STREAMED_FLAG in response.flags:
+            size = streamed.size
+        else:
+            size = len(response.body)
+        self.metrics.inc('retrogallery_response_bytes_total', size, domain=domain)
+        return response
 
-        # Must return only requests (not items).
-        for r in start_requests:
-            yield r
+    def process_exception(self, request, exception, spider):
+        request.meta.pop(self.START_META_KEY, None)
+        self.metrics.inc(
+            'retrogallery_download_errors_total',
+            domain=urlparse_cached(request).hostname or '',
+            exception=type(exception).__name__,
+        )
+        return None
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
 
 
-class RetrogalleryDownloaderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the downloader middleware does not modify the
-    # passed objects.
+def get_crawl_state(crawler):
+    """
+    Returns the incremental CrawlState of a crawler, opening it on first
+    use. The jobs of a crawl service share one database (see
+    retrogallery.service).
+    """
+    state = getattr(crawler, '_retrogallery_state', None)
+    if state is None:
+        path = crawler.settings.get('RETROGALLERY_STATE_DB', DEFAULT_STATE_DB)
+        state = crawler._retrogallery_state = shared(('state', str(path)), lambda: CrawlState(path))
+    return state
+
+
+class IncrementalCrawlMiddleware:
+    """
+    Downloader middleware for incremental re-crawls.
+
+    Gallery pages (requests carrying a gallery_url in their meta) are
+    revalidated against the state database with If-None-Match and
+    If-Modified-Since headers. A 304 Not Modified response, or a 200 whose
+    body hashes the same as last time, means the gallery has not changed:
+    the request is dropped, so the gallery is not parsed and none of its
+    images are scheduled. Image responses are recorded as they pass through
+    so the database also holds the validators and content hash of every
+    image.
+
+    A changed page is not recorded here but once its images are stored (see
+    IncrementalPageMiddleware), so a gallery whose images failed, or whose
+    crawl died part of the way through, is parsed again by the next crawl.
+
+    Enabled by RETROGALLERY_INCREMENTAL; the database lives at
+    RETROGALLERY_STATE_DB. Set request.meta['incremental'] = False to
+    force a full fetch of a single page.
+    """
+
+    def __init__(self, state, stats, checkpoint=None):
+        self.state = state
+        self.stats = stats
+        self.checkpoint = checkpoint
 
     @classmethod
     def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
-        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        if not crawler.settings.getbool('RETROGALLERY_INCREMENTAL'):
+            raise NotConfigured
+        s = cls(get_crawl_state(crawler), crawler.stats, get_checkpoint(crawler))
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
         return s
 
+    @staticmethod
+    def _is_gallery_page(request):
+        return 'gallery_url' in request.meta and request.meta.get('incremental', True)
+
+    @staticmethod
+    def _is_image(request):
+        return IMAGE_META_KEY in request.meta
+
     def process_request(self, request, spider):
-        # Called for each request that goes through the downloader
-        # middleware.
-
-        # Must either:
-        # - return None: continue processing this request
-        # - or return a Response object
-        # - or return a Request object
-        # - or raise IgnoreRequest: process_exception() methods of
-        #   installed downloader middleware will be called
+        if not self._is_gallery_page(request):
+            return None
+        previous = self.state.get('pages', request.url)
+        if previous:
+            if previous['etag']:
+                request.headers.setdefault('If-None-Match', previous['etag'])
+            if previous['last_modified']:
+                request.headers.setdefault('If-Modified-Since', previous['last_modified'])
         return None
 
     def process_response(self, request, response, spider):
-        # Called with the response returned from the downloader.
+        if self._is_gallery_page(request):
+            kind = 'pages'
+        elif self._is_image(request):
+            kind = 'images'
+        else:
+            return response
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        etag = etag.decode('latin-1') if etag else None
+        last_modified = last_modified.decode('latin-1') if last_modified else None
 
-        # Must either;
-        # - return a Response object
-        # - return a Request object
-        # - or raise IgnoreRequest
+        if response.status == 304 and kind == 'pages':
+            self.state.record(kind, request.url, status=304, etag=etag, last_modified=last_modified)
+            self.stats.inc_value('incremental/pages_not_modified', spider=spider)
+            self._drop_page(request)
+            raise IgnoreRequest(f"Gallery not modified: {request.url}")
+        if response.status != 200:
+            return response
+
+        streamed = request.meta.get(streaming.STREAMED_FILE_META_KEY)
+        if streamed is not None and streaming.STREAMED_FLAG in response.flags:
+            # The body of a streamed response is on disk, not in the response
+            content_hash = streamed.sha1
+        else:
+            content_hash = self.state.content_hash(response.body)
+        record = dict(status=response.status, etag=etag, last_modified=last_modified, content_hash=content_hash)
+        if kind == 'images':
+            self.state.record(kind, request.url, **record)
+            self.stats.inc_value('incremental/images_changed', spider=spider)
+            return response
+
+        previous = self.state.get(kind, request.url)
+        if previous and previous['content_hash'] == content_hash:
+            self.state.record(kind, request.url, **record)
+            self.stats.inc_value('incremental/pages_unchanged', spider=spider)
+            self._drop_page(request)
+            raise IgnoreRequest(f"Gallery unchanged: {request.url}")
+        request.meta[PAGE_RECORD_META_KEY] = record
+        self.stats.inc_value('incremental/pages_changed', spider=spider)
         return response
 
-    def process_exception(self, request, exception, spider):
-        # Called when a download handler or a process_request()
-        # (from other downloader middleware) raises an exception.
+    def _drop_page(self, request):
+        # A dropped page never reaches its callback, nor CheckpointMiddleware
+        if self.checkpoint is not None:
+            fp = request.meta.get(FINGERPRINT_META_KEY)
+            if fp is not None:
+                self.checkpoint.page_done(fp)
 
-        # Must either:
-        # - return None: continue processing this exception
-        # - return a Response object: stops process_exception() chain
-        # - return a Request object: stops process_exception() chain
-        pass
+    def spider_closed(self, spider):
+        if is_shared(self.state):
+            self.state.commit()
+        else:
+            self.state.close()
 
-    def spider_opened(self, spider):
-        spider.logger.info("Spider opened: %s" % spider.name)
+
+class IncrementalPageMiddleware:
+    """
+    Spider middleware that records a changed gallery page in the incremental
+    state database (see IncrementalCrawlMiddleware) once its callback has
+    finished and every item it yielded has been scraped with all of its
+    images stored. If an item is dropped or fails, an image of it fails, or
+    the crawl stops first, the page is not recorded, so the next crawl
+    parses it again and retries its images. A page with an image that
+    always fails (e.g. one too small to store) is therefore parsed on every
+    crawl.
+
+    Enabled by RETROGALLERY_INCREMENTAL, closer to the engine than any
+    middleware that drops items (a lower SPIDER_MIDDLEWARES order than
+    CheckpointMiddleware).
+    """
+
+    def __init__(self, state):
+        self.state = state
+        # page URL -> (record, outstanding items, whether all succeeded),
+        # for pages whose callback is running or whose items are
+        self.pages = {}
+        # id(item) -> page URL
+        self.items = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('RETROGALLERY_INCREMENTAL'):
+            raise NotConfigured
+        s = cls(get_crawl_state(crawler))
+        crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(s.item_failed, signal=signals.item_dropped)
+        crawler.signals.connect(s.item_failed, signal=signals.item_error)
+        return s
+
+    def process_spider_output(self, response, result, spider):
+        record = response.meta.get(PAGE_RECORD_META_KEY)
+        if record is None:
+            yield from result
+            return
+        url = response.request.url
+        # The callback counts as one outstanding item until it finishes
+        self.pages[url] = [record, 1, True]
+        try:
+            for i in result:
+                if is_item(i):
+                    self.items[id(i)] = url
+                    self.pages[url][1] += 1
+                yield i
+        except Exception:
+            self.pages[url][2] = False
+            raise
+        finally:
+            self._finished(url, True)
+
+    def process_spider_exception(self, response, exception, spider):
+        url = response.request.url
+        if url in self.pages:
+            self.pages[url][2] = False
+        return None
+
+    def _finished(self, url, ok):
+        page = self.pages.get(url)
+        if page is None:
+            return
+        page[1] -= 1
+        page[2] = page[2] and ok
+        if page[1]:
+            return
+        del self.pages[url]
+        record, _, ok = page
+        if ok:
+            self.state.record('pages', url, **record)
+
+    def item_scraped(self, item, response, spider):
+        url = self.items.pop(id(item), None)
+        if url is not None:
+            adapter = ItemAdapter(item)
+            stored = {image.get('url') for image in adapter.get('images') or []}
+            self._finished(url, stored.issuperset(adapter.get('image_urls') or []))
+
+    def item_failed(self, item, response, spider):
+        url = self.items.pop(id(item), None)
+        if url is not None:
+            self._finished(url, False)
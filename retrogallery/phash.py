@@ -0,0 +1,644 @@
+"""
+Perceptual hashes and a near-duplicate index of stored images.
+
+The same retro hardware photos turn up on both oldcrap.org and
+nostalgianerd.com, and in several galleries at different resolutions and
+compression levels. Neither the SHA1-of-URL paths of
+RetroGalleryLocalPipeline nor the content digests of the blob store can
+tell that two such files are the same photo; a perceptual hash can.
+
+Every image is reduced to a 32x32 grayscale thumbnail (the JPEG decoder
+does most of the downscaling, see Image.draft()) and hashed to 64 bits with
+one of:
+
+    ahash   each 4x4 block brighter than the mean
+    dhash   each of 8x9 blocks brighter than its left neighbour
+    phash   each of the 8x8 lowest DCT frequencies above their median
+
+Hashes of a batch of thumbnails are computed together with NumPy. Two
+images are near-duplicates when their hashes differ in at most
+max_distance bits.
+
+NearDuplicateIndex keeps the hashes in SQLite and, in memory, in a
+MultiIndexHash: the 64 bits are split into max_distance + 1 chunks, and by
+the pigeonhole principle any hash within max_distance bits of another
+shares at least one chunk with it exactly. A query only compares the hashes
+filed under its own chunks, so it takes time proportional to the number of
+candidates rather than to the size of the index.
+
+Each near-duplicate group has one canonical image, the one with the most
+pixels; every other member is linked to it (a hard link, symlink or blob
+store entry, like the blob store's own links) instead of being stored a
+second time. RetroGalleryLocalPipeline does this as each item completes
+when RETROGALLERYLOCALPIPELINE_NEAR_DUPLICATES is on. An existing store is
+deduplicated in a pool of worker processes with:
+
+    python -m retrogallery.phash dedup /tmp/retrogallery --dry-run
+    python -m retrogallery.phash dedup /tmp/retrogallery --max-distance 4
+    python -m retrogallery.phash show /tmp/retrogallery oldcrap/Commodore\\ 64/...
+
+This module requires NumPy.
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import suppress
+from functools import partial
+from io import BytesIO
+from pathlib import Path
+
+from scrapy.exceptions import NotConfigured
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+logger = logging.getLogger(__name__)
+
+
+ALGORITHMS = ('ahash', 'dhash', 'phash')
+DEFAULT_ALGORITHM = 'phash'
+DEFAULT_MAX_DISTANCE = 6
+# The name of the index database in the root of the image store
+DEFAULT_DB_NAME = 'phash.sqlite3'
+
+HASH_BITS = 64
+# The side of the grayscale thumbnail every hash is computed from
+THUMBNAIL_SIZE = 32
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff')
+
+
+def is_original(path):
+    """
+    Returns True for the {spider}/{gallery_title}/{image_title}/{guid}{ext}
+    paths of downloaded images, as opposed to thumbnails and derivatives,
+    which must never be linked to the (larger) original.
+    """
+    return len(path.split('/')) == 4 and path.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def require_numpy():
+    if np is None:
+        raise NotConfigured("Near-duplicate detection requires numpy")
+
+
+def _dct_matrix(n):
+    """
+    Returns the n x n orthonormal DCT-II matrix, so that D @ x is the DCT of
+    the column vector x.
+    """
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.sqrt(2 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+def thumbnail(source):
+    """
+    Decodes an image to a THUMBNAIL_SIZE x THUMBNAIL_SIZE grayscale array.
+
+    Parameters:
+        source (str, Path or bytes): The path of the image file, or its bytes.
+
+    Returns:
+        (pixels, (width, height)): The thumbnail as a uint8 array and the
+        dimensions of the original image.
+    """
+    from PIL import Image
+
+    with Image.open(source if isinstance(source, (str, Path)) else BytesIO(source)) as image:
+        size = image.size
+        # Let the JPEG decoder downscale by up to 8x while decoding
+        image.draft('L', (THUMBNAIL_SIZE * 2, THUMBNAIL_SIZE * 2))
+        image = image.convert('L').resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.Resampling.BOX)
+        return np.asarray(image, dtype=np.uint8), size
+
+
+def hash_thumbnails(thumbnails, algorithm=DEFAULT_ALGORITHM):
+    """
+    Hashes a batch of thumbnails at once.
+
+    Parameters:
+        thumbnails (array): An (N, THUMBNAIL_SIZE, THUMBNAIL_SIZE) array, or
+        a list of thumbnail() arrays.
+        algorithm (str): One of ALGORITHMS.
+
+    Returns:
+        list[int]: The N 64-bit hashes.
+    """
+    require_numpy()
+    pixels = np.asarray(thumbnails, dtype=np.float32)
+    if not len(pixels):
+        return []
+    count = len(pixels)
+    side = THUMBNAIL_SIZE // 8
+    if algorithm == 'ahash':
+        blocks = pixels.reshape(count, 8, side, 8, side).mean(axis=(2, 4)).reshape(count, 64)
+        bits = blocks > blocks.mean(axis=1, keepdims=True)
+    elif algorithm == 'dhash':
+        rows = pixels.reshape(count, 8, side, THUMBNAIL_SIZE).mean(axis=2)
+        # 9 columns of 3 or 4 pixels each
+        bounds = np.linspace(0, THUMBNAIL_SIZE, 10).astype(int)
+        columns = np.add.reduceat(rows, bounds[:-1], axis=2) / np.diff(bounds)
+        bits = (columns[:, :, 1:] > columns[:, :, :-1]).reshape(count, 64)
+    elif algorithm == 'phash':
+        dct = _dct_matrix(THUMBNAIL_SIZE).astype(np.float32)
+        low = (dct @ pixels @ dct.T)[:, :8, :8].reshape(count, 64)
+        # The DC term only measures overall brightness, so it is left out
+        # of the median
+        bits = low > np.median(low[:, 1:], axis=1, keepdims=True)
+    else:
+        raise ValueError(f"Unknown perceptual hash {algorithm!r}, expected one of {', '.join(ALGORITHMS)}")
+    packed = np.packbits(bits, axis=1).view('>u8').ravel()
+    return [int(value) for value in packed]
+
+
+def hash_files(paths, algorithm=DEFAULT_ALGORITHM):
+    """
+    Decodes and hashes a batch of image files. Runs in a worker thread or
+    process.
+
+    Returns:
+        list: A (hash, (width, height)) tuple per path, or None for files
+        that could not be decoded.
+    """
+    require_numpy()
+    thumbnails, sizes, decoded = [], [], []
+    for i, path in enumerate(paths):
+        try:
+            pixels, size = thumbnail(path)
+        except Exception as e:
+            logger.debug(f"Cannot hash {path}: {e}")
+            continue
+        thumbnails.append(pixels)
+        sizes.append(size)
+        decoded.append(i)
+    results = [None] * len(paths)
+    for i, image_hash, size in zip(decoded, hash_thumbnails(thumbnails, algorithm), sizes):
+        results[i] = (image_hash, size)
+    return results
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+def _to_sql(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def _from_sql(value):
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+
+class MultiIndexHash:
+    """
+    An in-memory index of 64-bit hashes answering "which keys have a hash
+    within max_distance bits of this one?" without scanning every hash.
+    See the module docstring.
+    """
+
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE):
+        if not 0 <= max_distance < HASH_BITS:
+            raise ValueError(f"max_distance must be between 0 and {HASH_BITS - 1}")
+        self.max_distance = max_distance
+        chunks = max_distance + 1
+        bounds = [HASH_BITS * i // chunks for i in range(chunks + 1)]
+        self.chunks = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        self.tables = [{} for _ in self.chunks]
+        self.hashes = {}
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, key):
+        return key in self.hashes
+
+    def _slots(self, value):
+        return [(table, (value >> start) & mask) for table, (start, mask) in zip(self.tables, self.chunks)]
+
+    def add(self, key, value):
+        if key in self.hashes:
+            self.remove(key)
+        self.hashes[key] = value
+        for table, chunk in self._slots(value):
+            table.setdefault(chunk, []).append(key)
+
+    def remove(self, key):
+        value = self.hashes.pop(key)
+        for table, chunk in self._slots(value):
+            keys = table[chunk]
+            keys.remove(key)
+            if not keys:
+                del table[chunk]
+
+    def search(self, value, max_distance=None):
+        """
+        Returns the (distance, key) pairs within max_distance bits of value
+        (at most the index's own max_distance), closest first.
+        """
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        matches = {}
+        for table, chunk in self._slots(value):
+            for key in table.get(chunk, ()):
+                if key not in matches:
+                    matches[key] = hamming(value, self.hashes[key])
+        return sorted((distance, key) for key, distance in matches.items() if distance <= max_distance)
+
+
+class NearDuplicateIndex:
+    """
+    The perceptual hashes of every image in a store, and which images are
+    near-duplicates of which.
+
+    Table:
+        images: one row per stored path, with its hash, dimensions and,
+        for near-duplicates, the canonical path it is linked to and the
+        distance between the two hashes.
+
+    Only canonical images are kept in the in-memory MultiIndexHash, so each
+    group of near-duplicates is matched through its largest member.
+
+    Parameters:
+        path (str): The SQLite database file.
+        algorithm (str): One of ALGORITHMS; hashes made by other algorithms
+        are ignored.
+        max_distance (int): The largest Hamming distance between the hashes
+        of near-duplicates.
+        commit_every (int): Commit after this many writes (default
+        COMMIT_EVERY).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS images (
+            path TEXT PRIMARY KEY,
+            algorithm TEXT NOT NULL,
+            hash INTEGER NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            canonical TEXT,
+            distance INTEGER,
+            updated REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS images_canonical ON images(canonical);
+    """
+
+    # Commit after this many writes; the index is also committed on close.
+    COMMIT_EVERY = 100
+
+    def __init__(self, path, algorithm=DEFAULT_ALGORITHM, max_distance=DEFAULT_MAX_DISTANCE, commit_every=None):
+        require_numpy()
+        if algorithm not in ALGORITHMS:
+            raise NotConfigured(f"Unknown perceptual hash {algorithm!r}, expected one of {', '.join(ALGORITHMS)}")
+        self.path = str(path)
+        self.algorithm = algorithm
+        self.commit_every = commit_every or self.COMMIT_EVERY
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.executescript(self.SCHEMA)
+        self._pending_writes = 0
+        self.hashes = MultiIndexHash(max_distance)
+        self.areas = {}
+        for path, value, width, height in self.conn.execute(
+            "SELECT path, hash, width, height FROM images WHERE algorithm = ? AND canonical IS NULL",
+            (algorithm,)
+        ):
+            self.hashes.add(path, _from_sql(value))
+            self.areas[path] = width * height
+
+    @classmethod
+    def from_settings(cls, settings, store_dir):
+        return cls(
+            settings.get('RETROGALLERYLOCALPIPELINE_NEAR_DUPLICATES_DB') or os.path.join(store_dir, DEFAULT_DB_NAME),
+            algorithm=settings.get('RETROGALLERYLOCALPIPELINE_NEAR_DUPLICATES_ALGORITHM', DEFAULT_ALGORITHM),
+            max_distance=settings.getint('RETROGALLERYLOCALPIPELINE_NEAR_DUPLICATES_MAX_DISTANCE', DEFAULT_MAX_DISTANCE),
+            # Distributed workers share the database
+            commit_every=1 if settings.getbool('RETROGALLERY_DISTRIBUTED') else None,
+        )
+
+    def _write(self, sql, params):
+        self.conn.execute(sql, params)
+        self._pending_writes += 1
+        if self._pending_writes >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._pending_writes = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def get(self, path):
+        """
+        Returns the recorded row of a path as a dict, or None.
+        """
+        row = self.conn.execute(
+            "SELECT path, algorithm, hash, width, height, canonical, distance, updated FROM images WHERE path = ?",
+            (path,)
+        ).fetchone()
+        if row is None:
+            return None
+        keys = ('path', 'algorithm', 'hash', 'width', 'height', 'canonical', 'distance', 'updated')
+        row = dict(zip(keys, row))
+        row['hash'] = _from_sql(row['hash'])
+        return row
+
+    def duplicates(self, canonical):
+        """
+        Returns the paths linked to a canonical path.
+        """
+        return [path for path, in self.conn.execute(
+            "SELECT path FROM images WHERE canonical = ? ORDER BY path", (canonical,)
+        )]
+
+    def _record(self, path, value, size, canonical=None, distance=None):
+        self._write(
+            "INSERT OR REPLACE INTO images (path, algorithm, hash, width, height, canonical, distance, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, self.algorithm, _to_sql(value), size[0], size[1], canonical, distance, time.time())
+        )
+
+    def add(self, path, value, size):
+        """
+        Adds an image to the index.
+
+        Parameters:
+            path (str): The stored path of the image.
+            value (int): Its perceptual hash.
+            size (tuple): Its (width, height).
+
+        Returns:
+            list[tuple]: (path, canonical, distance) for every path that must
+            now be linked to another: the new image, if it is a near-duplicate
+            of a larger one, or else the smaller images it replaces as the
+            canonical image of their group, with their own near-duplicates.
+            Empty if the image is not a near-duplicate of anything.
+        """
+        if path in self.hashes:
+            self.hashes.remove(path)
+            del self.areas[path]
+        area = size[0] * size[1]
+        matches = self.hashes.search(value)
+        if matches and self.areas[matches[0][1]] >= area:
+            distance, canonical = matches[0]
+            self._record(path, value, size, canonical, distance)
+            return [(path, canonical, distance)]
+
+        self._record(path, value, size)
+        self.hashes.add(path, value)
+        self.areas[path] = area
+        links = []
+        for distance, replaced in matches:
+            # Only groups whose canonical image is smaller get here
+            self.hashes.remove(replaced)
+            del self.areas[replaced]
+            self._write(
+                "UPDATE images SET canonical = ?, distance = ?, updated = ? WHERE path = ?",
+                (path, distance, time.time(), replaced)
+            )
+            links.append((replaced, path, distance))
+            for duplicate in self.duplicates(replaced):
+                duplicate_distance = hamming(value, self.get(duplicate)['hash'])
+                self._write(
+                    "UPDATE images SET canonical = ?, distance = ?, updated = ? WHERE path = ?",
+                    (path, duplicate_distance, time.time(), duplicate)
+                )
+                links.append((duplicate, path, duplicate_distance))
+        return links
+
+    def stats(self):
+        """
+        Returns the number of (images, canonical images, near-duplicates).
+        """
+        total, duplicates = self.conn.execute(
+            "SELECT COUNT(*), COUNT(canonical) FROM images"
+        ).fetchone()
+        return total, total - duplicates, duplicates
+
+
+def link_file(src, dst):
+    """
+    Replaces dst with a hard link to src (or a relative symlink where hard
+    links are not possible), atomically.
+    """
+    src, dst = Path(src), Path(dst)
+    if dst.exists() and os.path.samefile(src, dst):
+        return
+    tmp = dst.with_name(f".{dst.name}.link")
+    with suppress(FileNotFoundError):
+        os.unlink(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError as e:
+        logger.debug(f"Hard link {dst} -> {src} failed ({e}), using a symlink")
+        os.symlink(os.path.relpath(src, dst.parent), tmp)
+    os.replace(tmp, dst)
+
+
+class StoreLinker:
+    """
+    Finds and links the files of an image store, either a plain
+    FSFilesStore directory or a blob store (see retrogallery.blobstore).
+    """
+
+    def __init__(self, basedir, blobs=None):
+        self.basedir = Path(basedir)
+        self.blobs = blobs
+
+    def filesystem_path(self, path):
+        """
+        Returns the file holding the bytes of a stored path, or None.
+        """
+        if self.blobs is not None:
+            resolved = self.blobs.resolve(path)
+            return resolved[0] if resolved else None
+        local_path = self.basedir.joinpath(*path.split('/'))
+        return local_path if local_path.exists() else None
+
+    def link(self, path, canonical):
+        """
+        Makes a stored path refer to the bytes of its canonical path. In a
+        blob store, the path's old blob is removed once nothing refers to it.
+        """
+        if self.blobs is not None:
+            blob = self.blobs.index.blob_for_path(canonical)
+            if blob is None:
+                logger.warning(f"Not linking {path}: {canonical} is not in the blob store")
+                return False
+            previous = self.blobs.index.blob_for_path(path)
+            self.blobs.link(blob[0], path)
+            if previous is not None and previous[0] != blob[0]:
+                self.blobs.remove_unused(previous[0])
+            return True
+        src = self.filesystem_path(canonical)
+        if src is None:
+            logger.warning(f"Not linking {path}: {canonical} is missing")
+            return False
+        link_file(src, self.basedir.joinpath(*path.split('/')))
+        return True
+
+    def paths(self):
+        """
+        Yields the stored path of every original image in the store.
+        """
+        if self.blobs is not None:
+            for path, in self.blobs.index.conn.execute("SELECT path FROM entries ORDER BY path"):
+                if is_original(path):
+                    yield path
+            return
+        for root, dirs, files in os.walk(self.basedir):
+            # Skip hidden directories (the streaming spool, .partial) and
+            # the blob store
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.') and not (root == str(self.basedir) and d == 'blobs'))
+            for name in sorted(files):
+                path = Path(root, name).relative_to(self.basedir).as_posix()
+                if is_original(path) and not name.startswith('.'):
+                    yield path
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def dedup(basedir, db=None, algorithm=DEFAULT_ALGORITHM, max_distance=DEFAULT_MAX_DISTANCE,
+          workers=None, batch_size=256, dry_run=False):
+    """
+    Hashes every image in a store not yet in its index, in a pool of worker
+    processes, and links every near-duplicate to the largest image of its
+    group.
+
+    Returns:
+        dict: Counts of images hashed, skipped (already indexed or not
+        decodable) and linked.
+    """
+    from retrogallery.blobstore import BlobStore
+
+    basedir = Path(basedir)
+    blobs = BlobStore(basedir) if (basedir / 'blobs' / 'index.sqlite3').exists() else None
+    linker = StoreLinker(basedir, blobs)
+    index = NearDuplicateIndex(db or basedir / DEFAULT_DB_NAME, algorithm, max_distance)
+    if dry_run:
+        # Keep every change in one transaction, rolled back at the end
+        index.commit_every = float('inf')
+    counts = {'hashed': 0, 'skipped': 0, 'linked': 0}
+    try:
+        pending = {}
+        for path in linker.paths():
+            if index.get(path) is not None:
+                counts['skipped'] += 1
+                continue
+            local_path = linker.filesystem_path(path)
+            if local_path is None:
+                counts['skipped'] += 1
+                continue
+            # Paths sharing a blob only need hashing once
+            pending.setdefault(str(local_path), []).append(path)
+
+        files = list(pending)
+        hashed = []
+        workers = os.cpu_count() if workers is None else workers
+        if workers:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                batches = pool.map(partial(hash_files, algorithm=algorithm), _chunks(files, batch_size))
+                for batch, results in zip(_chunks(files, batch_size), batches):
+                    hashed.extend(zip(batch, results))
+        else:
+            hashed = list(zip(files, hash_files(files, algorithm)))
+
+        # Add the largest images first, so they become canonical without
+        # smaller ones having to be relinked
+        hashed = [(local_path, result) for local_path, result in hashed if result is not None]
+        counts['skipped'] += len(files) - len(hashed)
+        hashed.sort(key=lambda entry: -entry[1][1][0] * entry[1][1][1])
+        for local_path, (value, size) in hashed:
+            for path in pending[local_path]:
+                counts['hashed'] += 1
+                for duplicate, canonical, distance in index.add(path, value, size):
+                    logger.info(f"{duplicate} is a near-duplicate of {canonical} (distance {distance})")
+                    if dry_run or linker.link(duplicate, canonical):
+                        counts['linked'] += 1
+    finally:
+        if dry_run:
+            index.conn.rollback()
+            index.conn.close()
+        else:
+            index.close()
+        if blobs is not None:
+            blobs.close()
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m retrogallery.phash',
+        description='Find and link near-duplicate images in a retrogallery image store.'
+    )
+    parser.add_argument('--db', help=f'near-duplicate index (default: STORE/{DEFAULT_DB_NAME})')
+    parser.add_argument('--algorithm', choices=ALGORITHMS, default=DEFAULT_ALGORITHM)
+    parser.add_argument('--max-distance', type=int, default=DEFAULT_MAX_DISTANCE,
+                        help='largest Hamming distance between near-duplicates (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('dedup', help='hash every new image in a store and link near-duplicates')
+    command.add_argument('store')
+    command.add_argument('--workers', type=int, help='worker processes (default: number of CPUs, 0 for none)')
+    command.add_argument('--batch-size', type=int, default=256, help='images per worker task (default: %(default)s)')
+    command.add_argument('--dry-run', action='store_true', help='report near-duplicates without linking them')
+    command = commands.add_parser('stats', help='count indexed images and near-duplicates')
+    command.add_argument('store')
+    command = commands.add_parser('show', help='show the hash and near-duplicates of a stored path')
+    command.add_argument('store')
+    command.add_argument('path')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'dedup':
+            logging.basicConfig(level=logging.INFO if args.dry_run else logging.WARNING, format='%(message)s')
+            start = time.time()
+            counts = dedup(args.store, args.db, args.algorithm, args.max_distance, args.workers,
+                           args.batch_size, args.dry_run)
+            print(f"Hashed {counts['hashed']}, skipped {counts['skipped']}, "
+                  f"{'found' if args.dry_run else 'linked'} {counts['linked']} near-duplicate(s) "
+                  f"in {time.time() - start:.1f}s")
+            return 0
+        index = NearDuplicateIndex(args.db or Path(args.store, DEFAULT_DB_NAME), args.algorithm, args.max_distance)
+    except NotConfigured as e:
+        print(e, file=sys.stderr)
+        return 1
+    try:
+        if args.command == 'stats':
+            total, canonical, duplicates = index.stats()
+            print(f"images: {total} ({canonical} canonical, {duplicates} near-duplicates)")
+        elif args.command == 'show':
+            row = index.get(args.path)
+            if row is None:
+                print(f"{args.path} is not indexed")
+                return 1
+            row['hash'] = f"{row['hash']:016x}"
+            for key, value in row.items():
+                print(f"{key}: {value}")
+            for duplicate in index.duplicates(args.path):
+                print(f"  duplicate: {duplicate}")
+    finally:
+        index.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,48 +3,176 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
-import hashlib
+import functools
+import json
 import logging
 import os
+import time
 from contextlib import suppress
-from urllib.parse import urlparse
+from io import BytesIO
+from pathlib import Path
 
 import scrapy
 from scrapy.exceptions import DropItem, NotConfigured
+from scrapy.pipelines.files import FileException, FSFilesStore
 from scrapy.pipelines.images import ImagesPipeline
+from scrapy.utils.misc import md5sum
 from itemadapter.adapter import ItemAdapter
+from twisted.internet import defer, threads
+from twisted.internet.defer import DeferredList
+from twisted.python.failure import Failure
 
-from retrogallery import utils
+from retrogallery import catalog, derivatives, fswriter, phash, probe, streaming, urls
+from retrogallery.checkpoint import get_checkpoint
+from retrogallery.distributed import SeenImages
+from retrogallery.items import IMAGE_META_KEY
+from retrogallery.blobstore import BlobFilesStore
+from retrogallery.packstore import DEFAULT_PACK_SIZE, PackFilesStore
+from retrogallery.metrics import NULL_METRICS, get_metrics
+from retrogallery.s3 import S3Uploader
+from retrogallery.resources import is_shared, shared
+
+
+# The name of the manifest stored for each GalleryItem
+MANIFEST_NAME = 'manifest.json'
 
 
 class RetroGalleryLocalPipeline(ImagesPipeline):
+    # Time spent in get_media_requests, file_path and item_completed is
+    # recorded as retrogallery_pipeline_stage_seconds, see from_crawler()
+    metrics = NULL_METRICS
+    # The perceptual hash index, when near-duplicate detection is enabled
+    near_duplicates = None
+    # The image URLs claimed by every worker of a distributed crawl, see
+    # from_crawler()
+    seen_images = None
+    # The crawl's checkpoint journal, when checkpoints are enabled
+    checkpoint = None
+    # Writes the local store from a pool of threads, when asynchronous
+    # writes are enabled
+    writer = None
+
     def __init__(self, store_uri, download_func=None, settings=None):
         self.logger = logging.getLogger(self.__class__.__name__)
         # If we can find a RETROGALLERYLOCALPIPELINE_IMAGES_STORE setting,
         # use that, otherwise use the default store_uri
         if settings:
             store_uri = settings.get('RETROGALLERYLOCALPIPELINE_IMAGES_STORE', store_uri)
+        # If asynchronous writes are enabled, the local store is written from
+        # a pool of threads rather than the reactor thread (see
+        # retrogallery.fswriter)
+        if settings and settings.getbool('RETROGALLERYLOCALPIPELINE_ASYNC_WRITES'):
+            self.writer = fswriter.FSWriter.from_settings(settings)
+            self.STORE_SCHEMES = dict(
+                self.STORE_SCHEMES,
+                file=functools.partial(fswriter.AsyncFSFilesStore, writer=self.writer)
+            )
+        # If the blob store is enabled, local files are written once per
+        # unique content and gallery paths are linked to them
+        if settings and settings.getbool('RETROGALLERYLOCALPIPELINE_BLOB_STORE'):
+            link_mode = settings.get('RETROGALLERYLOCALPIPELINE_BLOB_LINK_MODE', 'hardlink')
+            self.STORE_SCHEMES = dict(
+                self.STORE_SCHEMES,
+                file=functools.partial(
+                    BlobFilesStore,
+                    link_mode=link_mode,
+                    # Distributed workers on one machine share the index
+                    commit_every=1 if settings.getbool('RETROGALLERY_DISTRIBUTED') else None,
+                    writer=self.writer,
+                )
+            )
+        # If the pack store is enabled, images are appended to large pack
+        # files rather than stored one file each (see retrogallery.packstore)
+        if settings and settings.getbool('RETROGALLERYLOCALPIPELINE_PACK_STORE'):
+            self.STORE_SCHEMES = dict(
+                self.STORE_SCHEMES,
+                file=functools.partial(
+                    PackFilesStore,
+                    pack_size=settings.getint('RETROGALLERYLOCALPIPELINE_PACK_SIZE', DEFAULT_PACK_SIZE),
+                    writer=self.writer,
+                )
+            )
         super().__init__(
             store_uri=store_uri,
             download_func=download_func,
             settings=settings
         )
+        # If streaming is enabled, image bodies are spooled to disk by
+        # retrogallery.streaming.StreamingHTTPDownloadHandler and moved into
+        # place instead of being held in memory
+        self.streaming = bool(settings and settings.getbool('RETROGALLERYLOCALPIPELINE_STREAMING'))
+        # If gallery manifests are enabled, a manifest.json listing the
+        # images of each GalleryItem is stored in its gallery's directory
+        self.manifests = bool(settings and settings.getbool('RETROGALLERYLOCALPIPELINE_GALLERY_MANIFESTS'))
+        # If derivatives, thumbnails or minimum dimensions are configured,
+        # images are decoded and resized in a pool of worker processes
+        # rather than on the reactor thread
+        self.derivative_specs = derivatives.parse_specs(
+            settings.getdict('RETROGALLERYLOCALPIPELINE_DERIVATIVES') if settings else None,
+            thumbs=self.thumbs
+        )
+        self.derivative_pool = None
+        if settings and (self.derivative_specs or self.min_width or self.min_height):
+            # The jobs of a crawl service share one pool of warm workers
+            # (see retrogallery.service)
+            self.derivative_pool = shared(
+                ('derivatives',), lambda: derivatives.DerivativePool.from_settings(settings)
+            )
+        # If near-duplicate detection is enabled, every new image is
+        # perceptually hashed and, if it is a near-duplicate of one already
+        # stored, linked to the larger of the two (see retrogallery.phash)
+        if (settings and settings.getbool('RETROGALLERYLOCALPIPELINE_NEAR_DUPLICATES')
+                and isinstance(self.store, FSFilesStore)):
+            try:
+                self.near_duplicates = phash.NearDuplicateIndex.from_settings(settings, self.store.basedir)
+            except NotConfigured as e:
+                self.logger.warning(f"Near-duplicate detection is disabled: {e}")
+            else:
+                blobs = self.store.blobs if isinstance(self.store, BlobFilesStore) else None
+                self.near_duplicate_linker = phash.StoreLinker(self.store.basedir, blobs)
+        # If probing is enabled, images are checked against their markup
+        # dimensions and their first bytes before they are downloaded, and
+        # skipped if too small or linked if already stored (see
+        # retrogallery.probe). Without minimum dimensions or a blob store
+        # there is nothing a probe could skip.
+        self.probe_bytes = None
+        if (settings and settings.getbool('RETROGALLERYLOCALPIPELINE_PROBE')
+                and (self.min_width or self.min_height or isinstance(self.store, BlobFilesStore))):
+            self.probe_bytes = settings.getint('RETROGALLERYLOCALPIPELINE_PROBE_BYTES', probe.DEFAULT_PROBE_BYTES)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipe = super().from_crawler(crawler)
+        pipe.metrics = get_metrics(crawler)
+        pipe.seen_images = SeenImages.from_crawler(crawler)
+        pipe.checkpoint = get_checkpoint(crawler)
+        if pipe.writer is not None:
+            pipe.writer.metrics = pipe.metrics
+        return pipe
 
     def get_media_requests(self, item, info):
         """
         get_media_requests() is called for each item that needs to be
         downloaded, which might represent multiple images. The URLs of
         the images are contained in the item's image_urls field. Builds
-        a scrapy.Request for each image_url and adds gallery title and
-        image title metadata. Yields a Request, including metadata, for
-        every URL in self.image_urls.
+        a scrapy.Request for each image_url, with the index of its image in
+        the item as metadata: the gallery title, image title and markup
+        dimensions of the image are read from the item (see _image()),
+        rather than copied into every request. Yields a Request, including
+        metadata, for every URL in self.image_urls.
         """
-        images_urls = ItemAdapter(item).get(self.images_urls_field, [])
-        for url in images_urls:
-            request = scrapy.Request(url)
-            request.meta['gallery_title'] = item.get('gallery_title')
-            request.meta['image_title'] = item.get('image_title')
-            yield request
+        with self.metrics.time('retrogallery_pipeline_stage_seconds', stage='get_media_requests'):
+            requests = []
+            adapter = ItemAdapter(item)
+            images_urls = adapter.get(self.images_urls_field, [])
+            for i, url in enumerate(images_urls):
+                request = scrapy.Request(url, meta={IMAGE_META_KEY: i})
+                if self.streaming:
+                    request.meta[streaming.STREAM_META_KEY] = True
+                    # A compressed body would have to be buffered to decompress it
+                    request.headers['Accept-Encoding'] = 'identity'
+                requests.append(request)
+            return requests
 
     def process_item(self, item, spider):
         """
@@ -56,6 +184,397 @@ class RetroGalleryLocalPipeline(ImagesPipeline):
         adapter['spider'] = spider.name
         return super().process_item(item, spider)
 
+    def close_spider(self, spider):
+        """
+        close_spider() is called when the spider is closed. Flushes and
+        closes the blob or pack index, if either store is in use, and the
+        near-duplicate index, and shuts down the derivative worker pool.
+        When asynchronous writes are enabled, this waits for the writer to
+        finish first. Returns a Deferred if either has to be waited for.
+        """
+        if self.writer is not None:
+            return self.writer.close().addBoth(lambda _: self._close())
+        return self._close()
+
+    def _close(self):
+        if self.near_duplicates is not None:
+            self.near_duplicates.close()
+        if isinstance(self.store, (BlobFilesStore, PackFilesStore)):
+            self.store.close()
+        if self.derivative_pool is not None and not is_shared(self.derivative_pool):
+            return self.derivative_pool.close()
+
+    def media_to_download(self, request, info, *, item=None):
+        """
+        media_to_download() is called for each request before it is
+        downloaded. Returning None forces a download, returning a result
+        dict skips it.
+
+        When the blob store is enabled and a blob has already been
+        downloaded from the request URL (by this or any previous crawl, for
+        any gallery), we link the existing blob into this item's path and
+        report the image as up to date instead of fetching it again.
+        Otherwise we defer to the default check of the stored file's age.
+
+        In a distributed crawl, an image that is not up to date is claimed
+        for this worker before it is downloaded. If another worker has
+        claimed it, we wait for that worker and then link or report its
+        stored image as up to date, so each image is downloaded by one
+        worker only.
+
+        When probing is enabled, an image that is still to be downloaded is
+        first probed (see retrogallery.probe): it fails if its markup or
+        header dimensions are below IMAGES_MIN_WIDTH/HEIGHT, is linked if a
+        stored blob has its size and first bytes, and is stored from the
+        probe response if that holds the whole image.
+
+        When asynchronous writes are enabled, a download is held back while
+        more than RETROGALLERYLOCALPIPELINE_WRITER_MAX_PENDING_BYTES are
+        waiting to be written.
+        """
+        result = self._link_stored_blob(request, info, item)
+        if result is not None:
+            return result
+        dfd = defer.maybeDeferred(super().media_to_download, request, info, item=item)
+        if self.seen_images is not None:
+            dfd.addCallback(self._claim_image, request, info, item)
+        if self.probe_bytes is not None:
+            dfd.addCallback(self._probe_image, request, info, item)
+        if self.writer is not None:
+            dfd.addCallback(self._wait_for_writer)
+        return dfd
+
+    def _wait_for_writer(self, result):
+        if result is not None:
+            return result
+        return self.writer.ready()
+
+    def _link_stored_blob(self, request, info, item):
+        if not isinstance(self.store, BlobFilesStore):
+            return None
+        blob = self.store.blobs.index.blob_for_url(urls.parse_url(request.url).canonical)
+        if not blob or not self.store.blobs.has_blob(blob[0]):
+            return None
+        # Download the URL again once it is older than IMAGES_EXPIRES, as
+        # FilesPipeline.media_to_download does for a stored path
+        age_days = (time.time() - blob[4]) / 60 / 60 / 24
+        if age_days > self.expires:
+            return None
+        return self._link_blob(blob, request, info, item)
+
+    def _link_blob(self, blob, request, info, item):
+        path = self.file_path(request, info=info, item=item)
+        self.inc_stats(info.spider, 'uptodate')
+        result = {
+            'url': request.url,
+            'path': path,
+            'checksum': blob[3],
+            'status': 'uptodate',
+        }
+        linked = self.store.link(blob[0], path)
+        if linked is not None:
+            return linked.addCallback(lambda _: self._describe_blob_entry(result, request, item))
+        return self._describe_blob_entry(result, request, item)
+
+    def _claim_image(self, result, request, info, item):
+        if result is not None:
+            return result
+
+        def _claimed(shared):
+            if shared is None:
+                return None
+            # Another worker stored the image: link its blob if the blob
+            # store is shared, otherwise refer to its path
+            linked = self._link_stored_blob(request, info, item)
+            if linked is not None:
+                return linked
+            self.inc_stats(info.spider, 'uptodate')
+            return dict(shared, url=request.url, status='uptodate')
+
+        return self.seen_images.claim(request.url).addCallback(_claimed)
+
+    def _probe_image(self, result, request, info, item):
+        if result is not None:
+            return result
+        size = self._image(request, item)[2]
+        if size and self._too_small(*size):
+            return self._too_small_failure(request, info, *size)
+
+        def _probed(response):
+            probed = probe.read_probe(response)
+            if probed is None:
+                return None
+            if probed.complete:
+                # The probe fetched the whole image, so store it as the download
+                info.spider.crawler.stats.inc_value('probe/complete', spider=info.spider)
+                return self.media_downloaded(response.replace(status=200), request, info, item=item)
+            if probed.width and self._too_small(probed.width, probed.height):
+                return self._too_small_failure(request, info, probed.width, probed.height)
+            if probed.size and isinstance(self.store, BlobFilesStore):
+                digest = self.store.blobs.find_prefix(probed.size, response.body)
+                if digest is not None:
+                    info.spider.crawler.stats.inc_value('probe/known_blob', spider=info.spider)
+                    linked = defer.maybeDeferred(
+                        self._link_blob, self.store.blobs.index.get_blob(digest), request, info, item
+                    )
+                    if self.seen_images is not None:
+                        linked.addBoth(self.seen_images.done, request.url)
+                    return linked
+            return None
+
+        def _failed(failure):
+            # A failed probe leaves the decision to the download
+            self.logger.debug("Error probing %s: %s", request.url, failure.value)
+            return None
+
+        info.spider.crawler.stats.inc_value('probe/requests', spider=info.spider)
+        dfd = self.crawler.engine.download(probe.probe_request(request, self.probe_bytes))
+        dfd.addCallbacks(_probed, _failed)
+        return dfd
+
+    def _too_small(self, width, height):
+        return width < self.min_width or height < self.min_height
+
+    def _too_small_failure(self, request, info, width, height):
+        # The same failure as an image found too small once downloaded
+        message = f"Image too small ({width}x{height} < {self.min_width}x{self.min_height})"
+        info.spider.crawler.stats.inc_value('probe/too_small', spider=info.spider)
+        self.logger.warning(f"Skipping {request.url}: {message}")
+        failure = Failure(FileException(message))
+        if self.seen_images is not None:
+            self.seen_images.done(failure, request.url)
+        return failure
+
+    def media_downloaded(self, response, request, info, *, item=None):
+        """
+        media_downloaded() is called for each successful download. When the
+        blob store is enabled, we also record which URL and gallery/image
+        titles the stored blob belongs to, so later crawls can find it.
+
+        Streamed responses arrive with an empty body and the spooled body
+        described in request.meta['streamed_file'], which is moved into the
+        store as is.
+
+        When derivatives, thumbnails or minimum dimensions are configured,
+        the image is decoded and resized in the derivative worker pool and
+        a Deferred is returned that fires once the original and its
+        derivatives are stored.
+
+        In a distributed crawl, the stored result is shared with the other
+        workers (or, if storing failed, this worker's claim is released).
+        """
+        if self.seen_images is None and self.checkpoint is None:
+            return self._store_download(response, request, info, item=item)
+        dfd = defer.maybeDeferred(self._store_checkpointed, response, request, info, item=item)
+        if self.seen_images is not None:
+            dfd.addBoth(self.seen_images.done, request.url)
+        return dfd
+
+    def media_failed(self, failure, request, info):
+        """
+        media_failed() is called for each failed download. In a distributed
+        crawl, this worker's claim on the image is released so another
+        worker can try.
+        """
+        if self.seen_images is not None:
+            self.seen_images.done(failure, request.url)
+        return super().media_failed(failure, request, info)
+
+    def _store_checkpointed(self, response, request, info, *, item=None):
+        """
+        Stores a download, journaling the image while it is written to the
+        local store so that a resumed crawl can remove it if the crawl died
+        half way through writing it (see retrogallery.checkpoint).
+        """
+        if self.checkpoint is None or not isinstance(self.store, FSFilesStore):
+            return self._store_download(response, request, info, item=item)
+        path = str(self.store._get_filesystem_path(self.file_path(request, info=info, item=item)))
+        self.checkpoint.media_started(path)
+        dfd = defer.maybeDeferred(self._store_download, response, request, info, item=item)
+        return dfd.addCallback(self._media_stored, path)
+
+    def _media_stored(self, result, path):
+        self.checkpoint.media_stored(path)
+        return result
+
+    def _store_download(self, response, request, info, *, item=None):
+        streamed = request.meta.get(streaming.STREAMED_FILE_META_KEY)
+        if self.derivative_pool is not None:
+            dfd = self._downloaded_with_derivatives(response, request, info, streamed, item=item)
+            if isinstance(self.store, BlobFilesStore):
+                dfd.addCallback(self._describe_blob_entry, request, item)
+            return dfd
+        if streamed is None:
+            result = self._written(request, super().media_downloaded, response, request, info, item=item)
+        else:
+            result = self._written(request, self._streamed_file_downloaded, response, request, info, streamed,
+                                   item=item)
+        if isinstance(self.store, BlobFilesStore):
+            if isinstance(result, defer.Deferred):
+                return result.addCallback(self._describe_blob_entry, request, item)
+            self._describe_blob_entry(result, request, item)
+        return result
+
+    def _written(self, request, store, *args, **kwargs):
+        """
+        Calls store(*args, **kwargs) to store a download. When asynchronous
+        writes are enabled, returns a Deferred firing with its result once
+        the files it queued are written.
+        """
+        if self.writer is None:
+            return store(*args, **kwargs)
+        with self.writer.collect() as writes:
+            result = store(*args, **kwargs)
+        if not writes:
+            return result
+
+        def _failed(failure):
+            self.logger.error(f"Error storing file from {request.url}: {failure.value}")
+            raise FileException(str(failure.value))
+
+        return fswriter.wait_for(writes).addCallbacks(lambda _: result, _failed)
+
+    def derivative_path(self, request, spec, response=None, info=None, *, item=None):
+        """
+        derivative_path() returns the path of a derivative relative to the
+        image store. IMAGES_THUMBS keep the stock thumb_path(); other
+        derivatives are stored beside the original, in a directory named
+        after the derivative.
+        """
+        if spec.name in self.thumbs:
+            return self.thumb_path(request, spec.name, response=response, info=info, item=item)
+        path = self.file_path(request, response=response, info=info, item=item)
+        directory, filename = os.path.split(path)
+        image_guid = os.path.splitext(filename)[0]
+        image_ext = derivatives.EXTENSIONS.get(spec.format, f".{spec.format.lower()}")
+        return f"{directory}/{spec.name}/{image_guid}{image_ext}"
+
+    def _check_download(self, response, request, streamed=None):
+        """
+        Raises FileException if a response did not deliver an image body.
+        """
+        if response.status != 200:
+            self.logger.warning(f"Error downloading {request.url} (status {response.status})")
+            raise FileException("download-error")
+        if not (streamed.size if streamed else response.body):
+            self.logger.warning(f"Empty file from {request.url}")
+            raise FileException("empty-content")
+
+    def _streamed_file_downloaded(self, response, request, info, streamed, *, item=None):
+        """
+        Stores a streamed download without decoding it, returning the same
+        result dict as FilesPipeline.media_downloaded().
+        """
+        try:
+            self._check_download(response, request, streamed)
+        except FileException:
+            streaming.discard(streamed)
+            raise
+        self.inc_stats(info.spider, 'downloaded')
+        try:
+            path = self.file_path(request, response=response, info=info, item=item)
+            streaming.persist_streamed_file(self.store, path, streamed, info, writer=self.writer)
+        except Exception as e:
+            streaming.discard(streamed)
+            self.logger.error(f"Error storing streamed file from {request.url}: {e}")
+            raise FileException(str(e))
+        return {
+            'url': request.url,
+            'path': path,
+            'checksum': streamed.md5,
+            'status': 'downloaded',
+        }
+
+    def _downloaded_with_derivatives(self, response, request, info, streamed, *, item=None):
+        """
+        Renders the derivatives of a download in the worker pool, then
+        stores the original as downloaded plus every derivative. Returns a
+        Deferred firing with the same result dict as
+        FilesPipeline.media_downloaded().
+        """
+        try:
+            self._check_download(response, request, streamed)
+        except FileException:
+            if streamed is not None:
+                streaming.discard(streamed)
+            raise
+        status = 'cached' if 'cached' in response.flags else 'downloaded'
+        self.inc_stats(info.spider, status)
+
+        def _store(rendered):
+            (width, height), outputs = rendered
+            path = self.file_path(request, response=response, info=info, item=item)
+            if streamed is not None:
+                streaming.persist_streamed_file(self.store, path, streamed, info, writer=self.writer)
+                checksum = streamed.md5
+            else:
+                buf = BytesIO(response.body)
+                checksum = md5sum(buf)
+                buf.seek(0)
+                self.store.persist_file(path, buf, info, meta={'width': width, 'height': height})
+            specs = {spec.name: spec for spec in self.derivative_specs}
+            for name, data, (derivative_width, derivative_height) in outputs:
+                spec = specs[name]
+                self.store.persist_file(
+                    self.derivative_path(request, spec, response=response, info=info, item=item),
+                    BytesIO(data),
+                    info,
+                    meta={'width': derivative_width, 'height': derivative_height},
+                    headers={'Content-Type': derivatives.CONTENT_TYPES.get(spec.format, 'image/jpeg')},
+                )
+            return {
+                'url': request.url,
+                'path': path,
+                'checksum': checksum,
+                'status': status,
+            }
+
+        def _failed(failure):
+            if streamed is not None:
+                streaming.discard(streamed)
+            if failure.check(FileException):
+                return failure
+            # Some errors, e.g. a worker process that died, have no message
+            message = f"{failure.type.__name__}: {failure.getErrorMessage()}"
+            self.logger.warning(f"Error processing image from {request.url}: {message}")
+            raise FileException(message)
+
+        source = streamed.path if streamed is not None else response.body
+        dfd = self.derivative_pool.submit(source, self.derivative_specs, self.min_width, self.min_height)
+        dfd.addCallback(lambda rendered: self._written(request, _store, rendered))
+        dfd.addErrback(_failed)
+        return dfd
+
+    def _describe_blob_entry(self, result, request, item):
+        gallery_title, image_title, _ = self._image(request, item)
+        self.store.blobs.index.describe_entry(
+            result['path'],
+            url=request.url,
+            spider=self.spiderinfo.spider.name,
+            gallery_title=gallery_title,
+            image_title=image_title,
+        )
+        if result['status'] != 'uptodate':
+            self.store.blobs.index.record_download(urls.parse_url(request.url).canonical, result['path'])
+        return result
+
+    def _image(self, request, item):
+        """
+        Returns the (gallery_title, image_title, image_size) of the image
+        requested: the image of item at the request's IMAGE_META_KEY index.
+        A GalleryItem carries the title of each of its images, and the
+        image_size, its dimensions in the page markup, is None if unknown.
+        """
+        i = request.meta.get(IMAGE_META_KEY)
+        image_titles = item.get('image_titles')
+        image_sizes = item.get('image_sizes')
+        if i is None:
+            # Not a request of get_media_requests()
+            image_titles = image_sizes = None
+        image_title = image_titles[i] if image_titles and i < len(image_titles) else item.get('image_title')
+        image_size = image_sizes[i] if image_sizes and i < len(image_sizes) else None
+        return item.get('gallery_title'), image_title, image_size
+
     def file_path(self, request, response=None, info=None, *, item=None):
         """
         file_path() is called for each image that is downloaded. It
@@ -65,19 +584,19 @@ class RetroGalleryLocalPipeline(ImagesPipeline):
         as the filename. We override this method to construct a path
         based on the gallery title, image title, and image URL hash.
         """
-        spider = self.spiderinfo.spider.name
-        gallery_title = request.meta.get('gallery_title') or item.get('gallery_title')
-        if not gallery_title:
-            raise DropItem("Missing gallery title")
-        image_title = request.meta.get('image_title') or item.get('image_title')
-        if not image_title:
-            raise DropItem("Missing image title")
-        # deepcode ignore InsecureHash: <not used in a security context>
-        image_guid = hashlib.sha1(request.url.encode()).hexdigest()
-        image_ext = utils.extract_image_extension(request.url)
-        file_path = f"{spider}/{gallery_title}/{image_title}/{image_guid}{image_ext}"
-        self.logger.debug(f"Saving {file_path}")
-        return file_path
+        with self.metrics.time('retrogallery_pipeline_stage_seconds', stage='file_path'):
+            spider = self.spiderinfo.spider.name
+            gallery_title, image_title, _ = self._image(request, item)
+            if not gallery_title:
+                raise DropItem("Missing gallery title")
+            if not image_title:
+                raise DropItem("Missing image title")
+            # The URL's hash and extension come from the URL cache, as
+            # file_path() is called several times per image
+            url = urls.parse_url(request.url)
+            file_path = f"{spider}/{gallery_title}/{image_title}/{url.guid}{url.extension}"
+            self.logger.debug("Saving %s", file_path)
+            return file_path
 
     def item_completed(self, results, item, info):
         """
@@ -89,6 +608,15 @@ class RetroGalleryLocalPipeline(ImagesPipeline):
         Iterates over the results, extracting the the path field from every
         successful result. The list of image paths is added to the image_paths
         field of the item. 
+
+        When near-duplicate detection is enabled, new images are hashed in a
+        worker thread and near-duplicates are linked to the canonical image
+        of their group, whose path is added to their result dict as
+        duplicate_of. A Deferred firing with the item is then returned.
+
+        The results of a GalleryItem are copied with the image_title of each
+        image added, and with RETROGALLERYLOCALPIPELINE_GALLERY_MANIFESTS,
+        the gallery's manifest is stored (see _store_manifest()).
         
         Finally, we return the item so that the next pipeline component can 
         process it.
@@ -135,44 +663,280 @@ class RetroGalleryLocalPipeline(ImagesPipeline):
         Returns:
             item (Item): The scraped item with image_paths added to it.
         """
-        downloads = [x for ok, x in results if ok]
-        if not downloads:
-            raise DropItem("Item contains no images")
-        with suppress(KeyError):
-            ItemAdapter(item)[self.images_result_field] = downloads # type: ignore
-        return item
+        with self.metrics.time('retrogallery_pipeline_stage_seconds', stage='item_completed'):
+            adapter = ItemAdapter(item)
+            image_titles = adapter.get('image_titles')
+            if image_titles is not None:
+                # Results are in request order, and may be shared with other
+                # items through the download cache, so are copied to title
+                results = [
+                    (ok, dict(x, image_title=title) if ok else x)
+                    for (ok, x), title in zip(results, image_titles)
+                ]
+            downloads = [x for ok, x in results if ok]
+            if not downloads:
+                raise DropItem("Item contains no images")
+            with suppress(KeyError):
+                adapter[self.images_result_field] = downloads # type: ignore
+            dfd = None
+            if self.near_duplicates is not None:
+                dfd = self._link_near_duplicates(downloads, info)
+            if self.manifests and image_titles is not None:
+                if dfd is None:
+                    return self._store_manifest(item, results, info)
+                dfd.addCallback(lambda _: self._store_manifest(item, results, info))
+            if dfd is not None:
+                return dfd.addCallback(lambda _: item)
+            return item
+
+    def _store_manifest(self, item, results, info):
+        """
+        Stores the manifest of a GalleryItem, listing every image of the
+        gallery with its download result (or the reason it failed), as
+        {spider}/{gallery_title}/manifest.json and adds its path to the item.
+        Returns a Deferred firing with the item; failures are logged, never
+        raised, so the item is not lost.
+        """
+        adapter = ItemAdapter(item)
+        path = f"{adapter.get('spider')}/{adapter.get('gallery_title')}/{MANIFEST_NAME}"
+        images = []
+        images_urls = adapter.get(self.images_urls_field)
+        for url, title, (ok, result) in zip(images_urls, adapter.get('image_titles'), results):
+            if ok:
+                images.append(result)
+            else:
+                images.append({'url': url, 'image_title': title, 'error': str(result.value)})
+        manifest = {
+            'spider': adapter.get('spider'),
+            'gallery_title': adapter.get('gallery_title'),
+            'gallery_url': adapter.get('gallery_url'),
+            'images': images,
+        }
+        buf = BytesIO(json.dumps(manifest, indent=2, sort_keys=True).encode())
+        headers = {'Content-Type': 'application/json'}
+        # The stores that write asynchronously return a Deferred
+        dfd = defer.maybeDeferred(self.store.persist_file, path, buf, info, headers=headers)
+
+        def _stored(_):
+            adapter['manifest'] = path
+            return item
+
+        def _failed(failure):
+            self.logger.error(f"Error storing the manifest of {adapter.get('gallery_url')}: {failure.value}")
+            return item
+
+        return dfd.addCallbacks(_stored, _failed)
+
+    def _link_near_duplicates(self, downloads, info):
+        """
+        Hashes the downloads that are not in the near-duplicate index yet
+        and links any near-duplicates. Returns a Deferred; failures are
+        logged, never raised, so the item is not lost.
+        """
+        pending = []
+        for download in downloads:
+            path = download['path']
+            if not phash.is_original(path) or self.near_duplicates.get(path) is not None:
+                continue
+            local_path = self.near_duplicate_linker.filesystem_path(path)
+            if local_path is not None:
+                pending.append((download, str(local_path)))
+
+        def _link(results):
+            for (download, _), result in zip(pending, results):
+                if result is None:
+                    continue
+                for path, canonical, distance in self.near_duplicates.add(download['path'], *result):
+                    self.logger.debug(f"{path} is a near-duplicate of {canonical} (distance {distance})")
+                    if self.near_duplicate_linker.link(path, canonical):
+                        info.spider.crawler.stats.inc_value('near_duplicates/linked', spider=info.spider)
+                    if path == download['path']:
+                        download['duplicate_of'] = canonical
+
+        def _failed(failure):
+            self.logger.error(f"Error linking near-duplicates: {failure.value}")
+
+        dfd = threads.deferToThread(
+            phash.hash_files, [local_path for _, local_path in pending], self.near_duplicates.algorithm
+        )
+        return dfd.addCallback(_link).addErrback(_failed)
     
 
-class RetroGalleryS3Pipeline(ImagesPipeline):
+def find_local_store(crawler):
+    """
+    Returns the files store of the crawler's RetroGalleryLocalPipeline, or
+    None if it is not enabled.
+    """
+    for pipe in crawler.engine.scraper.itemproc.middlewares:
+        if isinstance(pipe, RetroGalleryLocalPipeline):
+            return pipe.store
+    return None
+
+
+def local_store_path(local_store, local_store_uri, path):
+    """
+    Returns the local file of an image RetroGalleryLocalPipeline stored at
+    path (relative to the image store), or None if there is none. Images in
+    a pack store have no file of their own.
+    """
+    if isinstance(local_store, PackFilesStore):
+        return None
+    if isinstance(local_store, BlobFilesStore):
+        resolved = local_store.blobs.resolve(path)
+        return resolved[0] if resolved else None
+    if local_store is not None:
+        local_path = local_store._get_filesystem_path(path)
+    else:
+        local_path = Path(local_store_uri, *path.split('/'))
+    return local_path if local_path.exists() else None
+
+
+class RetroGalleryS3Pipeline:
     """
     Uploads images to S3.
+
+    Images are not downloaded again: the files RetroGalleryLocalPipeline
+    stored are uploaded under the same {spider}/{gallery_title}/
+    {image_title}/ layout, concurrently and skipping content that is already
+    in the bucket (see retrogallery.s3). This pipeline must therefore run
+    after RetroGalleryLocalPipeline. Items are passed on as soon as their
+    uploads are queued; the spider does not close until every upload has
+    finished.
     """
-    def __init__(self, store_uri, download_func=None, settings=None):
+    def __init__(self, uploader, local_store_uri):
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.uploader = uploader
+        self.local_store_uri = local_store_uri
+        self.local_store = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
         # If we do not have AWS credentials, raise NotConfigured
         if (not settings or (
                 not settings.get('AWS_ACCESS_KEY_ID') and
                 not settings.get('AWS_SECRET_ACCESS_KEY')
             ) and not settings.get('AWS_SESSION_TOKEN')):
             raise NotConfigured("No AWS credentials found")
-        # If we can find a RETROGALLERYS3PIPELINE_IMAGES_STORE setting,
-        # use that, otherwise use the default store_uri
-        if settings:
-            store_uri = settings.get('RETROGALLERYS3PIPELINE_IMAGES_STORE', store_uri)
-        super().__init__(
-            store_uri=store_uri,
-            download_func=download_func,
-            settings=settings
+        pipe = cls(
+            S3Uploader.from_settings(settings, stats=crawler.stats),
+            settings.get('RETROGALLERYLOCALPIPELINE_IMAGES_STORE')
         )
-"""
+        pipe.crawler = crawler
+        return pipe
+
+    def open_spider(self, spider):
+        self.uploader.start()
+        # Use the local pipeline's store to find files on disk, so paths
+        # that only exist in the blob store's manifest can be resolved too
+        self.local_store = find_local_store(self.crawler)
+
+    def close_spider(self, spider):
+        """
+        close_spider() is called when the spider is closed. Returns a
+        Deferred that fires once every queued upload has finished.
+        """
+        dfd = self.uploader.drain()
+        dfd.addBoth(lambda _: self.uploader.close())
+        return dfd
+
     def process_item(self, item, spider):
+        """
+        process_item() queues an upload for every image the local pipeline
+        stored and returns the item once the uploads have been accepted by
+        the upload queue.
+        """
         adapter = ItemAdapter(item)
-        gallery_title = adapter['gallery_title']
-        image_title = adapter['image_title']
-        images = adapter.get('images', [])
-        for image in images:
-            image_path = image['path']
-            s3_path = f"retrogallery/{spider.name}/{gallery_title}/{image_title}/{image_path}"
-            self.s3_client.upload_file(image_path, self.bucket_name, s3_path)
+        accepted = []
+        for image in adapter.get('images') or []:
+            local_path = self._local_path(image['path'])
+            if local_path is None:
+                self.logger.warning(f"Not uploading {image['path']}: no local file")
+                continue
+            accepted.append(self.uploader.enqueue(local_path, image['path'], image['checksum']))
+        if not accepted:
+            return item
+        return DeferredList(accepted).addCallback(lambda _: item)
+
+    def _local_path(self, path):
+        return local_store_path(self.local_store, self.local_store_uri, path)
+
+
+class RetroGalleryCatalogPipeline:
+    """
+    Writes a columnar catalog of the stored images (see retrogallery.catalog).
+
+    Every image in an item's download results becomes a catalog row. Rows
+    are buffered and written as a Parquet row group, in a worker thread,
+    every RETROGALLERYCATALOGPIPELINE_BATCH_SIZE rows and when the spider
+    closes. Dimensions and sizes are read from the files
+    RetroGalleryLocalPipeline stored, so this pipeline must run after it.
+    Items are passed on at once.
+    """
+    def __init__(self, directory, batch_size, compression, local_store_uri):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.directory = directory
+        self.batch_size = batch_size
+        self.compression = compression
+        self.local_store_uri = local_store_uri
+        self.local_store = None
+        self.writer = None
+        self.rows = []
+        self.local_paths = []
+        # Batches are written one at a time, in order
+        self.writing = defer.succeed(None)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        catalog.require_pyarrow()
+        settings = crawler.settings
+        pipe = cls(
+            settings.get('RETROGALLERYCATALOGPIPELINE_DIR', catalog.DEFAULT_CATALOG_DIR),
+            settings.getint('RETROGALLERYCATALOGPIPELINE_BATCH_SIZE', catalog.DEFAULT_BATCH_SIZE),
+            settings.get('RETROGALLERYCATALOGPIPELINE_COMPRESSION', catalog.DEFAULT_COMPRESSION),
+            settings.get('RETROGALLERYLOCALPIPELINE_IMAGES_STORE'),
+        )
+        pipe.crawler = crawler
+        return pipe
+
+    def open_spider(self, spider):
+        self.local_store = find_local_store(self.crawler)
+        self.writer = catalog.CatalogWriter(
+            catalog.catalog_path(self.directory, spider.name), compression=self.compression
+        )
+
+    def process_item(self, item, spider):
+        """
+        process_item() adds a catalog row for every image the local
+        pipeline stored, writing a batch once enough rows are buffered.
+        """
+        rows = catalog.rows(item, spider.name)
+        for row in rows:
+            # Paths are resolved here as the blob index belongs to this thread
+            self.local_paths.append(
+                local_store_path(self.local_store, self.local_store_uri, row['path']) if row['path'] else None
+            )
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batch_size:
+            self._write()
         return item
-        """
\ No newline at end of file
+
+    def _write(self):
+        rows, local_paths = self.rows, self.local_paths
+        self.rows, self.local_paths = [], []
+
+        def _failed(failure):
+            self.logger.error(f"Error writing {len(rows)} images to the catalog: {failure.value}")
+
+        self.writing.addCallback(lambda _: threads.deferToThread(self.writer.write, rows, local_paths))
+        self.writing.addErrback(_failed)
+
+    def close_spider(self, spider):
+        """
+        close_spider() writes the buffered rows and closes the catalog
+        file. Returns a Deferred that fires once it is closed.
+        """
+        self._write()
+        self.writing.addCallback(lambda _: threads.deferToThread(self.writer.close))
+        self.writing.addErrback(lambda failure: self.logger.error(f"Error closing the catalog: {failure.value}"))
+        return self.writing
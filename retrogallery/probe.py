@@ -0,0 +1,111 @@
+"""
+Probes images before they are downloaded, so RetroGalleryLocalPipeline can
+skip the ones it would throw away or already has.
+
+Every URL in image_urls used to be fetched in full before ImagesPipeline
+looked at it, including icons and placeholders below IMAGES_MIN_WIDTH or
+IMAGES_MIN_HEIGHT and copies of images already in the blob store under
+another URL. With RETROGALLERYLOCALPIPELINE_PROBE, an image is first checked
+against:
+
+    - its dimensions in the page markup (data-orig-size, or the width and
+      height of the original, see retrogallery.variants.original_sizes()),
+      carried in the item's image_sizes, with no request at all
+    - the first RETROGALLERYLOCALPIPELINE_PROBE_BYTES of the image, fetched
+      with a Range request, which give its format and dimensions (from the
+      header, see header_size()) and, with Content-Range, its size in bytes
+
+An image below the minimum dimensions fails as ImagesPipeline would fail it,
+and one whose size and first bytes match a blob already stored is linked to
+that blob. Anything else is downloaded as usual. If the server ignores the
+Range header, or the image is no bigger than the probe, the probe response
+is the whole image and is stored as the download.
+"""
+
+import re
+from collections import namedtuple
+from io import BytesIO
+
+from retrogallery import streaming
+
+
+DEFAULT_PROBE_BYTES = 16384
+
+# The request meta key that marks probe requests
+PROBE_META_KEY = 'image_probe'
+
+_CONTENT_RANGE = re.compile(rb'^bytes\s+(\d+)-(\d+)/(\d+|\*)$')
+
+ImageProbe = namedtuple('ImageProbe', ['format', 'width', 'height', 'size', 'complete'])
+ImageProbe.__doc__ = """
+What a probe response says about an image.
+
+    format (str): The image format (e.g. "JPEG"), or None if the header was
+    not recognised.
+    width (int): The width in pixels, or None.
+    height (int): The height in pixels, or None.
+    size (int): The size of the whole image in bytes, or None if unknown.
+    complete (bool): Whether the response holds the whole image.
+"""
+
+
+def probe_request(request, probe_bytes=DEFAULT_PROBE_BYTES):
+    """
+    Returns a request for the first probe_bytes of the image request asks
+    for. It is neither streamed to disk nor cached, as its body is not the
+    image's.
+    """
+    probe = request.replace()
+    probe.meta.pop(streaming.STREAM_META_KEY, None)
+    probe.meta[PROBE_META_KEY] = True
+    probe.meta['dont_cache'] = True
+    probe.headers['Range'] = f"bytes=0-{probe_bytes - 1}"
+    # Byte ranges of a compressed encoding are no use for the header
+    probe.headers['Accept-Encoding'] = 'identity'
+    return probe
+
+
+def content_range(response):
+    """
+    Returns the (first, last, total) byte positions of a 206 Partial Content
+    response; total is None if the server does not know it.
+    """
+    match = _CONTENT_RANGE.match((response.headers.get('Content-Range') or b'').strip())
+    if match is None:
+        return None
+    first, last, total = match.groups()
+    return int(first), int(last), None if total == b'*' else int(total)
+
+
+def header_size(data):
+    """
+    Returns the (format, width, height) read from the header in the first
+    bytes of an image, or None if it cannot be read from them.
+    """
+    from PIL import Image
+
+    try:
+        # Image.open() only parses the header
+        with Image.open(BytesIO(data)) as image:
+            return (image.format, *image.size)
+    except Exception:
+        return None
+
+
+def read_probe(response):
+    """
+    Returns the ImageProbe of a probe response, or None if the server could
+    not answer it (e.g. 404, or 416 for an empty file).
+    """
+    if response.status == 200:
+        complete, size = True, len(response.body)
+    elif response.status == 206:
+        byte_range = content_range(response)
+        if byte_range is None or byte_range[0] != 0:
+            return None
+        size = byte_range[2]
+        complete = size is not None and byte_range[1] + 1 >= size
+    else:
+        return None
+    image_format, width, height = header_size(response.body) or (None, None, None)
+    return ImageProbe(image_format, width, height, size, complete)
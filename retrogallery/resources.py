@@ -0,0 +1,92 @@
+"""
+Resources shared across the crawls of one process.
+
+A resident crawl service (retrogallery.service) runs many crawls in one
+process. The resources that are slow to set up, or that must not be opened
+twice in one process (the HTTP connection pool, the derivative workers,
+SQLite indexes, the S3 client), are created through shared(): while a
+service runs, each is created once, kept open across its crawls and closed
+when it stops; otherwise shared() just creates it. The modules that use them
+depend on this module rather than on the service.
+"""
+
+import logging
+
+from twisted.internet import defer
+
+
+logger = logging.getLogger(__name__)
+
+
+class Resident:
+    """
+    The resources a running CrawlService keeps open across its jobs, each
+    created on first use and closed when the service stops.
+    """
+
+    def __init__(self):
+        self._resources = {}
+
+    def get(self, key, factory, close='close'):
+        if key not in self._resources:
+            self._resources[key] = (factory(), close)
+        return self._resources[key][0]
+
+    def owns(self, resource):
+        return any(shared is resource for shared, _ in self._resources.values())
+
+    def keys(self):
+        return [key[0] if isinstance(key, tuple) else key for key in self._resources]
+
+    def close(self):
+        resources, self._resources = self._resources, {}
+        closing = []
+        for key, (resource, close) in resources.items():
+            if close is None:
+                continue
+            dfd = defer.maybeDeferred(getattr(resource, close))
+            dfd.addErrback(lambda failure, key=key: logger.warning(f"Error closing {key}: {failure.value}"))
+            closing.append(dfd)
+        return defer.DeferredList(closing)
+
+
+# The Resident of the CrawlService running in this process, if any
+_resident = None
+
+
+def install(resident):
+    """
+    Makes resident keep the resources shared() returns, until uninstall().
+    """
+    global _resident
+    _resident = resident
+
+
+def uninstall():
+    global _resident
+    _resident = None
+
+
+def shared(key, factory, close='close'):
+    """
+    Returns the resource shared under key by every job of the running
+    CrawlService, creating it with factory() on first use, or just
+    factory() when no service is running. Whoever gets a resource from
+    shared() must check is_shared() before closing it.
+
+    Parameters:
+        key (tuple): Names the resource, e.g. ('blobs', basedir).
+        factory (callable): Creates the resource.
+        close (str): The method that closes the resource when the service
+        stops, or None.
+    """
+    if _resident is None:
+        return factory()
+    return _resident.get(key, factory, close)
+
+
+def is_shared(resource):
+    """
+    Returns whether resource is kept open by the running CrawlService.
+    """
+    return _resident is not None and _resident.owns(resource)
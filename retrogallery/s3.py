@@ -0,0 +1,342 @@
+"""
+Concurrent, deduplicating S3 uploads of the local image store.
+
+S3Uploader uploads files that RetroGalleryLocalPipeline has already stored
+locally, so images are fetched from the origin once no matter how many
+stores they end up in. Uploads run on a dedicated thread pool sharing one
+pooled botocore client, and at most queue_size uploads are accepted at a
+time: the pipeline hands items on as soon as their uploads are queued, and
+only waits when the queue is full.
+
+Before uploading, the MD5 of the local file (the checksum FilesPipeline
+already reports) is compared with a local cache of what has been uploaded
+and, failing that, with the x-amz-meta-md5 of the object in the bucket
+(a HEAD request). Objects that already exist are skipped; content that
+exists under another key is copied server side. Files larger than the
+multipart threshold are uploaded in parts, so memory use is bounded by the
+part size.
+
+Any S3-compatible endpoint works, which makes a local stand-in such as moto
+server usable for development and testing:
+
+    moto_server -p 5000
+    scrapy crawl OldCrapGallerySpider \\
+        -s AWS_ENDPOINT_URL=http://127.0.0.1:5000 \\
+        -s AWS_ACCESS_KEY_ID=testing -s AWS_SECRET_ACCESS_KEY=testing
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.boto import is_botocore_available
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+from retrogallery.resources import shared
+
+
+logger = logging.getLogger(__name__)
+
+
+MiB = 1024 * 1024
+
+# The user metadata key holding the MD5 of the whole object; multipart
+# uploads have an ETag that is not the MD5 of their content.
+MD5_METADATA_KEY = 'md5'
+
+
+def parse_s3_uri(uri):
+    """
+    Splits s3://bucket/prefix into (bucket, prefix), where prefix ends in a
+    slash or is empty.
+    """
+    if not uri or not uri.startswith('s3://'):
+        raise ValueError(f"Incorrect URI scheme in {uri}, expected 's3'")
+    bucket, _, prefix = uri[5:].partition('/')
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    return bucket, prefix
+
+
+class S3ObjectCache:
+    """
+    A local SQLite record of the objects known to exist in the bucket, so
+    repeated crawls do not need a HEAD request per image.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS objects (
+            key TEXT PRIMARY KEY,
+            md5 TEXT NOT NULL,
+            size INTEGER,
+            uploaded REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS objects_md5 ON objects(md5);
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.executescript(self.SCHEMA)
+
+    def md5_for_key(self, key):
+        row = self.conn.execute("SELECT md5 FROM objects WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def key_for_md5(self, md5):
+        row = self.conn.execute("SELECT key FROM objects WHERE md5 = ? LIMIT 1", (md5,)).fetchone()
+        return row[0] if row else None
+
+    def record(self, key, md5, size=None):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO objects (key, md5, size, uploaded) VALUES (?, ?, ?, ?)",
+            (key, md5, size, time.time())
+        )
+        self.conn.commit()
+
+    def forget(self, key):
+        self.conn.execute("DELETE FROM objects WHERE key = ?", (key,))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class S3Uploader:
+    """
+    Uploads local files to S3 on a bounded thread pool.
+
+    Parameters:
+        client: A botocore S3 client.
+        bucket (str): The destination bucket.
+        prefix (str): A prefix for every key.
+        cache (S3ObjectCache): The local record of uploaded objects.
+        concurrency (int): The number of simultaneous uploads.
+        queue_size (int): The number of uploads accepted before enqueue()
+        starts to wait.
+        multipart_threshold (int): Files at least this large, in bytes, are
+        uploaded in parts.
+        part_size (int): The multipart part size in bytes (at least 5 MiB).
+        stats (StatsCollector): Optional crawler stats.
+    """
+
+    def __init__(self, client, bucket, prefix, cache, concurrency=8, queue_size=64,
+                 multipart_threshold=16 * MiB, part_size=8 * MiB, stats=None):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cache = cache
+        self.concurrency = concurrency
+        self.multipart_threshold = multipart_threshold
+        self.part_size = max(part_size, 5 * MiB)
+        self.stats = stats
+        self._queue = defer.DeferredSemaphore(max(queue_size, concurrency))
+        self._inflight = set()
+        self._threadpool = None
+
+    @classmethod
+    def from_settings(cls, settings, stats=None):
+        if not is_botocore_available():
+            raise NotConfigured("missing botocore library")
+        import botocore.session
+        from botocore.config import Config
+
+        bucket, prefix = parse_s3_uri(settings.get('RETROGALLERYS3PIPELINE_IMAGES_STORE'))
+        concurrency = settings.getint('RETROGALLERYS3PIPELINE_CONCURRENCY', 8)
+        options = dict(
+            aws_access_key_id=settings.get('AWS_ACCESS_KEY_ID'),
+            aws_secret_access_key=settings.get('AWS_SECRET_ACCESS_KEY'),
+            aws_session_token=settings.get('AWS_SESSION_TOKEN'),
+            endpoint_url=settings.get('AWS_ENDPOINT_URL'),
+            region_name=settings.get('AWS_REGION_NAME'),
+            use_ssl=settings.getbool('AWS_USE_SSL', True),
+            verify=settings.get('AWS_VERIFY'),
+        )
+        # The jobs of a crawl service share a client per account, endpoint
+        # and concurrency (see retrogallery.service)
+        client = shared(
+            ('s3_client', concurrency, *options.values()),
+            lambda: botocore.session.get_session().create_client(
+                's3',
+                # One connection per upload thread, reused across uploads
+                config=Config(
+                    max_pool_connections=concurrency,
+                    retries={'max_attempts': 5, 'mode': 'standard'},
+                ),
+                **options
+            ),
+            close=None,
+        )
+        return cls(
+            client,
+            bucket,
+            prefix,
+            S3ObjectCache(settings.get('RETROGALLERYS3PIPELINE_CACHE_DB', '/tmp/retrogallery/s3cache.sqlite3')),
+            concurrency=concurrency,
+            queue_size=settings.getint('RETROGALLERYS3PIPELINE_QUEUE_SIZE', 64),
+            multipart_threshold=settings.getint('RETROGALLERYS3PIPELINE_MULTIPART_THRESHOLD', 16 * MiB),
+            part_size=settings.getint('RETROGALLERYS3PIPELINE_PART_SIZE', 8 * MiB),
+            stats=stats,
+        )
+
+    def start(self):
+        self._threadpool = ThreadPool(1, self.concurrency, name='S3Uploader')
+        self._threadpool.start()
+
+    def _inc_stats(self, key):
+        if self.stats:
+            self.stats.inc_value(f's3/{key}')
+
+    def enqueue(self, local_path, key, md5):
+        """
+        Queues an upload of local_path to key, unless the local cache says
+        the object already holds content with this MD5.
+
+        Returns:
+            Deferred: Fires once the upload has been accepted into the
+            queue, not when it completes. See drain().
+        """
+        key = f"{self.prefix}{key}"
+        if self.cache.md5_for_key(key) == md5:
+            self._inc_stats('skipped_cached')
+            return defer.succeed(None)
+        return self._queue.acquire().addCallback(self._start_upload, str(local_path), key, md5)
+
+    def _start_upload(self, _, local_path, key, md5):
+        from twisted.internet import reactor
+
+        try:
+            copy_source = self.cache.key_for_md5(md5)
+            dfd = threads.deferToThreadPool(
+                reactor, self._threadpool, self._upload, local_path, key, md5, copy_source
+            )
+        except Exception:
+            # The upload never started, so give its slot back
+            self._queue.release()
+            raise
+        self._inflight.add(dfd)
+
+        def _done(result):
+            self._inflight.discard(dfd)
+            self._queue.release()
+            status, size = result
+            self.cache.record(key, md5, size)
+            self._inc_stats(status)
+            logger.debug("S3 %s: s3://%s/%s", status, self.bucket, key)
+
+        def _failed(failure):
+            self._inflight.discard(dfd)
+            self._queue.release()
+            self._inc_stats('failed')
+            logger.error("S3 upload of %s to s3://%s/%s failed: %s", local_path, self.bucket, key, failure.value)
+
+        dfd.addCallbacks(_done, _failed)
+
+    def drain(self):
+        """
+        Returns a Deferred that fires when every accepted upload has
+        finished.
+        """
+        return defer.DeferredList(list(self._inflight), consumeErrors=True)
+
+    def close(self):
+        if self._threadpool is not None:
+            self._threadpool.stop()
+            self._threadpool = None
+        self.cache.close()
+
+    # The methods below run on the upload thread pool.
+
+    def _upload(self, local_path, key, md5, copy_source=None):
+        """
+        Makes s3://bucket/key hold the content of local_path.
+
+        Returns:
+            (status, size): status is one of exists, copied, uploaded or
+            uploaded_multipart.
+        """
+        import botocore.exceptions
+
+        size = os.path.getsize(local_path)
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=key)
+            if head.get('Metadata', {}).get(MD5_METADATA_KEY) == md5 or head.get('ETag', '').strip('"') == md5:
+                return 'exists', size
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+                raise
+
+        if copy_source and copy_source != key:
+            try:
+                self.client.copy_object(
+                    Bucket=self.bucket,
+                    Key=key,
+                    CopySource={'Bucket': self.bucket, 'Key': copy_source},
+                    MetadataDirective='COPY',
+                )
+                return 'copied', size
+            except botocore.exceptions.ClientError:
+                # The source has gone; fall back to uploading
+                logger.debug("S3 copy from %s to %s failed, uploading instead", copy_source, key)
+
+        if size < self.multipart_threshold:
+            with open(local_path, 'rb') as f:
+                self.client.put_object(
+                    Bucket=self.bucket,
+                    Key=key,
+                    Body=f,
+                    ContentMD5=self._content_md5(md5),
+                    Metadata={MD5_METADATA_KEY: md5},
+                )
+            return 'uploaded', size
+        self._upload_multipart(local_path, key, md5)
+        return 'uploaded_multipart', size
+
+    @staticmethod
+    def _content_md5(md5):
+        import base64
+
+        return base64.b64encode(bytes.fromhex(md5)).decode('ascii')
+
+    def _upload_multipart(self, local_path, key, md5):
+        upload = self.client.create_multipart_upload(
+            Bucket=self.bucket,
+            Key=key,
+            Metadata={MD5_METADATA_KEY: md5},
+        )
+        upload_id = upload['UploadId']
+        parts = []
+        try:
+            with open(local_path, 'rb') as f:
+                part_number = 1
+                while True:
+                    chunk = f.read(self.part_size)
+                    if not chunk:
+                        break
+                    # deepcode ignore InsecureHash: <not used in a security context>
+                    part_md5 = hashlib.md5(chunk).hexdigest()
+                    response = self.client.upload_part(
+                        Bucket=self.bucket,
+                        Key=key,
+                        UploadId=upload_id,
+                        PartNumber=part_number,
+                        Body=chunk,
+                        ContentMD5=self._content_md5(part_md5),
+                    )
+                    parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+                    part_number += 1
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts},
+            )
+        except Exception:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
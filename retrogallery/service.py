@@ -0,0 +1,659 @@
+"""
+A resident crawl service: one process, one reactor, many crawl jobs.
+
+Every scrapy crawl (or python -m retrogallery.checkpoint crawl) pays for
+interpreter startup, importing Scrapy, Pillow and botocore, installing the
+reactor and warming up the pipelines, then throws it all away. For the many
+small, targeted re-crawls a scheduler fires, that dominates the crawl
+itself. CrawlService instead keeps one reactor running and accepts jobs
+over a local HTTP API:
+
+    python -m retrogallery.service serve
+    python -m retrogallery.service submit OldCrapGallerySpider \\
+        --gallery https://oldcrap.org/2018/02/21/texas-instruments-ti-99-4a/ --follow
+    python -m retrogallery.service jobs
+
+A job names a spider, optionally with its start URLs, the gallery pages to
+crawl instead of discovering them (see retrogallery.discovery) and setting
+overrides. Jobs may only override the settings in
+RETROGALLERY_SERVICE_JOB_SETTINGS (by default JOB_OVERRIDABLE_SETTINGS),
+which tune a crawl but cannot load code, write outside the service's
+directories or open ports. Up to RETROGALLERY_SERVICE_MAX_JOBS jobs run at
+once, each with its own crawler and stats; the rest wait in line.
+
+The resources that are slow to set up, or that must not be opened twice in
+one process, are kept open across jobs and shared by them (see
+retrogallery.resources):
+
+    - the HTTP connection pool of the download handler, so connections to
+      the gallery sites are kept alive between jobs
+    - the derivative worker processes (retrogallery.derivatives)
+    - the blob store index, HTTP cache index and incremental crawl state,
+      whose SQLite connections would otherwise lock each other out
+    - the botocore S3 client
+
+The API, on RETROGALLERY_SERVICE_HOST:PORT (127.0.0.1 unless set otherwise)
+or on the Unix socket RETROGALLERY_SERVICE_SOCKET, has no authentication
+and speaks JSON:
+
+    GET    /                  the service: uptime, job counts, shared resources
+    GET    /jobs              every job, newest first
+    POST   /jobs              submits {"spider": ..., "start_urls": [...],
+                              "gallery_urls": [...], "settings": {...}}
+    GET    /jobs/<id>         a job with its stats (and metrics, if enabled)
+    GET    /jobs/<id>/events  the job's events so far and then as they happen,
+                              one JSON object per line, until it ends
+    DELETE /jobs/<id>         cancels a job
+
+Progress events carry the numeric stats that changed in the last
+RETROGALLERY_SERVICE_PROGRESS_INTERVAL seconds. The latest
+RETROGALLERY_SERVICE_KEEP_JOBS finished jobs are remembered.
+
+Jobs run without checkpoints, the metrics endpoint and dump, and the telnet
+console, which would collide between jobs; a job's settings can turn
+checkpoints back on (each job then journals to its own checkpoint
+directory). The pack store (retrogallery.packstore) cannot be shared by
+concurrent jobs: run pack store jobs with
+RETROGALLERY_SERVICE_MAX_JOBS = 1.
+"""
+
+import argparse
+import http.client
+import ipaddress
+import json
+import logging
+import socket
+import sys
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+
+from twisted.internet import defer
+
+from retrogallery import resources
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 9420
+DEFAULT_MAX_JOBS = 4
+DEFAULT_PROGRESS_INTERVAL = 5
+DEFAULT_KEEP_JOBS = 100
+
+# Settings every job starts from, before its own overrides
+JOB_SETTINGS = {
+    'RETROGALLERY_CHECKPOINT_ENABLED': False,
+    'RETROGALLERY_METRICS_PORT': 0,
+    'RETROGALLERY_METRICS_DUMP': '',
+    'TELNETCONSOLE_ENABLED': False,
+}
+
+# The settings a job may override, unless RETROGALLERY_SERVICE_JOB_SETTINGS
+# says otherwise. Anything that loads classes (ITEM_PIPELINES, DOWNLOADER,
+# SCHEDULER, ...), names files or directories (FILES_STORE, the databases)
+# or opens ports is left to whoever runs the service.
+JOB_OVERRIDABLE_SETTINGS = (
+    'AUTOTHROTTLE_ENABLED',
+    'AUTOTHROTTLE_MAX_DELAY',
+    'AUTOTHROTTLE_START_DELAY',
+    'AUTOTHROTTLE_TARGET_CONCURRENCY',
+    'CLOSESPIDER_ERRORCOUNT',
+    'CLOSESPIDER_ITEMCOUNT',
+    'CLOSESPIDER_PAGECOUNT',
+    'CLOSESPIDER_TIMEOUT',
+    'CONCURRENT_ITEMS',
+    'CONCURRENT_REQUESTS',
+    'CONCURRENT_REQUESTS_PER_DOMAIN',
+    'DEPTH_LIMIT',
+    'DOWNLOAD_DELAY',
+    'DOWNLOAD_TIMEOUT',
+    'HTTPCACHE_ENABLED',
+    'IMAGES_EXPIRES',
+    'IMAGES_MIN_HEIGHT',
+    'IMAGES_MIN_WIDTH',
+    'LOG_LEVEL',
+    'RANDOMIZE_DOWNLOAD_DELAY',
+    'RETRY_ENABLED',
+    'RETRY_TIMES',
+    'RETROGALLERY_CHECKPOINT_ENABLED',
+    'RETROGALLERY_CHECKPOINT_INTERVAL',
+    'RETROGALLERY_DISCOVERY',
+    'RETROGALLERY_EXTRACTION_ENGINE',
+    'RETROGALLERY_GALLERY_ITEMS',
+    'RETROGALLERY_IMAGE_VARIANT_POLICY',
+    'RETROGALLERY_INCREMENTAL',
+    'RETROGALLERYLOCALPIPELINE_GALLERY_MANIFESTS',
+    'RETROGALLERYLOCALPIPELINE_PROBE',
+)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+DONE = (FINISHED, FAILED, CANCELLED)
+
+# The most events a job keeps for replay to new listeners
+MAX_EVENTS = 1000
+
+
+class CrawlJob:
+    """
+    A crawl submitted to a CrawlService.
+
+    Parameters:
+        spider (str): The name of the spider.
+        start_urls (list): Start URLs replacing the spider's, or None.
+        gallery_urls (list): Gallery pages to crawl instead of discovering
+        galleries, or None.
+        overrides (dict): Settings overriding the service's.
+    """
+
+    def __init__(self, spider, start_urls=None, gallery_urls=None, overrides=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.spider = spider
+        self.start_urls = start_urls
+        self.gallery_urls = gallery_urls
+        self.overrides = overrides or {}
+        self.state = QUEUED
+        self.reason = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.crawler = None
+        self.stats = {}
+        self.metrics = None
+        self.events = deque(maxlen=MAX_EVENTS)
+        self.listeners = set()
+        self._reported = {}
+
+    @property
+    def done(self):
+        return self.state in DONE
+
+    def spider_kwargs(self):
+        kwargs = {}
+        if self.start_urls:
+            kwargs['start_urls'] = list(self.start_urls)
+        if self.gallery_urls:
+            kwargs['gallery_urls'] = list(self.gallery_urls)
+        return kwargs
+
+    def current_stats(self):
+        if self.crawler is not None and self.crawler.stats is not None:
+            return self.crawler.stats.get_stats()
+        return self.stats
+
+    def emit(self, event, **fields):
+        """
+        Records an event and sends it to every listener.
+        """
+        line = json.dumps(dict(fields, time=time.time(), job=self.id, event=event), default=str)
+        self.events.append(line)
+        for request in list(self.listeners):
+            request.write(line.encode('utf-8') + b'\n')
+            if self.done:
+                request.finish()
+        if self.done:
+            self.listeners.clear()
+
+    def progress(self):
+        """
+        Emits a progress event with the numeric stats that changed since
+        the last one.
+        """
+        changed = {
+            key: value for key, value in self.current_stats().items()
+            if isinstance(value, (int, float)) and self._reported.get(key) != value
+        }
+        if changed:
+            self._reported.update(changed)
+            self.emit('progress', stats=changed)
+
+    def to_dict(self, stats=False):
+        job = {
+            'id': self.id,
+            'spider': self.spider,
+            'start_urls': self.start_urls,
+            'gallery_urls': self.gallery_urls,
+            'settings': self.overrides,
+            'state': self.state,
+            'reason': self.reason,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+        }
+        if stats:
+            job['stats'] = self.current_stats()
+            if self.metrics is not None:
+                job['metrics'] = self.metrics.snapshot()
+        return job
+
+
+class CrawlService:
+    """
+    Runs crawl jobs on one reactor, sharing a CrawlerProcess and its warm
+    resources between them. See the module docstring.
+
+    Parameters:
+        process (CrawlerProcess): Runs the jobs' crawlers.
+        max_jobs (int): The most jobs that run at once.
+        progress_interval (float): Seconds between progress events.
+        keep_jobs (int): The number of finished jobs to remember.
+        job_settings (iterable): The settings a job may override.
+    """
+
+    def __init__(self, process, max_jobs=DEFAULT_MAX_JOBS, progress_interval=DEFAULT_PROGRESS_INTERVAL,
+                 keep_jobs=DEFAULT_KEEP_JOBS, job_settings=JOB_OVERRIDABLE_SETTINGS):
+        self.process = process
+        self.settings = process.settings
+        self.progress_interval = progress_interval
+        self.keep_jobs = keep_jobs
+        self.job_settings = frozenset(job_settings)
+        self.jobs = {}
+        self.resident = resources.Resident()
+        self.started = time.time()
+        self._slots = defer.DeferredSemaphore(max_jobs)
+        self._task = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        from scrapy.crawler import CrawlerProcess
+        from scrapy.utils.reactor import install_reactor
+
+        process = CrawlerProcess(settings)
+        # Jobs' crawlers expect the reactor to be installed already, and the
+        # API listens before the first job
+        if settings.get('TWISTED_REACTOR'):
+            install_reactor(settings['TWISTED_REACTOR'], settings.get('ASYNCIO_EVENT_LOOP'))
+        return cls(
+            process,
+            max_jobs=settings.getint('RETROGALLERY_SERVICE_MAX_JOBS', DEFAULT_MAX_JOBS),
+            progress_interval=settings.getfloat('RETROGALLERY_SERVICE_PROGRESS_INTERVAL', DEFAULT_PROGRESS_INTERVAL),
+            keep_jobs=settings.getint('RETROGALLERY_SERVICE_KEEP_JOBS', DEFAULT_KEEP_JOBS),
+            job_settings=settings.getlist('RETROGALLERY_SERVICE_JOB_SETTINGS', JOB_OVERRIDABLE_SETTINGS),
+        )
+
+    def submit(self, spider, start_urls=None, gallery_urls=None, overrides=None):
+        """
+        Queues a job, returning its CrawlJob.
+
+        Raises:
+            KeyError: If there is no spider of that name.
+            TypeError: If overrides is not a dict.
+            ValueError: If overrides sets a setting jobs may not override.
+        """
+        self.process.spider_loader.load(spider)
+        if not isinstance(overrides or {}, dict):
+            raise TypeError("settings must be an object")
+        forbidden = sorted(set(overrides or {}) - self.job_settings)
+        if forbidden:
+            raise ValueError(f"jobs cannot override {', '.join(forbidden)}")
+        job = CrawlJob(spider, start_urls, gallery_urls, overrides)
+        self.jobs[job.id] = job
+        job.emit(QUEUED)
+        self._slots.run(self._run, job)
+        self._forget_finished()
+        return job
+
+    def _run(self, job):
+        if job.done:
+            return None
+        from scrapy import signals
+        from scrapy.crawler import Crawler
+        from retrogallery.checkpoint import DEFAULT_CHECKPOINT_DIR
+        from retrogallery.metrics import NULL_METRICS, get_metrics
+
+        settings = self.settings.copy()
+        settings.setdict(JOB_SETTINGS, priority='cmdline')
+        settings.setdict(job.overrides, priority='cmdline')
+        if settings.getbool('RETROGALLERY_CHECKPOINT_ENABLED'):
+            checkpoint_dir = settings.get('RETROGALLERY_CHECKPOINT_DIR') or DEFAULT_CHECKPOINT_DIR
+            settings.set('RETROGALLERY_CHECKPOINT_DIR', str(Path(checkpoint_dir, 'jobs', job.id)), priority='cmdline')
+        try:
+            job.crawler = Crawler(self.process.spider_loader.load(job.spider), settings)
+        except Exception as e:
+            self._finish(job, FAILED, str(e))
+            return None
+
+        def _closed(spider, reason):
+            job.reason = reason
+
+        job.crawler.signals.connect(_closed, signal=signals.spider_closed, weak=False)
+        metrics = get_metrics(job.crawler)
+        job.metrics = None if metrics is NULL_METRICS else metrics
+        job.state = RUNNING
+        job.started = time.time()
+        job.emit(RUNNING)
+        logger.info(f"Job {job.id}: crawling {job.spider}")
+        dfd = self.process.crawl(job.crawler, **job.spider_kwargs())
+        dfd.addCallbacks(
+            lambda _: self._finish(job, CANCELLED if job.reason == CANCELLED else FINISHED, job.reason),
+            lambda failure: self._finish(job, FAILED, str(failure.value)),
+        )
+        return dfd
+
+    def _finish(self, job, state, reason):
+        if job.crawler is not None:
+            job.stats = dict(job.crawler.stats.get_stats())
+            job.crawler = None
+        job.state = state
+        job.reason = reason
+        job.finished = time.time()
+        logger.info(f"Job {job.id}: {state} ({reason})")
+        job.emit(state, reason=reason, stats=job.stats)
+
+    def cancel(self, job):
+        """
+        Cancels a queued job, or closes the spider of a running one.
+        """
+        if job.state == QUEUED:
+            self._finish(job, CANCELLED, CANCELLED)
+        elif job.state == RUNNING and job.crawler is not None and job.crawler.engine is not None:
+            job.crawler.engine.close_spider(job.crawler.spider, CANCELLED)
+
+    def _forget_finished(self):
+        finished = sorted((job for job in self.jobs.values() if job.done), key=lambda job: job.finished)
+        for job in finished[:max(len(finished) - self.keep_jobs, 0)]:
+            del self.jobs[job.id]
+
+    def _progress(self):
+        for job in self.jobs.values():
+            if job.state == RUNNING:
+                job.progress()
+
+    def describe(self):
+        states = {}
+        for job in self.jobs.values():
+            states[job.state] = states.get(job.state, 0) + 1
+        return {
+            'uptime': time.time() - self.started,
+            'jobs': states,
+            'shared': self.resident.keys(),
+        }
+
+    def listen(self, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None):
+        """
+        Serves the job API on host:port, or on the Unix socket socket_path,
+        and returns the listening port. An empty host is the loopback
+        interface, not every interface.
+        """
+        from twisted.internet import reactor
+        from twisted.web.server import Site
+
+        site = Site(_api_resource(self))
+        if socket_path:
+            Path(socket_path).unlink(missing_ok=True)
+            listener = reactor.listenUNIX(socket_path, site)
+            logger.info(f"Serving crawl jobs on {socket_path}")
+            return listener
+        host = host or DEFAULT_HOST
+        if not _is_loopback(host):
+            logger.warning(f"The crawl service API on {host} has no authentication and is reachable from other hosts")
+        listener = reactor.listenTCP(port, site, interface=host)
+        logger.info(f"Serving crawl jobs on http://{host}:{listener.getHost().port}/jobs")
+        return listener
+
+    def start(self):
+        """
+        Runs the reactor until the process is interrupted.
+        """
+        from twisted.internet import reactor, task
+
+        resources.install(self.resident)
+        self._task = task.LoopingCall(self._progress)
+        self._task.start(self.progress_interval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self._stop)
+        self.process.start(stop_after_crawl=False)
+
+    def _stop(self):
+        if self._task is not None and self._task.running:
+            self._task.stop()
+        resources.uninstall()
+        return self.resident.close()
+
+
+def _is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _json_body(request, status, body):
+    request.setResponseCode(status)
+    request.setHeader(b'Content-Type', b'application/json')
+    return json.dumps(body, default=str).encode('utf-8')
+
+
+def _api_resource(service):
+    from twisted.web.resource import Resource
+    from twisted.web.server import NOT_DONE_YET
+
+    class ServiceAPI(Resource):
+        isLeaf = True
+
+        def render(self, request):
+            path = [part.decode('utf-8') for part in request.postpath if part]
+            method = request.method.decode('ascii')
+            if not path:
+                return _json_body(request, 200, service.describe())
+            if path[0] != 'jobs' or len(path) > 3:
+                return _json_body(request, 404, {'error': 'not found'})
+            if len(path) == 1:
+                if method == 'GET':
+                    jobs = sorted(service.jobs.values(), key=lambda job: job.submitted, reverse=True)
+                    return _json_body(request, 200, [job.to_dict() for job in jobs])
+                if method == 'POST':
+                    return self.submit(request)
+                return _json_body(request, 405, {'error': 'method not allowed'})
+            job = service.jobs.get(path[1])
+            if job is None:
+                return _json_body(request, 404, {'error': f"no job {path[1]}"})
+            if len(path) == 3:
+                if path[2] != 'events' or method != 'GET':
+                    return _json_body(request, 404, {'error': 'not found'})
+                return self.events(request, job)
+            if method == 'GET':
+                return _json_body(request, 200, job.to_dict(stats=True))
+            if method == 'DELETE':
+                service.cancel(job)
+                return _json_body(request, 202, job.to_dict())
+            return _json_body(request, 405, {'error': 'method not allowed'})
+
+        def submit(self, request):
+            try:
+                body = json.loads(request.content.read() or b'{}')
+                job = service.submit(
+                    body['spider'],
+                    start_urls=body.get('start_urls'),
+                    gallery_urls=body.get('gallery_urls'),
+                    overrides=body.get('settings'),
+                )
+            except (ValueError, KeyError, TypeError) as e:
+                return _json_body(request, 400, {'error': f"bad job: {e}"})
+            return _json_body(request, 201, job.to_dict())
+
+        def events(self, request, job):
+            request.setHeader(b'Content-Type', b'application/x-ndjson')
+            for line in job.events:
+                request.write(line.encode('utf-8') + b'\n')
+            if job.done:
+                return b''
+            job.listeners.add(request)
+            request.notifyFinish().addBoth(lambda _: job.listeners.discard(request))
+            return NOT_DONE_YET
+
+    return ServiceAPI()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class ServiceClient:
+    """
+    A client for the job API of a running CrawlService.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None, timeout=30):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def _connection(self, timeout):
+        if self.socket_path:
+            return _UnixHTTPConnection(self.socket_path, timeout=timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def request(self, method, path, body=None):
+        """
+        Returns the (status, decoded JSON) of an API request.
+        """
+        connection = self._connection(self.timeout)
+        try:
+            headers = {'Content-Type': 'application/json'} if body is not None else {}
+            connection.request(method, path, body=None if body is None else json.dumps(body), headers=headers)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read() or b'null')
+        finally:
+            connection.close()
+
+    def events(self, job_id):
+        """
+        Yields the events of a job, decoded, until it ends.
+        """
+        connection = self._connection(None)
+        try:
+            connection.request('GET', f'/jobs/{job_id}/events')
+            response = connection.getresponse()
+            if response.status != 200:
+                raise RuntimeError(json.loads(response.read() or b'null'))
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            connection.close()
+
+
+def _setting(value):
+    key, sep, value = value.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got {key!r}")
+    return key, value
+
+
+def _print_job(job):
+    finished = job.get('finished') or time.time()
+    elapsed = f"{finished - job['started']:.1f}s" if job.get('started') else '-'
+    reason = f" ({job['reason']})" if job.get('reason') and job['reason'] != job['state'] else ''
+    print(f"{job['id']}  {job['spider']:<28} {job['state']}{reason}  {elapsed}")
+
+
+def _print_event(event):
+    if event['event'] == 'progress':
+        stats = ', '.join(f"{key}={value}" for key, value in sorted(event['stats'].items()))
+        print(f"{event['job']} progress: {stats}")
+    else:
+        reason = f" ({event['reason']})" if event.get('reason') and event['reason'] != event['event'] else ''
+        print(f"{event['job']} {event['event']}{reason}")
+
+
+def main(argv=None):
+    from scrapy.utils.project import get_project_settings
+
+    settings = get_project_settings()
+    parser = argparse.ArgumentParser(
+        prog='python -m retrogallery.service',
+        description='Run a resident retrogallery crawl service, and submit and follow its jobs.'
+    )
+    parser.add_argument('--host', default=settings.get('RETROGALLERY_SERVICE_HOST', DEFAULT_HOST),
+                        help='API host (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=settings.getint('RETROGALLERY_SERVICE_PORT', DEFAULT_PORT),
+                        help='API port (default: %(default)s)')
+    parser.add_argument('--socket', default=settings.get('RETROGALLERY_SERVICE_SOCKET'),
+                        help='serve or connect to the API on this Unix socket instead')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('serve', help='run the service until interrupted')
+    command.add_argument('--max-jobs', type=int,
+                         default=settings.getint('RETROGALLERY_SERVICE_MAX_JOBS', DEFAULT_MAX_JOBS),
+                         help='jobs run at once (default: %(default)s)')
+    command.add_argument('-s', '--set', type=_setting, action='append', metavar='KEY=VALUE',
+                         help='override a Scrapy setting for every job')
+    command = commands.add_parser('submit', help='submit a crawl job')
+    command.add_argument('spider')
+    command.add_argument('--url', action='append', dest='start_urls', metavar='URL',
+                         help="replace the spider's start URLs")
+    command.add_argument('--gallery', action='append', dest='gallery_urls', metavar='URL',
+                         help='crawl this gallery page instead of discovering galleries')
+    command.add_argument('-s', '--set', type=_setting, action='append', metavar='KEY=VALUE',
+                         help='override a Scrapy setting for this job')
+    command.add_argument('--follow', action='store_true', help="print the job's events until it ends")
+    commands.add_parser('jobs', help='list the jobs')
+    commands.add_parser('status', help='show a job and its stats').add_argument('job')
+    commands.add_parser('events', help="print a job's events until it ends").add_argument('job')
+    commands.add_parser('cancel', help='cancel a job').add_argument('job')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        settings.setdict(dict(args.set or []), priority='cmdline')
+        settings.set('RETROGALLERY_SERVICE_MAX_JOBS', args.max_jobs, priority='cmdline')
+        service = CrawlService.from_settings(settings)
+        service.listen(args.host, args.port, args.socket)
+        service.start()
+        return 0
+
+    client = ServiceClient(args.host, args.port, args.socket)
+    try:
+        if args.command == 'submit':
+            status, job = client.request('POST', '/jobs', {
+                'spider': args.spider,
+                'start_urls': args.start_urls,
+                'gallery_urls': args.gallery_urls,
+                'settings': dict(args.set or []),
+            })
+            if status != 201:
+                print(job['error'], file=sys.stderr)
+                return 1
+            print(job['id'])
+            if args.follow:
+                for event in client.events(job['id']):
+                    _print_event(event)
+                    if event['event'] in DONE:
+                        return 0 if event['event'] == FINISHED else 1
+            return 0
+        if args.command == 'jobs':
+            _, jobs = client.request('GET', '/jobs')
+            for job in jobs:
+                _print_job(job)
+            return 0
+        if args.command == 'events':
+            for event in client.events(args.job):
+                _print_event(event)
+            return 0
+        method = 'DELETE' if args.command == 'cancel' else 'GET'
+        status, job = client.request(method, f'/jobs/{args.job}')
+        if status >= 400:
+            print(job['error'], file=sys.stderr)
+            return 1
+        print(json.dumps(job, indent=2, default=str))
+        return 0
+    except (OSError, RuntimeError) as e:
+        print(f"Cannot reach the crawl service: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,10 +6,6 @@
 #     https://docs.scrapy.org/en/latest/topics/settings.html
 #     https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 #     https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-import copy
-import scrapy.utils.log
-from colorlog import ColoredFormatter
-
 BOT_NAME = "retrogallery"
 
 SPIDER_MODULES = ["retrogallery.spiders"]
@@ -49,34 +45,194 @@ ROBOTSTXT_OBEY = True
 #SPIDER_MIDDLEWARES = {
 #    "retrogallery.middlewares.RetrogallerySpiderMiddleware": 543,
 #}
+SPIDER_MIDDLEWARES = {
+    # Only the first worker of a distributed crawl schedules start requests
+    "retrogallery.distributed.SharedStartRequestsMiddleware": 50,
+    # Record changed gallery pages for incremental re-crawls once their
+    # images are stored; closer to the engine than the checkpoint, which
+    # skips items completed before a resume
+    "retrogallery.middlewares.IncrementalPageMiddleware": 90,
+    # Journal the frontier and completed items for crash-safe resumes
+    "retrogallery.checkpoint.CheckpointMiddleware": 100,
+    # Batch the images of each gallery page into one GalleryItem
+    "retrogallery.middlewares.GalleryBatchMiddleware": 500,
+    # Time spider callbacks; ordered closest to the spider so only the
+    # callback itself is timed
+    "retrogallery.middlewares.RetrogallerySpiderMiddleware": 950,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 #DOWNLOADER_MIDDLEWARES = {
 #    "retrogallery.middlewares.RetrogalleryDownloaderMiddleware": 543,
 #}
+DOWNLOADER_MIDDLEWARES = {
+    "retrogallery.middlewares.IncrementalCrawlMiddleware": 580,
+    # Download latency, responses and bytes per domain; ordered closest to
+    # the downloader
+    "retrogallery.middlewares.RetrogalleryDownloaderMiddleware": 950,
+}
+
+# Incremental re-crawls: revalidate gallery pages with conditional requests
+# and skip galleries that have not changed since the last crawl (see
+# retrogallery.state). Enable per run with -s RETROGALLERY_INCREMENTAL=1 and
+# inspect the database with: python -m retrogallery.state stats
+RETROGALLERY_INCREMENTAL = False
+RETROGALLERY_STATE_DB = "/tmp/retrogallery/state.sqlite3"
+
+# Stream image bodies to disk as they arrive instead of buffering them in
+# memory (see retrogallery.streaming): enable the streaming download handler
+# and RETROGALLERYLOCALPIPELINE_STREAMING. Spool files live in
+# RETROGALLERY_STREAMING_SPOOL_DIR, which defaults to
+# RETROGALLERYLOCALPIPELINE_IMAGES_STORE/.partial
+#DOWNLOAD_HANDLERS = {
+#    "http": "retrogallery.streaming.StreamingHTTPDownloadHandler",
+#    "https": "retrogallery.streaming.StreamingHTTPDownloadHandler",
+#}
+#RETROGALLERY_STREAMING_SPOOL_DIR = "/tmp/retrogallery/.partial"
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
 #EXTENSIONS = {
 #    "scrapy.extensions.telnet.TelnetConsole": None,
 #}
+EXTENSIONS = {
+    "retrogallery.logs.QueueLogging": 0,
+    "retrogallery.metrics.MetricsExporter": 500,
+    "retrogallery.distributed.DistributedWorker": 500,
+}
+
+# Logging (see retrogallery.logs): records are formatted and written on a
+# background thread, in colour only on a terminal ("auto"; True or False to
+# force it), or as JSON lines with LOG_JSON. LOG_RATE_LIMITS caps the records
+# per second below ERROR of hot loggers and their children
+LOG_FORMAT = "%(levelname)-5s [%(asctime)s] %(name)s %(funcName)s :%(lineno)d %(message)s"
+LOG_DATEFORMAT = "%y-%m-%d %H:%M:%S"
+RETROGALLERY_LOG_QUEUE = True
+RETROGALLERY_LOG_COLOUR = "auto"
+RETROGALLERY_LOG_JSON = False
+RETROGALLERY_LOG_RATE_LIMITS = {
+    # "Scraped from" and "Dropped" for every item
+    "scrapy.core.scraper": 50,
+}
+
+# Crawl metrics (see retrogallery.metrics), once enabled: served in the
+# Prometheus format at
+# http://RETROGALLERY_METRICS_HOST:RETROGALLERY_METRICS_PORT/metrics if a
+# port (e.g. 9410) is set and dumped, with the Scrapy stats, to
+# RETROGALLERY_METRICS_DUMP if set, every RETROGALLERY_METRICS_INTERVAL seconds
+RETROGALLERY_METRICS_ENABLED = False
+RETROGALLERY_METRICS_HOST = "127.0.0.1"
+RETROGALLERY_METRICS_PORT = 0
+#RETROGALLERY_METRICS_DUMP = "/tmp/retrogallery/metrics.json"
+RETROGALLERY_METRICS_INTERVAL = 30
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
     "retrogallery.pipelines.RetroGalleryLocalPipeline": 100,
     "retrogallery.pipelines.RetroGalleryS3Pipeline": 200,
+    # Write a Parquet catalog of the stored images (see below)
+    #"retrogallery.pipelines.RetroGalleryCatalogPipeline": 300,
 }
 
 #IMAGES_STORE = "/tmp"
 IMAGES_RESULT_FIELD = "images"
 IMAGES_URLS_FIELD = "image_urls"
+# Which size of each image to download when a page links several: "original",
+# "largest" or "max-width:N" (see retrogallery.variants)
+RETROGALLERY_IMAGE_VARIANT_POLICY = "original"
+# How the spiders find galleries: "html" (menus and category pages), "sitemap"
+# (wp-sitemap.xml) or "rest" (the WordPress REST API, falling back to the
+# sitemap, then HTML; see retrogallery.discovery)
+RETROGALLERY_DISCOVERY = "html"
+# Yield one GalleryItem per gallery page, carrying all of its images, rather
+# than an ImageItem per image or carousel; with GALLERY_MANIFESTS, the local
+# pipeline also stores {spider}/{gallery_title}/manifest.json for each
+RETROGALLERY_GALLERY_ITEMS = False
+RETROGALLERYLOCALPIPELINE_GALLERY_MANIFESTS = False
+# Alt texts that are camera file names (DSC_1234, IMG_0001...) are replaced
+# by the gallery title. Add vendors' file name patterns, or remove them with
+# None (see retrogallery.titles)
+#RETROGALLERY_CAMERA_FILENAME_PATTERNS = {
+#    "gopro": r"g[hop]\d{6}",
+#}
+# How gallery pages are parsed: "parsel" (Scrapy Selectors), "lxml" (lxml
+# elements with precompiled XPath) or "selectolax" (requires selectolax)
+RETROGALLERY_EXTRACTION_ENGINE = "parsel"
 RETROGALLERYLOCALPIPELINE_IMAGES_STORE = "/tmp/retrogallery"
+# Store each unique image once under RETROGALLERYLOCALPIPELINE_IMAGES_STORE/blobs
+# and refer to it from the {spider}/{gallery_title}/{image_title}/ layout
+# (see retrogallery.blobstore). The link mode is one of "hardlink", "symlink"
+# or "manifest" (no gallery files at all, only entries in blobs/index.sqlite3)
+RETROGALLERYLOCALPIPELINE_BLOB_STORE = False
+RETROGALLERYLOCALPIPELINE_BLOB_LINK_MODE = "hardlink"
+# Append images to pack files of up to RETROGALLERYLOCALPIPELINE_PACK_SIZE
+# bytes under RETROGALLERYLOCALPIPELINE_IMAGES_STORE/packs instead of storing
+# a file per image; replaces the blob store. Inspect, compact or export the
+# packs with: python -m retrogallery.packstore
+RETROGALLERYLOCALPIPELINE_PACK_STORE = False
+RETROGALLERYLOCALPIPELINE_PACK_SIZE = 1024 * 1024 * 1024
+# Stream image downloads to disk (with the streaming download handler above)
+# and move them into the store without decoding them with Pillow unless
+# IMAGES_THUMBS or IMAGES_MIN_WIDTH/HEIGHT are configured
+RETROGALLERYLOCALPIPELINE_STREAMING = False
+# Before downloading an image, check its dimensions in the page markup and
+# fetch its first PROBE_BYTES with a Range request: images below
+# IMAGES_MIN_WIDTH/HEIGHT are skipped, and images whose size and first bytes
+# match a stored blob are linked to it (see retrogallery.probe)
+RETROGALLERYLOCALPIPELINE_PROBE = False
+RETROGALLERYLOCALPIPELINE_PROBE_BYTES = 16384
+# Write the local store from a pool of threads so the reactor never waits on
+# the filesystem (see retrogallery.fswriter). Downloads are held back while
+# more than RETROGALLERYLOCALPIPELINE_WRITER_MAX_PENDING_BYTES wait to be
+# written. WRITER_FSYNC syncs every file, and its directory once per batch
+RETROGALLERYLOCALPIPELINE_ASYNC_WRITES = False
+RETROGALLERYLOCALPIPELINE_WRITER_THREADS = 4
+RETROGALLERYLOCALPIPELINE_WRITER_BATCH_SIZE = 32
+RETROGALLERYLOCALPIPELINE_WRITER_MAX_PENDING_BYTES = 64 * 1024 * 1024
+RETROGALLERYLOCALPIPELINE_WRITER_FSYNC = False
+# Resized copies of every image, rendered in a pool of worker processes so
+# Pillow never runs on the reactor thread (see retrogallery.derivatives).
+# IMAGES_THUMBS and IMAGES_MIN_WIDTH/HEIGHT are handled by the same pool.
+# RETROGALLERY_DERIVATIVES_WORKERS defaults to the number of CPUs; 0 renders
+# inline on the reactor thread
+#RETROGALLERYLOCALPIPELINE_DERIVATIVES = {
+#    "small": {"size": (320, 320), "format": "WEBP", "quality": 80},
+#    "medium": {"size": (1024, 1024), "format": "JPEG", "quality": 85},
+#}
+#RETROGALLERY_DERIVATIVES_WORKERS = 4
+RETROGALLERY_DERIVATIVES_MAX_PENDING = 32
+# Link near-duplicate images (the same photo at another resolution or
+# quality, in any gallery of any spider) to the largest copy instead of
+# storing them again, using perceptual hashes (see retrogallery.phash;
+# requires numpy). The index defaults to
+# RETROGALLERYLOCALPIPELINE_IMAGES_STORE/phash.sqlite3
+RETROGALLERYLOCALPIPELINE_NEAR_DUPLICATES = False
+RETROGALLERYLOCALPIPELINE_NEAR_DUPLICATES_ALGORITHM = "phash"
+RETROGALLERYLOCALPIPELINE_NEAR_DUPLICATES_MAX_DISTANCE = 6
+#RETROGALLERYLOCALPIPELINE_NEAR_DUPLICATES_DB = "/tmp/retrogallery/phash.sqlite3"
 RETROGALLERYS3PIPELINE_IMAGES_STORE = "s3://retrogallery/images"
+# RetroGalleryS3Pipeline uploads the files stored by RetroGalleryLocalPipeline
+# (see retrogallery.s3). Set AWS_ENDPOINT_URL to use an S3-compatible
+# stand-in such as moto server
+RETROGALLERYS3PIPELINE_CONCURRENCY = 8
+RETROGALLERYS3PIPELINE_QUEUE_SIZE = 64
+RETROGALLERYS3PIPELINE_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+RETROGALLERYS3PIPELINE_PART_SIZE = 8 * 1024 * 1024
+RETROGALLERYS3PIPELINE_CACHE_DB = "/tmp/retrogallery/s3cache.sqlite3"
+# RetroGalleryCatalogPipeline, once added to ITEM_PIPELINES, writes a Parquet
+# catalog of the stored images (requires pyarrow, see retrogallery.catalog),
+# one row group every RETROGALLERYCATALOGPIPELINE_BATCH_SIZE images. Query it
+# with: python -m retrogallery.catalog summary
+RETROGALLERYCATALOGPIPELINE_DIR = "/tmp/retrogallery/catalog"
+RETROGALLERYCATALOGPIPELINE_BATCH_SIZE = 10000
+RETROGALLERYCATALOGPIPELINE_COMPRESSION = "zstd"
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
+# Disable it when using retrogallery.throttle.HostClassDownloader (see
+# below), which adapts delays and concurrency itself
 AUTOTHROTTLE_ENABLED = True
 # The initial download delay
 #AUTOTHROTTLE_START_DELAY = 5
@@ -88,41 +244,96 @@ AUTOTHROTTLE_ENABLED = True
 # Enable showing throttling stats for every response received:
 #AUTOTHROTTLE_DEBUG = False
 
+# Separate, adaptive concurrency/delay budgets for the origin sites (polite)
+# and images (parallel, most of all from CDNs), with gallery pages fetched
+# ahead of images (see retrogallery.throttle). Images do not count against CONCURRENT_REQUESTS.
+# To use them, set AUTOTHROTTLE_ENABLED = False and:
+#DOWNLOADER = "retrogallery.throttle.HostClassDownloader"
+RETROGALLERY_HOST_CLASSES = {
+    "cdn": {
+        "images": True,
+        "hosts": [r"^i[0-3]\.wp\.com$", r"\.cloudfront\.net$", r"\.akamaized\.net$", r"\.fastly\.net$"],
+        "concurrency": 8,
+        "max_concurrency": 32,
+        "target_latency": 2.0,
+    },
+    "images": {
+        "images": True,
+        "concurrency": 4,
+        "max_concurrency": 8,
+        "target_latency": 2.0,
+    },
+    "upload": {
+        "hosts": [r"(^|\.)s3[.-]([a-z0-9-]+\.)?amazonaws\.com$"],
+        "concurrency": 8,
+        "max_concurrency": 16,
+        "target_latency": 5.0,
+    },
+    "origin": {
+        "concurrency": 2,
+        "max_concurrency": 4,
+        "delay": 1.0,
+        "target_latency": 2.0,
+    },
+}
+
+# Distributed crawls: workers share the frontier, the dupefilter and the
+# images they have downloaded through RETROGALLERY_DISTRIBUTED_BACKEND (see
+# retrogallery.distributed). Start workers, which enable both settings
+# below, with:
+# python -m retrogallery.distributed worker --processes N SPIDER...
+#SCHEDULER = "retrogallery.distributed.DistributedScheduler"
+RETROGALLERY_DISTRIBUTED = False
+RETROGALLERY_DISTRIBUTED_BACKEND = "retrogallery.distributed.SQLiteBackend"
+RETROGALLERY_DISTRIBUTED_URI = "/tmp/retrogallery/distributed.sqlite3"
+RETROGALLERY_DISTRIBUTED_CRAWL = "retrogallery"
+# Seconds before another worker takes over an image a worker claimed but
+# has not stored
+RETROGALLERY_DISTRIBUTED_CLAIM_TIMEOUT = 300
+
+# Crash-safe checkpoints (see retrogallery.checkpoint): the frontier, completed
+# items and images being written are journaled to
+# RETROGALLERY_CHECKPOINT_DIR/<spider>.journal, which is synced to disk every
+# RETROGALLERY_CHECKPOINT_INTERVAL seconds. Checkpoint a crawl, and resume it
+# if it died, with (which enable checkpoints for that crawl):
+# python -m retrogallery.checkpoint crawl OldCrapGallerySpider [--resume]
+RETROGALLERY_CHECKPOINT_ENABLED = False
+RETROGALLERY_CHECKPOINT_DIR = "/tmp/retrogallery/checkpoints"
+RETROGALLERY_CHECKPOINT_INTERVAL = 10
+RETROGALLERY_CHECKPOINT_RESUME = False
+
+# The resident crawl service (see retrogallery.service), which runs crawl jobs
+# submitted over a local HTTP API, or a Unix socket if SOCKET is set:
+# python -m retrogallery.service serve
+RETROGALLERY_SERVICE_HOST = "127.0.0.1"
+RETROGALLERY_SERVICE_PORT = 9420
+#RETROGALLERY_SERVICE_SOCKET = "/tmp/retrogallery/service.sock"
+RETROGALLERY_SERVICE_MAX_JOBS = 4
+RETROGALLERY_SERVICE_PROGRESS_INTERVAL = 5
+RETROGALLERY_SERVICE_KEEP_JOBS = 100
+# The settings a submitted job may override (default:
+# retrogallery.service.JOB_OVERRIDABLE_SETTINGS)
+#RETROGALLERY_SERVICE_JOB_SETTINGS = ["DOWNLOAD_DELAY", "CLOSESPIDER_ITEMCOUNT"]
+
 # Enable and configure HTTP caching (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
 #HTTPCACHE_ENABLED = True
 #HTTPCACHE_EXPIRATION_SECS = 0
 #HTTPCACHE_DIR = "httpcache"
 #HTTPCACHE_IGNORE_HTTP_CODES = []
-#HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
+# Cache index pages, gallery pages and images under separate byte budgets,
+# each with its own TTL and LRU or LFU eviction (see retrogallery.httpcache)
+HTTPCACHE_STORAGE = "retrogallery.httpcache.RetrogalleryCacheStorage"
+RETROGALLERY_HTTPCACHE_CLASSES = {
+    # Start pages and category indexes change whenever a gallery is posted
+    "index": {"ttl": 60 * 60, "max_bytes": 64 * 1024 * 1024, "eviction": "lru"},
+    # Gallery posts rarely change once posted
+    "gallery": {"ttl": 30 * 24 * 60 * 60, "max_bytes": 256 * 1024 * 1024, "eviction": "lru"},
+    # Images never expire and are stored uncompressed
+    "image": {"ttl": 0, "max_bytes": 4 * 1024 * 1024 * 1024, "eviction": "lfu", "compress": False},
+}
 
 # Set settings whose default value is deprecated to a future-proof value
 REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
 TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
 FEED_EXPORT_ENCODING = "utf-8"
-
-# Set up coloured logging
-colour_formatter = ColoredFormatter(
-    (
-        '%(log_color)s%(levelname)-5s%(reset)s '
-        '%(yellow)s[%(asctime)s]%(reset)s'
-        '%(white)s %(name)s %(funcName)s %(bold_purple)s:%(lineno)d%(reset)s '
-        '%(log_color)s%(message)s%(reset)s'
-    ),
-    datefmt='%y-%m-%d %H:%M:%S',
-    log_colors={
-        'DEBUG': 'blue',
-        'INFO': 'bold_cyan',
-        'WARNING': 'red',
-        'ERROR': 'bg_bold_red',
-        'CRITICAL': 'red,bg_white',
-    }
-)
-
-_get_handler = copy.copy(scrapy.utils.log._get_handler)
-
-def _get_handler_custom(*args, **kwargs):
-    handler = _get_handler(*args, **kwargs)
-    handler.setFormatter(colour_formatter)
-    return handler
-scrapy.utils.log._get_handler = _get_handler_custom
\ No newline at end of file
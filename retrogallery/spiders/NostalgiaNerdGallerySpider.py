@@ -2,13 +2,15 @@ import logging
 import scrapy
 from scrapy.crawler import CrawlerProcess
 
+from retrogallery import extract, titles, utils, variants
+from retrogallery.discovery import WordPressDiscoveryMixin
 from retrogallery.items import ImageItem
 
 
 logger = logging.getLogger(__name__)
 
 
-class NostalgiaNerdGallerySpider(scrapy.Spider):
+class NostalgiaNerdGallerySpider(WordPressDiscoveryMixin, scrapy.Spider):
     """
     Crawls https://www.nostalgianerd.com/category/gallery
     """
@@ -17,6 +19,9 @@ class NostalgiaNerdGallerySpider(scrapy.Spider):
         'https://www.nostalgianerd.com/category/gallery',
     ]
     allowed_domains = [ 'nostalgianerd.com' ]
+    # Only posts in the gallery category are galleries (see
+    # retrogallery.discovery)
+    discovery_category = 'gallery'
 
     def parse(self, response):
         """
@@ -32,6 +37,11 @@ class NostalgiaNerdGallerySpider(scrapy.Spider):
                 'gallery_title': gallery_title,
                 'gallery_url': gallery_url,
             })
+        # Older galleries are on the following pages of the category:
+        # <a class="next page-numbers" href="https://www.nostalgianerd.com/category/gallery/page/2/">Next</a>
+        next_page = response.css("a.next.page-numbers::attr(href)").get()
+        if next_page:
+            yield response.follow(next_page, self.parse)
 
     def parse_gallery(self, response):
         """
@@ -42,24 +52,31 @@ class NostalgiaNerdGallerySpider(scrapy.Spider):
             ...
         </div>
         """
+        engine = extract.get_engine(
+            self.settings.get('RETROGALLERY_EXTRACTION_ENGINE', extract.DEFAULT_ENGINE)
+        )
+        document = engine.document(response)
         gallery_title = response.meta['gallery_title']
         gallery_url = response.meta['gallery_url']
-        entry_content = response.css("div.entry-content")
-        for img in entry_content.css("p a img"):
-            image = ImageItem()
-            image['gallery_title'] = gallery_title
-            image['gallery_url'] = gallery_url
-            # Defaults to the gallery title if there is no alt text or the alt
-            # text is simply a default photo name (e.g., DSC_1234.jpg)
-            image['image_title'] = img.css("::attr(alt)").get()
-            if not image['image_title'] or image['image_title'].startswith('DSC_'):
-                image['image_title'] = gallery_title
-            image['image_urls'] = img.css("::attr(src)").getall()
-            # TODO srcset contains the same image in different sizes. Do we
-            # want the different sizes, too? How do we store them? How do we
-            # store their sizes? How do we differentiate different sizes of
-            # the same image to avoid duplication?
-            yield image
+        variant_policy = self.settings.get('RETROGALLERY_IMAGE_VARIANT_POLICY', variants.DEFAULT_POLICY)
+        imgs = [engine.attributes(img) for img in engine.select(document, "div.entry-content p a img")]
+        # Defaults to the gallery title if there is no alt text or the alt
+        # text is simply a default photo name (e.g., DSC_1234.jpg)
+        image_titles = titles.get_classifier(self.settings).titles(
+            [attributes.get('alt') for attributes in imgs], default=gallery_title
+        )
+        for attributes, image_title in zip(imgs, image_titles):
+            # src and srcset contain the same image in different sizes, so
+            # pick one URL per image according to the variant policy; width
+            # and height give its dimensions
+            image_urls, image_sizes = utils.extract_images([attributes], policy=variant_policy)
+            yield ImageItem(
+                gallery_title=gallery_title,
+                gallery_url=gallery_url,
+                image_title=image_title,
+                image_urls=image_urls,
+                image_sizes=image_sizes,
+            )
 
 
 if __name__ == "__main__":
@@ -4,14 +4,15 @@ from urllib.parse import urlparse
 import scrapy
 from scrapy.crawler import CrawlerProcess
 
-from retrogallery import utils
+from retrogallery import extract, titles, utils, variants
+from retrogallery.discovery import WordPressDiscoveryMixin
 from retrogallery.items import ImageItem
 
 
 logger = logging.getLogger(__name__)
 
 
-class OldCrapGallerySpider(scrapy.Spider):
+class OldCrapGallerySpider(WordPressDiscoveryMixin, scrapy.Spider):
     name = 'OldCrapGallerySpider'
     start_urls = [
         'https://oldcrap.org',
@@ -72,52 +73,39 @@ class OldCrapGallerySpider(scrapy.Spider):
         # - <meta property="article:section" content="Apple III" />
         #   response.css("meta[property='article:section']::attr(content)").get()
         #   "Apple III"
-        gallery_title = response.css('h1.entry-title::text').get(response.meta['gallery_title'])
+        engine = extract.get_engine(
+            self.settings.get('RETROGALLERY_EXTRACTION_ENGINE', extract.DEFAULT_ENGINE)
+        )
+        document = engine.document(response)
+        gallery_title = engine.first_text(document, 'h1.entry-title') or response.meta['gallery_title']
         gallery_url = response.meta['gallery_url']
+        variant_policy = self.settings.get('RETROGALLERY_IMAGE_VARIANT_POLICY', variants.DEFAULT_POLICY)
+        classifier = titles.get_classifier(self.settings)
 
-        carousels = response.xpath('//div[@data-carousel-extra]')
-        for carousel in carousels:
-            image = ImageItem()
-            image['gallery_title'] = gallery_title
-            image['gallery_url'] = gallery_url
-            # TODO srcset contains the same image in different sizes. Do
-            # we want the different sizes, too? How do we store them? How
-            # do we store their sizes? How do we differentiate different
-            # sizes of the same image to avoid duplication?
-            image['image_urls'] = carousel.css("noscript img::attr(data-orig-file)").getall()
-
-            # Get the immediately preceding heading element, if any.
-            heading = carousel.xpath('preceding-sibling::*[self::h1 or self::h2 or self::h3][1]')
-            heading_text = heading.xpath('string()').get('').strip() if heading else ''
-
-            # Get the preceding parent heading element, if any.
-            if heading and heading.xpath('self::h3'):
-                parent_heading = carousel.xpath('preceding-sibling::*[self::h2][1]')
-            elif heading and heading.xpath('self::h2'):
-                parent_heading = carousel.xpath('preceding-sibling::*[self::h1][1]')
-            else:
-                parent_heading = None
-            parent_heading_text = parent_heading.xpath('string()').get('').strip() if parent_heading else ''
-
-            # Get the preceding grandparent heading element, if any.
-            if parent_heading and parent_heading.xpath('self::h2'):
-                grandparent_heading = carousel.xpath('preceding-sibling::*[self::h1][1]')
-            else:
-                grandparent_heading = None
-            grandparent_heading_text = grandparent_heading.xpath('string()').get('').strip() if grandparent_heading else ''
+        # Each carousel comes with the text of the h1/h2/h3 headings it sits
+        # under, found in one pass over the page rather than by searching
+        # back through the preceding siblings of every carousel
+        for carousel, headings in extract.carousels_with_headings(engine, document):
+            imgs = [engine.attributes(img) for img in engine.select(carousel, "noscript img")]
+            # data-orig-file, src and srcset contain the same image in
+            # different sizes, so pick one URL per image according to the
+            # variant policy; data-orig-size gives its dimensions
+            image_urls, image_sizes = utils.extract_images(imgs, policy=variant_policy)
 
             # Use the immediately preceding heading/subheading elements as the
             # image title, since most of the images do not provide alt text
-            image['image_title'] = ' '.join([
-                grandparent_heading_text,
-                parent_heading_text,
-                heading_text,
-            ]).strip()
+            image_title = ' '.join(headings).strip()
 
             # If we STILL don't have an image title, extract what we can from
             # the img tag
-            if not image['image_title']:
-                img = carousel.css("noscript img")
-                image['image_title'] = utils.extract_image_title(img, default=gallery_title)
+            if not image_title:
+                alt = next((img['alt'] for img in imgs if 'alt' in img), None)
+                image_title = classifier.title(alt, default=gallery_title)
 
-            yield image
\ No newline at end of file
+            yield ImageItem(
+                gallery_title=gallery_title,
+                gallery_url=gallery_url,
+                image_title=image_title,
+                image_urls=image_urls,
+                image_sizes=image_sizes,
+            )
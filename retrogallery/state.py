@@ -0,0 +1,193 @@
+"""
+Persistent crawl state for incremental re-crawls.
+
+Records, for every gallery page and every image URL fetched, when it was
+last fetched, the ETag and Last-Modified validators the server sent and a
+hash of the content. IncrementalCrawlMiddleware uses it to revalidate
+gallery pages with conditional requests and to skip galleries that have not
+changed since the previous crawl.
+
+The database can be inspected from the command line:
+
+    python -m retrogallery.state --db /tmp/retrogallery/state.sqlite3 stats
+    python -m retrogallery.state pages --limit 20
+    python -m retrogallery.state show https://oldcrap.org/2018/02/21/texas-instruments-ti-99-4a/
+    python -m retrogallery.state forget https://oldcrap.org/2018/02/21/texas-instruments-ti-99-4a/
+"""
+
+import argparse
+import hashlib
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+
+DEFAULT_STATE_DB = "/tmp/retrogallery/state.sqlite3"
+
+# The kinds of URL we keep state for; each is a table of the same shape.
+KINDS = ('pages', 'images')
+
+
+class CrawlState:
+    """
+    SQLite-backed store of per-URL fetch state.
+
+    Parameters:
+        path (str): The path of the SQLite database. Parent directories are
+        created if needed.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS {kind} (
+            url TEXT PRIMARY KEY,
+            fetched_at REAL NOT NULL,
+            status INTEGER,
+            etag TEXT,
+            last_modified TEXT,
+            content_hash TEXT
+        );
+    """
+
+    # Commit after this many writes; the database is also committed on close.
+    COMMIT_EVERY = 50
+
+    def __init__(self, path=DEFAULT_STATE_DB):
+        self.path = str(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        for kind in KINDS:
+            self.conn.executescript(self.SCHEMA.format(kind=kind))
+        self._pending_writes = 0
+
+    @staticmethod
+    def content_hash(body):
+        # deepcode ignore InsecureHash: <not used in a security context>
+        return hashlib.sha1(body).hexdigest()
+
+    def commit(self):
+        self.conn.commit()
+        self._pending_writes = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def get(self, kind, url):
+        """
+        Returns the stored state of a URL as a dict, or None if the URL has
+        never been fetched.
+        """
+        self.conn.row_factory = sqlite3.Row
+        try:
+            row = self.conn.execute(
+                f"SELECT * FROM {kind} WHERE url = ?", (url,)
+            ).fetchone()
+        finally:
+            self.conn.row_factory = None
+        return dict(row) if row else None
+
+    def record(self, kind, url, status=None, etag=None, last_modified=None, content_hash=None):
+        """
+        Records a fetch of url. Validators or hashes that are not supplied
+        keep their previously stored values, so a 304 Not Modified response
+        only refreshes the fetch time.
+        """
+        self.conn.execute(
+            f"INSERT INTO {kind} (url, fetched_at, status, etag, last_modified, content_hash) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(url) DO UPDATE SET "
+            "fetched_at = excluded.fetched_at, "
+            "status = excluded.status, "
+            "etag = COALESCE(excluded.etag, etag), "
+            "last_modified = COALESCE(excluded.last_modified, last_modified), "
+            "content_hash = COALESCE(excluded.content_hash, content_hash)",
+            (url, time.time(), status, etag, last_modified, content_hash)
+        )
+        self._pending_writes += 1
+        if self._pending_writes >= self.COMMIT_EVERY:
+            self.commit()
+
+    def forget(self, url):
+        """
+        Removes all state for url, forcing a full fetch and parse next time.
+        Returns the number of rows removed.
+        """
+        removed = 0
+        for kind in KINDS:
+            removed += self.conn.execute(f"DELETE FROM {kind} WHERE url = ?", (url,)).rowcount
+        self.commit()
+        return removed
+
+    def rows(self, kind, limit=None):
+        """
+        Returns the stored rows of a kind, most recently fetched first.
+        """
+        sql = f"SELECT url, fetched_at, status, etag, last_modified, content_hash FROM {kind} ORDER BY fetched_at DESC"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return self.conn.execute(sql).fetchall()
+
+    def stats(self):
+        """
+        Returns a dict of {kind: (count, oldest fetch, newest fetch)}.
+        """
+        return {
+            kind: self.conn.execute(
+                f"SELECT COUNT(*), MIN(fetched_at), MAX(fetched_at) FROM {kind}"
+            ).fetchone()
+            for kind in KINDS
+        }
+
+
+def _format_time(timestamp):
+    if timestamp is None:
+        return '-'
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m retrogallery.state',
+        description='Inspect the retrogallery incremental crawl state database.'
+    )
+    parser.add_argument('--db', default=DEFAULT_STATE_DB, help='state database (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('stats', help='summarise the number and age of recorded URLs')
+    for kind in KINDS:
+        command = commands.add_parser(kind, help=f'list recorded {kind}, newest first')
+        command.add_argument('--limit', type=int, default=50)
+    commands.add_parser('show', help='show the stored state of a URL').add_argument('url')
+    commands.add_parser('forget', help='forget a URL so it is fully re-crawled').add_argument('url')
+    args = parser.parse_args(argv)
+
+    state = CrawlState(args.db)
+    try:
+        if args.command == 'stats':
+            for kind, (count, oldest, newest) in state.stats().items():
+                print(f"{kind}: {count} (oldest {_format_time(oldest)}, newest {_format_time(newest)})")
+        elif args.command in KINDS:
+            for url, fetched_at, status, etag, last_modified, content_hash in state.rows(args.command, args.limit):
+                print(f"{_format_time(fetched_at)}  {status or '-':>3}  {(content_hash or '-')[:12]:12}  {url}")
+        elif args.command == 'show':
+            found = False
+            for kind in KINDS:
+                row = state.get(kind, args.url)
+                if row:
+                    found = True
+                    row['fetched_at'] = _format_time(row['fetched_at'])
+                    print(kind)
+                    for key, value in row.items():
+                        print(f"  {key}: {value}")
+            if not found:
+                print(f"{args.url} has not been fetched")
+                return 1
+        elif args.command == 'forget':
+            print(f"Removed {state.forget(args.url)} record(s)")
+    finally:
+        state.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
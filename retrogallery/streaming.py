@@ -0,0 +1,404 @@
+"""
+Streams image downloads to disk instead of buffering them in memory.
+
+Scrapy's HTTP/1.1 download handler accumulates every response body in a
+BytesIO, and ImagesPipeline then decodes and re-encodes it with Pillow. For
+multi-megapixel originals under high concurrency that makes peak memory
+proportional to concurrency x image size.
+
+StreamingHTTPDownloadHandler instead writes the body of requests flagged
+with meta['stream_to_file'] to a spool file as it arrives, hashing it
+incrementally, and hands the pipeline an empty-bodied response plus a
+StreamedFile describing the spool file. The pipeline then moves the file
+into place atomically, so peak memory is bounded by concurrency x chunk
+size. Requests without the flag are downloaded as usual.
+
+To enable it:
+
+    DOWNLOAD_HANDLERS = {
+        "http": "retrogallery.streaming.StreamingHTTPDownloadHandler",
+        "https": "retrogallery.streaming.StreamingHTTPDownloadHandler",
+    }
+    RETROGALLERYLOCALPIPELINE_STREAMING = True
+
+With RETROGALLERYLOCALPIPELINE_ASYNC_WRITES, spool files are written, and
+moved into the store, from a pool of threads (see retrogallery.fswriter).
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import uuid
+from collections import namedtuple
+from io import BytesIO
+from pathlib import Path
+
+from scrapy import signals
+from scrapy.core.downloader.handlers.http11 import (
+    HTTP11DownloadHandler,
+    ScrapyAgent,
+    _ResponseReader,
+)
+from scrapy.exceptions import StopDownload
+from scrapy.pipelines.files import FSFilesStore
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+from retrogallery.resources import is_shared, shared
+
+
+logger = logging.getLogger(__name__)
+
+
+# The request meta key that asks for a response to be streamed to disk, and
+# the key under which the resulting StreamedFile is returned.
+STREAM_META_KEY = 'stream_to_file'
+STREAMED_FILE_META_KEY = 'streamed_file'
+STREAMED_FLAG = 'streamed'
+
+# Spool files are written under the image store, so that moving them into
+# place is an atomic rename on the same filesystem.
+SPOOL_DIR_NAME = '.partial'
+
+StreamedFile = namedtuple('StreamedFile', ['path', 'size', 'sha1', 'md5'])
+StreamedFile.__doc__ = """
+A response body that has been streamed to a spool file.
+
+    path (str): The spool file.
+    size (int): The number of bytes received.
+    sha1 (str): The hex SHA1 digest of the body.
+    md5 (str): The hex MD5 digest of the body.
+"""
+
+
+def default_spool_dir(settings):
+    """
+    Returns the spool directory: RETROGALLERY_STREAMING_SPOOL_DIR if set,
+    otherwise a .partial directory in the local image store.
+    """
+    spool_dir = settings.get('RETROGALLERY_STREAMING_SPOOL_DIR')
+    if not spool_dir:
+        store = settings.get('RETROGALLERYLOCALPIPELINE_IMAGES_STORE') or tempfile.gettempdir()
+        spool_dir = os.path.join(store, SPOOL_DIR_NAME)
+    return spool_dir
+
+
+def spool_prefix(spider_name):
+    """
+    Returns the file name prefix of the spool files of a spider's crawls,
+    so that a resumed crawl removes its own spool files and no others (see
+    retrogallery.checkpoint).
+    """
+    return f"stream-{spider_name}-"
+
+
+def discard(streamed):
+    """
+    Removes a spool file that will not be stored.
+    """
+    try:
+        os.unlink(streamed.path)
+    except FileNotFoundError:
+        pass
+
+
+def persist_streamed_file(store, path, streamed, info, writer=None):
+    """
+    Moves a spool file into a files store at path.
+
+    Stores that understand spool files (e.g. BlobFilesStore) implement
+    persist_stream(); plain filesystem stores get an atomic rename; any other
+    store (S3, GCS, FTP) is handed the bytes as usual. With a writer (see
+    retrogallery.fswriter), the rename or read runs in its threads and a
+    Deferred is returned.
+    """
+    if hasattr(store, 'persist_stream'):
+        return store.persist_stream(path, streamed, info)
+    if writer is not None:
+        def _discard(result):
+            discard(streamed)
+            return result
+
+        if isinstance(store, FSFilesStore):
+            return writer.move(streamed.path, store._get_filesystem_path(path)).addErrback(_discard)
+        dfd = writer.call(streamed.path, Path(streamed.path).read_bytes)
+        dfd.addCallback(lambda data: store.persist_file(path, BytesIO(data), info))
+        return dfd.addBoth(_discard)
+    if isinstance(store, FSFilesStore):
+        absolute_path = store._get_filesystem_path(path)
+        store._mkdir(absolute_path.parent, info)
+        os.replace(streamed.path, absolute_path)
+        return None
+    try:
+        return store.persist_file(path, BytesIO(Path(streamed.path).read_bytes()), info)
+    finally:
+        discard(streamed)
+
+
+class _SpoolFile:
+    """
+    A spool file written from the threads of an FSWriter (see
+    retrogallery.fswriter), so that a streamed download never waits on the
+    disk on the reactor thread. Its jobs are queued under its path, so they
+    run in order.
+    """
+
+    def __init__(self, writer, spool_dir, prefix):
+        self.writer = writer
+        self.name = os.path.join(spool_dir, f"{prefix}{uuid.uuid4().hex}")
+        # The first error writing the file
+        self.failure = None
+        self._file = None
+
+    def write(self, data):
+        self.writer.call(self.name, self._write, data, size=len(data)).addErrback(self._failed)
+
+    def truncate(self, size):
+        # Only called on a download that is then cancelled, whose spool
+        # file is discarded
+        pass
+
+    def close(self):
+        """
+        Returns a Deferred that fires once the file is written and closed,
+        or fails with the first error writing it.
+        """
+        def _closed(_):
+            return self.failure
+
+        return self.writer.call(self.name, self._close).addCallback(_closed)
+
+    def discard(self):
+        """
+        Closes and removes the file, once its queued writes have run.
+        """
+        self.writer.call(self.name, self._discard).addErrback(self._failed)
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.name, 'wb')
+        return self._file
+
+    def _write(self, data):
+        self._open().write(data)
+
+    def _close(self):
+        self._open().close()
+
+    def _discard(self):
+        if self._file is not None:
+            self._file.close()
+        discard(StreamedFile(self.name, 0, None, None))
+
+    def _failed(self, failure):
+        if self.failure is None:
+            self.failure = failure
+
+
+class _StreamingResponseReader(_ResponseReader):
+    """
+    A response reader that writes the body to a spool file instead of a
+    BytesIO, hashing it as it arrives. With a writer, the spool file is
+    written from its threads, and reading pauses while the writer has more
+    than its max_pending_bytes waiting.
+    """
+
+    def __init__(self, *args, spool_dir, spool_prefix, writer=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if writer is not None:
+            self._bodybuf = _SpoolFile(writer, spool_dir, spool_prefix)
+        else:
+            self._bodybuf = tempfile.NamedTemporaryFile(dir=spool_dir, prefix=spool_prefix, delete=False)
+        self._writer = writer
+        # deepcode ignore InsecureHash: <not used in a security context>
+        self._sha1 = hashlib.sha1()
+        # deepcode ignore InsecureHash: <not used in a security context>
+        self._md5 = hashlib.md5()
+        self._finishing = False
+
+    def dataReceived(self, bodyBytes):
+        if not self._finished.called:
+            self._sha1.update(bodyBytes)
+            self._md5.update(bodyBytes)
+        super().dataReceived(bodyBytes)
+        if self._writer is not None and not self._finished.called:
+            ready = self._writer.ready()
+            if not ready.called:
+                self.transport.pauseProducing()
+                ready.addCallback(lambda _: self.transport.resumeProducing())
+
+    def _finish_response(self, flags=None, failure=None):
+        self._finishing = True
+        closed = self._bodybuf.close()
+        if isinstance(closed, defer.Deferred):
+            # Hand the spool file over once its last write has run
+            closed.addCallbacks(
+                lambda _: self._hand_over(flags, failure),
+                lambda write_failure: self._hand_over(flags, failure or write_failure),
+            )
+        else:
+            self._hand_over(flags, failure)
+
+    def _hand_over(self, flags, failure):
+        if self._finished.called:
+            # Cancelled while the spool file was being written
+            self._discard()
+            return
+        if failure is None:
+            self._request.meta[STREAMED_FILE_META_KEY] = StreamedFile(
+                self._bodybuf.name,
+                self._bytes_received,
+                self._sha1.hexdigest(),
+                self._md5.hexdigest(),
+            )
+        self._finished.callback(
+            {
+                "txresponse": self._txresponse,
+                "body": b"",
+                "flags": (flags or []) + [STREAMED_FLAG],
+                "certificate": self._certificate,
+                "ip_address": self._ip_address,
+                "failure": failure,
+            }
+        )
+        if failure is not None:
+            self._discard()
+
+    def connectionLost(self, reason):
+        super().connectionLost(reason)
+        if not self._finishing:
+            self._discard()
+
+    def _discard(self):
+        if isinstance(self._bodybuf, _SpoolFile):
+            self._bodybuf.discard()
+        else:
+            self._bodybuf.close()
+            discard(StreamedFile(self._bodybuf.name, 0, None, None))
+
+
+class _StreamingScrapyAgent(ScrapyAgent):
+    """
+    A ScrapyAgent that delivers flagged response bodies to a
+    _StreamingResponseReader. Scrapy has no hook for the reader, so
+    _cb_bodyready() is a copy of Scrapy 2.8.0's (the version pinned in
+    config/requirements.txt) with the reader swapped; tests/test_streaming.py
+    fails if Scrapy's copy, or the private API it uses, changes.
+    """
+
+    def __init__(self, *args, spool_dir, spool_prefix, writer=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._spool_dir = spool_dir
+        self._spool_prefix = spool_prefix
+        self._writer = writer
+
+    def _cb_bodyready(self, txresponse, request):
+        if not request.meta.get(STREAM_META_KEY):
+            return super()._cb_bodyready(txresponse, request)
+
+        headers_received_result = self._crawler.signals.send_catch_log(
+            signal=signals.headers_received,
+            headers=self._headers_from_twisted_response(txresponse),
+            body_length=txresponse.length,
+            request=request,
+            spider=self._crawler.spider,
+        )
+        for handler, result in headers_received_result:
+            if isinstance(result, Failure) and isinstance(result.value, StopDownload):
+                txresponse._transport.stopProducing()
+                txresponse._transport.loseConnection()
+                return {
+                    "txresponse": txresponse,
+                    "body": b"",
+                    "flags": ["download_stopped"],
+                    "certificate": None,
+                    "ip_address": None,
+                    "failure": result if result.value.fail else None,
+                }
+
+        if txresponse.length == 0:
+            return {
+                "txresponse": txresponse,
+                "body": b"",
+                "flags": None,
+                "certificate": None,
+                "ip_address": None,
+            }
+
+        maxsize = request.meta.get("download_maxsize", self._maxsize)
+        warnsize = request.meta.get("download_warnsize", self._warnsize)
+        expected_size = txresponse.length if txresponse.length != UNKNOWN_LENGTH else -1
+        if maxsize and expected_size > maxsize:
+            txresponse._transport.loseConnection()
+            raise defer.CancelledError(
+                f"Cancelling download of {request.url}: expected response size "
+                f"({expected_size}) larger than download max size ({maxsize})."
+            )
+
+        def _cancel(_):
+            txresponse._transport._producer.abortConnection()
+
+        d = defer.Deferred(_cancel)
+        txresponse.deliverBody(
+            _StreamingResponseReader(
+                finished=d,
+                txresponse=txresponse,
+                request=request,
+                maxsize=maxsize,
+                warnsize=warnsize,
+                fail_on_dataloss=request.meta.get("download_fail_on_dataloss", self._fail_on_dataloss),
+                crawler=self._crawler,
+                spool_dir=self._spool_dir,
+                spool_prefix=self._spool_prefix,
+                writer=self._writer,
+            )
+        )
+        self._txresponse = txresponse
+        return d
+
+
+class StreamingHTTPDownloadHandler(HTTP11DownloadHandler):
+    """
+    An HTTP/1.1 download handler that streams the bodies of requests flagged
+    with meta['stream_to_file'] to spool files. See the module docstring.
+    """
+
+    def __init__(self, settings, crawler=None):
+        super().__init__(settings, crawler)
+        # The jobs of a crawl service share one connection pool, so
+        # connections are kept alive between jobs (see retrogallery.service)
+        pool = self._pool
+        self._pool = shared(('http_pool',), lambda: pool, close='closeCachedConnections')
+        self._spool_dir = default_spool_dir(settings)
+        os.makedirs(self._spool_dir, exist_ok=True)
+        self._spool_prefix = spool_prefix(crawler.spidercls.name if crawler else '')
+        # With asynchronous writes, spool files are written from a pool of
+        # threads too (see retrogallery.fswriter, which imports this module)
+        self._writer = None
+        if settings.getbool('RETROGALLERYLOCALPIPELINE_ASYNC_WRITES'):
+            from retrogallery.fswriter import FSWriter
+            self._writer = FSWriter.from_settings(settings)
+
+    def download_request(self, request, spider):
+        if not request.meta.get(STREAM_META_KEY):
+            return super().download_request(request, spider)
+        agent = _StreamingScrapyAgent(
+            contextFactory=self._contextFactory,
+            pool=self._pool,
+            maxsize=getattr(spider, "download_maxsize", self._default_maxsize),
+            warnsize=getattr(spider, "download_warnsize", self._default_warnsize),
+            fail_on_dataloss=self._fail_on_dataloss,
+            crawler=self._crawler,
+            spool_dir=self._spool_dir,
+            spool_prefix=self._spool_prefix,
+            writer=self._writer,
+        )
+        return agent.download_request(request)
+
+    def close(self):
+        dfd = defer.succeed(None) if is_shared(self._pool) else super().close()
+        if self._writer is not None:
+            dfd.addBoth(lambda _: self._writer.close())
+        return dfd
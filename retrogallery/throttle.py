@@ -0,0 +1,326 @@
+"""
+Per host class download budgets that adapt to how each host is coping.
+
+Gallery pages come from the origin sites (oldcrap.org, nostalgianerd.com),
+which should be crawled politely, while most image bytes come from CDNs
+such as Jetpack's i0.wp.com that tolerate far more parallelism. A single
+AutoThrottle policy has to suit both, so it either hammers the origins or
+leaves the CDNs idle.
+
+HostClassDownloader replaces Scrapy's downloader (the DOWNLOADER setting).
+Every request is classified into a host class, and each download slot
+(one per class and host, e.g. "cdn:i0.wp.com") starts with its class's
+concurrency and delay. After every window of responses the budget of the
+slot is adapted:
+
+    error rate above max_error_rate  halve concurrency, double delay
+    mean latency above target        concurrency - 1
+    otherwise                        concurrency + 1, halve delay
+
+within the class's [min_concurrency, max_concurrency] and [min_delay,
+max_delay]. Errors are failed downloads and 429 or 5xx responses. The
+budgets outlive idle slots, so a slot recreated later resumes where it
+left off.
+
+Gallery pages are put ahead of images: images get slots of their own, a
+slot serving both (e.g. with no image classes) hands out queued pages
+first, and images (which the media pipeline sends straight to
+the downloader) do not count against CONCURRENT_REQUESTS, so a long image
+queue never stops gallery pages, and with them new images, being fetched.
+
+    DOWNLOADER = "retrogallery.throttle.HostClassDownloader"
+    RETROGALLERY_HOST_CLASSES = {
+        "cdn": {"images": True, "hosts": [r"^i[0-3]\\.wp\\.com$"], "concurrency": 8, "max_concurrency": 32},
+        "images": {"images": True, "concurrency": 4, "max_concurrency": 8},
+        "origin": {"concurrency": 2, "max_concurrency": 4, "delay": 1.0},
+    }
+
+Image requests are classified first, into the classes with "images" set,
+so images always get an image budget whatever their host; other requests
+(and images when no image class matches) into the rest. Within each,
+classes are matched in order by their "hosts" regular expressions; a class
+without hosts matches any host. The S3 pipeline's uploads do not go
+through the downloader and are bounded by RETROGALLERYS3PIPELINE_CONCURRENCY;
+the upload class covers uploads that do (e.g. FilesPipeline S3 stores).
+"""
+
+import logging
+import re
+from collections import deque
+from time import time
+
+from scrapy.core.downloader import Downloader, Slot
+from scrapy.exceptions import IgnoreRequest
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.python.failure import Failure
+
+from retrogallery.items import IMAGE_META_KEY
+from retrogallery.metrics import get_metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_HOST_CLASSES = {
+    'cdn': {
+        'images': True,
+        'hosts': [r'^i[0-3]\.wp\.com$', r'\.cloudfront\.net$', r'\.akamaized\.net$', r'\.fastly\.net$'],
+        'concurrency': 8,
+        'max_concurrency': 32,
+        'target_latency': 2.0,
+    },
+    'images': {
+        'images': True,
+        'concurrency': 4,
+        'max_concurrency': 8,
+        'target_latency': 2.0,
+    },
+    'upload': {
+        'hosts': [r'(^|\.)s3[.-]([a-z0-9-]+\.)?amazonaws\.com$'],
+        'concurrency': 8,
+        'max_concurrency': 16,
+        'target_latency': 5.0,
+    },
+    'origin': {
+        'concurrency': 2,
+        'max_concurrency': 4,
+        'delay': 1.0,
+        'target_latency': 2.0,
+    },
+}
+
+# The delay a slot backs off to when it starts seeing errors without a delay
+BACKOFF_DELAY = 0.25
+
+
+def is_image_request(request):
+    """
+    Returns True for image requests made by RetroGalleryLocalPipeline.
+    """
+    return IMAGE_META_KEY in request.meta
+
+
+class HostClass:
+    """
+    The budget of a class of hosts.
+
+    Parameters:
+        name (str): The class name, used in slot keys and stats.
+        hosts (list[str]): Regular expressions matching the hosts in the
+        class; empty to match any host.
+        images (bool): Whether the class is for image requests, which are
+        matched against image classes before any other.
+        concurrency (int): The initial concurrency of each slot.
+        min_concurrency (int): The lowest concurrency adaptation may set.
+        max_concurrency (int): The highest concurrency adaptation may set.
+        delay (float): The initial delay between requests, in seconds.
+        min_delay (float): The lowest delay adaptation may set (defaults to
+        delay, so a polite delay is never shortened).
+        max_delay (float): The highest delay adaptation may set.
+        target_latency (float): The download latency, in seconds, above
+        which concurrency is reduced.
+        max_error_rate (float): The error rate above which the slot backs
+        off.
+        window (int): The number of responses between adaptations.
+    """
+
+    def __init__(self, name, hosts=None, images=False, concurrency=8, min_concurrency=1, max_concurrency=None,
+                 delay=0.0, min_delay=None, max_delay=30.0, target_latency=2.0, max_error_rate=0.1,
+                 window=10):
+        self.name = name
+        self.patterns = [re.compile(host) for host in hosts or []]
+        self.images = images
+        self.concurrency = concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max(max_concurrency or concurrency, concurrency)
+        self.delay = delay
+        self.min_delay = delay if min_delay is None else min_delay
+        self.max_delay = max(max_delay, delay)
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.window = window
+
+    def matches(self, host):
+        return not self.patterns or any(pattern.search(host) for pattern in self.patterns)
+
+
+def parse_host_classes(host_classes):
+    """
+    Builds HostClass objects from the RETROGALLERY_HOST_CLASSES setting, a
+    dict of name -> HostClass keyword arguments. Classes without hosts are
+    moved to the end, so they only catch hosts no other class matches, and
+    a "default" class is added if no class other than an image class
+    matches any host.
+    """
+    classes = [HostClass(name, **options) for name, options in (host_classes or DEFAULT_HOST_CLASSES).items()]
+    classes.sort(key=lambda host_class: not host_class.patterns)
+    if not any(not host_class.patterns and not host_class.images for host_class in classes):
+        classes.append(HostClass('default'))
+    return classes
+
+
+class SlotBudget:
+    """
+    The adaptive concurrency and delay of one download slot.
+    """
+
+    __slots__ = ('host_class', 'concurrency', 'delay', 'responses', 'errors', 'latency')
+
+    def __init__(self, host_class):
+        self.host_class = host_class
+        self.concurrency = host_class.concurrency
+        self.delay = host_class.delay
+        self.responses = self.errors = 0
+        self.latency = 0.0
+
+    def record(self, latency, error):
+        """
+        Records a download and, at the end of a window, adapts the budget.
+
+        Returns:
+            changed (bool): Whether the concurrency or delay changed.
+        """
+        self.responses += 1
+        self.errors += bool(error)
+        self.latency += latency or 0.0
+        if self.responses < self.host_class.window:
+            return False
+
+        host_class = self.host_class
+        concurrency, delay = self.concurrency, self.delay
+        if self.errors / self.responses > host_class.max_error_rate:
+            concurrency = max(host_class.min_concurrency, concurrency // 2)
+            delay = min(host_class.max_delay, max(delay * 2, BACKOFF_DELAY))
+        elif self.latency / self.responses > host_class.target_latency:
+            concurrency = max(host_class.min_concurrency, concurrency - 1)
+        else:
+            concurrency = min(host_class.max_concurrency, concurrency + 1)
+            delay = max(host_class.min_delay, delay / 2 if delay > BACKOFF_DELAY / 4 else 0.0)
+        self.responses = self.errors = 0
+        self.latency = 0.0
+        changed = (concurrency, delay) != (self.concurrency, self.delay)
+        self.concurrency, self.delay = concurrency, delay
+        return changed
+
+
+class PagesFirstQueue:
+    """
+    A download slot queue that hands out queued page requests before image
+    requests, first in first out within each.
+    """
+
+    def __init__(self):
+        self.pages = deque()
+        self.images = deque()
+
+    def append(self, entry):
+        request, _ = entry
+        (self.images if is_image_request(request) else self.pages).append(entry)
+
+    def popleft(self):
+        return self.pages.popleft() if self.pages else self.images.popleft()
+
+    def __len__(self):
+        return len(self.pages) + len(self.images)
+
+    def __bool__(self):
+        return bool(self.pages or self.images)
+
+
+class HostClassDownloader(Downloader):
+    """
+    A downloader with adaptive per host class budgets. See the module
+    docstring.
+    """
+
+    def __init__(self, crawler):
+        super().__init__(crawler)
+        self.host_classes = parse_host_classes(self.settings.getdict('RETROGALLERY_HOST_CLASSES'))
+        self.budgets = {}
+        self.pages_active = 0
+        self.stats = crawler.stats
+        self.metrics = get_metrics(crawler)
+        if self.settings.getbool('AUTOTHROTTLE_ENABLED'):
+            logger.warning("AutoThrottle is enabled and will fight HostClassDownloader over download delays")
+
+    def classify(self, request):
+        host = urlparse_cached(request).hostname or ''
+        # Images first, so an image from an origin host still gets an image
+        # budget rather than the origin's
+        if is_image_request(request):
+            for host_class in self.host_classes:
+                if host_class.images and host_class.matches(host):
+                    return host_class
+        for host_class in self.host_classes:
+            if not host_class.images and host_class.matches(host):
+                return host_class
+
+    def fetch(self, request, spider):
+        dfd = super().fetch(request, spider)
+        if not is_image_request(request):
+            self.pages_active += 1
+
+            def _page_done(result):
+                self.pages_active -= 1
+                return result
+
+            dfd.addBoth(_page_done)
+        return dfd
+
+    def needs_backout(self):
+        # Images are bounded by the item pipeline (CONCURRENT_ITEMS), so
+        # only pages count against CONCURRENT_REQUESTS
+        return self.pages_active >= self.total_concurrency
+
+    def _get_slot_key(self, request, spider):
+        if self.DOWNLOAD_SLOT in request.meta:
+            return request.meta[self.DOWNLOAD_SLOT]
+        return f"{self.classify(request).name}:{super()._get_slot_key(request, spider)}"
+
+    def _get_slot(self, request, spider):
+        key = self._get_slot_key(request, spider)
+        if key not in self.slots:
+            budget = self.budgets.get(key)
+            if budget is None:
+                budget = self.budgets[key] = SlotBudget(self.classify(request))
+                self._record_budget(key, budget)
+            slot = Slot(budget.concurrency, budget.delay, self.randomize_delay)
+            slot.queue = PagesFirstQueue()
+            self.slots[key] = slot
+        return key, self.slots[key]
+
+    def _download(self, slot, request, spider):
+        start = time()
+        key = request.meta.get(self.DOWNLOAD_SLOT)
+
+        def _observe(result):
+            budget = self.budgets.get(key)
+            if budget is None:
+                return result
+            if isinstance(result, Failure):
+                if result.check(IgnoreRequest):
+                    return result
+                error = True
+            else:
+                error = result.status == 429 or result.status >= 500
+            latency = request.meta.get('download_latency', time() - start)
+            if budget.record(latency, error):
+                self._apply(key, budget, spider)
+            return result
+
+        return super()._download(slot, request, spider).addBoth(_observe)
+
+    def _apply(self, key, budget, spider):
+        logger.debug("Download slot %s: concurrency %d, delay %.2fs", key, budget.concurrency, budget.delay)
+        self._record_budget(key, budget)
+        slot = self.slots.get(key)
+        if slot is not None:
+            slot.concurrency, slot.delay = budget.concurrency, budget.delay
+            self._process_queue(spider, slot)
+
+    def _record_budget(self, key, budget):
+        self.stats.set_value(f'hostclass/{key}/concurrency', budget.concurrency)
+        self.stats.set_value(f'hostclass/{key}/delay', budget.delay)
+        host_class = budget.host_class.name
+        self.metrics.set('retrogallery_slot_concurrency', budget.concurrency, slot=key, host_class=host_class)
+        self.metrics.set('retrogallery_slot_delay_seconds', budget.delay, slot=key, host_class=host_class)
@@ -0,0 +1,141 @@
+"""
+Recognises alt texts that are not image titles: the file names cameras and
+phones give photos (DSC_1234, IMG_0001, P1010001...), screenshots and
+exported photos.
+
+Common prefixes for photo filenames (by no means a complete list):
+
+    _DSCxxxx - Sony a6000
+    _MG_xxxx - Canon EOS
+    _XXXxxxx - Canon EOS, with a custom three character prefix
+    DJI_xxxx - DJI Mavic 2 Pro
+    DSC_xxxx - Sony, Nikon
+    DSCxxxxx - Sony mirrorless and point and shoot / action models, Nikon
+               depending on colour space used
+    DSCFxxxx - Fuji
+    DSCNxxxx - Nikon
+    IMG_xxxx - Sony, Canon, Nikon, Olympus, Fuji, Panasonic, Samsung
+    IMGPxxxx - Pentax
+    Pxxxxxxx - Panasonic Lumix, Olymupus Tough
+    SDCxxxxx - Samsung
+
+Every pattern in the registry (CAMERA_FILENAME_PATTERNS, a dict of vendor
+name -> regular expression matched case-insensitively at the start of the
+alt text) is combined into one regular expression, compiled once, so an
+alt text is classified in a single match. Projects can add vendors, or
+drop them with None, from the settings:
+
+    RETROGALLERY_CAMERA_FILENAME_PATTERNS = {
+        "gopro": r"g[hop]\\d{6}",
+        "screenshot": None,
+    }
+"""
+
+import functools
+import re
+
+
+CAMERA_FILENAME_PATTERNS = {
+    'sony_alpha': r'_dsc',
+    'canon_eos': r'_mg',
+    'canon_eos_custom': r'_[a-z0-9]{3}\d{4}',
+    'dji': r'dji_',
+    # DSC_, DSCF (Fuji), DSCN (Nikon) and plain DSC
+    'sony_nikon_fuji': r'dsc',
+    'img': r'img_',
+    'pentax': r'imgp',
+    'panasonic_olympus': r'p\d{7,8}',
+    'samsung': r'sdc',
+    'screenshot': r'screenshot',
+    # Photos exported from Apple Photos
+    'apple_photos': r'fullsizeoutput',
+}
+
+
+class TitleClassifier:
+    """
+    Classifies alt texts as camera file names or titles.
+
+    Parameters:
+        patterns (dict): Vendor name -> regular expression matched at the
+        start of the alt text, ignoring case. Vendor names must be valid
+        Python identifiers.
+    """
+
+    def __init__(self, patterns=None):
+        self.patterns = dict(CAMERA_FILENAME_PATTERNS if patterns is None else patterns)
+        for name in self.patterns:
+            if not name.isidentifier():
+                raise ValueError(f"Camera file name pattern names must be identifiers, got {name!r}")
+        # Classifying only needs to know whether any pattern matches, which
+        # is quickest without capturing groups; vendor() names the match
+        combined = '|'.join(f'(?:{pattern})' for pattern in self.patterns.values()) or r'(?!)'
+        self._match = re.compile(combined, re.IGNORECASE).match
+        named = '|'.join(f'(?P<{name}>{pattern})' for name, pattern in self.patterns.items()) or r'(?!)'
+        self._vendor = re.compile(named, re.IGNORECASE).match
+
+    def vendor(self, text):
+        """
+        Returns the name of the vendor whose file name text is, or None if
+        it is not a camera file name.
+        """
+        match = self._vendor(text) if text else None
+        if match is None:
+            return None
+        return next(name for name, value in match.groupdict().items() if value is not None)
+
+    def is_camera_filename(self, text):
+        return bool(text) and self._match(text) is not None
+
+    def title(self, alt, default=None):
+        """
+        Returns alt as an image title, or default if alt is missing, or a
+        camera file name and a default is given.
+
+        Parameters:
+            alt (str): The alt text, or None if there is none.
+            default (str): The default image title.
+
+        Returns:
+            The image title, or the default.
+        """
+        if not alt:
+            return default
+        if default is not None and self._match(alt) is not None:
+            return default
+        return alt
+
+    def titles(self, alts, default=None):
+        """
+        Returns the image titles of many alt texts at once, as title() would
+        for each.
+        """
+        match = self._match
+        if default is None:
+            return [alt or None for alt in alts]
+        return [default if not alt or match(alt) is not None else alt for alt in alts]
+
+
+DEFAULT_CLASSIFIER = TitleClassifier()
+
+
+@functools.lru_cache(maxsize=None)
+def _classifier(overrides):
+    patterns = dict(CAMERA_FILENAME_PATTERNS)
+    for name, pattern in overrides:
+        if pattern is None:
+            patterns.pop(name, None)
+        else:
+            patterns[name] = pattern
+    return TitleClassifier(patterns)
+
+
+def get_classifier(settings=None):
+    """
+    Returns the (shared) TitleClassifier for the patterns added or removed
+    by RETROGALLERY_CAMERA_FILENAME_PATTERNS.
+    """
+    overrides = settings.getdict('RETROGALLERY_CAMERA_FILENAME_PATTERNS') if settings else None
+    if not overrides:
+        return DEFAULT_CLASSIFIER
+    return _classifier(tuple(sorted(overrides.items())))
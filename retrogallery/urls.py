@@ -0,0 +1,124 @@
+"""
+Parses each URL once into a compact, cached record of everything the
+spiders and pipelines derive from it.
+
+The same image and gallery URLs are looked at many times: by the variant
+resolver when grouping candidates, by RetroGalleryLocalPipeline.file_path()
+(called several times per image) and by the title helpers. parse_url()
+returns a ParsedURL for a URL from a bounded LRU cache, so the parsing,
+hashing and title construction happen once per URL.
+
+The normalised URL (canonical) identifies the same resource however it was
+linked:
+
+    - HTML entities left in attribute values are decoded (&#038;, &amp;)
+    - the scheme and host are lowercased, default ports and fragments
+      dropped
+    - Jetpack's image CDN (Photon, i0-i3.wp.com) is unwrapped to the origin
+      host, keeping only the query parameters that change the image served
+      (QUERY_RULES); other hosts lose tracking parameters
+    - the remaining query parameters are sorted
+"""
+
+import functools
+import hashlib
+import html
+import os
+import re
+from collections import namedtuple
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+
+# Entries in the URL cache; each record takes well under a kilobyte
+CACHE_SIZE = 16384
+
+# Jetpack's image CDN (Photon) wraps the origin host: i0.wp.com/<host>/<path>
+PHOTON_HOST = re.compile(r'^i[0-3]\.wp\.com$')
+# WordPress appends -{width}x{height} to the file name of resized copies
+SIZE_SUFFIX = re.compile(r'-(\d+)x(\d+)(?=\.[A-Za-z0-9]+$)')
+
+# Which query parameters survive normalisation, by host rule: a tuple of
+# parameters to keep, or a compiled pattern of parameters to drop
+QUERY_RULES = {
+    # Jetpack resize parameters change the bytes served; ssl, strip and
+    # is-pending-load do not
+    'photon': ('w', 'h', 'resize', 'fit', 'crop', 'lb', 'zoom', 'quality'),
+    'default': re.compile(r'^(utm_\w+|fbclid|gclid|mc_[a-z]+)$'),
+}
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+ParsedURL = namedtuple('ParsedURL', ['url', 'canonical', 'path', 'extension', 'title', 'guid', 'asset'])
+ParsedURL.__doc__ = """
+Everything derived from a URL.
+
+    url (str): The URL as given.
+    canonical (str): The normalised URL (see the module docstring), which
+    keys the URLs of the blob index and of the distributed seen image set.
+    path (str): The path on the origin host.
+    extension (str): The file extension, including the ".", or "".
+    title (str): A title constructed from the last component of the path
+    (see retrogallery.utils.construct_title_from_url()).
+    guid (str): The hex SHA1 of the URL as given, stable across crawls: the
+    stored path of an image does not move when the normalisation rules do.
+    asset (str): A key shared by every size variant of the same image: the
+    origin host and path without a WordPress size suffix.
+"""
+
+
+def _title(bare_url):
+    # Get the last component of the URL path, without trailing slashes.
+    title = os.path.basename(bare_url.rstrip('/'))
+    # Replace underscores and hyphens with spaces.
+    title = title.replace('_', ' ').replace('-', ' ').strip()
+    # Remove any file extension, and capitalise the first letter of each word.
+    return os.path.splitext(title)[0].title()
+
+
+def _query(params, rule):
+    if isinstance(rule, tuple):
+        params = [(key, value) for key, value in params if key in rule]
+    else:
+        params = [(key, value) for key, value in params if not rule.match(key)]
+    return urlencode(sorted(params))
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def parse_url(url):
+    """
+    Returns the ParsedURL of url, from the cache if it has been parsed
+    recently.
+    """
+    parsed = urlparse(url)
+    bare_url = parsed._replace(query='', fragment='').geturl()
+
+    unescaped = urlparse(html.unescape(url)) if '&' in url else parsed
+    scheme = unescaped.scheme.lower()
+    netloc = unescaped.netloc.lower()
+    # The asset key has always kept the host as linked, port included
+    asset_host, path = netloc, unescaped.path
+    host = unescaped.hostname or ''
+    try:
+        port = unescaped.port
+    except ValueError:
+        port = None
+    rule = 'default'
+    if PHOTON_HOST.match(netloc):
+        asset_host, _, path = path.lstrip('/').partition('/')
+        path = '/' + path
+        host, port, rule = asset_host, None, 'photon'
+    if port and port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{port}"
+    query = _query(parse_qsl(unescaped.query, keep_blank_values=True), QUERY_RULES[rule])
+    canonical = f"{scheme}://{host}{path}" + (f"?{query}" if query else '')
+
+    return ParsedURL(
+        url=url,
+        canonical=canonical,
+        path=path,
+        extension=os.path.splitext(bare_url)[1],
+        title=_title(bare_url),
+        # deepcode ignore InsecureHash: <not used in a security context>
+        guid=hashlib.sha1(url.encode()).hexdigest(),
+        asset=asset_host + SIZE_SUFFIX.sub('', path),
+    )
@@ -1,24 +1,39 @@
-import os
 import re
-from urllib.parse import urlparse
 
+from retrogallery import titles, urls, variants
 
-def extract_image_urls(img):
+
+def extract_image_urls(img, policy=variants.DEFAULT_POLICY):
     """
-    Extracts the URLs from an img tag.
+    Extracts the URLs from an img tag. The src, srcset, data-lazy-srcset and
+    data-orig-file attributes usually hold several sizes of the same image,
+    so the candidates are grouped by underlying asset and a single URL is
+    chosen for each asset according to policy (see retrogallery.variants).
 
     Parameters:
         img (Response): The img tag to extract the URLs from.
+        policy (str): The variant policy: "original", "largest" or
+        "max-width:N".
 
     Returns:
-        urls (list[str]): A list of URLs extracted from the img tag,
-        including the URLs from the srcset attribute.
+        urls (list[str]): A list of URLs extracted from the img tag, one per
+        underlying image.
     """
-    urls = img.css("::attr(src)").getall()
-    urls.extend(extract_srcset(img))
-    # Remove duplicate elements from urls list while preserving order.
-    urls = list(dict.fromkeys(urls))
-    return urls
+    return variants.resolve_image_urls(img, policy)
+
+
+def extract_images(img, policy=variants.DEFAULT_POLICY):
+    """
+    Extracts the URLs from an img tag as extract_image_urls() does, with the
+    dimensions of each where the tag gives them (data-orig-size, or the
+    width and height of the original).
+
+    Returns:
+        (urls, sizes) (tuple[list[str], list[tuple]]): The URLs, and the
+        (width, height) of each URL, or None where it is unknown.
+    """
+    images = variants.resolve_image_sizes(img, policy)
+    return [url for url, _ in images], [size for _, size in images]
 
 
 def extract_srcset(img):
@@ -45,31 +60,14 @@ def extract_image_extension(url):
         image_ext (str): The image extension (including the .), or None if
         the image extension cannot be extracted.
     """
-    url_without_params_or_fragments = urlparse(url)._replace(query='', fragment='').geturl()
-    image_ext = os.path.splitext(url_without_params_or_fragments)[1]
-    return image_ext
+    return urls.parse_url(url).extension
 
 
 def extract_image_title(img, default=None):
     """
     Extracts the image title from an img tag. Defaults to the gallery title if
     there is no alt text or the alt text is simply a common photo name (e.g.,
-    DSC_1234.jpg).
-
-    Common prefixes for photo filenames (by no means a complete list):
-        _DSCxxxx - Sony a6000
-        _MG_xxxx - Canon EOS
-        _XXXxxxx - Canon EOS
-        DJI_xxxx - DJI Mavic 2 Pro
-        DSC_xxxx - Sony, Nikon
-        DSCxxxxx - Sony mirrorless and point and shoot / action models, Nikon 
-                   depending on colour space used
-        DSCFxxxx - Fuji
-        DSCNxxxx - Nikon
-        IMG_xxxx - Sony, Canon, Nikon, Olympus, Fuji, Panasonic, Samsung
-        IMGPxxxx - Pentax
-        Pxxxxxxx - Panasonic Lumix, Olymupus Tough
-        SDCxxxxx - Samsung
+    DSC_1234.jpg). See retrogallery.titles for the photo names recognised.
 
     Parameters:
         img (Response): The img tag to extract the image title from.
@@ -80,24 +78,22 @@ def extract_image_title(img, default=None):
         The image title, or the default if the image title is not found.
         If no default is provided, returns None.
     """
-    image_title = img.css("::attr(alt)").get()
-    if (not image_title
-        or image_title.lower().startswith('_dsc')
-        or image_title.lower().startswith('_mg')
-        or image_title.lower().startswith('_xxx')
-        or image_title.lower().startswith('dji_')
-        or image_title.lower().startswith('dsc')
-        or image_title.lower().startswith('dsc')
-        or image_title.lower().startswith('img_')
-        or image_title.lower().startswith('imgp')
-        # regex match for P\d{7} or P\d{8} (Panasonic Lumix, Olympus Tough)
-        or re.match(r'p\d{7,8}', image_title.lower())
-        or image_title.lower().startswith('screenshot')
-        or image_title.lower().startswith('fullsizeoutput')
-        and default is not None
-    ):
-        image_title = default
-    return image_title
+    return title_from_alt_text(img.css("::attr(alt)").get(), default=default)
+
+
+def title_from_alt_text(image_title, default=None):
+    """
+    Returns the alt text of an img tag as an image title, or default if the
+    alt text is missing or a common photo name. See extract_image_title().
+
+    Parameters:
+        image_title (str): The alt text, or None if there is none.
+        default (str): The default image title.
+
+    Returns:
+        The image title, or the default.
+    """
+    return titles.DEFAULT_CLASSIFIER.title(image_title, default=default)
 
 
 def construct_image_title_from_url(url):
@@ -122,19 +118,4 @@ def construct_title_from_url(url):
     Returns:
         title (str): The title.
     """
-    # Strip query params and fragments.
-    url_without_params_or_fragments = urlparse(url)._replace(query='', fragment='').geturl()
-    # Strip trailing slashes.
-    url_without_params_or_fragments = url_without_params_or_fragments.rstrip('/')
-    # Get the last component of the URL path.
-    title = os.path.basename(url_without_params_or_fragments)
-    # Replace underscores and hyphens with spaces.
-    title = title.replace('_', ' ')
-    title = title.replace('-', ' ')
-    # Remove any leading or trailing whitespace.
-    title = title.strip()
-    # Remove any file extension.
-    title = os.path.splitext(title)[0]
-    # Capitalise the first letter of each word.
-    title = title.title()
-    return title
\ No newline at end of file
+    return urls.parse_url(url).title
@@ -0,0 +1,287 @@
+"""
+Resolves the many size variants of an image in a page down to one URL per
+underlying asset.
+
+WordPress and Jetpack publish the same photo under several URLs:
+
+    https://oldcrap.org/wp-content/uploads/2017/12/fullsizeoutput_134e.jpeg
+    https://oldcrap.org/wp-content/uploads/2017/12/fullsizeoutput_134e-1024x524.jpeg
+    https://i0.wp.com/oldcrap.org/wp-content/uploads/2017/12/fullsizeoutput_134e-1024x524.jpeg?w=600&ssl=1
+    https://i0.wp.com/oldcrap.org/wp-content/uploads/2017/12/fullsizeoutput_134e.jpeg?fit=3249%2C1661&ssl=1
+
+The img attributes that carry them (src, srcset, data-lazy-srcset,
+data-orig-file, data-orig-size, width) are parsed into ImageCandidate
+records, grouped by asset and reduced to a single URL by a policy:
+
+    original      - the original upload, or the largest candidate if the
+                    original is not linked
+    largest       - the widest candidate
+    max-width:N   - the widest candidate no wider than N pixels
+"""
+
+import html
+import math
+import re
+from collections import OrderedDict, namedtuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+from parsel import SelectorList
+
+from retrogallery import urls
+
+
+DEFAULT_POLICY = 'original'
+
+ImageCandidate = namedtuple('ImageCandidate', ['url', 'width', 'density', 'original'])
+ImageCandidate.__doc__ = """
+A URL at which an image can be fetched.
+
+    url (str): The URL of the variant.
+    width (int): The width in pixels, or None if unknown.
+    density (float): The pixel density descriptor from srcset, or None.
+    original (bool): Whether the URL is the original upload rather than a
+    resized copy.
+"""
+
+# Jetpack resize parameters that change the bytes served
+_RESIZE_PARAMS = ('w', 'h', 'resize', 'fit', 'crop', 'lb', 'zoom')
+# Split a srcset on the commas between candidates, not those inside URLs
+_SRCSET_SPLIT = re.compile(r',\s*(?=(?:https?:)?//|/|data:)')
+
+
+def parse_srcset(srcset):
+    """
+    Parses a srcset attribute into candidates, skipping inline data: URLs
+    (lazy-loading placeholders).
+
+    Parameters:
+        srcset (str): The srcset attribute value.
+
+    Returns:
+        candidates (list[ImageCandidate]): The candidates in srcset order.
+    """
+    candidates = []
+    if not srcset:
+        return candidates
+    for part in _SRCSET_SPLIT.split(html.unescape(srcset).strip()):
+        fields = part.split()
+        if not fields or fields[0].startswith('data:'):
+            continue
+        url = fields[0]
+        width = density = None
+        descriptor = fields[1] if len(fields) > 1 else ''
+        if descriptor.endswith('w') and descriptor[:-1].isdigit():
+            width = int(descriptor[:-1])
+        elif descriptor.endswith('x'):
+            try:
+                density = float(descriptor[:-1])
+            except ValueError:
+                pass
+        if width is None:
+            width = infer_width(url)
+        candidates.append(ImageCandidate(url, width, density, is_original(url)))
+    return candidates
+
+
+def infer_width(url):
+    """
+    Infers the width of the image served at url from Jetpack resize
+    parameters (?w=600, ?resize=600,400, ?fit=600,400) or a WordPress size
+    suffix (-600x400.jpg). Returns None if the width cannot be inferred.
+    """
+    parsed = urlparse(url)
+    params = parse_qs(parsed.query)
+    if 'w' in params and params['w'][0].isdigit():
+        return int(params['w'][0])
+    for param in ('resize', 'fit'):
+        if param in params:
+            width = unquote(params[param][0]).split(',')[0]
+            if width.isdigit():
+                return int(width)
+    match = urls.SIZE_SUFFIX.search(parsed.path)
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def is_original(url):
+    """
+    Returns True if url refers to an original upload, i.e. it has neither a
+    WordPress size suffix nor Jetpack resize parameters.
+    """
+    parsed = urlparse(url)
+    if urls.SIZE_SUFFIX.search(parsed.path):
+        return False
+    params = parse_qs(parsed.query)
+    return not any(param in params for param in _RESIZE_PARAMS)
+
+
+def asset_key(url):
+    """
+    Returns a key shared by every variant of the same underlying asset: the
+    origin host and path with any Photon CDN wrapper, query string and
+    WordPress size suffix removed.
+
+    Example:
+        https://i0.wp.com/oldcrap.org/a/photo-1024x524.jpeg?w=600&ssl=1
+        -> oldcrap.org/a/photo.jpeg
+    """
+    return urls.parse_url(url).asset
+
+
+def extract_candidates(img):
+    """
+    Extracts every candidate URL from one or more img tags, from the
+    data-orig-file/data-orig-size, src/width, srcset and data-lazy-srcset
+    attributes.
+
+    Parameters:
+        img (Selector, SelectorList or list): The img tag(s), as Selectors,
+        lxml elements or attribute dicts (see retrogallery.extract).
+
+    Returns:
+        candidates (list[ImageCandidate]): The candidates in document order.
+    """
+    nodes = img if isinstance(img, (SelectorList, list, tuple)) else [img]
+    candidates = []
+    for node in nodes:
+        attrib = getattr(node, 'attrib', node)
+        orig_file = attrib.get('data-orig-file')
+        if orig_file:
+            orig_size = attrib.get('data-orig-size', '').split(',')[0]
+            width = int(orig_size) if orig_size.isdigit() else infer_width(orig_file)
+            candidates.append(ImageCandidate(html.unescape(orig_file), width, None, True))
+        src = attrib.get('src')
+        if src and not src.startswith('data:'):
+            src = html.unescape(src)
+            width = attrib.get('width', '')
+            width = infer_width(src) if not width.isdigit() else int(width)
+            candidates.append(ImageCandidate(src, width, None, is_original(src)))
+        for attribute in ('srcset', 'data-lazy-srcset'):
+            candidates.extend(parse_srcset(attrib.get(attribute)))
+    return candidates
+
+
+def parse_policy(policy):
+    """
+    Parses a variant policy string into a (name, max_width) tuple.
+
+    Parameters:
+        policy (str): One of "original", "largest" or "max-width:N".
+
+    Returns:
+        (name, max_width) (tuple[str, int]): max_width is None unless the
+        policy is max-width.
+    """
+    policy = (policy or DEFAULT_POLICY).strip().lower()
+    if policy in ('original', 'largest'):
+        return policy, None
+    name, _, max_width = policy.replace('=', ':').partition(':')
+    if name == 'max-width' and max_width.strip().isdigit():
+        return name, int(max_width)
+    raise ValueError(f"Unknown image variant policy {policy!r}")
+
+
+def choose_variant(candidates, policy=DEFAULT_POLICY):
+    """
+    Chooses one candidate from the variants of a single asset.
+
+    Parameters:
+        candidates (list[ImageCandidate]): The variants of one asset.
+        policy (str): The variant policy, see parse_policy().
+
+    Returns:
+        candidate (ImageCandidate): The chosen variant.
+    """
+    name, max_width = parse_policy(policy)
+
+    def size(candidate):
+        # An original of unknown width is at least as large as any resized
+        # copy WordPress generated from it.
+        if candidate.width is None:
+            width = math.inf if candidate.original else 0
+        else:
+            width = candidate.width
+        return width, candidate.density or 1.0
+
+    if name == 'original':
+        originals = [c for c in candidates if c.original]
+        return max(originals or candidates, key=size)
+    if name == 'max-width':
+        fitting = [c for c in candidates if c.width is not None and c.width <= max_width]
+        if fitting:
+            return max(fitting, key=size)
+        sized = [c for c in candidates if c.width is not None]
+        if sized:
+            return min(sized, key=size)
+    return max(candidates, key=size)
+
+
+def _group_by_asset(img):
+    assets = OrderedDict()
+    for candidate in extract_candidates(img):
+        assets.setdefault(asset_key(candidate.url), []).append(candidate)
+    return assets
+
+
+def resolve_image_urls(img, policy=DEFAULT_POLICY):
+    """
+    Resolves the img tag(s) to one URL per underlying asset.
+
+    Parameters:
+        img (Selector, SelectorList or list): The img tag(s), see
+        extract_candidates().
+        policy (str): The variant policy, see parse_policy().
+
+    Returns:
+        urls (list[str]): One URL per asset, in order of first appearance.
+    """
+    return [choose_variant(variants, policy).url for variants in _group_by_asset(img).values()]
+
+
+def original_sizes(img):
+    """
+    Returns the (width, height) of the originals the img tag(s) give the
+    dimensions of, in data-orig-size or in the width and height of an
+    original src, by asset key.
+    """
+    nodes = img if isinstance(img, (SelectorList, list, tuple)) else [img]
+    sizes = {}
+    for node in nodes:
+        attrib = getattr(node, 'attrib', node)
+        orig_file = attrib.get('data-orig-file')
+        orig_size = attrib.get('data-orig-size', '').split(',')
+        if orig_file and len(orig_size) == 2 and all(value.isdigit() for value in orig_size):
+            sizes.setdefault(asset_key(html.unescape(orig_file)), tuple(map(int, orig_size)))
+        src = attrib.get('src')
+        width, height = attrib.get('width', ''), attrib.get('height', '')
+        if src and not src.startswith('data:') and width.isdigit() and height.isdigit():
+            src = html.unescape(src)
+            if is_original(src):
+                sizes.setdefault(asset_key(src), (int(width), int(height)))
+    return sizes
+
+
+def resolve_image_sizes(img, policy=DEFAULT_POLICY):
+    """
+    Resolves the img tag(s) to one URL per underlying asset, as
+    resolve_image_urls() does, with the dimensions of the chosen variant
+    where the markup gives the original's (see original_sizes()). A resized
+    copy keeps the original's aspect ratio.
+
+    Returns:
+        images (list[tuple]): One (url, size) per asset, in order of first
+        appearance; size is a (width, height) tuple, or None if unknown.
+    """
+    sizes = original_sizes(img)
+    images = []
+    for key, candidates in _group_by_asset(img).items():
+        chosen = choose_variant(candidates, policy)
+        size = sizes.get(key)
+        if size is not None and not chosen.original:
+            if chosen.width and size[0]:
+                size = (chosen.width, round(chosen.width * size[1] / size[0]))
+            else:
+                size = None
+        images.append((chosen.url, size))
+    return images
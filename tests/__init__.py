@@ -0,0 +1,60 @@
+import time
+
+from scrapy import Spider
+from scrapy.crawler import Crawler
+from twisted.internet import reactor
+from twisted.python.failure import Failure
+
+
+class TestSpider(Spider):
+    name = 'test'
+
+
+def get_crawler(settings=None, spidercls=TestSpider):
+    """
+    Returns a crawler with the given settings (on top of Scrapy's defaults,
+    not the project's) and its spider, without starting it.
+
+    scrapy.utils.test.get_crawler() is not used, as importing it makes
+    unittest.TestCase unloadable by nose2.
+    """
+    crawler = Crawler(spidercls, settings or {})
+    crawler.spider = crawler._create_spider()
+    return crawler
+
+
+def run_until_fired(dfd, timeout=10):
+    """
+    Iterates the reactor until dfd has fired, and returns its result or
+    raises its failure.
+
+    The reactor is never run, so plain unittest.TestCase tests can wait for
+    threads and Deferreds (twisted.trial tests are not loadable by nose2).
+    """
+    results = []
+    dfd.addBoth(results.append)
+    deadline = time.monotonic() + timeout
+    while not results:
+        if time.monotonic() > deadline:
+            raise AssertionError(f"Deferred not fired after {timeout}s")
+        reactor.iterate(0.01)
+    if isinstance(results[0], Failure):
+        results[0].raiseException()
+    return results[0]
+
+
+def start_reactor_threads(testcase):
+    """
+    Starts the reactor's thread pool, used by deferToThread(), for the
+    length of a test. It otherwise only starts with the reactor, and a pool
+    left running keeps the test process from exiting.
+    """
+    threadpool = reactor.getThreadPool()
+    threadpool.start()
+
+    def _stop():
+        threadpool.stop()
+        # A stopped pool cannot be started again; the next test gets a new one
+        reactor.threadpool = None
+
+    testcase.addCleanup(_stop)
@@ -0,0 +1,145 @@
+import tempfile
+import time
+import unittest
+from io import BytesIO
+from pathlib import Path
+
+from scrapy.http import Request
+
+from retrogallery.blobstore import BlobIndex, BlobStore
+from retrogallery.items import IMAGE_META_KEY, ImageItem
+from retrogallery.pipelines import RetroGalleryLocalPipeline
+from tests import get_crawler
+
+
+IMAGE_URL = 'https://i0.wp.com/oldcrap.org/wp-content/uploads/2018/02/ti99.jpeg'
+IMAGE_BYTES = b'\xff\xd8\xff\xe0 not really a jpeg'
+
+
+class BlobIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.index = BlobIndex(Path(self.directory.name) / 'index.sqlite3')
+        self.index.add_blob('abc', '.jpg', 3, 'md5')
+
+    def tearDown(self):
+        self.index.close()
+        self.directory.cleanup()
+
+    def test_blob_for_path(self):
+        self.assertIsNone(self.index.blob_for_path('a/b.jpg'))
+        self.index.set_entry('a/b.jpg', 'abc')
+        self.assertEqual(self.index.blob_for_path('a/b.jpg'), ('abc', '.jpg', 3, 'md5'))
+
+    def test_blob_for_url_is_only_set_by_a_download(self):
+        self.index.set_entry('a/b.jpg', 'abc')
+        self.index.describe_entry('a/b.jpg', url=IMAGE_URL)
+        self.assertIsNone(self.index.blob_for_url(IMAGE_URL))
+        before = time.time()
+        self.index.record_download(IMAGE_URL, 'a/b.jpg')
+        digest, ext, size, md5, fetched = self.index.blob_for_url(IMAGE_URL)
+        self.assertEqual((digest, ext, size, md5), ('abc', '.jpg', 3, 'md5'))
+        self.assertGreaterEqual(fetched, before)
+
+    def test_linking_does_not_refresh_the_download_time(self):
+        self.index.set_entry('a/b.jpg', 'abc')
+        self.index.record_download(IMAGE_URL, 'a/b.jpg')
+        fetched = self.index.blob_for_url(IMAGE_URL)[4]
+        self.index.set_entry('c/d.jpg', 'abc')
+        self.index.describe_entry('c/d.jpg', url=IMAGE_URL)
+        self.assertEqual(self.index.blob_for_url(IMAGE_URL)[4], fetched)
+
+    def test_remove_blob_if_unused(self):
+        self.index.set_entry('a/b.jpg', 'abc')
+        self.assertIsNone(self.index.remove_blob_if_unused('abc'))
+        self.index.add_blob('def', '.png', 4, 'md5')
+        self.assertEqual(self.index.remove_blob_if_unused('def'), ('def', '.png', 4, 'md5'))
+        self.assertIsNone(self.index.get_blob('def'))
+
+
+class BlobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = BlobStore(self.directory.name)
+
+    def tearDown(self):
+        self.store.index.close()
+        self.directory.cleanup()
+
+    def test_identical_bytes_are_stored_once(self):
+        digest, created = self.store.put(IMAGE_BYTES, '.jpg')
+        self.assertTrue(created)
+        self.assertEqual(self.store.put(IMAGE_BYTES, '.jpg'), (digest, False))
+        self.assertEqual(self.store.blob_path(digest, '.jpg').read_bytes(), IMAGE_BYTES)
+
+    def test_find_prefix(self):
+        digest, _ = self.store.put(IMAGE_BYTES, '.jpg')
+        self.assertEqual(self.store.find_prefix(len(IMAGE_BYTES), IMAGE_BYTES[:8]), digest)
+        self.assertIsNone(self.store.find_prefix(len(IMAGE_BYTES), b'nope'))
+
+
+class BlobExpiryTest(unittest.TestCase):
+    """
+    An image URL already downloaded into the blob store is linked rather
+    than downloaded again, until it is older than IMAGES_EXPIRES.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        crawler = get_crawler({
+            'IMAGES_STORE': self.directory.name,
+            'IMAGES_EXPIRES': 30,
+            'RETROGALLERYLOCALPIPELINE_BLOB_STORE': True,
+        })
+        self.pipeline = RetroGalleryLocalPipeline.from_crawler(crawler)
+        self.pipeline.open_spider(crawler.spider)
+        self.info = self.pipeline.spiderinfo
+        self.index = self.pipeline.store.blobs.index
+        self._download('TI-99/4A')
+
+    def tearDown(self):
+        self.index.close()
+        self.directory.cleanup()
+
+    def _request(self, gallery_title, url=IMAGE_URL):
+        item = ImageItem(gallery_title=gallery_title, image_title='Console', image_urls=[url])
+        return Request(url, meta={IMAGE_META_KEY: 0}), item
+
+    def _download(self, gallery_title):
+        request, item = self._request(gallery_title)
+        path = self.pipeline.file_path(request, info=self.info, item=item)
+        self.pipeline.store.persist_file(path, BytesIO(IMAGE_BYTES), self.info)
+        result = {'url': IMAGE_URL, 'path': path, 'checksum': 'md5', 'status': 'downloaded'}
+        self.pipeline._describe_blob_entry(result, request, item)
+
+    def _age(self, days):
+        self.index.conn.execute("UPDATE downloads SET fetched = ?", (time.time() - days * 24 * 60 * 60,))
+
+    def test_stored_url_is_linked(self):
+        request, item = self._request('Texas Instruments')
+        result = self.pipeline.media_to_download(request, self.info, item=item)
+        self.assertEqual(result['status'], 'uptodate')
+        path = self.pipeline.file_path(request, info=self.info, item=item)
+        self.assertEqual(result['path'], path)
+        self.assertEqual((Path(self.directory.name) / path).read_bytes(), IMAGE_BYTES)
+
+    def test_other_spelling_of_stored_url_is_linked(self):
+        request, item = self._request('Texas Instruments', IMAGE_URL + '?ssl=1')
+        result = self.pipeline.media_to_download(request, self.info, item=item)
+        self.assertEqual(result['status'], 'uptodate')
+        self.assertEqual(result['url'], IMAGE_URL + '?ssl=1')
+
+    def test_linking_keeps_the_url_expiring(self):
+        self._age(20)
+        request, item = self._request('Texas Instruments')
+        self.assertEqual(self.pipeline.media_to_download(request, self.info, item=item)['status'], 'uptodate')
+        self._age(31)
+        request, item = self._request('TI')
+        self.assertNotIsInstance(self.pipeline.media_to_download(request, self.info, item=item), dict)
+
+    def test_expired_url_is_downloaded_again(self):
+        self._age(31)
+        request, item = self._request('Texas Instruments')
+        self.assertIsNone(self.pipeline._link_stored_blob(request, self.info, item))
@@ -0,0 +1,119 @@
+import contextlib
+import io
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import pyarrow.parquet as pq
+from PIL import Image
+
+from retrogallery import catalog
+from retrogallery.items import GalleryItem, ImageItem
+from retrogallery.pipelines import RetroGalleryCatalogPipeline
+from tests import get_crawler, run_until_fired, start_reactor_threads
+
+GALLERY_URL = 'https://oldcrap.org/2018/02/21/texas-instruments-ti-99-4a/'
+OTHER_GALLERY_URL = 'https://oldcrap.org/2018/02/22/commodore-64/'
+
+
+class CatalogTest(unittest.TestCase):
+    """
+    RetroGalleryCatalogPipeline writing the images of a few items to a
+    catalog, read back with pyarrow and the command line queries.
+    """
+
+    def setUp(self):
+        start_reactor_threads(self)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.images = Path(directory.name, 'images')
+        self.catalog = Path(directory.name, 'catalog')
+        self.crawler = get_crawler({
+            'RETROGALLERYCATALOGPIPELINE_DIR': str(self.catalog),
+            'RETROGALLERYCATALOGPIPELINE_BATCH_SIZE': 2,
+            'RETROGALLERYLOCALPIPELINE_IMAGES_STORE': str(self.images),
+        })
+
+    def _image(self, path, size):
+        local_path = self.images / path
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        Image.new('RGB', size).save(local_path, 'JPEG')
+        return {'url': f'https://oldcrap.org/{path}', 'path': path, 'checksum': 'md5', 'status': 'downloaded'}
+
+    def _crawl(self):
+        items = [
+            GalleryItem(spider='test', gallery_title='TI-99/4A', gallery_url=GALLERY_URL, images=[
+                dict(self._image('test/TI-99/4A/Console/a.jpg', (640, 480)), image_title='Console'),
+                dict(self._image('test/TI-99/4A/Speech/b.jpg', (320, 240)), image_title='Speech',
+                     duplicate_of='test/TI-99/4A/Console/a.jpg'),
+            ]),
+            ImageItem(spider='test', gallery_title='Commodore 64', gallery_url=OTHER_GALLERY_URL,
+                      image_title='Breadbin', images=[self._image('test/Commodore 64/Breadbin/c.jpg', (800, 600))]),
+            # A download result whose file is gone has no dimensions
+            ImageItem(spider='test', gallery_title='Commodore 64', gallery_url=OTHER_GALLERY_URL,
+                      image_title='1541', images=[{'url': 'https://oldcrap.org/d.jpg', 'path': 'test/gone.jpg',
+                                                   'checksum': 'md5', 'status': 'uptodate'}]),
+        ]
+        pipeline = RetroGalleryCatalogPipeline.from_crawler(self.crawler)
+        spider = self.crawler.spider
+        with mock.patch('retrogallery.pipelines.find_local_store', return_value=None):
+            pipeline.open_spider(spider)
+        for item in items:
+            self.assertIs(pipeline.process_item(item, spider), item)
+        run_until_fired(pipeline.close_spider(spider))
+
+    def _query(self, *args):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            status = catalog.main(['--dir', str(self.catalog), *args])
+        return status, output.getvalue().splitlines()
+
+    def test_rows_are_written_in_row_groups(self):
+        self._crawl()
+        [path] = self.catalog.iterdir()
+        self.assertRegex(path.name, r'^test-\d{8}T\d{6}\.parquet$')
+        parquet = pq.ParquetFile(path)
+        self.assertEqual(parquet.schema_arrow.names, [name for name, _ in catalog.COLUMNS])
+        self.assertEqual(parquet.metadata.num_row_groups, 2)
+        rows = parquet.read().to_pylist()
+        self.assertEqual(
+            [(row['gallery_title'], row['image_title'], row['width'], row['height']) for row in rows],
+            [('TI-99/4A', 'Console', 640, 480), ('TI-99/4A', 'Speech', 320, 240),
+             ('Commodore 64', 'Breadbin', 800, 600), ('Commodore 64', '1541', None, None)],
+        )
+        self.assertEqual(rows[0]['size'], (self.images / rows[0]['path']).stat().st_size)
+        self.assertEqual(rows[1]['duplicate_of'], 'test/TI-99/4A/Console/a.jpg')
+        self.assertEqual(rows[3]['status'], 'uptodate')
+        self.assertIsNone(rows[3]['size'])
+
+    def test_queries(self):
+        self._crawl()
+        [summary] = catalog.summary(self.catalog)
+        self.assertEqual((summary['gallery_url_count_distinct'], summary['path_count']), (2, 4))
+        self.assertEqual([row['gallery_title'] for row in catalog.galleries(self.catalog, spider='test')],
+                         ['Commodore 64', 'TI-99/4A'])
+        self.assertEqual(catalog.galleries(self.catalog, spider='other'), [])
+        images = catalog.gallery_images(self.catalog, GALLERY_URL)
+        self.assertEqual([row['image_title'] for row in images], ['Console', 'Speech'])
+
+    def test_command_line(self):
+        self._crawl()
+        status, lines = self._query('summary')
+        self.assertEqual(status, 0)
+        self.assertRegex(lines[0], r'^test: 2 galleries, 4 images, [\d.]+KB$')
+        status, lines = self._query('gallery', 'TI-99/4A')
+        self.assertEqual(status, 0)
+        self.assertEqual(len(lines), 2)
+        self.assertRegex(lines[0], r'^downloaded\s+640x480\s+\S+\s+test/TI-99/4A/Console/a.jpg$')
+        status, lines = self._query('files')
+        self.assertRegex(lines[0], r'\.parquet: 2 row groups, 4 rows$')
+        with contextlib.redirect_stderr(io.StringIO()) as error:
+            status, _ = self._query('gallery', 'Apple ///')
+        self.assertEqual((status, error.getvalue()), (1, 'No images for Apple ///\n'))
+
+    def test_a_failed_crawl_leaves_no_catalog(self):
+        writer = catalog.CatalogWriter(catalog.catalog_path(self.catalog, 'test'))
+        writer.write(catalog.rows(ImageItem(images=[{'path': 'a.jpg'}]), 'test'))
+        self.assertEqual([path.name for path in self.catalog.iterdir()], [f'.{writer.path.name}.partial'])
+        self.assertEqual(self._query('summary'), (0, []))
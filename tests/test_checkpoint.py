@@ -0,0 +1,127 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from scrapy.http import HtmlResponse, Request
+
+from retrogallery import checkpoint, streaming
+from retrogallery.checkpoint import Checkpoint, CheckpointMiddleware, CheckpointState, get_checkpoint
+from tests import get_crawler
+
+
+GALLERY_URL = 'https://oldcrap.org/2018/02/21/texas-instruments-ti-99-4a/'
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name) / 'test.journal'
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _journal(self):
+        journal = Checkpoint(self.path)
+        journal.request_scheduled(b'a' * 20, {'url': GALLERY_URL})
+        journal.request_scheduled(b'b' * 20, {'url': GALLERY_URL + '2/'})
+        journal.page_done(b'a' * 20)
+        journal.item_completed(b'i' * 20)
+        journal.media_started('/store/half.jpg')
+        journal.media_started('/store/whole.jpg')
+        journal.media_stored('/store/whole.jpg')
+        journal.close()
+
+    def test_journal_is_replayed(self):
+        self._journal()
+        state = CheckpointState.load(self.path)
+        self.assertEqual(list(state.pending), [b'b' * 20])
+        self.assertEqual(state.done, {b'a' * 20})
+        self.assertEqual(state.items, {b'i' * 20})
+        self.assertEqual(state.media, {'/store/half.jpg'})
+        resumed = Checkpoint(self.path, resume=True)
+        self.assertEqual(list(resumed.pending_requests()), [{'url': GALLERY_URL + '2/'}])
+        resumed.close()
+
+    def test_torn_record_is_ignored(self):
+        self._journal()
+        with open(self.path, 'ab') as f:
+            f.write(checkpoint._record(checkpoint.DONE, b'b' * 20)[:-3])
+        self.assertEqual(list(CheckpointState.load(self.path).pending), [b'b' * 20])
+
+    def test_new_journal_discards_the_previous_crawl(self):
+        self._journal()
+        Checkpoint(self.path).close()
+        self.assertFalse(CheckpointState.load(self.path))
+
+
+class RemovePartialFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = Path(self.directory.name)
+        self.spool = self.store / streaming.SPOOL_DIR_NAME
+        (self.store / 'gallery').mkdir()
+        self.spool.mkdir()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _touch(self, *paths):
+        for path in paths:
+            (self.store / path).write_bytes(b'x')
+
+    def test_removes_only_the_crawls_partial_files(self):
+        self._touch(
+            'gallery/half.jpg', 'gallery/.half.jpg.tmp', 'gallery/.half.jpg.link',
+            'gallery/whole.jpg', 'gallery/.other.jpg.tmp',
+            '.partial/stream-test-abc', '.partial/stream-other-abc',
+        )
+        state = CheckpointState()
+        state.media.add(str(self.store / 'gallery/half.jpg'))
+        self.assertEqual(checkpoint.remove_partial_files(state, str(self.spool), 'test'), 4)
+        remaining = sorted(str(path.relative_to(self.store)) for path in self.store.rglob('*') if path.is_file())
+        self.assertEqual(remaining, ['.partial/stream-other-abc', 'gallery/.other.jpg.tmp', 'gallery/whole.jpg'])
+
+
+class CheckpointMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = {
+            'RETROGALLERY_CHECKPOINT_ENABLED': True,
+            'RETROGALLERY_CHECKPOINT_DIR': self.directory.name,
+            'RETROGALLERYLOCALPIPELINE_IMAGES_STORE': self.directory.name,
+        }
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _middleware(self, **settings):
+        crawler = get_crawler(dict(self.settings, **settings))
+        return crawler, CheckpointMiddleware.from_crawler(crawler)
+
+    def test_resume_replaces_the_start_requests(self):
+        crawler, middleware = self._middleware()
+        pending = Request(GALLERY_URL, meta={'gallery_title': 'TI-99/4A'})
+        middleware.request_scheduled(pending, crawler.spider)
+        done = Request(GALLERY_URL + '2/')
+        middleware.request_scheduled(done, crawler.spider)
+        # A page whose callback yielded nothing is done
+        list(middleware.process_spider_output(HtmlResponse(done.url, request=done), iter([]), crawler.spider))
+        middleware.spider_closed(crawler.spider, 'shutdown')
+        self.assertTrue(get_checkpoint(crawler).path.exists())
+
+        crawler, middleware = self._middleware(RETROGALLERY_CHECKPOINT_RESUME=True)
+        start = [Request('https://oldcrap.org')]
+        resumed = list(middleware.process_start_requests(start, crawler.spider))
+        self.assertEqual([request.url for request in resumed], [GALLERY_URL])
+        self.assertEqual(resumed[0].meta['gallery_title'], 'TI-99/4A')
+        middleware.spider_closed(crawler.spider, 'finished')
+
+    def test_finished_crawl_removes_its_journal(self):
+        crawler, middleware = self._middleware()
+        middleware.request_scheduled(Request(GALLERY_URL), crawler.spider)
+        middleware.spider_closed(crawler.spider, 'finished')
+        self.assertFalse(os.path.exists(get_checkpoint(crawler).path))
@@ -0,0 +1,132 @@
+import tempfile
+import unittest
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image
+from scrapy.http import Request, Response
+from scrapy.pipelines.files import FileException
+
+from retrogallery import derivatives
+from retrogallery.derivatives import DerivativePool, DerivativeSpec
+from retrogallery.items import IMAGE_META_KEY, ImageItem
+from retrogallery.pipelines import RetroGalleryLocalPipeline
+from tests import get_crawler, run_until_fired, start_reactor_threads
+
+IMAGE_URL = 'https://i0.wp.com/oldcrap.org/wp-content/uploads/2018/02/ti99.jpeg'
+
+# Spawning the first worker process imports Pillow and Twisted afresh
+TIMEOUT = 60
+
+
+def jpeg(size=(640, 480), mode='RGB'):
+    buf = BytesIO()
+    Image.new(mode, size, (200, 40, 40)).save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+class RenderTest(unittest.TestCase):
+
+    def test_every_spec_is_rendered_within_its_box(self):
+        specs = [DerivativeSpec('small', (64, 64), 'JPEG', 80), DerivativeSpec('medium', (320, 320), 'PNG', None)]
+        size, outputs = derivatives.render(jpeg(), specs)
+        self.assertEqual(size, (640, 480))
+        self.assertEqual([(name, size) for name, _, size in outputs], [('small', (64, 48)), ('medium', (320, 240))])
+        self.assertEqual(Image.open(BytesIO(outputs[1][1])).format, 'PNG')
+
+    def test_transparency_is_flattened_for_jpeg(self):
+        buf = BytesIO()
+        Image.new('RGBA', (100, 100), (0, 0, 0, 0)).save(buf, 'PNG')
+        _, [(_, data, _)] = derivatives.render(buf.getvalue(), [DerivativeSpec('small', (50, 50), 'JPEG', None)])
+        image = Image.open(BytesIO(data))
+        self.assertEqual(image.mode, 'RGB')
+        self.assertEqual(image.getpixel((25, 25)), (255, 255, 255))
+
+    def test_small_images_are_rejected(self):
+        with self.assertRaisesRegex(ValueError, 'too small'):
+            derivatives.render(jpeg((100, 100)), [], min_width=200)
+
+    def test_unwritable_formats_are_skipped(self):
+        with self.assertLogs('retrogallery.derivatives', 'WARNING'):
+            specs = derivatives.parse_specs({'odd': {'size': (10, 10), 'format': 'NOPE'}}, thumbs={'t': [5, 5]})
+        self.assertEqual(specs, [DerivativeSpec('t', (5, 5), 'JPEG', None)])
+
+
+class DerivativePoolTest(unittest.TestCase):
+    """
+    Renders in a worker process.
+    """
+
+    def setUp(self):
+        start_reactor_threads(self)
+        self.pool = DerivativePool(max_workers=1, max_pending=2)
+        self.addCleanup(lambda: run_until_fired(self.pool.close(), TIMEOUT))
+
+    def test_render_in_a_worker_process(self):
+        spec = DerivativeSpec('small', (64, 64), 'WEBP', 80)
+        size, [(name, data, thumb_size)] = run_until_fired(self.pool.submit(jpeg(), [spec]), TIMEOUT)
+        self.assertEqual((size, name, thumb_size), ((640, 480), 'small', (64, 48)))
+        self.assertEqual(Image.open(BytesIO(data)).format, 'WEBP')
+
+    def test_worker_errors_fail_the_deferred(self):
+        with self.assertRaisesRegex(ValueError, 'too small'):
+            run_until_fired(self.pool.submit(jpeg((100, 100)), [], min_width=200), TIMEOUT)
+
+    def test_jobs_handed_to_the_pool_are_bounded(self):
+        spec = DerivativeSpec('small', (64, 64), 'JPEG', None)
+        jobs = [self.pool.submit(jpeg(), [spec]) for _ in range(5)]
+        # Two jobs are in the pool, the rest wait for a slot
+        self.assertEqual(self.pool.pending, 3)
+        self.assertEqual(len(self.pool._executor._pending_work_items), 2)
+        for job in jobs:
+            run_until_fired(job, TIMEOUT)
+            self.assertLessEqual(len(self.pool._executor._pending_work_items), 2)
+        self.assertEqual(self.pool.pending, 0)
+
+    def test_close_waits_for_the_workers(self):
+        run_until_fired(self.pool.submit(jpeg(), []), TIMEOUT)
+        processes = list(self.pool._executor._processes.values())
+        run_until_fired(self.pool.close(), TIMEOUT)
+        self.assertTrue(all(not process.is_alive() for process in processes))
+        self.assertIsNone(self.pool._executor)
+
+
+class PipelineDerivativesTest(unittest.TestCase):
+    """
+    RetroGalleryLocalPipeline rendering thumbnails in the worker pool.
+    """
+
+    def setUp(self):
+        start_reactor_threads(self)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        crawler = get_crawler({
+            'IMAGES_STORE': self.directory.name,
+            'IMAGES_THUMBS': {'small': (64, 64)},
+            'IMAGES_MIN_WIDTH': 200,
+            'RETROGALLERY_DERIVATIVES_WORKERS': 1,
+        })
+        self.pipeline = RetroGalleryLocalPipeline.from_crawler(crawler)
+        self.pipeline.open_spider(crawler.spider)
+        self.addCleanup(lambda: run_until_fired(self.pipeline.close_spider(crawler.spider), TIMEOUT))
+        self.item = ImageItem(gallery_title='TI-99/4A', image_title='Console', image_urls=[IMAGE_URL])
+        self.request = Request(IMAGE_URL, meta={IMAGE_META_KEY: 0})
+
+    def _downloaded(self, body):
+        response = Response(IMAGE_URL, body=body, request=self.request)
+        dfd = self.pipeline.media_downloaded(response, self.request, self.pipeline.spiderinfo, item=self.item)
+        return run_until_fired(dfd, TIMEOUT)
+
+    def test_thumbnail_is_stored(self):
+        result = self._downloaded(jpeg())
+        self.assertEqual(result['status'], 'downloaded')
+        self.assertTrue(Path(self.directory.name, result['path']).is_file())
+        thumb = self.pipeline.derivative_path(self.request, self.pipeline.derivative_specs[0], item=self.item)
+        with Image.open(Path(self.directory.name, thumb)) as image:
+            self.assertEqual(image.size, (64, 48))
+
+    def test_small_image_is_a_file_exception(self):
+        with self.assertLogs('RetroGalleryLocalPipeline', 'WARNING'):
+            with self.assertRaisesRegex(FileException, 'too small'):
+                self._downloaded(jpeg((100, 100)))
+        self.assertEqual(list(Path(self.directory.name).iterdir()), [])
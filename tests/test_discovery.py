@@ -0,0 +1,98 @@
+import json
+import tempfile
+import unittest
+import urllib.error
+import urllib.request
+from collections import deque
+
+from scrapy.http import Request
+from scrapy.responsetypes import responsetypes
+from scrapy.spidermiddlewares.httperror import HttpError
+from twisted.python.failure import Failure
+
+from benchmarks import fixtures
+from benchmarks.server import FixtureServer, replay_url
+from retrogallery.spiders.OldCrapGallerySpider import OldCrapGallerySpider
+from tests import get_crawler
+
+
+class RestDiscoveryTest(unittest.TestCase):
+    """
+    REST discovery against the local stand-in of the sites (see
+    benchmarks.server).
+    """
+
+    # Enough attached images for two pages of the media route
+    IMAGES = 60
+    # A post whose images are inline in its page rather than attached to it
+    INLINE_POST = 101
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        fixtures.generate(cls.directory.name, galleries=3, images=cls.IMAGES, image_size=(32, 24))
+        media_path = fixtures.fixture_path(cls.directory.name, f'{fixtures.OLDCRAP}/wp-json/wp/v2/media')
+        media = json.loads(media_path.read_bytes())
+        media_path.write_text(json.dumps([entry for entry in media if entry['post'] != cls.INLINE_POST]))
+        cls.server = FixtureServer(cls.directory.name).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.directory.cleanup()
+
+    def _fetch(self, request):
+        try:
+            with urllib.request.urlopen(replay_url(self.server.origin, request.url)) as f:
+                status, headers, body = f.status, dict(f.headers), f.read()
+        except urllib.error.HTTPError as e:
+            status, headers, body = e.code, dict(e.headers), e.read()
+        respcls = responsetypes.from_args(headers=headers, url=request.url, body=body)
+        return respcls(url=request.url, status=status, headers=headers, body=body, request=request)
+
+    def _crawl(self, spider):
+        """
+        Runs the spider's requests and callbacks to the end, returning its
+        items and the URLs it requested.
+        """
+        queue, items, requested = deque(spider.start_requests()), [], []
+        while queue:
+            request = queue.popleft()
+            requested.append(request.url)
+            response = self._fetch(request)
+            if response.status >= 400:
+                # As HttpErrorMiddleware and the scraper would
+                failure = Failure(HttpError(response))
+                failure.request = request
+                outputs = request.errback(failure)
+            else:
+                outputs = request.callback(response)
+            for output in outputs or ():
+                (queue if isinstance(output, Request) else items).append(output)
+        return items, requested
+
+    def test_posts_without_attached_images_are_parsed_from_their_pages(self):
+        crawler = get_crawler({'RETROGALLERY_DISCOVERY': 'rest'}, spidercls=OldCrapGallerySpider)
+        items, requested = self._crawl(crawler.spider)
+        galleries = {}
+        for item in items:
+            galleries.setdefault(item['gallery_url'], []).extend(item['image_urls'])
+        self.assertEqual(len(galleries), 3)
+        self.assertTrue(all(len(urls) == self.IMAGES for urls in galleries.values()))
+        # The attached images span two media pages, after which the one
+        # post without any is fetched as a gallery page
+        media_pages = [url for url in requested if '/wp/v2/media' in url]
+        self.assertEqual(len(media_pages), 2)
+        gallery_pages = [url for url in requested if '/wp-json/' not in url]
+        self.assertEqual(gallery_pages, [f'{fixtures.OLDCRAP}/2018/02/02/retro-computer-2/'])
+        self.assertEqual(crawler.stats.get_value('discovery/rest/html_galleries'), 1)
+        self.assertEqual(crawler.stats.get_value('discovery/rest/images'), 2 * self.IMAGES)
+
+    def test_every_post_falls_back_when_the_media_route_fails(self):
+        crawler = get_crawler({'RETROGALLERY_DISCOVERY': 'rest'}, spidercls=OldCrapGallerySpider)
+        media_path = fixtures.fixture_path(self.directory.name, f'{fixtures.OLDCRAP}/wp-json/wp/v2/media')
+        moved = media_path.rename(media_path.with_name('moved'))
+        self.addCleanup(moved.rename, media_path)
+        items, requested = self._crawl(crawler.spider)
+        self.assertEqual(crawler.stats.get_value('discovery/rest/html_galleries'), 3)
+        self.assertEqual(len({item['gallery_url'] for item in items}), 3)
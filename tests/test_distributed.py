@@ -0,0 +1,111 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from scrapy.http import Request
+from twisted.python.failure import Failure
+
+from retrogallery.distributed import SeenImages, SharedDupeFilter, SharedPriorityQueue, SQLiteBackend
+from tests import get_crawler
+
+
+GALLERY_URL = 'https://oldcrap.org/2018/02/21/texas-instruments-ti-99-4a/'
+IMAGE_URL = 'https://i0.wp.com/oldcrap.org/wp-content/uploads/2018/02/ti99.jpeg'
+
+
+class SQLiteBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name) / 'distributed.sqlite3'
+        self.backend = SQLiteBackend(self.path)
+
+    def tearDown(self):
+        self.backend.close()
+        self.directory.cleanup()
+
+    def test_queue_pops_by_priority_then_age(self):
+        self.backend.push('t:q', b'low', priority=-1)
+        self.backend.push('t:q', b'first')
+        self.backend.push('t:q', b'high', priority=5)
+        self.backend.push('t:q', b'second')
+        self.backend.push('t:other', b'elsewhere', priority=10)
+        self.assertEqual(self.backend.size('t:q'), 4)
+        self.assertEqual([self.backend.pop('t:q') for _ in range(5)], [b'high', b'first', b'second', b'low', None])
+        self.assertEqual(self.backend.size('t:other'), 1)
+
+    def test_queue_is_shared_between_connections(self):
+        other = SQLiteBackend(self.path)
+        self.addCleanup(other.close)
+        self.backend.push('t:q', b'page')
+        self.assertEqual(other.pop('t:q'), b'page')
+        self.assertIsNone(self.backend.pop('t:q'))
+
+    def test_sets(self):
+        self.assertTrue(self.backend.add('t:seen', 'a'))
+        self.assertFalse(self.backend.add('t:seen', 'a'))
+        self.assertEqual(self.backend.setdefault('t:images', 'a', 'claim 1'), 'claim 1')
+        self.assertEqual(self.backend.setdefault('t:images', 'a', 'claim 2'), 'claim 1')
+        self.backend.set('t:images', 'a', 'stored')
+        self.assertEqual(self.backend.get('t:images', 'a'), 'stored')
+        self.backend.discard('t:images', 'a')
+        self.assertIsNone(self.backend.get('t:images', 'a'))
+        self.assertEqual(self.backend.count('t:seen'), 1)
+
+    def test_clear_forgets_only_its_crawl(self):
+        self.backend.push('t:q', b'page')
+        self.backend.add('t:seen', 'a')
+        self.backend.add('u:seen', 'a')
+        self.backend.heartbeat('t', 'worker', True)
+        self.assertEqual(self.backend.stats('t'), {'t:q': 1, 't:seen': 1})
+        self.backend.clear('t')
+        self.assertEqual(self.backend.stats('t'), {})
+        self.assertEqual(self.backend.workers('t', 0), [])
+        self.assertEqual(self.backend.stats('u'), {'u:seen': 1})
+
+
+class SharedFrontierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = {
+            'RETROGALLERY_DISTRIBUTED': True,
+            'RETROGALLERY_DISTRIBUTED_URI': str(Path(self.directory.name) / 'distributed.sqlite3'),
+            'RETROGALLERY_DISTRIBUTED_CRAWL': 't',
+        }
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _worker(self):
+        crawler = get_crawler(self.settings)
+        self.addCleanup(lambda: crawler._retrogallery_backend.close())
+        return crawler, SharedPriorityQueue.from_crawler(crawler), SharedDupeFilter.from_crawler(crawler)
+
+    def test_workers_share_the_frontier_and_dupefilter(self):
+        _, queue, dupefilter = self._worker()
+        _, other_queue, other_dupefilter = self._worker()
+        request = Request(GALLERY_URL, meta={'gallery_title': 'TI-99/4A'}, priority=1)
+        self.assertFalse(dupefilter.request_seen(request))
+        self.assertTrue(other_dupefilter.request_seen(Request(GALLERY_URL)))
+        queue.push(request)
+        queue.push(Request(GALLERY_URL + '2/'))
+        self.assertEqual(len(other_queue), 2)
+        popped = other_queue.pop()
+        self.assertEqual((popped.url, popped.meta['gallery_title']), (GALLERY_URL, 'TI-99/4A'))
+        self.assertEqual(queue.pop().url, GALLERY_URL + '2/')
+        self.assertIsNone(queue.pop())
+
+    def test_seen_images(self):
+        crawler, _, _ = self._worker()
+        images = SeenImages.from_crawler(crawler)
+        claimed = []
+        images.claim(IMAGE_URL).addCallback(claimed.append)
+        self.assertEqual(claimed, [None])
+        images.done(Failure(ValueError()), IMAGE_URL)
+        images.claim(IMAGE_URL).addCallback(claimed.append)
+        self.assertEqual(claimed, [None, None])
+        images.done({'path': 'a/b.jpeg', 'checksum': 'md5'}, IMAGE_URL)
+        other = SeenImages(images.backend, images.name, 'other worker')
+        other.claim(IMAGE_URL + '?ssl=1').addCallback(claimed.append)
+        self.assertEqual(claimed[-1], {'url': IMAGE_URL, 'path': 'a/b.jpeg', 'checksum': 'md5'})
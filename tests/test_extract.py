@@ -0,0 +1,144 @@
+import unittest
+
+from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse, Request
+
+from retrogallery import extract
+from retrogallery.extract import Headings
+from retrogallery.spiders.NostalgiaNerdGallerySpider import NostalgiaNerdGallerySpider
+from retrogallery.spiders.OldCrapGallerySpider import OldCrapGallerySpider
+from tests import get_crawler
+
+
+OLDCRAP_URL = 'https://oldcrap.org/2017/12/06/robotron-kc85-3/'
+NOSTALGIANERD_URL = 'https://www.nostalgianerd.com/dragon-32/'
+UPLOADS = 'https://i0.wp.com/oldcrap.org/wp-content/uploads/2017/12'
+
+
+def carousel(*names):
+    imgs = ''.join(
+        f'<img data-orig-file="{UPLOADS}/{name}.jpeg?fit=1600%2C1200&amp;ssl=1" data-orig-size="1600,1200" '
+        f'data-image-description src="{UPLOADS}/{name}-1024x768.jpeg?ssl=1" alt="{alt}" />'
+        for name, alt in names
+    )
+    return f'<div class="tiled-gallery" data-carousel-extra=\'{{"blog_id":1}}\'><noscript>{imgs}</noscript></div>'
+
+
+OLDCRAP_PAGE = f"""<!DOCTYPE html>
+<html><head><title>Robotron KC 85/3 &#8211; Old Crap</title></head>
+<body>
+<article>
+<h1 class="entry-title">Robotron KC 85/3</h1>
+<div class="entry-content">
+{carousel(('front', 'DSC_0001.jpg'))}
+<h1>Computer</h1>
+<p>Some text</p>
+{carousel(('computer', ''))}
+<h2>Keyboard</h2>
+{carousel(('keyboard', ''))}
+<h3>Close-up &amp; <em>detail</em></h3>
+{carousel(('closeup', ''))}
+<h2>Back</h2>
+<p>More text</p>
+{carousel(('back-left', ''), ('back-right', ''))}
+<section>
+<h3>Box</h3>
+{carousel(('box', ''))}
+</section>
+</div>
+</article>
+</body></html>
+"""
+
+NOSTALGIANERD_PAGE = """<!DOCTYPE html>
+<html><body>
+<div class="entry-content">
+<p><a href="/1.jpg"><img src="https://www.nostalgianerd.com/wp-content/uploads/2019/11/dragon32_1.jpg" alt="Dragon 32"
+    width="800" height="600" srcset="https://www.nostalgianerd.com/wp-content/uploads/2019/11/dragon32_1-300x225.jpg 300w,
+    https://www.nostalgianerd.com/wp-content/uploads/2019/11/dragon32_1.jpg 800w" /></a></p>
+<p><a href="/2.jpg"><img src="https://www.nostalgianerd.com/wp-content/uploads/2019/11/dragon32_2.jpg" alt="IMG_1234"
+    width="800" height="600" /></a></p>
+<p>No image here</p>
+<p><a href="/3.jpg"><img src="https://www.nostalgianerd.com/wp-content/uploads/2019/11/dragon32_3.jpg" /></a></p>
+</div>
+</body></html>
+"""
+
+
+def available_engines():
+    engines = []
+    for name in sorted(extract.ENGINES):
+        try:
+            extract.get_engine(name)
+        except NotConfigured:
+            continue
+        engines.append(name)
+    return engines
+
+
+class CarouselsWithHeadingsTest(unittest.TestCase):
+
+    def test_single_pass_heading_walk(self):
+        response = HtmlResponse(OLDCRAP_URL, body=OLDCRAP_PAGE.encode(), encoding='utf-8')
+        expected = [
+            Headings('', '', ''),
+            Headings('', '', 'Computer'),
+            Headings('', 'Computer', 'Keyboard'),
+            Headings('Computer', 'Keyboard', 'Close-up & detail'),
+            Headings('', 'Computer', 'Back'),
+            Headings('', '', 'Box'),
+        ]
+        for name in available_engines():
+            with self.subTest(engine=name):
+                engine = extract.get_engine(name)
+                document = engine.document(response)
+                found = [headings for _, headings in extract.carousels_with_headings(engine, document)]
+                self.assertEqual(found, expected)
+
+    def test_unknown_engine(self):
+        with self.assertRaises(NotConfigured):
+            extract.get_engine('beautifulsoup')
+
+
+class EngineParityTest(unittest.TestCase):
+    """
+    Every extraction engine gives the spiders the same items.
+    """
+
+    def _parse(self, spidercls, engine, url, body):
+        crawler = get_crawler({'RETROGALLERY_EXTRACTION_ENGINE': engine}, spidercls=spidercls)
+        request = Request(url, meta={'gallery_title': 'From the index', 'gallery_url': url})
+        response = HtmlResponse(url, body=body.encode(), encoding='utf-8', request=request)
+        return [
+            (item.gallery_title, item.image_title, item.image_urls, item.image_sizes)
+            for item in crawler.spider.parse_gallery(response)
+        ]
+
+    def _assert_parity(self, spidercls, url, body, expected):
+        engines = available_engines()
+        self.assertIn('parsel', engines)
+        for name in engines:
+            with self.subTest(engine=name):
+                self.assertEqual(self._parse(spidercls, name, url, body), expected)
+
+    def test_oldcrap_gallery(self):
+        def image(name):
+            return [f'{UPLOADS}/{name}.jpeg?fit=1600%2C1200&ssl=1']
+
+        size = [(1600, 1200)]
+        self._assert_parity(OldCrapGallerySpider, OLDCRAP_URL, OLDCRAP_PAGE, [
+            ('Robotron KC 85/3', 'Robotron KC 85/3', image('front'), size),
+            ('Robotron KC 85/3', 'Computer', image('computer'), size),
+            ('Robotron KC 85/3', 'Computer Keyboard', image('keyboard'), size),
+            ('Robotron KC 85/3', 'Computer Keyboard Close-up & detail', image('closeup'), size),
+            ('Robotron KC 85/3', 'Computer Back', image('back-left') + image('back-right'), size * 2),
+            ('Robotron KC 85/3', 'Box', image('box'), size),
+        ])
+
+    def test_nostalgianerd_gallery(self):
+        uploads = 'https://www.nostalgianerd.com/wp-content/uploads/2019/11'
+        self._assert_parity(NostalgiaNerdGallerySpider, NOSTALGIANERD_URL, NOSTALGIANERD_PAGE, [
+            ('From the index', 'Dragon 32', [f'{uploads}/dragon32_1.jpg'], [(800, 600)]),
+            ('From the index', 'From the index', [f'{uploads}/dragon32_2.jpg'], [(800, 600)]),
+            ('From the index', 'From the index', [f'{uploads}/dragon32_3.jpg'], [None]),
+        ])
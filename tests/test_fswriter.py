@@ -0,0 +1,161 @@
+import os
+import tempfile
+import threading
+import unittest
+from io import BytesIO
+from pathlib import Path
+
+from twisted.internet import defer
+
+from retrogallery.fswriter import AsyncFSFilesStore, FSWriter, wait_for
+from tests import run_until_fired
+
+
+class FSWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = Path(self.directory.name)
+        self.writer = FSWriter(threads=1, batch_size=4, max_pending_bytes=100)
+        self.addCleanup(lambda: run_until_fired(self.writer.close()))
+
+    def _hold(self):
+        """
+        Queues a job that keeps the only writer thread busy until the
+        returned event is set.
+        """
+        release = threading.Event()
+        self.writer.call(self.root / 'hold', release.wait, 10)
+        self.addCleanup(release.set)
+        return release
+
+    def test_write_creates_directories_and_leaves_no_temporary_file(self):
+        path = self.root / 'gallery' / 'title' / 'image.jpg'
+        run_until_fired(self.writer.write(path, b'image'))
+        self.assertEqual(path.read_bytes(), b'image')
+        self.assertEqual(os.listdir(path.parent), ['image.jpg'])
+        self.assertIn(str(path.parent), self.writer.directories)
+
+    def test_waiting_writes_to_a_path_are_coalesced(self):
+        release = self._hold()
+        path = self.root / 'image.jpg'
+        first = self.writer.write(path, b'first version')
+        second = self.writer.write(path, b'second')
+        # One job, holding the newer bytes
+        self.assertEqual(self.writer.pending, 1)
+        self.assertEqual(self.writer.pending_bytes, len(b'second'))
+        release.set()
+        run_until_fired(wait_for([first, second]))
+        self.assertEqual(path.read_bytes(), b'second')
+        self.assertEqual(self.writer.pending_bytes, 0)
+
+    def test_jobs_for_a_path_run_in_order(self):
+        path = self.root / 'image.jpg'
+        order = []
+        dfds = [self.writer.write(path, b'a')]
+        dfds.append(self.writer.call(path, lambda: order.append(path.read_bytes())))
+        dfds.append(self.writer.write(path, b'b'))
+        dfds.append(self.writer.call(path, lambda: order.append(path.read_bytes())))
+        run_until_fired(wait_for(dfds))
+        self.assertEqual(order, [b'a', b'b'])
+
+    def test_a_write_already_running_is_not_replaced(self):
+        path = self.root / 'image.jpg'
+        started, release = threading.Event(), threading.Event()
+        self.addCleanup(release.set)
+
+        def _slow():
+            started.set()
+            release.wait(10)
+
+        first = self.writer.call(path, _slow)
+        self.assertTrue(started.wait(10))
+        second = self.writer.write(path, b'newer')
+        self.assertEqual(self.writer.pending, 1)
+        release.set()
+        run_until_fired(wait_for([first, second]))
+        self.assertEqual(path.read_bytes(), b'newer')
+
+    def test_ready_holds_back_until_pending_bytes_drain(self):
+        release = self._hold()
+        self.assertTrue(self.writer.ready().called)
+        write = self.writer.write(self.root / 'big.jpg', b'x' * 150)
+        ready = self.writer.ready()
+        self.assertFalse(ready.called)
+        release.set()
+        run_until_fired(ready)
+        self.assertTrue(write.called)
+        self.assertEqual(self.writer.pending_bytes, 0)
+
+    def test_call_sizes_count_against_pending_bytes(self):
+        release = self._hold()
+        self.writer.call(self.root / 'spool', lambda: None, size=100)
+        ready = self.writer.ready()
+        self.assertFalse(ready.called)
+        release.set()
+        run_until_fired(ready)
+
+    def test_flush_waits_for_every_job_and_close_shuts_the_threads_down(self):
+        self.assertTrue(self.writer.flush().called)
+        release = self._hold()
+        writes = [self.writer.write(self.root / f'{i}.jpg', b'image') for i in range(10)]
+        flushed, closed = self.writer.flush(), self.writer.close()
+        self.assertFalse(flushed.called)
+        self.assertFalse(closed.called)
+        release.set()
+        run_until_fired(closed)
+        self.assertTrue(flushed.called)
+        self.assertTrue(all(dfd.called for dfd in writes))
+        self.assertEqual(len(list(self.root.glob('*.jpg'))), 10)
+        self.assertIsNone(self.writer._executor)
+
+    def test_errors_reach_the_callers_deferred(self):
+        (self.root / 'file').write_bytes(b'')
+        failed = self.writer.write(self.root / 'file' / 'image.jpg', b'image')
+        raised = self.writer.call(self.root / 'other', int, 'not a number')
+        written = self.writer.write(self.root / 'image.jpg', b'image')
+        with self.assertRaises(OSError):
+            run_until_fired(failed)
+        with self.assertRaises(ValueError):
+            run_until_fired(raised)
+        run_until_fired(written)
+        self.assertEqual(run_until_fired(self.writer.call(self.root / 'other', int, '3')), 3)
+
+    def test_wait_for_fails_with_the_first_failure(self):
+        self.assertIsNone(run_until_fired(wait_for([])))
+        dfds = [self.writer.call(self.root / 'a', int, '1'), self.writer.call(self.root / 'b', int, 'b')]
+        with self.assertRaises(ValueError):
+            run_until_fired(wait_for(dfds))
+
+    def test_collect(self):
+        with self.writer.collect() as writes:
+            self.writer.write(self.root / 'a.jpg', b'a')
+            with self.writer.collect() as inner:
+                self.writer.move(self.root / 'a.jpg', self.root / 'b.jpg')
+            self.writer.write(self.root / 'c.jpg', b'c')
+        self.assertEqual(len(writes), 2)
+        self.assertEqual(len(inner), 1)
+        run_until_fired(wait_for(writes + inner))
+        self.assertEqual(sorted(path.name for path in self.root.iterdir()), ['b.jpg', 'c.jpg'])
+
+
+class AsyncFSFilesStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.writer = FSWriter(threads=2)
+        self.addCleanup(lambda: run_until_fired(self.writer.close()))
+        self.store = AsyncFSFilesStore(self.directory.name, self.writer)
+
+    def test_stat_file_is_queued_behind_the_write(self):
+        persisted = self.store.persist_file('gallery/image.jpg', BytesIO(b'image'), info=None)
+        stat = self.store.stat_file('gallery/image.jpg', info=None)
+        self.assertIsInstance(persisted, defer.Deferred)
+        result = run_until_fired(stat)
+        self.assertEqual(result['checksum'], '78805a221a988e79ef3f42d7c5bfd418')
+        self.assertTrue(persisted.called)
+
+    def test_stat_file_of_a_missing_file(self):
+        self.assertEqual(run_until_fired(self.store.stat_file('missing.jpg', info=None)), {})
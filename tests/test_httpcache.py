@@ -0,0 +1,110 @@
+import tempfile
+import unittest
+
+from scrapy.http import Request, Response
+
+from retrogallery.httpcache import RetrogalleryCacheStorage, parse_cache_classes, request_class
+from retrogallery.items import IMAGE_META_KEY
+from tests import get_crawler
+
+
+GALLERY_URL = 'https://oldcrap.org/2018/02/21/texas-instruments-ti-99-4a/'
+IMAGE_URL = 'https://i0.wp.com/oldcrap.org/wp-content/uploads/2018/02/ti99-{}.jpeg'
+BODY = b'\xff' * 100
+
+
+class RetrogalleryCacheStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.crawler = get_crawler({
+            'HTTPCACHE_DIR': self.directory.name,
+            'RETROGALLERY_HTTPCACHE_CLASSES': {
+                'index': {'ttl': 60},
+                'gallery': {'max_bytes': 250, 'compress': False},
+                'image': {'max_bytes': 250},
+            },
+        })
+        self.storage = RetrogalleryCacheStorage(self.crawler.settings)
+        self.storage.open_spider(self.crawler.spider)
+
+    def tearDown(self):
+        self.storage.close_spider(self.crawler.spider)
+        self.directory.cleanup()
+
+    def _store(self, request, body=BODY):
+        self.storage.store_response(self.crawler.spider, request, Response(request.url, body=body))
+
+    def _cached(self, request):
+        return self.storage.retrieve_response(self.crawler.spider, request)
+
+    def _gallery(self, i):
+        return Request(f'{GALLERY_URL}{i}/', meta={'gallery_url': GALLERY_URL})
+
+    def _image(self, i):
+        return Request(IMAGE_URL.format(i), meta={IMAGE_META_KEY: 0})
+
+    def test_round_trip(self):
+        request = Request(GALLERY_URL)
+        self.assertIsNone(self._cached(request))
+        self._store(request, b'<html>index</html>')
+        cached = self._cached(request)
+        self.assertEqual((cached.url, cached.status, cached.body), (GALLERY_URL, 200, b'<html>index</html>'))
+
+    def test_lru_evicts_the_least_recently_used(self):
+        first, second, third = (self._gallery(i) for i in range(3))
+        self._store(first)
+        self._store(second)
+        self.assertIsNotNone(self._cached(first))
+        self._store(third)
+        self.assertIsNone(self._cached(second))
+        self.assertIsNotNone(self._cached(first))
+        self.assertIsNotNone(self._cached(third))
+        self.assertEqual(self.crawler.stats.get_value('httpcache/evicted/gallery'), 1)
+
+    def test_lfu_evicts_the_least_frequently_used(self):
+        first, second, third = (self._image(i) for i in range(3))
+        self._store(first)
+        self._store(second)
+        self._cached(second)
+        self._store(third)
+        # first and third are unused, and first is the older
+        self.assertIsNone(self._cached(first))
+        self.assertIsNotNone(self._cached(second))
+        self.assertIsNotNone(self._cached(third))
+
+    def test_classes_have_separate_budgets(self):
+        gallery = self._gallery(0)
+        self._store(gallery)
+        for i in range(5):
+            self._store(self._image(i))
+        self.assertIsNotNone(self._cached(gallery))
+        self.assertLessEqual(self.storage.index.class_bytes('image'), 250)
+
+    def test_expired_entries_are_evicted(self):
+        request = Request(GALLERY_URL)
+        self._store(request)
+        self.storage.index.conn.execute("UPDATE entries SET stored = stored - 61")
+        self.assertIsNone(self._cached(request))
+        self.assertIsNone(self.storage.index.get(self.crawler.request_fingerprinter.fingerprint(request).hex()))
+
+    def test_not_modified_is_not_stored(self):
+        request = Request(GALLERY_URL)
+        self.storage.store_response(self.crawler.spider, request, Response(GALLERY_URL, status=304))
+        self.assertIsNone(self._cached(request))
+
+
+class CacheClassesTest(unittest.TestCase):
+
+    def test_request_class(self):
+        self.assertEqual(request_class(Request(GALLERY_URL)), 'index')
+        self.assertEqual(request_class(Request(GALLERY_URL, meta={'gallery_url': GALLERY_URL})), 'gallery')
+        self.assertEqual(request_class(Request(IMAGE_URL.format(0), meta={IMAGE_META_KEY: 0})), 'image')
+
+    def test_parse_cache_classes(self):
+        classes = parse_cache_classes({'gallery': {'max_bytes': 10}}, default_ttl=5)
+        self.assertEqual((classes['gallery'].max_bytes, classes['gallery'].ttl), (10, 5))
+        self.assertEqual(classes['image'].ttl, 5)
+        self.assertFalse(classes['image'].compress)
+        with self.assertRaises(ValueError):
+            parse_cache_classes({'index': {'eviction': 'fifo'}})
@@ -0,0 +1,116 @@
+import tempfile
+import unittest
+
+from itemadapter import ItemAdapter
+from scrapy.exceptions import DropItem, IgnoreRequest
+from twisted.python.failure import Failure
+
+from retrogallery.items import IMAGE_META_KEY, GalleryItem, ImageItem
+from retrogallery.pipelines import RetroGalleryLocalPipeline
+from tests import get_crawler
+
+GALLERY_URL = 'https://oldcrap.org/2018/02/21/texas-instruments-ti-99-4a/'
+IMAGE_URL = 'https://i0.wp.com/oldcrap.org/wp-content/uploads/2018/02/ti99.jpeg'
+
+
+class ItemAdapterTest(unittest.TestCase):
+    """
+    The dataclass items through ItemAdapter, as the pipelines and feed
+    exports use them.
+    """
+
+    def test_field_names(self):
+        self.assertEqual(
+            list(ItemAdapter(ImageItem()).field_names()),
+            ['spider', 'gallery_title', 'gallery_url', 'image_title', 'image_urls', 'image_sizes', 'images'],
+        )
+        self.assertEqual(
+            list(ItemAdapter(GalleryItem()).field_names()),
+            ['spider', 'gallery_title', 'gallery_url', 'image_titles', 'image_urls', 'image_sizes', 'images',
+             'manifest'],
+        )
+
+    def test_get_and_set(self):
+        for item in (ImageItem(gallery_title='TI-99/4A'), GalleryItem(gallery_title='TI-99/4A')):
+            with self.subTest(type(item).__name__):
+                adapter = ItemAdapter(item)
+                self.assertEqual(adapter['gallery_title'], 'TI-99/4A')
+                self.assertEqual(adapter.get('gallery_title'), 'TI-99/4A')
+                self.assertIsNone(adapter.get('images'))
+                adapter['images'] = [{'path': 'a.jpg'}]
+                self.assertEqual(item.images, [{'path': 'a.jpg'}])
+                self.assertEqual(item['images'], [{'path': 'a.jpg'}])
+                with self.assertRaises(KeyError):
+                    adapter['image_paths'] = []
+                self.assertFalse(hasattr(item, '__dict__'))
+
+    def test_export(self):
+        item = ImageItem(gallery_title='TI-99/4A', image_urls=[IMAGE_URL])
+        self.assertEqual(ItemAdapter(item).asdict(), {
+            'spider': None, 'gallery_title': 'TI-99/4A', 'gallery_url': None, 'image_title': None,
+            'image_urls': [IMAGE_URL], 'image_sizes': None, 'images': None,
+        })
+
+    def test_dict_access(self):
+        item = ImageItem(gallery_title='TI-99/4A')
+        self.assertIn('gallery_title', item)
+        self.assertNotIn('image_title', item)
+        self.assertNotIn('other', item)
+        self.assertEqual(item.get('image_title', 'Untitled'), 'Untitled')
+        self.assertEqual(item.get('other', 'Untitled'), 'Untitled')
+        with self.assertRaises(KeyError):
+            item['image_title']
+        with self.assertRaises(KeyError):
+            item['other']
+
+    def test_strings_are_interned(self):
+        title = ''.join(['TI-99', '/4A'])
+        first, second = ImageItem(gallery_title=title), ImageItem()
+        second['gallery_title'] = ''.join(['TI-99/', '4A'])
+        self.assertIs(first.gallery_title, second.gallery_title)
+
+
+class PipelineItemTest(unittest.TestCase):
+    """
+    RetroGalleryLocalPipeline with each item type.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        crawler = get_crawler({'IMAGES_STORE': self.directory.name})
+        self.spider = crawler.spider
+        self.pipeline = RetroGalleryLocalPipeline.from_crawler(crawler)
+        self.pipeline.open_spider(self.spider)
+        self.addCleanup(self.pipeline.close_spider, self.spider)
+        self.stored = {'url': IMAGE_URL, 'path': 'test/TI-99/4A/Console/abc.jpeg', 'checksum': 'md5',
+                       'status': 'downloaded'}
+
+    def test_image_item(self):
+        item = ImageItem(spider='test', gallery_title='TI-99/4A', gallery_url=GALLERY_URL, image_title='Console',
+                         image_urls=[IMAGE_URL])
+        requests = self.pipeline.get_media_requests(item, self.pipeline.spiderinfo)
+        self.assertEqual([(r.url, r.meta[IMAGE_META_KEY]) for r in requests], [(IMAGE_URL, 0)])
+        self.assertTrue(self.pipeline.file_path(requests[0], item=item).startswith('test/TI-99/4A/Console/'))
+        results = [(True, self.stored)]
+        self.assertIs(self.pipeline.item_completed(results, item, self.pipeline.spiderinfo), item)
+        self.assertEqual(item.images, [self.stored])
+        self.assertEqual(ItemAdapter(item).get('images'), [self.stored])
+
+    def test_gallery_item(self):
+        item = GalleryItem(spider='test', gallery_title='TI-99/4A', gallery_url=GALLERY_URL,
+                           image_titles=['Console', 'Speech Synthesizer'],
+                           image_urls=[IMAGE_URL, 'https://oldcrap.org/speech.jpg'])
+        requests = self.pipeline.get_media_requests(item, self.pipeline.spiderinfo)
+        self.assertTrue(self.pipeline.file_path(requests[1], item=item).startswith('test/TI-99/4A/Speech Synthesizer/'))
+        results = [(True, self.stored), (False, Failure(IgnoreRequest('404 Not Found')))]
+        self.assertIs(self.pipeline.item_completed(results, item, self.pipeline.spiderinfo), item)
+        self.assertEqual(item.images, [dict(self.stored, image_title='Console')])
+        self.assertIsNone(item.manifest)
+
+    def test_item_without_images_is_dropped(self):
+        item = ImageItem(spider='test', gallery_title='TI-99/4A', image_title='Console', image_urls=[IMAGE_URL])
+        results = [(False, Failure(IgnoreRequest('404 Not Found')))]
+        with self.assertRaises(DropItem):
+            self.pipeline.item_completed(results, item, self.pipeline.spiderinfo)
+        self.assertIsNone(item.images)
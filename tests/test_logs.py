@@ -0,0 +1,177 @@
+import json
+import logging
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from scrapy.settings import Settings
+from scrapy.utils.log import get_scrapy_root_handler, install_scrapy_root_handler
+
+from retrogallery import logs
+from retrogallery.logs import JSONFormatter, QueueLogging, RateLimitFilter
+from tests import TestSpider
+
+
+def make_record(name='retrogallery.test', level=logging.INFO, msg='Stored %s', args=('a.jpg',), **extra):
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+class JSONFormatterTest(unittest.TestCase):
+
+    def test_fields(self):
+        record = make_record(spider=TestSpider(), bytes=123)
+        document = json.loads(JSONFormatter().format(record))
+        self.assertEqual(document['message'], 'Stored a.jpg')
+        self.assertEqual((document['level'], document['logger']), ('INFO', 'retrogallery.test'))
+        self.assertEqual((document['spider'], document['bytes']), ('test', 123))
+        self.assertTrue(document['time'].endswith('+00:00'))
+        self.assertNotIn('args', document)
+
+    def test_exception(self):
+        try:
+            raise ValueError('bad image')
+        except ValueError:
+            record = logging.LogRecord('x', logging.ERROR, __file__, 1, 'Failed', (), __import__('sys').exc_info())
+        document = json.loads(JSONFormatter().format(record))
+        self.assertIn('ValueError: bad image', document['exception'])
+
+
+class RateLimitFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('retrogallery.logs.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.filter = RateLimitFilter({'scrapy.core': 2}, report_interval=60)
+
+    def _passed(self, name, count, level=logging.DEBUG):
+        return sum(self.filter.filter(make_record(name, level)) for _ in range(count))
+
+    def test_limits_loggers_and_their_children(self):
+        self.assertEqual(self._passed('scrapy.core.scraper', 5), 2)
+        self.assertEqual(self._passed('scrapy.core', 5), 0)
+        self.assertEqual(self._passed('scrapy.core.scraper', 5, logging.ERROR), 5)
+        self.assertEqual(self._passed('scrapy.coreish', 5), 5)
+        self.now += 1
+        self.assertEqual(self._passed('scrapy.core.engine', 5), 2)
+
+    def test_reports_dropped_records(self):
+        self._passed('scrapy.core.scraper', 5)
+        self.now += 61
+        with self.assertLogs('retrogallery.logs', 'WARNING') as logged:
+            self._passed('other', 1)
+        self.assertEqual(logged.output, ['WARNING:retrogallery.logs:Dropped 3 log records from scrapy.core (limit 2/s)'])
+
+
+class QueueLoggingTest(unittest.TestCase):
+    """
+    QueueLogging behind a Scrapy root handler writing to a file.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.log_file = Path(self.directory.name) / 'crawl.log'
+        self.settings = Settings({
+            'LOG_FILE': str(self.log_file),
+            'LOG_FORMAT': '%(levelname)s %(name)s %(message)s',
+            'RETROGALLERY_LOG_QUEUE': True,
+            'RETROGALLERY_LOG_RATE_LIMITS': {'retrogallery.noisy': 1},
+        })
+        root = logging.getLogger()
+        level = root.level
+        install_scrapy_root_handler(self.settings)
+        target = get_scrapy_root_handler()
+
+        def _uninstall():
+            QueueLogging.shutdown()
+            root.removeHandler(target)
+            target.close()
+            root.setLevel(level)
+
+        self.addCleanup(_uninstall)
+        self.logger = logging.getLogger('retrogallery.test')
+
+    def _lines(self):
+        return self.log_file.read_text().splitlines()
+
+    def test_records_go_through_the_queue_and_are_flushed_at_shutdown(self):
+        QueueLogging(self.settings).install()
+        root = logging.getLogger()
+        self.assertIn(QueueLogging.handler, root.handlers)
+        self.assertNotIn(get_scrapy_root_handler(), root.handlers)
+        self.assertTrue(QueueLogging.listener._thread.is_alive())
+        for i in range(1000):
+            self.logger.info("Stored %d", i)
+        listener = QueueLogging.listener
+        QueueLogging.shutdown()
+        self.assertIsNone(listener._thread)
+        lines = self._lines()
+        self.assertEqual(len(lines), 1000)
+        self.assertEqual(lines[-1], 'INFO retrogallery.test Stored 999')
+        # Scrapy's handler is back for whatever is logged after shutdown
+        self.assertIn(get_scrapy_root_handler(), root.handlers)
+        self.logger.info("After shutdown")
+        get_scrapy_root_handler().flush()
+        self.assertEqual(self._lines()[-1], 'INFO retrogallery.test After shutdown')
+
+    def test_a_second_crawler_shares_the_listener(self):
+        QueueLogging(self.settings).install()
+        handler, listener = QueueLogging.handler, QueueLogging.listener
+        install_scrapy_root_handler(self.settings)
+        QueueLogging(self.settings).install()
+        self.assertIs(QueueLogging.handler, handler)
+        self.assertIs(QueueLogging.listener, listener)
+        self.assertEqual(logging.getLogger().handlers.count(handler), 1)
+
+    def test_message_is_merged_when_logged(self):
+        QueueLogging(self.settings).install()
+        images = ['a.jpg']
+        self.logger.info("Stored %s", images)
+        images.append('b.jpg')
+        QueueLogging.shutdown()
+        self.assertEqual(self._lines(), ["INFO retrogallery.test Stored ['a.jpg']"])
+
+    def test_prepare_keeps_the_exception(self):
+        QueueLogging(self.settings).install()
+        try:
+            raise ValueError('bad image')
+        except ValueError:
+            self.logger.exception("Failed %s", 'a.jpg')
+        record = make_record(msg='Stored %s', args=('a.jpg',))
+        prepared = QueueLogging.handler.prepare(record)
+        self.assertEqual((prepared.msg, prepared.args), ('Stored a.jpg', None))
+        self.assertEqual(record.args, ('a.jpg',))
+        QueueLogging.shutdown()
+        lines = self._lines()
+        self.assertEqual(lines[0], 'ERROR retrogallery.test Failed a.jpg')
+        self.assertEqual(lines[-1], 'ValueError: bad image')
+
+    def test_rate_limits(self):
+        QueueLogging(self.settings).install()
+        noisy = logging.getLogger('retrogallery.noisy')
+        for _ in range(10):
+            noisy.info("Noise")
+        noisy.error("Error")
+        QueueLogging.shutdown()
+        self.assertEqual(self._lines(), ['INFO retrogallery.noisy Noise', 'ERROR retrogallery.noisy Error'])
+
+    def test_json(self):
+        self.settings.set('RETROGALLERY_LOG_JSON', True)
+        QueueLogging(self.settings).install()
+        self.logger.info("Stored %s", 'a.jpg', extra={'bytes': 123})
+        QueueLogging.shutdown()
+        document = json.loads(self._lines()[0])
+        self.assertEqual((document['message'], document['bytes']), ('Stored a.jpg', 123))
+
+    def test_colour_only_on_a_terminal(self):
+        extension = QueueLogging(self.settings)
+        target = get_scrapy_root_handler()
+        self.assertIs(type(extension.formatter(target)), logging.Formatter)
+        self.settings.set('RETROGALLERY_LOG_COLOUR', True)
+        if logs.ColoredFormatter is not None:
+            self.assertIsInstance(extension.formatter(target), logs.ColoredFormatter)
@@ -0,0 +1,186 @@
+import json
+import math
+import socket
+import tempfile
+import unittest
+import urllib.request
+from pathlib import Path
+from types import SimpleNamespace
+
+from scrapy.exceptions import NotConfigured
+from twisted.internet import threads
+
+from retrogallery.metrics import BUCKETS, NULL_METRICS, Histogram, Metrics, MetricsExporter, get_metrics
+from tests import get_crawler, run_until_fired, start_reactor_threads
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_quantiles_are_bucket_bounds(self):
+        histogram = Histogram()
+        self.assertIsNone(histogram.quantile(0.5))
+        for value in (0.002,) * 9 + (3,):
+            histogram.observe(value)
+        self.assertEqual(histogram.quantile(0.5), 0.0025)
+        self.assertEqual(histogram.quantile(0.99), 3)
+        self.assertEqual(histogram.to_dict()['count'], 10)
+        self.assertAlmostEqual(histogram.to_dict()['mean'], 0.3018)
+
+    def test_values_past_the_last_bound(self):
+        histogram = Histogram()
+        histogram.observe(1000)
+        self.assertEqual(histogram.buckets[-1], 1)
+        self.assertEqual(BUCKETS[-1], math.inf)
+        self.assertEqual(histogram.quantile(0.5), 1000)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.inc('retrogallery_responses_total', domain='oldcrap.org', status=200)
+        self.metrics.inc('retrogallery_responses_total', 2, status=200, domain='oldcrap.org')
+        self.metrics.set('retrogallery_queue_depth', 7, queue='scheduler')
+        self.metrics.observe('retrogallery_download_seconds', 0.2, domain='oldcrap.org')
+
+    def test_labels_in_any_order_are_one_series(self):
+        self.assertEqual(self.metrics.counters, {
+            ('retrogallery_responses_total', (('domain', 'oldcrap.org'), ('status', '200'))): 3,
+        })
+
+    def test_prometheus(self):
+        lines = self.metrics.render_prometheus().splitlines()
+        self.assertEqual(lines[:4], [
+            '# TYPE retrogallery_responses_total counter',
+            'retrogallery_responses_total{domain="oldcrap.org",status="200"} 3',
+            '# TYPE retrogallery_queue_depth gauge',
+            'retrogallery_queue_depth{queue="scheduler"} 7',
+        ])
+        self.assertEqual(lines[4], '# TYPE retrogallery_download_seconds histogram')
+        self.assertIn('retrogallery_download_seconds_bucket{domain="oldcrap.org",le="0.1"} 0', lines)
+        self.assertIn('retrogallery_download_seconds_bucket{domain="oldcrap.org",le="0.25"} 1', lines)
+        self.assertEqual(lines[-3], 'retrogallery_download_seconds_bucket{domain="oldcrap.org",le="+Inf"} 1')
+        self.assertEqual(lines[-1], 'retrogallery_download_seconds_count{domain="oldcrap.org"} 1')
+
+    def test_label_values_are_escaped(self):
+        metrics = Metrics()
+        metrics.inc('retrogallery_callback_items_total', callback='say "hi"\n')
+        self.assertIn('{callback="say \\"hi\\"\\n"} 1', metrics.render_prometheus())
+
+    def test_snapshot(self):
+        snapshot = json.loads(json.dumps(self.metrics.snapshot()))
+        self.assertEqual(snapshot['retrogallery_queue_depth'], [{'labels': {'queue': 'scheduler'}, 'value': 7}])
+        self.assertEqual(snapshot['retrogallery_download_seconds'][0]['value']['count'], 1)
+
+    def test_time(self):
+        with self.metrics.time('retrogallery_pipeline_stage_seconds', stage='file_path'):
+            pass
+        with self.assertRaises(ValueError):
+            with self.metrics.time('retrogallery_pipeline_stage_seconds', stage='file_path'):
+                raise ValueError
+        [(_, histogram)] = [(k, v) for k, v in self.metrics.histograms.items() if k[0].endswith('stage_seconds')]
+        self.assertEqual(histogram.count, 2)
+
+
+class GetMetricsTest(unittest.TestCase):
+
+    def test_disabled(self):
+        self.assertIs(get_metrics(get_crawler()), NULL_METRICS)
+        self.assertIs(get_metrics(None), NULL_METRICS)
+        NULL_METRICS.inc('retrogallery_responses_total')
+        with NULL_METRICS.time('retrogallery_download_seconds'):
+            pass
+        self.assertEqual(NULL_METRICS.render_prometheus(), '\n')
+
+    def test_one_registry_per_crawler(self):
+        crawler = get_crawler({'RETROGALLERY_METRICS_ENABLED': True})
+        metrics = get_metrics(crawler)
+        self.assertIsInstance(metrics, Metrics)
+        self.assertIsNot(metrics, NULL_METRICS)
+        self.assertIs(get_metrics(crawler), metrics)
+        self.assertIsNot(get_metrics(get_crawler({'RETROGALLERY_METRICS_ENABLED': True})), metrics)
+
+    def test_disabled_by_default_in_the_project(self):
+        from retrogallery import settings
+
+        self.assertFalse(settings.RETROGALLERY_METRICS_ENABLED)
+
+
+class MetricsExporterTest(unittest.TestCase):
+
+    def setUp(self):
+        start_reactor_threads(self)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.dump_path = Path(self.directory.name, 'metrics', 'metrics.json')
+        self.port = free_port()
+        self.crawler = get_crawler({
+            'RETROGALLERY_METRICS_ENABLED': True,
+            'RETROGALLERY_METRICS_PORT': self.port,
+            'RETROGALLERY_METRICS_DUMP': str(self.dump_path),
+        })
+        self.crawler.stats.set_value('item_scraped_count', 4)
+        self.exporter = MetricsExporter.from_crawler(self.crawler)
+        self.metrics = get_metrics(self.crawler)
+        self.metrics.inc('retrogallery_responses_total', domain='oldcrap.org', status=200)
+
+    def _get(self, path):
+        url = f'http://127.0.0.1:{self.port}{path}'
+
+        def _fetch():
+            with urllib.request.urlopen(url, timeout=5) as response:
+                return response.headers['Content-Type'], response.read().decode()
+
+        return run_until_fired(threads.deferToThread(_fetch))
+
+    def test_disabled(self):
+        with self.assertRaises(NotConfigured):
+            MetricsExporter.from_crawler(get_crawler())
+
+    def test_http_endpoint(self):
+        self.exporter.spider_opened(self.crawler.spider)
+        self.addCleanup(self.exporter.spider_closed, self.crawler.spider, 'finished')
+        content_type, body = self._get('/metrics')
+        self.assertTrue(content_type.startswith('text/plain; version=0.0.4'))
+        self.assertIn('retrogallery_responses_total{domain="oldcrap.org",status="200"} 1', body.splitlines())
+        content_type, body = self._get('/stats.json')
+        self.assertEqual(content_type, 'application/json')
+        self.assertEqual(json.loads(body)['stats']['item_scraped_count'], 4)
+
+    def test_dump(self):
+        self.exporter.spider_opened(self.crawler.spider)
+        # The first dump is written when the spider opens
+        self.assertEqual(json.loads(self.dump_path.read_text())['stats']['item_scraped_count'], 4)
+        self.metrics.inc('retrogallery_responses_total', domain='oldcrap.org', status=200)
+        self.exporter.spider_closed(self.crawler.spider, 'finished')
+        self.assertIsNone(self.exporter.listener)
+        self.assertFalse(self.exporter.task.running)
+        dumped = json.loads(self.dump_path.read_text())
+        self.assertEqual(dumped['metrics']['retrogallery_responses_total'][0]['value'], 2)
+        self.assertEqual(list(self.dump_path.parent.iterdir()), [self.dump_path])
+
+    def test_queue_depths(self):
+        self.exporter.sample_queues()
+        self.assertEqual(self.metrics.gauges, {})
+        self.crawler.engine = SimpleNamespace(
+            slot=SimpleNamespace(scheduler=[1, 2, 3]),
+            downloader=SimpleNamespace(active={1}, slots={'a': SimpleNamespace(queue=[1, 2]),
+                                                          'b': SimpleNamespace(queue=[3])}),
+            scraper=SimpleNamespace(slot=SimpleNamespace(queue=[], active={1, 2}, itemproc_size=5)),
+        )
+        self.exporter.sample_queues()
+        depths = {dict(labels)['queue']: value for (_, labels), value in self.metrics.gauges.items()}
+        self.assertEqual(depths, {
+            'scheduler': 3,
+            'downloader_active': 1,
+            'downloader_queued': 3,
+            'scraper_queued': 0,
+            'scraper_active': 2,
+            'pipeline_items': 5,
+        })
@@ -0,0 +1,241 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import HtmlResponse, Request, Response
+from twisted.python.failure import Failure
+
+from retrogallery import streaming
+from retrogallery.checkpoint import FINGERPRINT_META_KEY, get_checkpoint
+from retrogallery.items import IMAGE_META_KEY, GalleryItem, ImageItem
+from retrogallery.middlewares import GalleryBatchMiddleware, IncrementalCrawlMiddleware, IncrementalPageMiddleware
+from retrogallery.pipelines import MANIFEST_NAME, RetroGalleryLocalPipeline
+from retrogallery.state import CrawlState
+from tests import get_crawler, run_until_fired
+
+
+GALLERY_URL = 'https://oldcrap.org/2018/02/21/texas-instruments-ti-99-4a/'
+IMAGE_URL = 'https://i0.wp.com/oldcrap.org/wp-content/uploads/2018/02/ti99.jpeg'
+
+
+class IncrementalCrawlMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = {
+            'RETROGALLERY_INCREMENTAL': True,
+            'RETROGALLERY_STATE_DB': str(Path(self.directory.name) / 'state.sqlite3'),
+        }
+        self.crawler = get_crawler(self.settings)
+        self.spider = self.crawler.spider
+        self.middleware = IncrementalCrawlMiddleware.from_crawler(self.crawler)
+        self.pages = IncrementalPageMiddleware.from_crawler(self.crawler)
+        self.state = self.middleware.state
+
+    def tearDown(self):
+        self.middleware.spider_closed(self.spider)
+        self.directory.cleanup()
+
+    def _page_request(self):
+        return Request(GALLERY_URL, meta={'gallery_title': 'TI-99/4A', 'gallery_url': GALLERY_URL})
+
+    def _page(self, request, body=b'<html>gallery</html>', status=200, headers=None):
+        return HtmlResponse(request.url, status=status, body=body, headers=headers, request=request)
+
+    def _item(self):
+        return ImageItem(gallery_title='TI-99/4A', gallery_url=GALLERY_URL, image_title='Console', image_urls=[IMAGE_URL])
+
+    def _parse(self, response, items, stored=True):
+        """
+        Runs items through IncrementalPageMiddleware as the output of the
+        page's callback, and scrapes each, with its image stored or not.
+        """
+        for item in self.pages.process_spider_output(response, iter(items), self.spider):
+            if stored:
+                item['images'] = [{'url': url, 'path': 'x', 'checksum': 'y', 'status': 'downloaded'}
+                                  for url in item['image_urls']]
+            self.pages.item_scraped(item, response, self.spider)
+
+    def _crawl(self, body=b'<html>gallery</html>', headers=None, stored=True):
+        request = self._page_request()
+        self.middleware.process_request(request, self.spider)
+        response = self.middleware.process_response(request, self._page(request, body, headers=headers), self.spider)
+        self._parse(response, [self._item()], stored)
+        return request
+
+    def test_records_page_once_its_images_are_stored(self):
+        request = self._page_request()
+        response = self._page(request, headers={'ETag': '"abc"', 'Last-Modified': 'Wed, 21 Feb 2018 00:00:00 GMT'})
+        self.assertIs(self.middleware.process_response(request, response, self.spider), response)
+        self.assertIsNone(self.state.get('pages', GALLERY_URL))
+        item = self._item()
+        output = self.pages.process_spider_output(response, iter([item]), self.spider)
+        self.assertEqual(list(output), [item])
+        self.assertIsNone(self.state.get('pages', GALLERY_URL))
+        item['images'] = [{'url': IMAGE_URL}]
+        self.pages.item_scraped(item, response, self.spider)
+        page = self.state.get('pages', GALLERY_URL)
+        self.assertEqual(page['etag'], '"abc"')
+        self.assertEqual(page['content_hash'], CrawlState.content_hash(response.body))
+
+    def test_page_with_failed_images_is_parsed_again(self):
+        self._crawl(stored=False)
+        self.assertIsNone(self.state.get('pages', GALLERY_URL))
+        request = self._page_request()
+        response = self._page(request)
+        self.assertIs(self.middleware.process_response(request, response, self.spider), response)
+
+    def test_page_with_dropped_item_is_not_recorded(self):
+        request = self._page_request()
+        response = self.middleware.process_response(request, self._page(request), self.spider)
+        item = self._item()
+        list(self.pages.process_spider_output(response, iter([item]), self.spider))
+        self.pages.item_failed(item, response, self.spider)
+        self.assertIsNone(self.state.get('pages', GALLERY_URL))
+
+    def test_page_without_items_is_recorded(self):
+        request = self._page_request()
+        response = self.middleware.process_response(request, self._page(request), self.spider)
+        self._parse(response, [])
+        self.assertIsNotNone(self.state.get('pages', GALLERY_URL))
+
+    def test_revalidates_known_page(self):
+        self._crawl(headers={'ETag': '"abc"'})
+        request = self._page_request()
+        self.middleware.process_request(request, self.spider)
+        self.assertEqual(request.headers.get('If-None-Match'), b'"abc"')
+
+    def test_not_modified_page_is_dropped(self):
+        self._crawl()
+        request = self._page_request()
+        with self.assertRaises(IgnoreRequest):
+            self.middleware.process_response(request, self._page(request, body=b'', status=304), self.spider)
+        self.assertEqual(self.crawler.stats.get_value('incremental/pages_not_modified'), 1)
+
+    def test_unchanged_page_is_dropped(self):
+        self._crawl()
+        request = self._page_request()
+        with self.assertRaises(IgnoreRequest):
+            self.middleware.process_response(request, self._page(request), self.spider)
+        request = self._page_request()
+        response = self._page(request, body=b'<html>new images</html>')
+        self.assertIs(self.middleware.process_response(request, response, self.spider), response)
+
+    def test_dropped_page_is_done_in_the_checkpoint(self):
+        self._crawl()
+        self.state.commit()
+        self.settings.update({
+            'RETROGALLERY_CHECKPOINT_ENABLED': True,
+            'RETROGALLERY_CHECKPOINT_DIR': self.directory.name,
+        })
+        crawler = get_crawler(self.settings)
+        middleware = IncrementalCrawlMiddleware.from_crawler(crawler)
+        checkpoint = get_checkpoint(crawler)
+        request = self._page_request()
+        fp = crawler.request_fingerprinter.fingerprint(request)
+        request.meta[FINGERPRINT_META_KEY] = fp
+        checkpoint.request_scheduled(fp, request.to_dict())
+        with self.assertRaises(IgnoreRequest):
+            middleware.process_response(request, self._page(request), crawler.spider)
+        self.assertEqual(checkpoint.state.pending, {})
+        self.assertEqual(checkpoint.state.done, {fp})
+        checkpoint.close()
+        middleware.spider_closed(crawler.spider)
+
+    def test_streamed_image_is_hashed_from_its_spool_file(self):
+        hashes = set()
+        for i, body in enumerate([b'first image', b'second image']):
+            url = f'{IMAGE_URL}?{i}'
+            request = Request(url, meta={IMAGE_META_KEY: 0})
+            sha1 = CrawlState.content_hash(body)
+            request.meta[streaming.STREAMED_FILE_META_KEY] = streaming.StreamedFile('/dev/null', len(body), sha1, None)
+            response = Response(url, body=b'', flags=[streaming.STREAMED_FLAG], request=request)
+            self.middleware.process_response(request, response, self.spider)
+            hashes.add(self.state.get('images', url)['content_hash'])
+        self.assertEqual(hashes, {CrawlState.content_hash(b'first image'), CrawlState.content_hash(b'second image')})
+
+    def test_other_requests_pass_through(self):
+        request = Request('https://oldcrap.org/')
+        response = HtmlResponse(request.url, body=b'<html></html>', request=request)
+        self.assertIs(self.middleware.process_response(request, response, self.spider), response)
+        self.assertIsNone(self.state.get('pages', request.url))
+
+
+class GalleryBatchMiddlewareTest(unittest.TestCase):
+
+    OTHER_GALLERY_URL = 'https://oldcrap.org/2018/02/22/commodore-64/'
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.crawler = get_crawler({
+            'RETROGALLERY_GALLERY_ITEMS': True,
+            'RETROGALLERYLOCALPIPELINE_GALLERY_MANIFESTS': True,
+            'IMAGES_STORE': self.directory.name,
+        })
+        self.spider = self.crawler.spider
+        self.middleware = GalleryBatchMiddleware.from_crawler(self.crawler)
+
+    def _batch(self, result):
+        response = HtmlResponse(GALLERY_URL, body=b'<html>gallery</html>')
+        return list(self.middleware.process_spider_output(response, iter(result), self.spider))
+
+    def test_disabled_by_default(self):
+        with self.assertRaises(NotConfigured):
+            GalleryBatchMiddleware.from_crawler(get_crawler())
+
+    def test_images_of_a_gallery_are_one_item(self):
+        next_page = Request('https://oldcrap.org/page/2/')
+        output = self._batch([
+            ImageItem(gallery_title='TI-99/4A', gallery_url=GALLERY_URL, image_title='Console',
+                      image_urls=[IMAGE_URL, f'{IMAGE_URL}?2'], image_sizes=[(640, 480), (320, 240)]),
+            next_page,
+            ImageItem(gallery_title='Commodore 64', gallery_url=self.OTHER_GALLERY_URL, image_title='Breadbin',
+                      image_urls=['https://oldcrap.org/c64.jpg']),
+            ImageItem(gallery_title='TI-99/4A', gallery_url=GALLERY_URL, image_title='Speech Synthesizer',
+                      image_urls=['https://oldcrap.org/speech.jpg']),
+        ])
+        # Requests are passed on at once, the galleries after the callback
+        self.assertIs(output[0], next_page)
+        self.assertEqual(len(output), 3)
+        ti99, c64 = output[1:]
+        self.assertIsInstance(ti99, GalleryItem)
+        self.assertEqual((ti99.gallery_title, ti99.gallery_url), ('TI-99/4A', GALLERY_URL))
+        self.assertEqual(ti99.image_urls, [IMAGE_URL, f'{IMAGE_URL}?2', 'https://oldcrap.org/speech.jpg'])
+        self.assertEqual(ti99.image_titles, ['Console', 'Console', 'Speech Synthesizer'])
+        self.assertEqual(ti99.image_sizes, [(640, 480), (320, 240), None])
+        self.assertEqual(c64.image_urls, ['https://oldcrap.org/c64.jpg'])
+        self.assertEqual(c64.image_titles, ['Breadbin'])
+
+    def test_manifest_lists_every_image_of_the_gallery(self):
+        item = self._batch([
+            ImageItem(gallery_title='TI-99/4A', gallery_url=GALLERY_URL, image_title='Console',
+                      image_urls=[IMAGE_URL]),
+            ImageItem(gallery_title='TI-99/4A', gallery_url=GALLERY_URL, image_title='Speech Synthesizer',
+                      image_urls=['https://oldcrap.org/speech.jpg']),
+        ])[0]
+        item.spider = self.spider.name
+        pipeline = RetroGalleryLocalPipeline.from_crawler(self.crawler)
+        pipeline.open_spider(self.spider)
+        stored = {'url': IMAGE_URL, 'path': 'test/TI-99/4A/Console/abc.jpeg', 'checksum': 'md5',
+                  'status': 'downloaded'}
+        results = [(True, stored), (False, Failure(IgnoreRequest('404 Not Found')))]
+        item = run_until_fired(pipeline.item_completed(results, item, pipeline.spiderinfo))
+        path = f'test/TI-99/4A/{MANIFEST_NAME}'
+        self.assertEqual(item.manifest, path)
+        self.assertEqual(item.images, [dict(stored, image_title='Console')])
+        # The download result is shared, so it is not changed
+        self.assertNotIn('image_title', stored)
+        manifest = json.loads(Path(self.directory.name, path).read_text())
+        self.assertEqual(manifest, {
+            'spider': 'test',
+            'gallery_title': 'TI-99/4A',
+            'gallery_url': GALLERY_URL,
+            'images': [
+                dict(stored, image_title='Console'),
+                {'url': 'https://oldcrap.org/speech.jpg', 'image_title': 'Speech Synthesizer',
+                 'error': '404 Not Found'},
+            ],
+        })
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from io import BytesIO
+from pathlib import Path
+
+from retrogallery import packstore
+from retrogallery.fswriter import FSWriter
+from retrogallery.packstore import PackFilesStore, PackStore, pack_name, pack_numbers
+from tests import run_until_fired
+
+
+def md5_of(data):
+    # deepcode ignore InsecureHash: <not used in a security context>
+    return hashlib.md5(data).hexdigest()
+
+
+class PackStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.basedir = self.directory.name
+        self.packs = Path(self.basedir) / packstore.PACKS_DIR
+        self.store = PackStore(self.basedir, pack_size=1024)
+
+    def tearDown(self):
+        self.store.close()
+
+    def _reopen(self):
+        self.store.close()
+        self.store = PackStore(self.basedir, pack_size=1024)
+
+    def _read(self, path):
+        view = self.store.reader.read(path)
+        if view is None:
+            return None
+        try:
+            return bytes(view)
+        finally:
+            view.release()
+
+    def test_round_trip(self):
+        self.store.put('spider/gallery/a.jpg', b'a' * 100, 'image/jpeg')
+        self.store.put('spider/gallery/b.png', b'b' * 50, 'image/png')
+        self.assertEqual(self._read('spider/gallery/a.jpg'), b'a' * 100)
+        self.assertEqual(self._read('spider/gallery/b.png'), b'b' * 50)
+        self.assertIsNone(self._read('spider/gallery/c.jpg'))
+        pack, _, length, md5, content_type, _ = self.store.index.get('spider/gallery/a.jpg')
+        self.assertEqual((pack, length, md5, content_type), (1, 100, md5_of(b'a' * 100), 'image/jpeg'))
+
+    def test_put_file_moves_the_file_in(self):
+        src = Path(self.basedir) / 'spool'
+        src.write_bytes(b'streamed' * 10)
+        self.store.put_file('a.jpg', src, 80, md5_of(b'streamed' * 10), 'image/jpeg')
+        self.assertFalse(src.exists())
+        self.assertEqual(self._read('a.jpg'), b'streamed' * 10)
+
+    def test_storing_a_path_again_replaces_it(self):
+        self.store.put('a.jpg', b'old', 'image/jpeg')
+        self.store.put('a.jpg', b'new', 'image/jpeg')
+        self.assertEqual(self._read('a.jpg'), b'new')
+        self.assertEqual(self.store.index.entries().fetchall()[0][4], md5_of(b'new'))
+
+    def test_packs_roll_over_at_the_size_limit(self):
+        for i in range(5):
+            self.store.put(f'{i}.jpg', bytes([i]) * 400, 'image/jpeg')
+        # Two records of about 430 bytes fit in a pack of 1024
+        self.assertEqual(pack_numbers(self.packs), [1, 2, 3])
+        self.assertEqual([row[1] for row in self.store.index.entries()], [1, 1, 2, 2, 3])
+        for number in (1, 2):
+            self.assertLessEqual((self.packs / pack_name(number)).stat().st_size, 1024)
+        for i in range(5):
+            self.assertEqual(self._read(f'{i}.jpg'), bytes([i]) * 400)
+
+    def test_a_record_larger_than_a_pack_gets_a_pack_of_its_own(self):
+        self.store.put('small.jpg', b's' * 10, 'image/jpeg')
+        self.store.put('large.jpg', b'l' * 2000, 'image/jpeg')
+        self.store.put('next.jpg', b'n' * 10, 'image/jpeg')
+        self.assertEqual([row[1] for row in self.store.index.entries()], [1, 2, 3])
+
+    def test_reopening_appends_to_the_newest_pack(self):
+        self.store.put('a.jpg', b'a' * 600, 'image/jpeg')
+        self.store.put('b.jpg', b'b' * 600, 'image/jpeg')
+        self._reopen()
+        self.assertEqual(self._read('a.jpg'), b'a' * 600)
+        self.store.put('c.jpg', b'c' * 10, 'image/jpeg')
+        self.assertEqual(self.store.index.get('c.jpg')[0], 2)
+        self.assertEqual(self._read('b.jpg'), b'b' * 600)
+
+    def test_records_after_the_last_index_commit_are_recovered(self):
+        self.store.put('a.jpg', b'a' * 100, 'image/jpeg')
+        self.store.index.commit()
+        self.store.put('b.jpg', b'b' * 100, 'image/jpeg')
+        # A crash: the last entry is never committed
+        os.close(self.store._fd)
+        self.store._fd = None
+        self.store.index.conn.close()
+        self.store.reader.close()
+        with self.assertLogs('retrogallery.packstore', 'INFO'):
+            self.store = PackStore(self.basedir, pack_size=1024)
+        self.assertEqual(self._read('b.jpg'), b'b' * 100)
+        self.assertEqual(self.store.index.get('b.jpg')[3], md5_of(b'b' * 100))
+
+    def test_a_torn_record_is_cut_off(self):
+        self.store.put('a.jpg', b'a' * 100, 'image/jpeg')
+        self.store.close()
+        pack = self.packs / pack_name(1)
+        size = pack.stat().st_size
+        with open(pack, 'ab') as f:
+            f.write(packstore._record_header('b.jpg', 'image/jpeg', 100, 0) + b'b' * 10)
+        with self.assertLogs('retrogallery.packstore', 'WARNING'):
+            self.store = PackStore(self.basedir, pack_size=1024)
+        self.assertEqual(pack.stat().st_size, size)
+        self.assertIsNone(self.store.index.get('b.jpg'))
+        self.store.put('c.jpg', b'c', 'image/jpeg')
+        self.assertEqual(self._read('c.jpg'), b'c')
+
+    def test_rebuild_indexes_the_last_record_of_every_path(self):
+        self.store.put('a.jpg', b'old' * 200, 'image/jpeg')
+        self.store.put('b.jpg', b'b' * 600, 'image/jpeg')
+        self.store.put('a.jpg', b'new', 'image/jpeg')
+        self.store.close()
+        (self.packs / packstore.INDEX_NAME).unlink()
+        self.assertEqual(packstore.rebuild(self.basedir), 2)
+        self.store = PackStore(self.basedir, pack_size=1024)
+        self.assertEqual(self._read('a.jpg'), b'new')
+        self.assertEqual(self._read('b.jpg'), b'b' * 600)
+        self.assertEqual(self.store.index.get('a.jpg')[3], md5_of(b'new'))
+
+    def test_compact_and_export(self):
+        self.store.put('a.jpg', b'a' * 600, 'image/jpeg')
+        self.store.put('b.jpg', b'b' * 600, 'image/jpeg')
+        self.store.put('a.jpg', b'A' * 600, 'image/jpeg')
+        self.store.close()
+        packs, reclaimed = packstore.compact(self.basedir, min_live=0.5, pack_size=1024)
+        self.assertEqual(packs, 1)
+        self.assertGreater(reclaimed, 600)
+        self.assertNotIn(1, pack_numbers(self.packs))
+        destination = Path(self.basedir) / 'export'
+        self.assertEqual(packstore.export(self.basedir, destination), (2, 1200))
+        self.assertEqual((destination / 'a.jpg').read_bytes(), b'A' * 600)
+        self.assertEqual((destination / 'b.jpg').read_bytes(), b'b' * 600)
+        self.store = PackStore(self.basedir, pack_size=1024)
+
+    def test_writes_through_a_writer(self):
+        self.store.close()
+        writer = FSWriter(threads=2)
+        self.addCleanup(lambda: run_until_fired(writer.close()))
+        self.store = PackStore(self.basedir, pack_size=1024, writer=writer)
+        dfds = [self.store.put(f'{i}.jpg', bytes([i]) * 300, 'image/jpeg') for i in range(6)]
+        self.assertIsNone(self.store.index.get('0.jpg'))
+        for dfd in dfds:
+            run_until_fired(dfd)
+        for i in range(6):
+            self.assertEqual(self._read(f'{i}.jpg'), bytes([i]) * 300)
+        self.assertEqual(pack_numbers(self.packs), [1, 2])
+
+
+class PackFilesStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.store = PackFilesStore(f'file://{self.directory.name}')
+        self.addCleanup(self.store.close)
+
+    def test_stat_file(self):
+        self.assertEqual(self.store.stat_file('missing.jpg', info=None), {})
+        self.store.persist_file('a.jpg', BytesIO(b'image'), info=None, headers={'Content-Type': 'image/webp'})
+        stat = self.store.stat_file('a.jpg', info=None)
+        self.assertEqual(stat['checksum'], md5_of(b'image'))
+        self.assertIsInstance(stat['last_modified'], float)
+        self.assertEqual(self.store.packs.index.get('a.jpg')[4], 'image/webp')
+
+    def test_content_type_is_guessed_from_the_path(self):
+        self.store.persist_file('a.png', BytesIO(b'image'), info=None)
+        self.assertEqual(self.store.packs.index.get('a.png')[4], 'image/png')
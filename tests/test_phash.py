@@ -0,0 +1,175 @@
+import os
+import random
+import tempfile
+import unittest
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from retrogallery import phash
+from retrogallery.items import ImageItem
+from retrogallery.phash import MultiIndexHash, NearDuplicateIndex
+from retrogallery.pipelines import RetroGalleryLocalPipeline
+from tests import get_crawler, run_until_fired, start_reactor_threads
+
+
+def photo(seed, size=(640, 480)):
+    """
+    Returns a smooth image of overlapping shapes, different for each seed.
+    """
+    rng = random.Random(seed)
+    image = Image.new('RGB', size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        w, h = rng.randrange(40, 300), rng.randrange(40, 300)
+        shape = draw.ellipse if rng.random() < 0.5 else draw.rectangle
+        shape((x - w // 2, y - h // 2, x + w // 2, y + h // 2), fill=tuple(rng.randrange(256) for _ in range(3)))
+    return image.filter(ImageFilter.GaussianBlur(3))
+
+
+def encode(image, format='JPEG', **params):
+    buf = BytesIO()
+    image.save(buf, format, **params)
+    return buf.getvalue()
+
+
+ORIGINAL = photo(1)
+COPIES = {
+    'scaled': encode(ORIGINAL.resize((320, 240), Image.Resampling.LANCZOS), quality=90),
+    'recompressed': encode(ORIGINAL, quality=25),
+    'png thumbnail': encode(ORIGINAL.resize((200, 150)), 'PNG'),
+}
+DISTINCT = [encode(photo(seed), quality=90) for seed in range(2, 8)]
+
+
+@unittest.skipIf(phash.np is None, "numpy is not installed")
+class PerceptualHashTest(unittest.TestCase):
+
+    def _hash(self, data, algorithm):
+        return phash.hash_thumbnails([phash.thumbnail(data)[0]], algorithm)[0]
+
+    def test_copies_are_near_duplicates(self):
+        for algorithm in phash.ALGORITHMS:
+            original = self._hash(encode(ORIGINAL, quality=95), algorithm)
+            for name, data in COPIES.items():
+                with self.subTest(algorithm=algorithm, copy=name):
+                    distance = phash.hamming(original, self._hash(data, algorithm))
+                    self.assertLessEqual(distance, phash.DEFAULT_MAX_DISTANCE)
+
+    def test_distinct_images_are_not(self):
+        for algorithm in phash.ALGORITHMS:
+            hashes = [self._hash(data, algorithm) for data in [encode(ORIGINAL, quality=95)] + DISTINCT]
+            with self.subTest(algorithm=algorithm):
+                distances = [phash.hamming(a, b) for i, a in enumerate(hashes) for b in hashes[i + 1:]]
+                self.assertGreater(min(distances), phash.DEFAULT_MAX_DISTANCE)
+
+    def test_hash_files_skips_what_cannot_be_decoded(self):
+        with tempfile.TemporaryDirectory() as directory:
+            image, broken = Path(directory, 'a.jpg'), Path(directory, 'b.jpg')
+            image.write_bytes(COPIES['scaled'])
+            broken.write_bytes(b'not an image')
+            results = phash.hash_files([str(broken), str(image)])
+        self.assertIsNone(results[0])
+        self.assertEqual(results[1], (self._hash(COPIES['scaled'], phash.DEFAULT_ALGORITHM), (320, 240)))
+
+    def test_unknown_algorithm(self):
+        with self.assertRaises(ValueError):
+            phash.hash_thumbnails([phash.thumbnail(COPIES['scaled'])[0]], 'md5')
+
+
+class MultiIndexHashTest(unittest.TestCase):
+
+    def test_search_finds_every_hash_within_the_distance(self):
+        rng = random.Random(0)
+        index = MultiIndexHash(max_distance=6)
+        hashes = {}
+        base = rng.getrandbits(64)
+        for i in range(500):
+            value = base
+            # Half of the hashes are a few bits from base
+            for bit in rng.sample(range(64), rng.randrange(12) if i % 2 else 32):
+                value ^= 1 << bit
+            hashes[i] = value
+            index.add(i, value)
+        expected = sorted((phash.hamming(base, value), key) for key, value in hashes.items()
+                          if phash.hamming(base, value) <= 6)
+        self.assertTrue(expected)
+        self.assertEqual(index.search(base), expected)
+        self.assertEqual(index.search(base, max_distance=2), [match for match in expected if match[0] <= 2])
+        index.remove(expected[0][1])
+        self.assertEqual(index.search(base), expected[1:])
+
+
+@unittest.skipIf(phash.np is None, "numpy is not installed")
+class NearDuplicateIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.index = NearDuplicateIndex(Path(self.directory.name) / 'phash.sqlite3')
+        self.addCleanup(lambda: self.index.close())
+
+    def test_the_largest_image_is_canonical(self):
+        self.assertEqual(self.index.add('small.jpg', 0b1111, (320, 240)), [])
+        self.assertEqual(self.index.add('smaller.jpg', 0b0111, (200, 150)), [('smaller.jpg', 'small.jpg', 1)])
+        self.assertEqual(self.index.add('other.jpg', 1 << 40 | 0xff << 20, (640, 480)), [])
+        # A larger copy takes over the group
+        self.assertEqual(
+            self.index.add('large.jpg', 0b11111, (640, 480)),
+            [('small.jpg', 'large.jpg', 1), ('smaller.jpg', 'large.jpg', 2)]
+        )
+        self.assertEqual(self.index.duplicates('large.jpg'), ['small.jpg', 'smaller.jpg'])
+        self.assertEqual(self.index.stats(), (4, 2, 2))
+        self.index.close()
+        self.index = NearDuplicateIndex(self.index.path)
+        self.assertEqual(self.index.add('copy.jpg', 0b11111, (100, 75)), [('copy.jpg', 'large.jpg', 0)])
+
+
+@unittest.skipIf(phash.np is None, "numpy is not installed")
+class NearDuplicatePipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        start_reactor_threads(self)
+        self.crawler = get_crawler({
+            'IMAGES_STORE': self.directory.name,
+            'RETROGALLERYLOCALPIPELINE_NEAR_DUPLICATES': True,
+        })
+        self.pipeline = RetroGalleryLocalPipeline.from_crawler(self.crawler)
+        self.pipeline.open_spider(self.crawler.spider)
+        self.addCleanup(self.pipeline.close_spider, self.crawler.spider)
+
+    def _complete(self, gallery_title, images):
+        """
+        Stores images ({path: bytes}) and completes an item downloading them.
+        """
+        results = []
+        for path, data in images.items():
+            local_path = Path(self.directory.name, *path.split('/'))
+            local_path.parent.mkdir(parents=True, exist_ok=True)
+            local_path.write_bytes(data)
+            url = f'https://oldcrap.org/{path}'
+            results.append((True, {'url': url, 'path': path, 'checksum': 'md5', 'status': 'downloaded'}))
+        item = ImageItem(gallery_title=gallery_title, image_title='Console', image_urls=[x['url'] for _, x in results])
+        return run_until_fired(self.pipeline.item_completed(results, item, self.pipeline.spiderinfo))
+
+    def test_near_duplicates_are_linked_to_the_largest_copy(self):
+        small, other = 'test/TI-99/Console/small.jpg', 'test/TI-99/Console/other.jpg'
+        item = self._complete('TI-99', {small: COPIES['scaled'], other: DISTINCT[0]})
+        self.assertNotIn('duplicate_of', item.images[0])
+        large = 'test/TI-99-4A/Console/large.jpg'
+        item = self._complete('TI-99-4A', {large: encode(ORIGINAL, quality=95)})
+        self.assertNotIn('duplicate_of', item.images[0])
+        root = Path(self.directory.name)
+        self.assertTrue(os.path.samefile(root / small, root / large))
+        self.assertFalse(os.path.samefile(root / other, root / large))
+        self.assertEqual(self.pipeline.near_duplicates.get(small)['canonical'], large)
+        self.assertEqual(self.crawler.stats.get_value('near_duplicates/linked'), 1)
+        # A smaller copy stored later is linked as its item completes
+        copy = 'test/TI/Console/copy.png'
+        item = self._complete('TI', {copy: COPIES['png thumbnail']})
+        self.assertEqual(item.images[0]['duplicate_of'], large)
+        self.assertTrue(os.path.samefile(root / copy, root / large))
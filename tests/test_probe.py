@@ -0,0 +1,84 @@
+import unittest
+from io import BytesIO
+
+from PIL import Image
+from scrapy.http import Request, Response
+
+from retrogallery import probe, streaming
+
+
+IMAGE_URL = 'https://i0.wp.com/oldcrap.org/wp-content/uploads/2018/02/ti99.jpeg'
+
+
+def _png(width, height):
+    buf = BytesIO()
+    Image.new('RGB', (width, height)).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+class ContentRangeTest(unittest.TestCase):
+
+    def _range(self, value):
+        return probe.content_range(Response(IMAGE_URL, status=206, headers={'Content-Range': value}))
+
+    def test_content_range(self):
+        self.assertEqual(self._range('bytes 0-16383/524288'), (0, 16383, 524288))
+        self.assertEqual(self._range(' bytes 0-99/* '), (0, 99, None))
+
+    def test_unusable_content_range(self):
+        self.assertIsNone(probe.content_range(Response(IMAGE_URL, status=206)))
+        self.assertIsNone(self._range('bytes */524288'))
+        self.assertIsNone(self._range('items 0-9/10'))
+
+
+class ReadProbeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.image = _png(640, 480)
+
+    def test_partial_response(self):
+        response = Response(IMAGE_URL, status=206, body=self.image[:64],
+                            headers={'Content-Range': f'bytes 0-63/{len(self.image)}'})
+        self.assertEqual(probe.read_probe(response), probe.ImageProbe('PNG', 640, 480, len(self.image), False))
+
+    def test_probe_holds_the_whole_image(self):
+        last = len(self.image) - 1
+        response = Response(IMAGE_URL, status=206, body=self.image,
+                            headers={'Content-Range': f'bytes 0-{last}/{len(self.image)}'})
+        self.assertTrue(probe.read_probe(response).complete)
+
+    def test_range_ignored(self):
+        response = Response(IMAGE_URL, status=200, body=self.image)
+        self.assertEqual(probe.read_probe(response), probe.ImageProbe('PNG', 640, 480, len(self.image), True))
+
+    def test_unknown_size(self):
+        response = Response(IMAGE_URL, status=206, body=self.image[:64], headers={'Content-Range': 'bytes 0-63/*'})
+        self.assertEqual(probe.read_probe(response), probe.ImageProbe('PNG', 640, 480, None, False))
+
+    def test_unrecognised_header(self):
+        response = Response(IMAGE_URL, status=206, body=b'<html>', headers={'Content-Range': 'bytes 0-5/100'})
+        self.assertEqual(probe.read_probe(response), probe.ImageProbe(None, None, None, 100, False))
+
+    def test_unanswered_probes(self):
+        self.assertIsNone(probe.read_probe(Response(IMAGE_URL, status=404)))
+        self.assertIsNone(probe.read_probe(Response(IMAGE_URL, status=416)))
+        # A range that does not start at the beginning of the image
+        response = Response(IMAGE_URL, status=206, body=self.image[10:20],
+                            headers={'Content-Range': f'bytes 10-19/{len(self.image)}'})
+        self.assertIsNone(probe.read_probe(response))
+
+
+class ProbeRequestTest(unittest.TestCase):
+
+    def test_probe_request(self):
+        request = Request(IMAGE_URL, meta={streaming.STREAM_META_KEY: True, 'image_index': 2})
+        probed = probe.probe_request(request, 1024)
+        self.assertEqual(probed.headers['Range'], b'bytes=0-1023')
+        self.assertEqual(probed.headers['Accept-Encoding'], b'identity')
+        self.assertTrue(probed.meta[probe.PROBE_META_KEY])
+        self.assertTrue(probed.meta['dont_cache'])
+        self.assertNotIn(streaming.STREAM_META_KEY, probed.meta)
+        self.assertEqual(probed.meta['image_index'], 2)
+        # The image request itself is untouched
+        self.assertIn(streaming.STREAM_META_KEY, request.meta)
+        self.assertNotIn('Range', request.headers)
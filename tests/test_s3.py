@@ -0,0 +1,222 @@
+import hashlib
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import botocore.session
+from moto import mock_aws
+
+from retrogallery.s3 import MD5_METADATA_KEY, MiB, S3ObjectCache, S3Uploader, parse_s3_uri
+from tests import get_crawler, run_until_fired
+
+
+BUCKET = 'retrogallery'
+
+
+def md5_of(data):
+    # deepcode ignore InsecureHash: <not used in a security context>
+    return hashlib.md5(data).hexdigest()
+
+
+class ParseS3UriTest(unittest.TestCase):
+
+    def test_bucket_and_prefix(self):
+        self.assertEqual(parse_s3_uri('s3://bucket'), ('bucket', ''))
+        self.assertEqual(parse_s3_uri('s3://bucket/'), ('bucket', ''))
+        self.assertEqual(parse_s3_uri('s3://bucket/images'), ('bucket', 'images/'))
+        self.assertEqual(parse_s3_uri('s3://bucket/a/b/'), ('bucket', 'a/b/'))
+
+    def test_other_schemes_are_rejected(self):
+        for uri in (None, '', '/tmp/images', 'gs://bucket/images'):
+            with self.assertRaises(ValueError):
+                parse_s3_uri(uri)
+
+
+class S3ObjectCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = S3ObjectCache(Path(self.directory.name) / 'cache' / 's3.sqlite3')
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def test_record_and_forget(self):
+        self.assertIsNone(self.cache.md5_for_key('a.jpg'))
+        self.cache.record('a.jpg', 'abc', 3)
+        self.assertEqual(self.cache.md5_for_key('a.jpg'), 'abc')
+        self.assertEqual(self.cache.key_for_md5('abc'), 'a.jpg')
+        self.cache.record('a.jpg', 'def', 3)
+        self.assertEqual(self.cache.md5_for_key('a.jpg'), 'def')
+        self.assertIsNone(self.cache.key_for_md5('abc'))
+        self.cache.forget('a.jpg')
+        self.assertIsNone(self.cache.md5_for_key('a.jpg'))
+
+    def test_survives_reopening(self):
+        self.cache.record('a.jpg', 'abc', 3)
+        self.cache.close()
+        self.cache = S3ObjectCache(self.cache.path)
+        self.assertEqual(self.cache.md5_for_key('a.jpg'), 'abc')
+
+
+class S3UploaderTest(unittest.TestCase):
+    """
+    S3Uploader against moto's in-process stand-in for S3.
+    """
+
+    def setUp(self):
+        self.aws = mock_aws()
+        self.aws.start()
+        self.addCleanup(self.aws.stop)
+        self.client = botocore.session.get_session().create_client(
+            's3', region_name='us-east-1', aws_access_key_id='testing', aws_secret_access_key='testing'
+        )
+        self.client.create_bucket(Bucket=BUCKET)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.stats = get_crawler().stats
+        self.uploader = S3Uploader(
+            self.client, BUCKET, 'images/', S3ObjectCache(Path(self.directory.name) / 's3.sqlite3'),
+            concurrency=2, queue_size=2, multipart_threshold=6 * MiB, part_size=5 * MiB, stats=self.stats,
+        )
+        self.uploader.start()
+        self.addCleanup(self.uploader.close)
+
+    def _file(self, name, data):
+        path = Path(self.directory.name) / name
+        path.write_bytes(data)
+        return path
+
+    def _upload(self, name, data, key=None):
+        """
+        Uploads data through the thread pool and waits for it to finish.
+        """
+        run_until_fired(self.uploader.enqueue(self._file(name, data), key or name, md5_of(data)))
+        run_until_fired(self.uploader.drain())
+
+    def _object(self, key):
+        return self.client.get_object(Bucket=BUCKET, Key=f'images/{key}')
+
+    def test_upload_records_the_md5(self):
+        self._upload('a.jpg', b'a' * 100)
+        obj = self._object('a.jpg')
+        self.assertEqual(obj['Body'].read(), b'a' * 100)
+        self.assertEqual(obj['Metadata'][MD5_METADATA_KEY], md5_of(b'a' * 100))
+        self.assertEqual(self.uploader.cache.md5_for_key('images/a.jpg'), md5_of(b'a' * 100))
+        self.assertEqual(self.stats.get_value('s3/uploaded'), 1)
+
+    def test_cached_md5_is_skipped_without_a_request(self):
+        self._upload('a.jpg', b'a' * 100)
+        with mock.patch.object(self.client, 'head_object') as head_object:
+            self._upload('a.jpg', b'a' * 100)
+        head_object.assert_not_called()
+        self.assertEqual(self.stats.get_value('s3/skipped_cached'), 1)
+        self.assertEqual(self.stats.get_value('s3/uploaded'), 1)
+
+    def test_matching_object_is_skipped_after_a_head_request(self):
+        data = b'b' * 100
+        self.client.put_object(Bucket=BUCKET, Key='images/b.jpg', Body=data, Metadata={MD5_METADATA_KEY: md5_of(data)})
+        with mock.patch.object(self.client, 'put_object') as put_object:
+            self._upload('b.jpg', data)
+        put_object.assert_not_called()
+        self.assertEqual(self.stats.get_value('s3/exists'), 1)
+        self.assertEqual(self.uploader.cache.md5_for_key('images/b.jpg'), md5_of(data))
+
+    def test_changed_object_is_uploaded_again(self):
+        self.client.put_object(Bucket=BUCKET, Key='images/b.jpg', Body=b'old')
+        self._upload('b.jpg', b'new')
+        self.assertEqual(self._object('b.jpg')['Body'].read(), b'new')
+        self.assertEqual(self.stats.get_value('s3/uploaded'), 1)
+
+    def test_content_seen_under_another_key_is_copied(self):
+        data = b'c' * 100
+        self._upload('c.jpg', data)
+        with mock.patch.object(self.client, 'put_object') as put_object:
+            self._upload('copy.jpg', data)
+        put_object.assert_not_called()
+        self.assertEqual(self._object('copy.jpg')['Body'].read(), data)
+        self.assertEqual(self.stats.get_value('s3/copied'), 1)
+
+    def test_copy_falls_back_to_uploading_when_the_source_has_gone(self):
+        data = b'c' * 100
+        self._upload('c.jpg', data)
+        self.client.delete_object(Bucket=BUCKET, Key='images/c.jpg')
+        self._upload('copy.jpg', data)
+        self.assertEqual(self._object('copy.jpg')['Body'].read(), data)
+        self.assertEqual(self.stats.get_value('s3/uploaded'), 2)
+
+    def test_multipart_threshold(self):
+        below, at = b'd' * (6 * MiB - 1), b'e' * (6 * MiB)
+        self._upload('below.bin', below)
+        self._upload('at.bin', at)
+        self.assertEqual(self.stats.get_value('s3/uploaded'), 1)
+        self.assertEqual(self.stats.get_value('s3/uploaded_multipart'), 1)
+        obj = self._object('at.bin')
+        self.assertEqual(obj['Body'].read(), at)
+        # Parts of part_size, with the MD5 of the whole object in the
+        # metadata rather than the ETag
+        self.assertTrue(obj['ETag'].strip('"').endswith('-2'))
+        self.assertEqual(obj['Metadata'][MD5_METADATA_KEY], md5_of(at))
+
+    def test_multipart_upload_is_aborted_when_a_part_fails(self):
+        data = b'f' * (6 * MiB)
+        upload_part = self.client.upload_part
+        calls = []
+
+        def _failing_second_part(**kwargs):
+            calls.append(kwargs['PartNumber'])
+            if kwargs['PartNumber'] == 2:
+                raise ConnectionError('connection reset')
+            return upload_part(**kwargs)
+
+        with self.assertLogs('retrogallery.s3', 'ERROR'), \
+                mock.patch.object(self.client, 'upload_part', side_effect=_failing_second_part), \
+                mock.patch.object(self.client, 'abort_multipart_upload',
+                                  wraps=self.client.abort_multipart_upload) as abort:
+            self._upload('f.bin', data)
+        self.assertEqual(calls, [1, 2])
+        abort.assert_called_once()
+        self.assertEqual(self.client.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []), [])
+        self.assertNotIn('Contents', self.client.list_objects_v2(Bucket=BUCKET))
+        self.assertIsNone(self.uploader.cache.md5_for_key('images/f.bin'))
+        self.assertEqual(self.stats.get_value('s3/failed'), 1)
+
+    def test_drain_waits_for_every_upload(self):
+        started, released = [], threading.Event()
+        upload = self.uploader._upload
+
+        def _held_upload(*args):
+            # Uploads are held on their threads until released
+            started.append(args[1])
+            released.wait(10)
+            return upload(*args)
+
+        names = ['a.jpg', 'b.jpg', 'c.jpg']
+        with mock.patch.object(self.uploader, '_upload', side_effect=_held_upload):
+            accepted = [
+                self.uploader.enqueue(self._file(name, name.encode()), name, md5_of(name.encode()))
+                for name in names
+            ]
+            # Two uploads fill the queue, so the third waits to be accepted
+            self.assertEqual([dfd.called for dfd in accepted], [True, True, False])
+            drained = self.uploader.drain()
+            self.assertFalse(drained.called)
+            released.set()
+            run_until_fired(accepted[2])
+            run_until_fired(self.uploader.drain())
+        self.assertTrue(drained.called)
+        self.assertEqual(sorted(started), [f'images/{name}' for name in names])
+        self.assertEqual(self.stats.get_value('s3/uploaded'), 3)
+        self.assertEqual(self.uploader._queue.tokens, 2)
+
+    def test_queue_slot_is_released_when_an_upload_cannot_start(self):
+        with mock.patch.object(self.uploader.cache, 'key_for_md5', side_effect=RuntimeError('database is locked')):
+            for _ in range(3):
+                with self.assertRaises(RuntimeError):
+                    run_until_fired(self.uploader.enqueue(self._file('a.jpg', b'a'), 'a.jpg', md5_of(b'a')))
+        self.assertEqual(self.uploader._queue.tokens, 2)
+        self._upload('a.jpg', b'a')
+        self.assertEqual(self.stats.get_value('s3/uploaded'), 1)
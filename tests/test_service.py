@@ -0,0 +1,186 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from scrapy import Request, Spider
+from scrapy.crawler import CrawlerRunner
+from scrapy.settings import Settings
+from twisted.internet import defer, reactor, threads
+
+from retrogallery import resources
+from retrogallery.middlewares import get_crawl_state
+from retrogallery.service import CANCELLED, FINISHED, QUEUED, RUNNING, CrawlService, ServiceClient
+from tests import run_until_fired, start_reactor_threads
+
+
+class CountingSpider(Spider):
+    """
+    Scrapes an item from each of a few data: URLs, so jobs crawl without a
+    network.
+    """
+    name = 'counting'
+    pages = 3
+    # The CrawlState of each crawl, see SharedResourceTest
+    states = []
+
+    def start_requests(self):
+        yield Request('data:,0')
+
+    def parse(self, response):
+        page = int(response.text)
+        yield {'page': page}
+        if page + 1 < self.pages:
+            yield Request(f'data:,{page + 1}')
+
+    def closed(self, reason):
+        if self.settings.getbool('RETROGALLERY_INCREMENTAL'):
+            self.states.append(get_crawl_state(self.crawler))
+
+
+class EndlessSpider(CountingSpider):
+    name = 'endless'
+    pages = float('inf')
+
+
+class ServiceTestCase(unittest.TestCase):
+    """
+    Runs a CrawlService of one job at a time, without starting the reactor.
+    """
+
+    settings = {}
+
+    def setUp(self):
+        start_reactor_threads(self)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        settings = Settings({
+            'SPIDER_MODULES': [__name__],
+            'LOG_ENABLED': False,
+            'TELNETCONSOLE_ENABLED': False,
+            **self.settings,
+        })
+        self.service = CrawlService(CrawlerRunner(settings), max_jobs=1)
+        resources.install(self.service.resident)
+        self.addCleanup(lambda: run_until_fired(self.service._stop()))
+
+    def _wait(self, job, states=(FINISHED,), until=None):
+        """
+        Runs the reactor until job is in one of states, or until() is true.
+        """
+        dfd = defer.Deferred()
+
+        def _check():
+            if until() if until else job.state in states:
+                dfd.callback(job)
+            else:
+                reactor.callLater(0.01, _check)
+
+        _check()
+        return run_until_fired(dfd)
+
+
+class CrawlServiceTest(ServiceTestCase):
+
+    def test_submit_runs_jobs_one_at_a_time(self):
+        first = self.service.submit('counting')
+        second = self.service.submit('counting')
+        self.assertEqual((first.state, second.state), (RUNNING, QUEUED))
+        self._wait(second)
+        self.assertEqual(first.state, FINISHED)
+        self.assertEqual(first.stats['item_scraped_count'], 3)
+        self.assertEqual(second.to_dict(stats=True)['stats']['item_scraped_count'], 3)
+        self.assertEqual(self.service.describe()['jobs'], {FINISHED: 2})
+
+    def test_unknown_spider(self):
+        with self.assertRaises(KeyError):
+            self.service.submit('nope')
+
+    def test_overrides_are_limited_to_the_allowed_settings(self):
+        job = self.service.submit('counting', overrides={'CLOSESPIDER_ITEMCOUNT': 1, 'LOG_LEVEL': 'INFO'})
+        self._wait(job)
+        self.assertEqual(job.reason, 'closespider_itemcount')
+        for name in ('ITEM_PIPELINES', 'FILES_STORE', 'DOWNLOADER', 'SCHEDULER', 'TELNETCONSOLE_ENABLED',
+                     'RETROGALLERY_METRICS_PORT', 'RETROGALLERY_STATE_DB'):
+            with self.subTest(setting=name), self.assertRaises(ValueError):
+                self.service.submit('counting', overrides={'DOWNLOAD_DELAY': 0, name: 'x'})
+        with self.assertRaises(TypeError):
+            self.service.submit('counting', overrides=['DOWNLOAD_DELAY'])
+        self.assertEqual(len(self.service.jobs), 1)
+
+    def test_cancel(self):
+        running = self.service.submit('endless')
+        queued = self.service.submit('counting')
+        self._wait(running, until=lambda: running.current_stats().get('item_scraped_count'))
+        self.service.cancel(queued)
+        self.assertEqual((queued.state, queued.reason), (CANCELLED, CANCELLED))
+        self.service.cancel(running)
+        self._wait(running, (CANCELLED,))
+        self.assertGreater(running.stats['item_scraped_count'], 0)
+        self.assertIn('"event": "cancelled"', running.events[-1])
+
+    def test_api(self):
+        listener = self.service.listen(port=0)
+        self.addCleanup(listener.stopListening)
+        address = listener.getHost()
+        self.assertEqual(address.host, '127.0.0.1')
+        client = ServiceClient(address.host, address.port, timeout=10)
+
+        def request(*args):
+            return run_until_fired(threads.deferToThread(client.request, *args))
+
+        status, job = request('POST', '/jobs', {'spider': 'counting', 'settings': {'DOWNLOAD_DELAY': 0}})
+        self.assertEqual(status, 201)
+        status, error = request('POST', '/jobs', {'spider': 'counting', 'settings': {'ITEM_PIPELINES': {}}})
+        self.assertEqual(status, 400)
+        self.assertIn('ITEM_PIPELINES', error['error'])
+        self.assertEqual(request('POST', '/jobs', {'spider': 'nope'})[0], 400)
+        self._wait(self.service.jobs[job['id']])
+        status, job = request('GET', f"/jobs/{job['id']}")
+        self.assertEqual((status, job['state']), (200, FINISHED))
+        self.assertEqual(job['stats']['item_scraped_count'], 3)
+        status, jobs = request('GET', '/jobs')
+        self.assertEqual([listed['id'] for listed in jobs], [job['id']])
+        self.assertEqual(request('GET', '/jobs/nope')[0], 404)
+        events = run_until_fired(threads.deferToThread(lambda: list(client.events(job['id']))))
+        self.assertEqual([event['event'] for event in events], [QUEUED, RUNNING, FINISHED])
+
+    def test_an_empty_host_is_the_loopback_interface(self):
+        listener = self.service.listen(host='', port=0)
+        self.addCleanup(listener.stopListening)
+        self.assertEqual(listener.getHost().host, '127.0.0.1')
+
+
+class SharedResourceTest(ServiceTestCase):
+    """
+    The incremental crawl state is opened once and shared by every job.
+    """
+
+    settings = {
+        'DOWNLOADER_MIDDLEWARES': {'retrogallery.middlewares.IncrementalCrawlMiddleware': 580},
+        'RETROGALLERY_INCREMENTAL': True,
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.service.settings.set('RETROGALLERY_STATE_DB', str(Path(self.directory.name) / 'state.sqlite3'))
+        CountingSpider.states = []
+
+    def test_jobs_share_the_crawl_state(self):
+        self._wait(self.service.submit('counting'))
+        self._wait(self.service.submit('counting'))
+        first, second = CountingSpider.states
+        self.assertIs(first, second)
+        self.assertEqual(self.service.describe()['shared'], ['state'])
+        # Still open after the jobs, and closed with the service
+        first.conn.execute("SELECT 1")
+        run_until_fired(self.service._stop())
+        with self.assertRaises(Exception):
+            first.conn.execute("SELECT 1")
+        self.assertEqual(self.service.resident.keys(), [])
+
+    def test_without_a_service_each_crawl_opens_its_own(self):
+        resources.uninstall()
+        self.assertIsNot(
+            resources.shared(('state', 'x'), object),
+            resources.shared(('state', 'x'), object),
+        )
@@ -0,0 +1,100 @@
+import contextlib
+import io
+import tempfile
+import unittest
+from pathlib import Path
+
+from retrogallery import state
+from retrogallery.state import CrawlState
+
+
+GALLERY_URL = 'https://oldcrap.org/2018/02/21/texas-instruments-ti-99-4a/'
+IMAGE_URL = 'https://i0.wp.com/oldcrap.org/wp-content/uploads/2018/02/ti99.jpeg'
+
+
+class CrawlStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name) / 'nested' / 'state.sqlite3'
+        self.state = CrawlState(self.path)
+
+    def tearDown(self):
+        self.state.close()
+        self.directory.cleanup()
+
+    def test_record_and_get(self):
+        self.assertIsNone(self.state.get('pages', GALLERY_URL))
+        self.state.record('pages', GALLERY_URL, status=200, etag='"v1"', last_modified='Wed, 21 Feb 2018',
+                          content_hash=CrawlState.content_hash(b'page'))
+        page = self.state.get('pages', GALLERY_URL)
+        self.assertEqual(
+            (page['status'], page['etag'], page['last_modified'], page['content_hash']),
+            (200, '"v1"', 'Wed, 21 Feb 2018', CrawlState.content_hash(b'page')),
+        )
+        self.assertIsNone(self.state.get('images', GALLERY_URL))
+
+    def test_not_modified_keeps_validators(self):
+        self.state.record('pages', GALLERY_URL, status=200, etag='"v1"', content_hash='abc')
+        fetched_at = self.state.get('pages', GALLERY_URL)['fetched_at']
+        self.state.record('pages', GALLERY_URL, status=304)
+        page = self.state.get('pages', GALLERY_URL)
+        self.assertEqual((page['status'], page['etag'], page['content_hash']), (304, '"v1"', 'abc'))
+        self.assertGreaterEqual(page['fetched_at'], fetched_at)
+
+    def test_writes_survive_reopening(self):
+        self.state.record('images', IMAGE_URL, status=200)
+        self.state.close()
+        self.state = CrawlState(self.path)
+        self.assertEqual(self.state.get('images', IMAGE_URL)['status'], 200)
+
+    def test_forget(self):
+        self.state.record('pages', GALLERY_URL, status=200)
+        self.state.record('images', GALLERY_URL, status=200)
+        self.state.record('images', IMAGE_URL, status=200)
+        self.assertEqual(self.state.forget(GALLERY_URL), 2)
+        self.assertIsNone(self.state.get('pages', GALLERY_URL))
+        self.assertIsNotNone(self.state.get('images', IMAGE_URL))
+
+    def test_rows_and_stats(self):
+        self.state.record('images', IMAGE_URL, status=200)
+        self.state.record('images', IMAGE_URL + '?2', status=200)
+        self.state.conn.execute("UPDATE images SET fetched_at = 1 WHERE url = ?", (IMAGE_URL,))
+        self.assertEqual([row[0] for row in self.state.rows('images', limit=1)], [IMAGE_URL + '?2'])
+        stats = self.state.stats()
+        self.assertEqual(stats['pages'], (0, None, None))
+        self.assertEqual(stats['images'][0], 2)
+
+
+class StateCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = str(Path(self.directory.name) / 'state.sqlite3')
+        crawl_state = CrawlState(self.db)
+        crawl_state.record('pages', GALLERY_URL, status=200, content_hash='abc')
+        crawl_state.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _run(self, *args):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            code = state.main(['--db', self.db, *args])
+        return code, out.getvalue()
+
+    def test_show_and_forget(self):
+        code, out = self._run('show', GALLERY_URL)
+        self.assertEqual(code, 0)
+        self.assertIn('content_hash: abc', out)
+        self.assertEqual(self._run('forget', GALLERY_URL), (0, "Removed 1 record(s)\n"))
+        code, out = self._run('show', GALLERY_URL)
+        self.assertEqual(code, 1)
+        self.assertIn('has not been fetched', out)
+
+    def test_stats(self):
+        code, out = self._run('stats')
+        self.assertEqual(code, 0)
+        self.assertTrue(out.startswith('pages: 1 '))
+        self.assertIn('images: 0 (oldest -, newest -)', out)
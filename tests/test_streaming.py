@@ -0,0 +1,92 @@
+import hashlib
+import inspect
+import tempfile
+import unittest
+from pathlib import Path
+
+from scrapy.core.downloader.handlers.http11 import ScrapyAgent, _ResponseReader
+from scrapy.http import Request
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+
+from retrogallery import streaming
+from tests import get_crawler
+
+
+IMAGE_URL = 'https://i0.wp.com/oldcrap.org/wp-content/uploads/2018/02/ti99.jpeg'
+
+# The SHA1 of the source of ScrapyAgent._cb_bodyready() in Scrapy 2.8.0,
+# which _StreamingScrapyAgent._cb_bodyready() copies
+CB_BODYREADY_SHA1 = '4336e6edf06224e1e9761f19a7c983b87af6d958'
+
+
+class ScrapyPrivateAPITest(unittest.TestCase):
+    """
+    Fails when a Scrapy upgrade changes the private API that
+    _StreamingScrapyAgent and _StreamingResponseReader rely on: re-copy
+    _cb_bodyready() from the new ScrapyAgent and update the checks here.
+    """
+
+    def test_cb_bodyready_is_unchanged(self):
+        source = inspect.getsource(ScrapyAgent._cb_bodyready)
+        self.assertEqual(hashlib.sha1(source.encode()).hexdigest(), CB_BODYREADY_SHA1)
+
+    def test_agent_attributes(self):
+        agent = ScrapyAgent(contextFactory=None, crawler=get_crawler())
+        for name in ('_crawler', '_maxsize', '_warnsize', '_fail_on_dataloss', '_txresponse'):
+            self.assertTrue(hasattr(agent, name), name)
+        self.assertTrue(callable(agent._headers_from_twisted_response))
+
+    def test_reader_api(self):
+        self.assertEqual(
+            list(inspect.signature(_ResponseReader.__init__).parameters),
+            ['self', 'finished', 'txresponse', 'request', 'maxsize', 'warnsize', 'fail_on_dataloss', 'crawler'],
+        )
+        reader = _ResponseReader(defer.Deferred(), None, Request(IMAGE_URL), 0, 0, True, get_crawler())
+        for name in ('_bodybuf', '_bytes_received', '_certificate', '_ip_address', '_finish_response'):
+            self.assertTrue(hasattr(reader, name), name)
+
+
+class StreamingResponseReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.request = Request(IMAGE_URL, meta={streaming.STREAM_META_KEY: True})
+        self.finished = defer.Deferred()
+        self.reader = streaming._StreamingResponseReader(
+            finished=self.finished,
+            txresponse=None,
+            request=self.request,
+            maxsize=0,
+            warnsize=0,
+            fail_on_dataloss=True,
+            crawler=get_crawler(),
+            spool_dir=self.directory.name,
+            spool_prefix=streaming.spool_prefix('test'),
+        )
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_body_is_spooled_and_hashed(self):
+        results = []
+        self.finished.addCallback(results.append)
+        self.reader.dataReceived(b'\xff\xd8')
+        self.reader.dataReceived(b'\xff\xe0')
+        self.reader.connectionLost(Failure(ResponseDone()))
+        self.assertEqual(results[0]['body'], b'')
+        self.assertIn(streaming.STREAMED_FLAG, results[0]['flags'])
+        streamed = self.request.meta[streaming.STREAMED_FILE_META_KEY]
+        self.assertEqual(Path(streamed.path).read_bytes(), b'\xff\xd8\xff\xe0')
+        self.assertTrue(Path(streamed.path).name.startswith('stream-test-'))
+        self.assertEqual(
+            (streamed.size, streamed.sha1, streamed.md5),
+            (4, hashlib.sha1(b'\xff\xd8\xff\xe0').hexdigest(), hashlib.md5(b'\xff\xd8\xff\xe0').hexdigest()),
+        )
+
+    def test_failed_download_removes_its_spool_file(self):
+        self.finished.addErrback(lambda _: None)
+        self.reader.dataReceived(b'\xff\xd8')
+        self.reader.connectionLost(Failure(ValueError()))
+        self.assertEqual(list(Path(self.directory.name).iterdir()), [])
@@ -0,0 +1,111 @@
+import inspect
+import unittest
+
+from scrapy.core.downloader import Downloader, Slot
+from scrapy.http import Request
+
+from retrogallery.items import IMAGE_META_KEY
+from retrogallery.throttle import HostClassDownloader, PagesFirstQueue, parse_host_classes
+from tests import get_crawler, run_until_fired
+
+
+GALLERY_URL = 'https://oldcrap.org/2018/02/21/texas-instruments-ti-99-4a/'
+CDN_IMAGE_URL = 'https://i0.wp.com/oldcrap.org/wp-content/uploads/2018/02/ti99.jpeg'
+ORIGIN_IMAGE_URL = 'https://oldcrap.org/wp-content/uploads/2018/02/ti99.jpeg'
+
+
+class HostClassDownloaderTest(unittest.TestCase):
+
+    def _downloader(self, host_classes=None):
+        return HostClassDownloader(get_crawler({'RETROGALLERY_HOST_CLASSES': host_classes or {}}))
+
+    def _class_name(self, downloader, url, image=False):
+        request = Request(url, meta={IMAGE_META_KEY: 0} if image else {})
+        return downloader.classify(request).name
+
+    def test_images_get_an_image_class_whatever_their_host(self):
+        downloader = self._downloader()
+        self.assertEqual(self._class_name(downloader, CDN_IMAGE_URL, image=True), 'cdn')
+        self.assertEqual(self._class_name(downloader, ORIGIN_IMAGE_URL, image=True), 'images')
+
+    def test_other_requests_are_classified_by_host(self):
+        downloader = self._downloader()
+        self.assertEqual(self._class_name(downloader, GALLERY_URL), 'origin')
+        self.assertEqual(self._class_name(downloader, ORIGIN_IMAGE_URL), 'origin')
+        self.assertEqual(self._class_name(downloader, 'https://bucket.s3.amazonaws.com/a.jpeg'), 'upload')
+
+    def test_images_fall_back_to_host_classes(self):
+        downloader = self._downloader({'cdn': {'hosts': [r'^i[0-3]\.wp\.com$']}})
+        self.assertEqual(self._class_name(downloader, CDN_IMAGE_URL, image=True), 'cdn')
+        self.assertEqual(self._class_name(downloader, ORIGIN_IMAGE_URL, image=True), 'default')
+
+    def test_image_slots_are_separate(self):
+        downloader = self._downloader()
+        page_key, _ = downloader._get_slot(Request(GALLERY_URL), None)
+        image_key, slot = downloader._get_slot(Request(ORIGIN_IMAGE_URL, meta={IMAGE_META_KEY: 0}), None)
+        self.assertEqual((page_key, image_key), ('origin:oldcrap.org', 'images:oldcrap.org'))
+        self.assertEqual(slot.concurrency, 4)
+
+
+class ParseHostClassesTest(unittest.TestCase):
+
+    def test_catch_all_classes_go_last(self):
+        classes = parse_host_classes({'any': {}, 'cdn': {'hosts': ['cdn']}})
+        self.assertEqual([host_class.name for host_class in classes], ['cdn', 'any'])
+
+    def test_default_class_is_added_for_pages(self):
+        classes = parse_host_classes({'images': {'images': True}})
+        self.assertEqual([host_class.name for host_class in classes], ['images', 'default'])
+
+
+class PagesFirstQueueTest(unittest.TestCase):
+
+    def test_pages_are_handed_out_first(self):
+        queue = PagesFirstQueue()
+        image, page = Request(CDN_IMAGE_URL, meta={IMAGE_META_KEY: 0}), Request(GALLERY_URL)
+        queue.append((image, None))
+        queue.append((page, None))
+        self.assertEqual(len(queue), 2)
+        self.assertEqual([queue.popleft()[0], queue.popleft()[0]], [page, image])
+        self.assertFalse(queue)
+
+
+class ScrapyDownloaderApiTest(unittest.TestCase):
+    """
+    HostClassDownloader overrides private methods of Scrapy's Downloader
+    and replaces the queue of its slots. These tests fail if a Scrapy
+    upgrade changes any of them.
+    """
+
+    def test_overridden_methods_keep_their_signatures(self):
+        for name, parameters in (
+            ('_get_slot', ['self', 'request', 'spider']),
+            ('_get_slot_key', ['self', 'request', 'spider']),
+            ('_download', ['self', 'slot', 'request', 'spider']),
+            ('_process_queue', ['self', 'spider', 'slot']),
+        ):
+            with self.subTest(name):
+                self.assertEqual(list(inspect.signature(getattr(Downloader, name)).parameters), parameters)
+
+    def test_slot_queue_is_a_replaceable_attribute(self):
+        slot = Slot(1, 0, False)
+        self.assertTrue(hasattr(slot, 'queue'))
+        self.assertEqual(list(inspect.signature(Slot).parameters), ['concurrency', 'delay', 'randomize_delay'])
+
+    def test_downloads_go_through_the_overrides(self):
+        crawler = get_crawler({'RETROGALLERY_HOST_CLASSES': {'data': {'window': 1, 'concurrency': 2, 'max_concurrency': 4}}})
+        downloader = HostClassDownloader(crawler)
+        request = Request('data:,ti99')
+        response = run_until_fired(downloader.fetch(request, crawler.spider))
+        self.assertEqual(response.body, b'ti99')
+        # The request was queued in a slot made by _get_slot(), keyed by
+        # _get_slot_key(), and downloaded through _download()
+        key = request.meta[Downloader.DOWNLOAD_SLOT]
+        self.assertEqual(key, 'data:')
+        self.assertIsInstance(downloader.slots[key].queue, PagesFirstQueue)
+        # A window of one response adapts the budget, which is applied to
+        # the slot with _process_queue()
+        self.assertEqual(downloader.budgets[key].concurrency, 3)
+        self.assertEqual(downloader.slots[key].concurrency, 3)
+        self.assertEqual(downloader.pages_active, 0)
+        downloader.close()
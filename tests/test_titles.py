@@ -0,0 +1,64 @@
+import unittest
+
+from scrapy.settings import Settings
+
+from retrogallery.titles import DEFAULT_CLASSIFIER, TitleClassifier, get_classifier
+
+
+class TitleClassifierTest(unittest.TestCase):
+
+    def test_camera_filenames(self):
+        for alt, vendor in (
+            ('DSC_1234', 'sony_nikon_fuji'),
+            ('dscf0042', 'sony_nikon_fuji'),
+            ('_DSC0001', 'sony_alpha'),
+            ('_MG_4711', 'canon_eos'),
+            ('IMG_0001', 'img'),
+            ('IMGP1234', 'pentax'),
+            ('P1010001', 'panasonic_olympus'),
+            ('DJI_0007', 'dji'),
+            ('Screenshot 2018-02-21 at 10.00.00', 'screenshot'),
+            ('fullsizeoutput_134e', 'apple_photos'),
+        ):
+            self.assertTrue(DEFAULT_CLASSIFIER.is_camera_filename(alt), alt)
+            self.assertEqual(DEFAULT_CLASSIFIER.vendor(alt), vendor, alt)
+
+    def test_titles(self):
+        for alt in ('Texas Instruments TI-99/4A', 'Pong', 'The IMG_0001 of a console', ''):
+            self.assertFalse(DEFAULT_CLASSIFIER.is_camera_filename(alt), alt)
+            self.assertIsNone(DEFAULT_CLASSIFIER.vendor(alt), alt)
+        self.assertIsNone(DEFAULT_CLASSIFIER.vendor(None))
+
+    def test_title(self):
+        classifier = DEFAULT_CLASSIFIER
+        self.assertEqual(classifier.title('Pong', 'Atari'), 'Pong')
+        self.assertEqual(classifier.title('DSC_1234', 'Atari'), 'Atari')
+        self.assertEqual(classifier.title(None, 'Atari'), 'Atari')
+        self.assertEqual(classifier.title('DSC_1234'), 'DSC_1234')
+        alts = ['Pong', 'DSC_1234', None, '']
+        self.assertEqual(classifier.titles(alts, 'Atari'), [classifier.title(alt, 'Atari') for alt in alts])
+        self.assertEqual(classifier.titles(alts), ['Pong', 'DSC_1234', None, None])
+
+    def test_pattern_names_must_be_identifiers(self):
+        with self.assertRaises(ValueError):
+            TitleClassifier({'go pro': r'g[hop]\d{6}'})
+
+    def test_no_patterns(self):
+        self.assertFalse(TitleClassifier({}).is_camera_filename('DSC_1234'))
+
+
+class GetClassifierTest(unittest.TestCase):
+
+    def test_default(self):
+        self.assertIs(get_classifier(), DEFAULT_CLASSIFIER)
+        self.assertIs(get_classifier(Settings()), DEFAULT_CLASSIFIER)
+
+    def test_overrides(self):
+        settings = Settings({
+            'RETROGALLERY_CAMERA_FILENAME_PATTERNS': '{"gopro": "g[hop]\\\\d{6}", "screenshot": null}',
+        })
+        classifier = get_classifier(settings)
+        self.assertIs(get_classifier(settings), classifier)
+        self.assertEqual(classifier.vendor('GH010042'), 'gopro')
+        self.assertFalse(classifier.is_camera_filename('Screenshot 2018-02-21'))
+        self.assertTrue(classifier.is_camera_filename('DSC_1234'))
@@ -0,0 +1,54 @@
+import hashlib
+import unittest
+
+from retrogallery import urls
+
+
+class ParseURLTest(unittest.TestCase):
+
+    def test_photon_url(self):
+        url = 'https://i0.wp.com/oldcrap.org/wp-content/uploads/2018/02/ti-99_4a-800x600.jpeg?ssl=1&w=800'
+        parsed = urls.parse_url(url)
+        self.assertEqual(parsed.url, url)
+        self.assertEqual(parsed.canonical, 'https://oldcrap.org/wp-content/uploads/2018/02/ti-99_4a-800x600.jpeg?w=800')
+        self.assertEqual(parsed.path, '/wp-content/uploads/2018/02/ti-99_4a-800x600.jpeg')
+        self.assertEqual(parsed.extension, '.jpeg')
+        self.assertEqual(parsed.title, 'Ti 99 4A 800X600')
+        self.assertEqual(parsed.asset, 'oldcrap.org/wp-content/uploads/2018/02/ti-99_4a.jpeg')
+
+    def test_guid_hashes_the_url_as_given(self):
+        url = 'https://i1.wp.com/oldcrap.org/a.png?ssl=1'
+        self.assertEqual(urls.parse_url(url).guid, hashlib.sha1(url.encode()).hexdigest())
+        self.assertNotEqual(urls.parse_url(url).guid, urls.parse_url('https://i1.wp.com/oldcrap.org/a.png').guid)
+
+    def test_spellings_of_one_url_share_a_canonical_url(self):
+        canonical = urls.parse_url('https://oldcrap.org/a.png?b=2&a=1').canonical
+        for url in (
+            'HTTPS://OldCrap.org:443/a.png?a=1&b=2',
+            'https://oldcrap.org/a.png?a=1&#038;b=2',
+            'https://oldcrap.org/a.png?a=1&amp;b=2&utm_source=feed#top',
+            'https://oldcrap.org/a.png?fbclid=x&a=1&b=2',
+        ):
+            self.assertEqual(urls.parse_url(url).canonical, canonical, url)
+        self.assertEqual(canonical, 'https://oldcrap.org/a.png?a=1&b=2')
+
+    def test_photon_hosts_are_unwrapped(self):
+        canonical = {
+            urls.parse_url(f'https://i{i}.wp.com/oldcrap.org/a.png?ssl=1&strip=all').canonical
+            for i in range(4)
+        }
+        self.assertEqual(canonical, {'https://oldcrap.org/a.png'})
+        self.assertEqual(urls.parse_url('https://i4.wp.com/oldcrap.org/a.png').canonical,
+                         'https://i4.wp.com/oldcrap.org/a.png')
+
+    def test_non_default_port_is_kept(self):
+        self.assertEqual(urls.parse_url('http://127.0.0.1:8080/a.png').canonical, 'http://127.0.0.1:8080/a.png')
+
+    def test_page_url(self):
+        parsed = urls.parse_url('https://oldcrap.org/2018/02/21/texas-instruments-ti-99-4a/')
+        self.assertEqual(parsed.extension, '')
+        self.assertEqual(parsed.title, 'Texas Instruments Ti 99 4A')
+
+    def test_results_are_cached(self):
+        url = 'https://oldcrap.org/cached.png'
+        self.assertIs(urls.parse_url(url), urls.parse_url(url))
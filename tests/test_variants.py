@@ -0,0 +1,67 @@
+import unittest
+
+from parsel import Selector
+
+from retrogallery import variants
+
+
+ORIGINAL = 'https://oldcrap.org/wp-content/uploads/2017/12/fullsizeoutput_134e.jpeg'
+PHOTON = 'https://i0.wp.com/oldcrap.org/wp-content/uploads/2017/12/fullsizeoutput_134e'
+IMG = f'''
+<img src="{PHOTON}-1024x524.jpeg?w=600&amp;ssl=1"
+     width="600"
+     data-orig-file="{ORIGINAL}"
+     data-orig-size="3249,1661"
+     srcset="{PHOTON}.jpeg?w=300&amp;ssl=1 300w,
+             {PHOTON}.jpeg?resize=1024%2C524&amp;ssl=1 1024w,
+             data:image/gif;base64,R0lGODlhAQABAAAAACw= 1w">
+<img src="https://oldcrap.org/wp-content/uploads/2017/12/keyboard-300x200.jpeg" width="300" height="200">
+'''
+
+
+class ResolveImageURLsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.img = Selector(text=IMG).css('img')
+
+    def test_original_policy(self):
+        self.assertEqual(variants.resolve_image_urls(self.img), [
+            ORIGINAL,
+            'https://oldcrap.org/wp-content/uploads/2017/12/keyboard-300x200.jpeg',
+        ])
+
+    def test_max_width_policy(self):
+        urls = variants.resolve_image_urls(self.img, 'max-width:700')
+        self.assertEqual(urls[0], f'{PHOTON}-1024x524.jpeg?w=600&ssl=1')
+        # Nothing fits: the smallest variant
+        urls = variants.resolve_image_urls(self.img, 'max-width:100')
+        self.assertEqual(urls[0], f'{PHOTON}.jpeg?w=300&ssl=1')
+
+    def test_largest_policy(self):
+        self.assertEqual(variants.resolve_image_urls(self.img, 'largest')[0], ORIGINAL)
+
+    def test_attribute_dicts(self):
+        img = [{'src': 'https://oldcrap.org/a-150x150.png', 'srcset': 'https://oldcrap.org/a.png 2x'}]
+        self.assertEqual(variants.resolve_image_urls(img), ['https://oldcrap.org/a.png'])
+
+    def test_sizes_follow_the_chosen_variant(self):
+        images = variants.resolve_image_sizes(self.img, 'max-width:700')
+        self.assertEqual(images[0][1], (600, 307))
+        self.assertEqual(images[1][1], None)
+        self.assertEqual(variants.resolve_image_sizes(self.img)[0][1], (3249, 1661))
+
+
+class ParsePolicyTest(unittest.TestCase):
+
+    def test_policies(self):
+        self.assertEqual(variants.parse_policy(None), ('original', None))
+        self.assertEqual(variants.parse_policy(' Largest '), ('largest', None))
+        self.assertEqual(variants.parse_policy('max-width=800'), ('max-width', 800))
+        with self.assertRaises(ValueError):
+            variants.parse_policy('smallest')
+
+    def test_infer_width(self):
+        self.assertEqual(variants.infer_width('https://i0.wp.com/oldcrap.org/a.jpeg?w=600'), 600)
+        self.assertEqual(variants.infer_width('https://i0.wp.com/oldcrap.org/a.jpeg?fit=3249%2C1661'), 3249)
+        self.assertEqual(variants.infer_width('https://oldcrap.org/a-1024x524.jpeg'), 1024)
+        self.assertIsNone(variants.infer_width('https://oldcrap.org/a.jpeg'))